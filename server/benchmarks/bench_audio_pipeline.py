@@ -0,0 +1,63 @@
+"""
+Стоимость серверного аудиоконвейера (AudioConverter) на один кадр в микросекундах
+для типичных форматов микрофона.
+
+    python server/benchmarks/bench_audio_pipeline.py --frames 5000 --frame-ms 85
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+os.environ.setdefault("DATABASE_URL", "postgresql://bench@localhost/bench")
+
+import numpy as np
+
+from main import AudioConverter
+
+FORMATS = [
+    (24000, 1, "pcm16"),
+    (16000, 1, "pcm16"),
+    (44100, 1, "pcm16"),
+    (48000, 1, "pcm16"),
+    (48000, 2, "float32"),
+    (44100, 2, "float32"),
+]
+
+
+def make_frame(sample_rate: int, channels: int, encoding: str, frame_ms: float) -> bytes:
+    samples = int(sample_rate * frame_ms / 1000)
+    t = np.arange(samples) / sample_rate
+    signal = 0.3 * np.sin(2 * np.pi * 220 * t) + 0.05 * np.random.randn(samples)
+    if channels > 1:
+        signal = np.repeat(signal, channels)
+    if encoding == "float32":
+        return signal.astype("<f4").tobytes()
+    return (signal * 32767).astype("<i2").tobytes()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=5000, help="число кадров на формат")
+    parser.add_argument("--frame-ms", type=float, default=85.0, help="длительность кадра (2048 сэмплов при 24 кГц ~ 85 мс)")
+    args = parser.parse_args()
+
+    print(f"Кадр {args.frame_ms:.0f} мс, {args.frames} кадров на формат")
+    print(f"{'формат':28} {'мкс/кадр':>10} {'CPU % на поток':>15}")
+    for sample_rate, channels, encoding in FORMATS:
+        frame = make_frame(sample_rate, channels, encoding, args.frame_ms)
+        converter = AudioConverter(sample_rate, channels, encoding)
+        converter.convert(frame)
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            converter.convert(frame)
+        per_frame = (time.perf_counter() - start) / args.frames
+        cpu_share = per_frame / (args.frame_ms / 1000) * 100
+        label = f"{sample_rate} Гц x{channels} {encoding}"
+        print(f"{label:28} {per_frame * 1e6:10.1f} {cpu_share:15.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Сравнение затрат CPU релея на один аудиопоток для JSON и бинарного протокола.
+
+JSON:   клиент -> релей: определение типа input_audio_buffer.append по началу кадра и пересылка текста;
+        релей -> клиент: определение типа response.audio.delta и пересылка текста.
+Binary: клиент -> релей: base64 + склейка с предсериализованным шаблоном append;
+        релей -> клиент: определение типа по началу кадра, извлечение delta без разбора JSON
+        и base64-декодирование в бинарный кадр.
+
+    python server/benchmarks/bench_audio_protocol.py --frames 20000
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+os.environ.setdefault("DATABASE_URL", "postgresql://bench@localhost/bench")
+
+from main import AUDIO_APPEND_PREFIX, AUDIO_APPEND_SUFFIX, extract_audio_delta, sniff_event_type
+
+SAMPLE_RATE = 24000
+BYTES_PER_SAMPLE = 2
+
+
+def make_frames(frame_samples: int):
+    pcm = os.urandom(frame_samples * BYTES_PER_SAMPLE)
+    audio_b64 = base64.b64encode(pcm).decode("ascii")
+    upstream_json = json.dumps({"type": "input_audio_buffer.append", "event_id": "audio_1700000000000", "audio": audio_b64})
+    downstream_json = json.dumps({
+        "type": "response.audio.delta",
+        "event_id": "event_abc123",
+        "response_id": "resp_abc123",
+        "item_id": "item_abc123",
+        "output_index": 0,
+        "content_index": 0,
+        "delta": audio_b64
+    })
+    return pcm, upstream_json, downstream_json
+
+
+def cpu_per_frame(func, frames: int) -> float:
+    start = time.process_time()
+    for _ in range(frames):
+        func()
+    return (time.process_time() - start) / frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=20000, help="число кадров в каждом замере")
+    parser.add_argument("--frame-samples", type=int, default=2048, help="размер кадра в сэмплах (как bufferSize в widget.js)")
+    args = parser.parse_args()
+
+    pcm, upstream_json, downstream_json = make_frames(args.frame_samples)
+    frames_per_second = SAMPLE_RATE / args.frame_samples
+
+    def json_upstream():
+        sniff_event_type(upstream_json)
+        return upstream_json
+
+    def binary_upstream():
+        return AUDIO_APPEND_PREFIX + base64.b64encode(pcm).decode("ascii") + AUDIO_APPEND_SUFFIX
+
+    def json_downstream():
+        sniff_event_type(downstream_json)
+        return downstream_json
+
+    def binary_downstream():
+        sniff_event_type(downstream_json)
+        return base64.b64decode(extract_audio_delta(downstream_json))
+
+    results = {
+        "json": (cpu_per_frame(json_upstream, args.frames), cpu_per_frame(json_downstream, args.frames), len(upstream_json), len(downstream_json)),
+        "binary": (cpu_per_frame(binary_upstream, args.frames), cpu_per_frame(binary_downstream, args.frames), len(pcm), len(pcm)),
+    }
+
+    print(f"Кадр: {args.frame_samples} сэмплов PCM16 @ {SAMPLE_RATE} Гц, {frames_per_second:.1f} кадров/с на поток")
+    print(f"{'режим':8} {'вверх мкс/кадр':>15} {'вниз мкс/кадр':>15} {'CPU % на поток':>15} {'байт/кадр клиента':>20}")
+    for mode, (up, down, up_bytes, down_bytes) in results.items():
+        cpu_share = (up + down) * frames_per_second * 100
+        print(f"{mode:8} {up * 1e6:15.2f} {down * 1e6:15.2f} {cpu_share:15.4f} {up_bytes:>9} / {down_bytes:<9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Микро-бенчмарк проверки авторизации: запросы/сек к /api/users/me
+без кэша токенов (декодирование JWT + запрос к БД на каждый вызов)
+и с кэшем проверенных токенов.
+
+Требует DATABASE_URL с доступной базой PostgreSQL (после alembic upgrade head):
+    DATABASE_URL=postgresql://... python server/benchmarks/bench_auth_cache.py --requests 2000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import httpx
+
+import main
+
+
+async def run_series(client: httpx.AsyncClient, headers: dict, requests: int, cached: bool) -> float:
+    start = time.perf_counter()
+    for _ in range(requests):
+        if not cached:
+            # Имитируем поведение до кэширования: каждый запрос заново проверяет токен и читает пользователя
+            main.auth_cache.clear()
+        response = await client.get("/api/users/me", headers=headers)
+        response.raise_for_status()
+    return requests / (time.perf_counter() - start)
+
+
+async def main_async(args):
+    await main.verify_schema_version()
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        email = f"bench-{uuid.uuid4().hex[:12]}@example.com"
+        response = await client.post("/api/auth/register", json={"email": email, "password": "bench"})
+        response.raise_for_status()
+        headers = {"Authorization": f"Bearer {response.json()['token']}"}
+
+        # Прогрев
+        await run_series(client, headers, 50, cached=True)
+
+        before = await run_series(client, headers, args.requests, cached=False)
+        after = await run_series(client, headers, args.requests, cached=True)
+
+    print(f"Запросов в серии: {args.requests}")
+    print(f"Без кэша: {before:10.1f} req/s")
+    print(f"С кэшем:  {after:10.1f} req/s  (x{after / before:.1f})")
+    print(f"Кэш токенов: {main.auth_cache.get_stats()}")
+    await main.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="число запросов в каждой серии")
+    asyncio.run(main_async(parser.parse_args()))
@@ -0,0 +1,158 @@
+"""
+Бенчмарк истории и статистики диалогов на большой таблице conversations.
+
+Создает отдельного пользователя с --assistants ассистентами и генерирует в БД --rows
+диалогов за --days дней (generate_series на стороне PostgreSQL), заполняет суточную
+сводку так же, как это делает писатель диалогов, и измеряет через API:
+первую страницу истории, глубокую страницу по курсору, выборку за сутки, поиск
+по подстроке и суточную статистику. Для сравнения измеряется та же статистика
+прямым GROUP BY по conversations. В конце данные удаляются (--keep - оставить).
+
+    alembic -c server/alembic.ini upgrade head
+    DATABASE_URL=postgresql://... python server/benchmarks/bench_conversation_history.py --rows 10000000
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import httpx
+import sqlalchemy as sa
+
+import main
+
+GENERATE_SQL = """
+INSERT INTO conversations (id, assistant_id, user_message, assistant_message, duration_seconds, client_info, created_at)
+SELECT gen_random_uuid(),
+       (:assistants)[1 + i % CAST(:count AS integer)],
+       'Вопрос пользователя номер ' || i,
+       'Ответ ассистента на вопрос ' || i,
+       random() * 120,
+       '{}'::json,
+       now() - (random() * CAST(:days AS integer) * interval '1 day')
+FROM generate_series(CAST(:start AS bigint), CAST(:stop AS bigint)) AS i
+"""
+
+ROLLUP_SQL = """
+INSERT INTO conversation_daily_stats (assistant_id, day, conversations, total_duration_seconds)
+SELECT assistant_id, (created_at AT TIME ZONE 'UTC')::date, count(*), coalesce(sum(duration_seconds), 0)
+FROM conversations
+WHERE assistant_id = ANY(:assistants)
+GROUP BY 1, 2
+"""
+
+RAW_STATS_SQL = """
+SELECT (created_at AT TIME ZONE 'UTC')::date, count(*), sum(duration_seconds)
+FROM conversations
+WHERE assistant_id = :assistant_id AND created_at >= :since
+GROUP BY 1
+ORDER BY 1
+"""
+
+
+async def timed(func, repeats: int) -> float:
+    """Медиана времени выполнения в миллисекундах"""
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        await func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+async def generate(assistant_ids, rows: int, days: int, chunk: int):
+    start = time.perf_counter()
+    for first in range(1, rows + 1, chunk):
+        async with main.engine.begin() as conn:
+            await conn.execute(sa.text(GENERATE_SQL).bindparams(
+                sa.bindparam("assistants", type_=sa.ARRAY(main.UUID(as_uuid=True)))
+            ), {"assistants": assistant_ids, "count": len(assistant_ids), "days": days, "start": first, "stop": min(first + chunk - 1, rows)})
+        done = min(first + chunk - 1, rows)
+        print(f"  сгенерировано {done}/{rows} ({time.perf_counter() - start:.0f} с)", flush=True)
+    async with main.engine.begin() as conn:
+        await conn.execute(sa.text(ROLLUP_SQL).bindparams(
+            sa.bindparam("assistants", type_=sa.ARRAY(main.UUID(as_uuid=True)))
+        ), {"assistants": assistant_ids})
+    async with main.engine.connect() as conn:
+        await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(sa.text("ANALYZE conversations"))
+        await conn.execute(sa.text("ANALYZE conversation_daily_stats"))
+
+
+async def main_async(args):
+    await main.verify_schema_version()
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        email = f"bench-{uuid.uuid4().hex[:12]}@example.com"
+        response = await client.post("/api/auth/register", json={"email": email, "password": "bench"})
+        response.raise_for_status()
+        user_id = response.json()["user"]["id"]
+        headers = {"Authorization": f"Bearer {response.json()['token']}"}
+        await client.put("/api/users/me", headers=headers, json={"openai_api_key": "sk-bench"})
+
+        assistant_ids = []
+        for i in range(args.assistants):
+            response = await client.post("/api/assistants", headers=headers, json={"name": f"bench-{i}"})
+            response.raise_for_status()
+            assistant_ids.append(uuid.UUID(response.json()["id"]))
+        assistant_id = str(assistant_ids[0])
+        base = f"/api/assistants/{assistant_id}/conversations"
+
+        try:
+            print(f"Генерация {args.rows} диалогов для {args.assistants} ассистентов за {args.days} дней")
+            await generate(assistant_ids, args.rows, args.days, args.chunk)
+
+            # Курсор страницы в глубине истории
+            cursor = None
+            for _ in range(args.deep_pages):
+                response = await client.get(base, headers=headers, params={"limit": 100, **({"cursor": cursor} if cursor else {})})
+                response.raise_for_status()
+                cursor = response.headers.get("x-next-cursor")
+            day_ago = (datetime.now(timezone.utc) - timedelta(days=1)).isoformat()
+            since = datetime.now(timezone.utc) - timedelta(days=args.days)
+
+            async def get(params):
+                response = await client.get(base, headers=headers, params=params)
+                response.raise_for_status()
+
+            async def stats():
+                response = await client.get(f"{base}/stats", headers=headers, params={"days": args.days})
+                response.raise_for_status()
+
+            async def raw_stats():
+                async with main.SessionLocal() as db:
+                    await db.execute(sa.text(RAW_STATS_SQL), {"assistant_id": assistant_ids[0], "since": since})
+
+            per_assistant = args.rows // args.assistants
+            print(f"\nДиалогов у ассистента: ~{per_assistant}, повторов: {args.repeats} (медиана, мс)")
+            print(f"  история, первая страница (50):        {await timed(lambda: get({}), args.repeats):8.2f}")
+            print(f"  история, страница {args.deep_pages * 100:>6} по курсору:   "
+                  f"{await timed(lambda: get({'limit': 100, 'cursor': cursor}), args.repeats):8.2f}")
+            print(f"  история за сутки (since):             {await timed(lambda: get({'since': day_ago}), args.repeats):8.2f}")
+            print(f"  поиск по подстроке (search):          {await timed(lambda: get({'search': 'номер 12345'}), args.repeats):8.2f}")
+            print(f"  статистика из суточной сводки:        {await timed(stats, args.repeats):8.2f}")
+            print(f"  та же статистика GROUP BY по таблице: {await timed(raw_stats, args.repeats):8.2f}")
+        finally:
+            if not args.keep:
+                print("\nУдаление тестовых данных...")
+                async with main.engine.begin() as conn:
+                    await conn.execute(sa.delete(main.User).where(main.User.id == uuid.UUID(user_id)))
+    await main.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000, help="число диалогов в таблице")
+    parser.add_argument("--assistants", type=int, default=100, help="число ассистентов, между которыми делятся диалоги")
+    parser.add_argument("--days", type=int, default=90, help="период, за который распределены диалоги")
+    parser.add_argument("--chunk", type=int, default=1_000_000, help="диалогов в одной транзакции генерации")
+    parser.add_argument("--deep-pages", type=int, default=50, help="на сколько страниц по 100 уйти вглубь истории")
+    parser.add_argument("--repeats", type=int, default=20, help="повторов каждого запроса")
+    parser.add_argument("--keep", action="store_true", help="не удалять сгенерированные данные")
+    asyncio.run(main_async(parser.parse_args()))
@@ -0,0 +1,108 @@
+"""
+Микро-бенчмарк классификации кадров релея: полный json.loads каждого кадра
+против определения типа по началу кадра и разбора только нужных релею событий.
+
+По умолчанию используется синтетическая запись реалтайм-трафика (кадры клиента
+и OpenAI в типичных пропорциях для одного хода диалога). Можно передать
+собственную запись: JSONL-файл, где каждая строка - исходный кадр.
+
+    python server/benchmarks/bench_frame_classifier.py --turns 200
+    python server/benchmarks/bench_frame_classifier.py --trace recorded_frames.jsonl
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+os.environ.setdefault("DATABASE_URL", "postgresql://bench@localhost/bench")
+
+import ujson
+
+from main import (
+    CLIENT_EVENTS_TO_PARSE,
+    OPENAI_EVENTS_TO_PARSE,
+    extract_audio_delta,
+    sniff_event_type,
+)
+
+
+def synthetic_turn(turn: int):
+    """Кадры одного хода: аудио пользователя, события VAD, аудио и транскрипт ответа"""
+    audio_in = base64.b64encode(os.urandom(4096)).decode("ascii")
+    audio_out = base64.b64encode(os.urandom(4800)).decode("ascii")
+    frames = []
+    for i in range(40):
+        frames.append(json.dumps({"type": "input_audio_buffer.append", "event_id": f"audio_{turn}_{i}", "audio": audio_in}))
+    frames.append(json.dumps({"type": "input_audio_buffer.speech_started", "event_id": "e1", "audio_start_ms": 1000, "item_id": f"item_{turn}"}))
+    frames.append(json.dumps({"type": "input_audio_buffer.speech_stopped", "event_id": "e2", "audio_end_ms": 3000, "item_id": f"item_{turn}"}))
+    frames.append(json.dumps({"type": "response.created", "event_id": "e3", "response": {"id": f"resp_{turn}", "status": "in_progress", "output": []}}))
+    for i in range(60):
+        frames.append(json.dumps({
+            "type": "response.audio.delta", "event_id": f"e_a{i}", "response_id": f"resp_{turn}",
+            "item_id": f"item_out_{turn}", "output_index": 0, "content_index": 0, "delta": audio_out
+        }))
+        if i % 2 == 0:
+            frames.append(json.dumps({
+                "type": "response.audio_transcript.delta", "event_id": f"e_t{i}", "response_id": f"resp_{turn}",
+                "item_id": f"item_out_{turn}", "output_index": 0, "content_index": 0, "delta": "слово "
+            }))
+    frames.append(json.dumps({"type": "response.audio.done", "event_id": "e4", "response_id": f"resp_{turn}"}))
+    frames.append(json.dumps({
+        "type": "response.done", "event_id": "e5",
+        "response": {"id": f"resp_{turn}", "status": "completed", "output": [{"type": "message", "content": [{"type": "audio", "transcript": "слово " * 30}]}]}
+    }))
+    return frames
+
+
+def full_parse(frames):
+    for frame in frames:
+        json.loads(frame).get("type")
+
+
+def classified(frames):
+    parse_types = CLIENT_EVENTS_TO_PARSE | OPENAI_EVENTS_TO_PARSE
+    for frame in frames:
+        msg_type = sniff_event_type(frame)
+        if msg_type is None or msg_type in parse_types:
+            ujson.loads(frame)
+        elif msg_type == "response.audio.delta":
+            extract_audio_delta(frame)
+
+
+def measure(func, frames, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(frames)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=200, help="число синтетических ходов диалога")
+    parser.add_argument("--trace", help="JSONL-файл с записанными кадрами (по одному на строку)")
+    parser.add_argument("--repeat", type=int, default=5, help="число повторов, берется лучший результат")
+    args = parser.parse_args()
+
+    if args.trace:
+        with open(args.trace, "r", encoding="utf-8") as f:
+            frames = [line.rstrip("\n") for line in f if line.strip()]
+    else:
+        frames = [frame for turn in range(args.turns) for frame in synthetic_turn(turn)]
+
+    total_bytes = sum(len(frame) for frame in frames)
+    baseline = measure(full_parse, frames, args.repeat)
+    fast = measure(classified, frames, args.repeat)
+
+    print(f"Кадров: {len(frames)}, объем: {total_bytes / 1e6:.1f} МБ")
+    print(f"json.loads каждого кадра: {baseline / len(frames) * 1e6:8.2f} мкс/кадр")
+    print(f"классификатор кадров:     {fast / len(frames) * 1e6:8.2f} мкс/кадр  (x{baseline / fast:.1f})")
+
+
+if __name__ == "__main__":
+    main()
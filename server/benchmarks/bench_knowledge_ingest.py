@@ -0,0 +1,133 @@
+"""
+Бенчмарк загрузки документа в базу знаний: пропускная способность потоковой загрузки,
+рост пикового RSS процесса относительно размера файла, максимальная задержка цикла
+событий во время загрузки и повторная загрузка документа с --changed долей измененных
+абзацев (сколько фрагментов эмбеддится заново).
+
+Эмбеддинги - локальные (KNOWLEDGE_EMBEDDING_MODEL=hash), сеть не нужна; нужна БД
+после alembic upgrade head. Тело запроса отдается генератором, т.е. документ
+не собирается целиком и на стороне клиента.
+
+    DATABASE_URL=postgresql://... python server/benchmarks/bench_knowledge_ingest.py --mb 50
+"""
+import argparse
+import asyncio
+import os
+import random
+import resource
+import sys
+import time
+import uuid
+
+os.environ.setdefault("KNOWLEDGE_EMBEDDING_MODEL", "hash")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import httpx
+import sqlalchemy as sa
+
+import main
+
+WORDS = ("доставка возврат гарантия оплата курьер склад заказ менеджер скидка договор счет офис "
+         "сервис ремонт товар клиент срок условия тариф подключение").split()
+BOUNDARY = "bench-knowledge-boundary"
+
+
+def make_paragraphs(size_bytes: int, seed: int):
+    rng = random.Random(seed)
+    paragraphs, total = [], 0
+    while True:
+        paragraph = f"Раздел {len(paragraphs)}. " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 120))) + "."
+        total += len(paragraph.encode()) + 2
+        if total > size_bytes:
+            return paragraphs
+        paragraphs.append(paragraph)
+
+
+async def multipart_body(paragraphs, filename: str):
+    yield (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+           f"Content-Type: text/markdown\r\n\r\n").encode()
+    piece = []
+    for paragraph in paragraphs:
+        piece.append(paragraph)
+        if len(piece) == 64:
+            yield ("\n\n".join(piece) + "\n\n").encode()
+            piece = []
+    yield ("\n\n".join(piece)).encode()
+    yield f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+async def upload(client, headers, assistant_id: str, paragraphs) -> tuple:
+    """Загружает документ, параллельно замеряя задержку цикла событий; возвращает (ответ, секунды, макс. задержка)"""
+    lags = [0.0]
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - start - 0.01)
+
+    task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    response = await client.post(
+        f"/api/assistants/{assistant_id}/files",
+        headers={**headers, "Content-Type": f"multipart/form-data; boundary={BOUNDARY}"},
+        content=multipart_body(paragraphs, "bench.md"),
+        timeout=None
+    )
+    elapsed = time.perf_counter() - start
+    done.set()
+    await task
+    response.raise_for_status()
+    return response.json(), elapsed, max(lags)
+
+
+async def main_async(args):
+    await main.verify_schema_version()
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        email = f"bench-{uuid.uuid4().hex[:12]}@example.com"
+        response = await client.post("/api/auth/register", json={"email": email, "password": "bench"})
+        response.raise_for_status()
+        user_id = response.json()["user"]["id"]
+        headers = {"Authorization": f"Bearer {response.json()['token']}"}
+        await client.put("/api/users/me", headers=headers, json={"openai_api_key": "sk-bench"})
+        response = await client.post("/api/assistants", headers=headers, json={"name": "bench-knowledge"})
+        response.raise_for_status()
+        assistant_id = response.json()["id"]
+
+        try:
+            paragraphs = make_paragraphs(args.mb * 1024 * 1024, args.seed)
+            size_mb = sum(len(p.encode()) + 2 for p in paragraphs) / 1024 / 1024
+            # Прогрев: запуск пула процессов разбора
+            await upload(client, headers, assistant_id, paragraphs[:10])
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+            result, elapsed, lag = await upload(client, headers, assistant_id, paragraphs)
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            print(f"Документ: {size_mb:.1f} МБ, {len(paragraphs)} абзацев")
+            print(f"Загрузка:   {elapsed:6.2f} с ({size_mb / elapsed:.1f} МБ/с), фрагментов {result['chunks']}, "
+                  f"новых {result['new_chunks']}")
+            print(f"  рост пикового RSS: {rss_after - rss_before:.1f} МБ, макс. задержка цикла событий: {lag * 1000:.1f} мс")
+
+            rng = random.Random(args.seed + 1)
+            changed = rng.sample(range(len(paragraphs)), max(1, int(len(paragraphs) * args.changed)))
+            for i in changed:
+                paragraphs[i] = paragraphs[i].replace("Раздел", "Глава", 1)
+            result, elapsed, lag = await upload(client, headers, assistant_id, paragraphs)
+            print(f"Повторная загрузка ({len(changed)} абзацев изменено): {elapsed:6.2f} с, фрагментов {result['chunks']}, "
+                  f"заново проиндексировано {result['new_chunks']} ({result['new_chunks'] / result['chunks']:.1%}), "
+                  f"макс. задержка цикла событий: {lag * 1000:.1f} мс")
+        finally:
+            async with main.engine.begin() as conn:
+                await conn.execute(sa.delete(main.User).where(main.User.id == uuid.UUID(user_id)))
+    main.get_ingest_pool().shutdown()
+    await main.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mb", type=int, default=50, help="размер документа в МБ")
+    parser.add_argument("--changed", type=float, default=0.01, help="доля абзацев, измененных перед повторной загрузкой")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main_async(parser.parse_args()))
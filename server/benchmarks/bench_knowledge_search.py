@@ -0,0 +1,118 @@
+"""
+Бенчмарк поиска по базе знаний: задержка top-k поиска по индексу на диске (mmap)
+и полнота (recall) относительно точного перебора всей матрицы.
+
+Синтетический корпус: --chunks нормированных векторов размерности --dim,
+сгруппированных вокруг --topics тем (как фрагменты документов). Запросы - зашумленные
+фрагменты корпуса. Для сравнения замеряется перебор всей матрицы. Перед этим
+проверяется локальный эмбеддинг hash_embeddings: запрос своими словами должен
+находить нужный фрагмент. Сеть и БД не нужны.
+
+    python server/benchmarks/bench_knowledge_search.py --chunks 100000
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+
+import main
+
+DOCUMENTS = [
+    "Доставка по Москве бесплатная при заказе от 3000 рублей, срок доставки один-два дня.",
+    "Возврат товара возможен в течение 14 дней при сохранении упаковки и чека.",
+    "Офис работает с понедельника по пятницу с 9 до 18 часов, в субботу до 15 часов.",
+    "Оплатить заказ можно картой, наличными курьеру или по счету для юридических лиц.",
+    "Гарантия на технику составляет 12 месяцев, ремонт проводится в сервисном центре.",
+]
+
+QUERIES = [
+    ("сколько стоит доставка по москве", 0),
+    ("можно ли вернуть товар", 1),
+    ("часы работы офиса в субботу", 2),
+    ("оплата картой", 3),
+    ("какая гарантия на технику", 4),
+]
+
+
+def check_hash_embeddings(directory: str, dim: int):
+    vectors = main.hash_embeddings(DOCUMENTS, dim)
+    ids = np.arange(len(DOCUMENTS) * 16, dtype=np.uint8).reshape(-1, 16)
+    main.write_knowledge_index(directory, ids, vectors)
+    index = main.KnowledgeIndex(directory, "hash", 1)
+    hits = 0
+    for query, expected in QUERIES:
+        found = index.search(main.hash_embeddings([query], dim)[0], 1)
+        hits += found[0][0].bytes == ids[expected].tobytes()
+    print(f"Локальный эмбеддинг: {hits}/{len(QUERIES)} запросов нашли нужный фрагмент")
+
+
+def make_corpus(chunks: int, dim: int, topics: int, rng) -> np.ndarray:
+    centers = main.normalize_rows(rng.standard_normal((topics, dim), dtype=np.float32))
+    vectors = np.empty((chunks, dim), dtype=np.float32)
+    for start in range(0, chunks, 10_000):
+        stop = min(start + 10_000, chunks)
+        noise = rng.standard_normal((stop - start, dim), dtype=np.float32) * 0.06
+        vectors[start:stop] = centers[rng.integers(0, topics, stop - start)] + noise
+    return main.normalize_rows(vectors)
+
+
+def percentile(samples, q: float) -> float:
+    return sorted(samples)[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def main_cli(args):
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        check_hash_embeddings(os.path.join(tmp, "hash"), args.dim)
+
+        print(f"\nКорпус: {args.chunks} фрагментов, dim={args.dim}, {args.topics} тем")
+        vectors = make_corpus(args.chunks, args.dim, args.topics, rng)
+        ids = rng.integers(0, 256, (args.chunks, 16), dtype=np.uint8)
+        start = time.perf_counter()
+        main.write_knowledge_index(os.path.join(tmp, "index"), ids, vectors)
+        print(f"Построение индекса: {time.perf_counter() - start:.1f} с")
+        start = time.perf_counter()
+        index = main.KnowledgeIndex(os.path.join(tmp, "index"), "bench", 1)
+        print(f"Открытие индекса (mmap): {(time.perf_counter() - start) * 1000:.2f} мс, "
+              f"кластеров: {0 if index.centroids is None else len(index.centroids)}")
+
+        picks = rng.integers(0, args.chunks, args.queries)
+        queries = main.normalize_rows(vectors[picks] + rng.standard_normal((args.queries, args.dim), dtype=np.float32) * 0.03)
+
+        exact, exact_ms = [], []
+        for query in queries:
+            start = time.perf_counter()
+            scores = vectors @ query
+            top = np.argpartition(-scores, args.k - 1)[:args.k]
+            exact_ms.append((time.perf_counter() - start) * 1000)
+            exact.append({ids[i].tobytes() for i in top})
+
+        for probes in args.probes:
+            samples, recall = [], []
+            for query, expected in zip(queries, exact):
+                start = time.perf_counter()
+                found = index.search(query, args.k, probes=probes)
+                samples.append((time.perf_counter() - start) * 1000)
+                recall.append(len(expected & {chunk_id.bytes for chunk_id, _ in found}) / args.k)
+            print(f"  индекс, probes={probes:>3}: p50 {statistics.median(samples):6.3f} мс, "
+                  f"p99 {percentile(samples, 0.99):6.3f} мс, recall@{args.k} {statistics.mean(recall):.3f}")
+        print(f"  перебор всей матрицы: p50 {statistics.median(exact_ms):6.3f} мс, p99 {percentile(exact_ms, 0.99):6.3f} мс")
+        del index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=100_000, help="число фрагментов в индексе")
+    parser.add_argument("--dim", type=int, default=main.KNOWLEDGE_EMBEDDING_DIM, help="размерность эмбеддингов")
+    parser.add_argument("--topics", type=int, default=2_000, help="число тем, вокруг которых группируются фрагменты")
+    parser.add_argument("--queries", type=int, default=1_000, help="число запросов")
+    parser.add_argument("--k", type=int, default=main.KNOWLEDGE_SEARCH_TOP_K, help="фрагментов в ответе")
+    parser.add_argument("--probes", type=int, nargs="+", default=[4, main.KNOWLEDGE_IVF_PROBES, 32], help="просматриваемых кластеров")
+    parser.add_argument("--seed", type=int, default=0)
+    main_cli(parser.parse_args())
@@ -0,0 +1,134 @@
+"""
+Планы горячих запросов до и после индексов из миграций Alembic.
+
+Во временной схеме PostgreSQL применяется начальная ревизия (0001 - схема, которую
+раньше создавал create_all), таблицы заполняются --users пользователями,
+--assistants ассистентами на пользователя и --conversations диалогами. Затем
+для запросов входа (пользователь по email и его ассистенты), списка ассистентов
+и истории диалогов выводятся EXPLAIN ANALYZE до и после ревизии 0002 (индексы).
+Схема удаляется в конце.
+
+    DATABASE_URL=postgresql://... python server/benchmarks/bench_schema_plans.py --users 100000
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sqlalchemy as sa
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from alembic.script import ScriptDirectory
+
+import main
+
+SCHEMA = "bench_schema_plans"
+
+FILL_SQL = [
+    """
+    INSERT INTO users (id, email, password_hash, created_at)
+    SELECT gen_random_uuid(), 'user' || i || '@example.com', md5(i::text), now() - i * interval '1 minute'
+    FROM generate_series(1, CAST(:users AS integer)) AS i
+    """,
+    """
+    INSERT INTO assistant_configs (id, user_id, name, system_prompt, voice, language, is_active, created_at)
+    SELECT gen_random_uuid(), u.id, 'Ассистент ' || n, repeat('Инструкция. ', 50), 'alloy', 'ru', true, now() - n * interval '1 hour'
+    FROM users u CROSS JOIN generate_series(1, CAST(:assistants AS integer)) AS n
+    """,
+    """
+    INSERT INTO conversations (id, assistant_id, user_message, assistant_message, duration_seconds, client_info, created_at)
+    SELECT gen_random_uuid(), a.id, 'Вопрос ' || i, 'Ответ ' || i, random() * 120, '{}'::json, now() - random() * interval '90 days'
+    FROM (SELECT id, row_number() OVER () AS n FROM assistant_configs) AS a
+    JOIN generate_series(1, CAST(:conversations AS integer)) AS i ON a.n = 1 + i % CAST(:assistant_count AS integer)
+    """,
+]
+
+QUERIES = [
+    ("вход: пользователь по email",
+     "SELECT * FROM users WHERE email = :email"),
+    ("вход: ассистенты пользователя",
+     "SELECT * FROM assistant_configs WHERE user_id = :user_id"),
+    ("список ассистентов (страница по 20)",
+     "SELECT id, name, voice, created_at FROM assistant_configs WHERE user_id = :user_id ORDER BY created_at, id LIMIT 21"),
+    ("история диалогов (первая страница)",
+     "SELECT * FROM conversations WHERE assistant_id = :assistant_id ORDER BY created_at DESC, id DESC LIMIT 51"),
+]
+
+
+def run_revision(connection, script: ScriptDirectory, revision: str):
+    """Выполняет upgrade() одной ревизии на соединении (search_path указывает на временную схему)"""
+    module = script.get_revision(revision).module
+    context = MigrationContext.configure(connection)
+    with Operations.context(context):
+        module.upgrade()
+
+
+async def explain(conn, sql: str, params: dict, repeats: int):
+    plan = (await conn.execute(sa.text("EXPLAIN (ANALYZE, COSTS OFF) " + sql), params)).scalars().all()
+    times = []
+    for _ in range(repeats):
+        rows = (await conn.execute(sa.text("EXPLAIN (ANALYZE, COSTS OFF) " + sql), params)).scalars().all()
+        times.append(float(rows[-1].split(":")[1].strip().split()[0]))
+    return plan, statistics.median(times)
+
+
+async def report(conn, title: str, params: dict, repeats: int):
+    print(f"\n=== {title} ===")
+    for name, sql in QUERIES:
+        plan, elapsed = await explain(conn, sql, params, repeats)
+        print(f"\n{name}: {elapsed:.3f} мс (медиана)")
+        for line in plan:
+            if not line.startswith(("Planning", "Execution")):
+                print(f"    {line}")
+
+
+async def main_async(args):
+    script = ScriptDirectory.from_config(Config(os.path.join(os.path.dirname(main.__file__), "alembic.ini")))
+    async with main.engine.connect() as conn:
+        await conn.execute(sa.text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        await conn.execute(sa.text(f"CREATE SCHEMA {SCHEMA}"))
+        await conn.execute(sa.text(f"SET search_path TO {SCHEMA}"))
+        try:
+            await conn.run_sync(run_revision, script, "0001")
+            print(f"Заполнение: {args.users} пользователей, по {args.assistants} ассистентов, {args.conversations} диалогов")
+            params = {
+                "users": args.users,
+                "assistants": args.assistants,
+                "conversations": args.conversations,
+                "assistant_count": args.users * args.assistants,
+            }
+            for sql in FILL_SQL:
+                await conn.execute(sa.text(sql), params)
+            await conn.commit()
+            await conn.execute(sa.text("ANALYZE"))
+
+            row = (await conn.execute(sa.text(
+                "SELECT u.email, u.id, a.id FROM users u JOIN assistant_configs a ON a.user_id = u.id "
+                "ORDER BY u.email DESC LIMIT 1"
+            ))).one()
+            query_params = {"email": row[0], "user_id": row[1], "assistant_id": row[2]}
+
+            await report(conn, "до: ревизия 0001", query_params, args.repeats)
+            await conn.commit()
+            await conn.run_sync(run_revision, script, "0002")
+            await conn.commit()
+            await conn.execute(sa.text("ANALYZE"))
+            await report(conn, "после: ревизия 0002", query_params, args.repeats)
+        finally:
+            await conn.rollback()
+            await conn.execute(sa.text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+            await conn.commit()
+    await main.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000, help="число пользователей")
+    parser.add_argument("--assistants", type=int, default=5, help="ассистентов на пользователя")
+    parser.add_argument("--conversations", type=int, default=2_000_000, help="число диалогов")
+    parser.add_argument("--repeats", type=int, default=20, help="повторов каждого запроса")
+    asyncio.run(main_async(parser.parse_args()))
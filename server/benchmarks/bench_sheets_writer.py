@@ -0,0 +1,212 @@
+"""
+Бенчмарк записи в Google Таблицы на локальной заглушке Sheets API.
+
+Заглушка - минимальный HTTP/1.1-сервер (keep-alive) на asyncio с эндпоинтом
+values:append, который, как настоящий API, ограничивает частоту запросов к таблице
+(--quota запросов в секунду, сверх нее - 429 с Retry-After) и с вероятностью
+--error-rate отвечает 503. В течение --seconds сессии --sheets ассистентов
+пишут в сумме --rows-per-sec строк в секунду:
+
+  * построчно - каждый ход ждет свой запрос append, как при синхронной записи;
+  * через GoogleSheetsWriter - строки копятся по таблицам и уходят пачками.
+
+Выводятся число запросов и ответов 429, доставленные и потерянные строки,
+задержка хода (время, которое сессия ждет запись) и задержка цикла событий.
+Для писателя дополнительно проверяется, что строки каждой таблицы дошли
+без пропусков и в исходном порядке. Внешняя сеть не нужна; к БД бенчмарк не
+подключается (токены задаются заранее), но main.py при импорте требует DATABASE_URL.
+
+    DATABASE_URL=postgresql://... python server/benchmarks/bench_sheets_writer.py --sheets 20 --rows-per-sec 400
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from urllib.parse import unquote
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main
+
+
+class SheetsStandIn:
+    """Заглушка Sheets API: values:append с ограничением частоты на таблицу и случайными 503"""
+
+    def __init__(self, quota: float, error_rate: float, delay: float):
+        self.quota = quota
+        self.error_rate = error_rate
+        self.delay = delay
+        self.rows = {}       # sheet_id -> строки в порядке записи
+        self.last = {}       # sheet_id -> время последнего принятого запроса
+        self.responses = {}  # код ответа -> число
+        self.connections = 0
+
+    def respond(self, sheet_id: str, body: dict, authorization: str) -> tuple:
+        if authorization != "Bearer bench-token":
+            return 401, {}
+        now = time.monotonic()
+        if now - self.last.get(sheet_id, 0.0) < 1 / self.quota:
+            return 429, {"Retry-After": "1"}
+        if random.random() < self.error_rate:
+            return 503, {}
+        self.last[sheet_id] = now
+        self.rows.setdefault(sheet_id, []).extend(body["values"])
+        return 200, {}
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode().split("\r\n")
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = json.loads(await reader.readexactly(int(headers.get("content-length", 0))))
+                path = lines[0].split()[1].split("?")[0]
+                sheet_id = unquote(path.split("/")[3])
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                status, extra = self.respond(sheet_id, body, headers.get("authorization", ""))
+                self.responses[status] = self.responses.get(status, 0) + 1
+                payload = json.dumps({"updates": {"updatedRows": len(body["values"])}} if status == 200 else {"error": {"code": status}}).encode()
+                writer.write(f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n".encode()
+                             + "".join(f"{name}: {value}\r\n" for name, value in extra.items()).encode() + b"\r\n" + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+
+async def measure_loop_lag(samples: list, stop: asyncio.Event):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        samples.append((time.perf_counter() - start - 0.01) * 1000)
+
+
+def percentile(samples, q: float) -> float:
+    return sorted(samples)[min(len(samples) - 1, int(len(samples) * q))] if samples else 0.0
+
+
+async def produce(args, write_row) -> list:
+    """Ходы сессий: строка на ход, --rows-per-sec в сумме по всем таблицам; возвращает задержки ходов в мс"""
+    waits = []
+    tasks = []
+    interval = 1 / args.rows_per_sec
+    sequence = {}
+    start = time.perf_counter()
+    for index in range(int(args.rows_per_sec * args.seconds)):
+        sheet_id = f"sheet-{index % args.sheets}"
+        number = sequence[sheet_id] = sequence.get(sheet_id, -1) + 1
+        row = ["Диалог", time.time(), f"{sheet_id}:{number}", "Вопрос пользователя", "Ответ ассистента", 12.5]
+
+        async def turn(sheet_id=sheet_id, row=row):
+            begin = time.perf_counter()
+            await write_row(sheet_id, row)
+            waits.append((time.perf_counter() - begin) * 1000)
+
+        tasks.append(asyncio.create_task(turn()))
+        delay = start + (index + 1) * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    await asyncio.gather(*tasks)
+    return waits
+
+
+async def run_mode(args, title: str, stand_in: SheetsStandIn, write_row, finish=None):
+    stand_in.rows.clear()
+    stand_in.responses.clear()
+    stand_in.last.clear()
+    lags = []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(lags, stop))
+    waits = await produce(args, write_row)
+    if finish:
+        await finish()
+    stop.set()
+    await lag_task
+    expected = int(args.rows_per_sec * args.seconds)
+    delivered = sum(len(rows) for rows in stand_in.rows.values())
+    print(f"\n{title}:")
+    print(f"  запросов {sum(stand_in.responses.values())}, ответы {dict(sorted(stand_in.responses.items()))}")
+    print(f"  доставлено строк {delivered} из {expected}")
+    print(f"  ожидание хода: p50 {statistics.median(waits):.3f} мс, p99 {percentile(waits, 0.99):.3f} мс, "
+          f"макс {max(waits):.3f} мс")
+    print(f"  задержка цикла событий: p99 {percentile(lags, 0.99):.2f} мс, макс {max(lags, default=0):.2f} мс")
+    return delivered
+
+
+async def main_async(args):
+    random.seed(args.seed)
+    stand_in = SheetsStandIn(args.quota, args.error_rate, args.delay_ms / 1000)
+    server = await asyncio.start_server(stand_in.handle, "127.0.0.1", 0)
+    api_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    print(f"Таблиц: {args.sheets}, строк в секунду: {args.rows_per_sec}, секунд: {args.seconds}, "
+          f"квота заглушки: {args.quota} запросов/с на таблицу, 503: {args.error_rate:.0%}")
+
+    async def append_row_now(sheet_id: str, row: list):
+        # Построчная синхронная запись: ошибка или 429 - строка потеряна, ход ждет ответ
+        try:
+            await main.http_client.post(
+                f"{api_url}/v4/spreadsheets/{sheet_id}/values/A1:append",
+                params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+                json={"values": [row]}, headers={"Authorization": "Bearer bench-token"}
+            )
+        except Exception:
+            pass
+
+    await run_mode(args, "Построчно, ход ждет запись", stand_in, append_row_now)
+
+    writer = main.GoogleSheetsWriter(
+        api_url, flush_interval_ms=args.flush_ms, batch_rows=main.GOOGLE_SHEETS_BATCH_ROWS,
+        max_pending_rows=main.GOOGLE_SHEETS_MAX_PENDING_ROWS, max_retries=main.GOOGLE_SHEETS_MAX_RETRIES,
+        backoff_max=main.GOOGLE_SHEETS_BACKOFF_MAX
+    )
+    writer.tokens["bench-user"] = {"access_token": "bench-token"}
+    writer.start()
+
+    async def append_row_batched(sheet_id: str, row: list):
+        writer.append("bench-user", sheet_id, "A1", row)
+
+    async def finish():
+        # Дожидаемся, пока писатель (с повторами после 429/503) отправит все строки
+        deadline = time.monotonic() + args.drain_timeout
+        while writer.get_stats()["pending_rows"] or writer.sending:
+            if time.monotonic() > deadline:
+                break
+            await asyncio.sleep(0.05)
+        await writer.stop()
+
+    delivered = await run_mode(args, "GoogleSheetsWriter (пачки по таблицам)", stand_in, append_row_batched, finish)
+    ordered = all(
+        [int(row[2].split(":")[1]) for row in rows] == list(range(len(rows)))
+        for rows in stand_in.rows.values()
+    )
+    print(f"  строки каждой таблицы без пропусков и по порядку: {'да' if ordered else 'НЕТ'}")
+    print(f"  статистика писателя: {writer.get_stats()}")
+    server.close()
+    await main.http_client.aclose()
+    if not ordered or delivered != int(args.rows_per_sec * args.seconds):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sheets", type=int, default=20, help="число таблиц (ассистентов)")
+    parser.add_argument("--rows-per-sec", type=float, default=400, help="строк в секунду по всем таблицам")
+    parser.add_argument("--seconds", type=float, default=10, help="длительность нагрузки")
+    parser.add_argument("--quota", type=float, default=1, help="запросов в секунду на таблицу, которые принимает заглушка")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="доля ответов 503")
+    parser.add_argument("--delay-ms", type=float, default=30, help="задержка ответа заглушки")
+    parser.add_argument("--flush-ms", type=int, default=main.GOOGLE_SHEETS_FLUSH_INTERVAL_MS, help="интервал отправки писателя")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="сколько ждать отправки оставшихся строк")
+    parser.add_argument("--seed", type=int, default=1, help="зерно генератора ошибок заглушки")
+    asyncio.run(main_async(parser.parse_args()))
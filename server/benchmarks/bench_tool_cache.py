@@ -0,0 +1,95 @@
+"""
+Бенчмарк кэша результатов функций на локальной заглушке webhook (из bench_tool_calls).
+
+Имитирует справочную функцию (цена по артикулу), которую сессии вызывают с
+повторяющимися аргументами: --calls вызовов при --concurrency одновременных, артикулы
+выбираются из --keys по закону Ципфа (популярные запрашиваются чаще), в аргументах
+есть поле, не входящее в ключ кэша. Серия выполняется без кэша и с кэшем
+{"ttl": --ttl, "key": ["sku"]}; выводятся задержка вызова (p50/p99), число запросов
+к заглушке, доля попаданий и сэкономленное время из статистики кэша ассистента.
+Внешняя сеть не нужна; к БД бенчмарк не подключается, но main.py при импорте
+требует DATABASE_URL.
+
+    DATABASE_URL=postgresql://... python server/benchmarks/bench_tool_cache.py --calls 5000 --keys 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main
+from bench_tool_calls import WebhookStandIn, percentile
+
+
+def make_call(index: int, url: str, cache: dict = None) -> main.ToolCall:
+    spec = {"name": "get_price", "handler": {"type": "webhook", "url": url}}
+    if cache:
+        spec["cache"] = cache
+    return main.ToolCall(
+        client_id=f"bench-{index % 100}", assistant_id="bench", call_id=f"call-{index}",
+        name="get_price", spec=spec, api_key=None
+    )
+
+
+async def run_series(url: str, skus: list, concurrency: int, cache: dict = None) -> tuple:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(index: int, sku: str):
+        async with semaphore:
+            start = time.perf_counter()
+            output = await main.execute_tool_call(make_call(index, url, cache), json.dumps({"sku": sku, "session": index % 100}))
+            latencies.append((time.perf_counter() - start) * 1000)
+            assert json.loads(output)["echo"]["sku"] == sku, output
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i, sku) for i, sku in enumerate(skus)))
+    return len(skus) / (time.perf_counter() - start), latencies
+
+
+async def main_async(args):
+    stand_in = WebhookStandIn(args.delay_ms / 1000)
+    server = await asyncio.start_server(stand_in.handle, "127.0.0.1", 0)
+    url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/hook"
+    main.TOOL_WEBHOOK_ALLOW_PRIVATE = True  # Заглушка работает по http на loopback
+
+    async def bench_generation(assistant_id):
+        return 0  # Поколение кэша не читается из БД: сбросов во время бенчмарка нет
+
+    main.load_tool_cache_generation = bench_generation
+    rng = random.Random(args.seed)
+    weights = [1 / (rank + 1) ** args.zipf for rank in range(args.keys)]
+    skus = [f"SKU-{rank}" for rank in rng.choices(range(args.keys), weights=weights, k=args.calls)]
+    print(f"Вызовов: {args.calls}, одновременно: {args.concurrency}, артикулов: {args.keys} (Ципф s={args.zipf}), "
+          f"задержка заглушки: {args.delay_ms} мс")
+
+    await run_series(url, skus[:args.concurrency], args.concurrency)  # Прогрев пула соединений
+    for title, cache in (("без кэша", None), ("с кэшем", {"ttl": args.ttl, "key": ["sku"]})):
+        requests = stand_in.requests
+        rate, latencies = await run_series(url, skus, args.concurrency, cache)
+        print(f"  {title:9} {rate:8.0f} вызовов/с, p50 {statistics.median(latencies):7.2f} мс, "
+              f"p99 {percentile(latencies, 0.99):7.2f} мс, запросов к webhook {stand_in.requests - requests}")
+
+    stats = main.get_tool_result_cache("bench").get_stats()["functions"]["get_price"]
+    print(f"\nКэш: попаданий {stats['hits']}, ожиданий одинакового вызова {stats['shared']}, промахов {stats['misses']}, "
+          f"доля {stats['hit_rate']:.1%}, сэкономлено {stats['saved_ms'] / 1000:.1f} с")
+    server.close()
+    await main.http_client.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=5000, help="число вызовов в серии")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных вызовов")
+    parser.add_argument("--keys", type=int, default=200, help="число различных артикулов")
+    parser.add_argument("--zipf", type=float, default=1.1, help="показатель распределения популярности артикулов")
+    parser.add_argument("--ttl", type=float, default=60, help="время жизни результата в кэше")
+    parser.add_argument("--delay-ms", type=float, default=40, help="задержка ответа заглушки")
+    parser.add_argument("--seed", type=int, default=1, help="зерно генератора артикулов")
+    asyncio.run(main_async(parser.parse_args()))
@@ -0,0 +1,140 @@
+"""
+Бенчмарк выполнения вызовов функций сервером на локальной заглушке webhook.
+
+Заглушка - минимальный HTTP/1.1-сервер (keep-alive) на asyncio, отвечающий через
+--delay-ms. Через execute_tool_call выполняется --calls вызовов при --concurrency
+одновременных: с общим пулом соединений http_client и, для сравнения, с новым
+httpx.AsyncClient на каждый вызов. Выводятся пропускная способность и накладные
+расходы сверх задержки заглушки (p50/p99), затем проверяется, что вызов медленнее
+таймаута функции завершается ошибкой вовремя. Внешняя сеть не нужна; к БД бенчмарк
+не подключается, но main.py при импорте требует DATABASE_URL.
+
+    DATABASE_URL=postgresql://... python server/benchmarks/bench_tool_calls.py --calls 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import httpx
+
+import main
+
+
+class WebhookStandIn:
+    """Локальная заглушка webhook: отвечает {"ok": true, "echo": аргументы} через delay секунд"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.connections = 0
+        self.requests = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":")[1])
+                body = json.loads(await reader.readexactly(length))
+                self.requests += 1
+                delay = float(body["arguments"].get("delay", self.delay))
+                if delay:
+                    await asyncio.sleep(delay)
+                payload = json.dumps({"ok": True, "echo": body["arguments"]}).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: "
+                             + str(len(payload)).encode() + b"\r\n\r\n" + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+
+def make_call(index: int, url: str, timeout: float = None) -> main.ToolCall:
+    handler = {"type": "webhook", "url": url}
+    if timeout:
+        handler["timeout"] = timeout
+    return main.ToolCall(
+        client_id="bench", assistant_id="bench", call_id=f"call-{index}",
+        name="bench_webhook", spec={"name": "bench_webhook", "handler": handler}, api_key=None
+    )
+
+
+async def run_series(url: str, calls: int, concurrency: int, delay: float) -> tuple:
+    semaphore = asyncio.Semaphore(concurrency)
+    overheads = []
+
+    async def one(index: int):
+        async with semaphore:
+            start = time.perf_counter()
+            output = await main.execute_tool_call(make_call(index, url), json.dumps({"n": index}))
+            overheads.append((time.perf_counter() - start - delay) * 1000)
+            assert json.loads(output)["echo"]["n"] == index, output
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(calls)))
+    return calls / (time.perf_counter() - start), overheads
+
+
+def percentile(samples, q: float) -> float:
+    return sorted(samples)[min(len(samples) - 1, int(len(samples) * q))]
+
+
+async def main_async(args):
+    stand_in = WebhookStandIn(args.delay_ms / 1000)
+    server = await asyncio.start_server(stand_in.handle, "127.0.0.1", 0)
+    url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/hook"
+    main.TOOL_WEBHOOK_ALLOW_PRIVATE = True  # Заглушка работает по http на loopback
+    delay = args.delay_ms / 1000
+    print(f"Вызовов: {args.calls}, одновременно: {args.concurrency}, задержка заглушки: {args.delay_ms} мс")
+
+    # Прогрев пула соединений
+    await run_series(url, args.concurrency, args.concurrency, delay)
+    connections = stand_in.connections
+    rate, overheads = await run_series(url, args.calls, args.concurrency, delay)
+    print(f"  общий пул http_client:     {rate:8.0f} вызовов/с, накладные p50 {statistics.median(overheads):6.2f} мс, "
+          f"p99 {percentile(overheads, 0.99):6.2f} мс, новых соединений {stand_in.connections - connections}")
+
+    shared = main.http_client
+    original_post = shared.post
+
+    async def post_with_new_client(*post_args, **kwargs):
+        async with httpx.AsyncClient() as client:
+            return await client.post(*post_args, **kwargs)
+
+    shared.post = post_with_new_client
+    connections = stand_in.connections
+    try:
+        rate, overheads = await run_series(url, args.calls, args.concurrency, delay)
+    finally:
+        shared.post = original_post
+    print(f"  новый клиент на вызов:     {rate:8.0f} вызовов/с, накладные p50 {statistics.median(overheads):6.2f} мс, "
+          f"p99 {percentile(overheads, 0.99):6.2f} мс, новых соединений {stand_in.connections - connections}")
+
+    start = time.perf_counter()
+    output = await main.execute_tool_call(make_call(-1, url, timeout=0.2), json.dumps({"delay": 1.0}))
+    print(f"  вызов дольше таймаута 0.2 с: {output} за {(time.perf_counter() - start) * 1000:.0f} мс")
+    await asyncio.sleep(1.0)  # Заглушка дописывает ответ на прерванный вызов
+
+    print("\nМетрика tool_call_seconds:")
+    for line in main.metrics_registry.render({}).splitlines():
+        if line.startswith("tool_call_seconds_count") or line.startswith("tool_call_seconds_sum"):
+            print(f"  {line}")
+    server.close()
+    await main.http_client.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=2000, help="число вызовов в серии")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных вызовов")
+    parser.add_argument("--delay-ms", type=float, default=20, help="задержка ответа заглушки")
+    asyncio.run(main_async(parser.parse_args()))
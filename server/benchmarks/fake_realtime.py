@@ -0,0 +1,141 @@
+"""
+Локальная заглушка OpenAI Realtime для нагрузочного тестирования релея.
+
+Принимает те же события, что и OpenAI: отвечает session.updated на session.update,
+считает входящее аудио и после каждых --turn-ms миллисекунд речи (или по response.create)
+отправляет типичную последовательность ответа: speech_started, speech_stopped,
+response.created, пары response.audio.delta / response.audio_transcript.delta
+с шагом --delta-ms (в --speed раз быстрее реального времени), response.audio.done
+и response.done.
+
+Кадры ответа помечаются event_id вида ts_<unix time> - генератор нагрузки по ним
+считает задержку OpenAI -> клиент. Задержку клиент -> OpenAI заглушка считает по
+event_id входящих append (JSON-режим) и передает в response.done (metadata.upstream_latency_ms).
+
+    python server/benchmarks/fake_realtime.py --port 8765
+    REALTIME_WS_URL=ws://127.0.0.1:8765 uvicorn main:app --port 5050
+"""
+import argparse
+import asyncio
+import base64
+import json
+import time
+
+import websockets
+
+BYTES_PER_MS = 48  # PCM16 24 кГц моно
+
+
+def dumps(event) -> str:
+    # Компактный JSON, как у OpenAI: метки "event_id":"ts_..." ищутся без разбора кадра
+    return json.dumps(event, separators=(",", ":"), ensure_ascii=False)
+
+stats = {"connections": 0, "active": 0, "responses": 0, "frames_in": 0, "frames_out": 0}
+
+
+def make_handler(args):
+    delta_audio = base64.b64encode(b"\x00\x08" * (BYTES_PER_MS // 2 * args.delta_ms)).decode("ascii")
+    chunks = max(1, args.response_ms // args.delta_ms)
+    chunk_interval = args.delta_ms / 1000 / args.speed
+
+    async def respond(ws, counter: int, upstream_latency: list):
+        response_id = f"resp_{counter}"
+        item_id = f"item_{counter}"
+        await ws.send(dumps({"type": "input_audio_buffer.speech_started", "event_id": f"evt_{counter}_ss", "item_id": item_id}))
+        await ws.send(dumps({"type": "input_audio_buffer.speech_stopped", "event_id": f"evt_{counter}_se", "item_id": item_id}))
+        await asyncio.sleep(args.first_audio_ms / 1000)
+        await ws.send(dumps({"type": "response.created", "event_id": f"evt_{counter}_rc", "response": {"id": response_id, "status": "in_progress"}}))
+        for _ in range(chunks):
+            await ws.send(dumps({
+                "type": "response.audio.delta", "event_id": f"ts_{time.time():.6f}", "response_id": response_id,
+                "item_id": item_id, "output_index": 0, "content_index": 0, "delta": delta_audio
+            }))
+            await ws.send(dumps({
+                "type": "response.audio_transcript.delta", "event_id": f"ts_{time.time():.6f}", "response_id": response_id,
+                "item_id": item_id, "output_index": 0, "content_index": 0, "delta": "слово "
+            }))
+            stats["frames_out"] += 2
+            await asyncio.sleep(chunk_interval)
+        await ws.send(dumps({"type": "response.audio.done", "event_id": f"evt_{counter}_ad", "response_id": response_id}))
+        await ws.send(dumps({
+            "type": "response.done", "event_id": f"evt_{counter}_rd",
+            "response": {
+                "id": response_id, "status": "completed",
+                "output": [{"type": "message", "content": [{"type": "audio", "transcript": "слово " * chunks}]}],
+                "metadata": {"upstream_latency_ms": upstream_latency[-200:]}
+            }
+        }))
+        upstream_latency.clear()
+        stats["responses"] += 1
+
+    async def handler(ws, path=None):
+        stats["connections"] += 1
+        stats["active"] += 1
+        audio_ms = 0.0
+        counter = 0
+        upstream_latency = []
+        response_task = None
+        try:
+            await ws.send(dumps({"type": "session.created", "event_id": "evt_created", "session": {"id": "sess_fake"}}))
+            async for message in ws:
+                if isinstance(message, bytes):
+                    continue
+                stats["frames_in"] += 1
+                head = message[:120]
+                if '"input_audio_buffer.append"' in head:
+                    # Без полного разбора JSON: длительность по размеру base64, задержка по event_id
+                    audio_ms += len(message) * 3 / 4 / BYTES_PER_MS
+                    marker = head.find('"event_id":"ts_')
+                    if marker != -1:
+                        end = head.find('"', marker + 15)
+                        if end != -1:
+                            upstream_latency.append(round((time.time() - float(head[marker + 15:end])) * 1000, 2))
+                    if audio_ms < args.turn_ms:
+                        continue
+                    audio_ms = 0.0
+                elif '"session.update"' in head:
+                    await ws.send(dumps({"type": "session.updated", "event_id": "evt_updated", "session": {"id": "sess_fake"}}))
+                    continue
+                elif '"response.create"' not in head:
+                    continue
+                if response_task is None or response_task.done():
+                    counter += 1
+                    response_task = asyncio.create_task(respond(ws, counter, upstream_latency))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            stats["active"] -= 1
+            if response_task is not None:
+                response_task.cancel()
+
+    return handler
+
+
+async def serve(args):
+    async with websockets.serve(make_handler(args), args.host, args.port, max_size=None, ping_interval=None):
+        print(f"Заглушка OpenAI Realtime: ws://{args.host}:{args.port}", flush=True)
+        while True:
+            await asyncio.sleep(args.report_interval or 3600)
+            if args.report_interval:
+                print(f"соединений: {stats['active']} (всего {stats['connections']}), ответов: {stats['responses']}, "
+                      f"кадров получено: {stats['frames_in']}, отправлено: {stats['frames_out']}", flush=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--turn-ms", type=int, default=3000, help="сколько мс входящего аудио вызывает ответ")
+    parser.add_argument("--first-audio-ms", type=int, default=300, help="задержка от конца речи до первого аудио ответа")
+    parser.add_argument("--response-ms", type=int, default=2000, help="длительность аудио ответа")
+    parser.add_argument("--delta-ms", type=int, default=50, help="длительность аудио в одном response.audio.delta")
+    parser.add_argument("--speed", type=float, default=2.0, help="во сколько раз быстрее реального времени отправляется ответ")
+    parser.add_argument("--report-interval", type=float, default=10.0, help="период вывода статистики в секундах (0 - не выводить)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,456 @@
+"""
+Нагрузочный тест релея /ws/{assistant_id}: много одновременных сокетов, как у виджета,
+каждый передает PCM16 24 кГц моно в реальном времени.
+
+Отчет: устойчивые сессии (продержались до конца без разрывов) и сессий на ядро,
+перцентили задержки кадров в обе стороны, память на сессию и CPU на поток.
+CPU и память релея берутся из /proc/<pid> (Linux), поэтому нужен --server-pid
+или --spawn. Задержки считаются по меткам времени заглушки fake_realtime.py.
+
+С --spawn скрипт сам запускает заглушку OpenAI (fake_realtime.py) и релей
+(uvicorn main:app, один воркер) с REALTIME_WS_URL на заглушку и без лимитов тарифа;
+нужна только доступная база в DATABASE_URL со схемой, обновленной alembic upgrade head. Ассистент создается через API,
+если не передан --assistant-id. Генератор лучше запускать на других ядрах,
+чем релей (taskset), и с увеличенным ulimit -n.
+
+--db-delay-ms (с --spawn) ставит перед Postgres TCP-прокси, который задерживает
+каждый запрос релея к БД: так проверяется, что медленная база не задерживает
+аудио (в отчете - задержки кадров и время подключения сессии).
+
+    python server/benchmarks/load_relay.py --spawn --sessions 500 --duration 60
+    python server/benchmarks/load_relay.py --url ws://127.0.0.1:5050 --assistant-id <id> --server-pid <pid> --binary
+    python server/benchmarks/load_relay.py --spawn --sessions 200 --max-p99-ms 150 --json-out report.json
+    python server/benchmarks/load_relay.py --spawn --sessions 100 --db-delay-ms 200
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import wave
+from urllib.parse import urlsplit, urlunsplit
+
+import httpx
+import numpy as np
+import websockets
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(BENCH_DIR, "..")
+SAMPLE_RATE = 24000
+
+# Без лимитов тарифа: иначе допуск сессий остановит тест на первых подключениях
+UNLIMITED_PLANS = json.dumps({
+    plan: {"max_sessions": 0, "max_sessions_per_assistant": 0, "audio_bytes_per_sec": 0, "max_session_minutes": 0, "daily_minutes": 0}
+    for plan in ("free", "start", "pro")
+})
+
+
+def load_audio(path: str, frame_samples: int):
+    """Кадры PCM16 24 кГц моно из WAV или синтетическая речь (слоги с паузами, громче порога тишины)"""
+    if path:
+        with wave.open(path, "rb") as wav:
+            if wav.getframerate() != SAMPLE_RATE or wav.getnchannels() != 1 or wav.getsampwidth() != 2:
+                raise SystemExit(f"{path}: нужен WAV PCM16 {SAMPLE_RATE} Гц моно")
+            pcm = wav.readframes(wav.getnframes())
+    else:
+        t = np.arange(SAMPLE_RATE * 10) / SAMPLE_RATE
+        envelope = (np.sin(2 * np.pi * 0.4 * t) > -0.3).astype(np.float32)
+        signal = envelope * (0.3 * np.sin(2 * np.pi * 180 * t) + 0.05 * np.random.randn(t.size))
+        pcm = (signal * 32767).astype("<i2").tobytes()
+    frame_bytes = frame_samples * 2
+    return [pcm[i:i + frame_bytes] for i in range(0, len(pcm) - frame_bytes + 1, frame_bytes)]
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "max": None}
+    array = np.asarray(values)
+    return {
+        "count": int(array.size),
+        "p50": round(float(np.percentile(array, 50)), 2),
+        "p95": round(float(np.percentile(array, 95)), 2),
+        "p99": round(float(np.percentile(array, 99)), 2),
+        "max": round(float(array.max()), 2),
+    }
+
+
+def process_sample(pid: int):
+    """(CPU секунд, RSS в байтах) процесса из /proc"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+        return cpu, rss
+    except (OSError, StopIteration, IndexError, ValueError):
+        return None
+
+
+class Session:
+    def __init__(self):
+        self.connected = False
+        self.sustained = False
+        self.error = None
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.responses = 0
+        self.downstream_ms = []
+        self.upstream_ms = []
+        self.send_lag_ms = 0.0  # Максимальное отставание отправки от реального времени на стороне генератора
+        self.connect_ms = None  # От открытия сокета до статуса connected (релей подключился к OpenAI)
+
+
+async def receive_loop(ws, session: Session):
+    async for message in ws:
+        session.frames_received += 1
+        session.bytes_received += len(message)
+        if isinstance(message, bytes):
+            continue
+        now = time.time()
+        marker = message.find('"event_id":"ts_', 0, 120)
+        if marker != -1:
+            end = message.find('"', marker + 15)
+            session.downstream_ms.append((now - float(message[marker + 15:end])) * 1000)
+        elif '"response.done"' in message[:60]:
+            session.responses += 1
+            metadata = json.loads(message).get("response", {}).get("metadata") or {}
+            session.upstream_ms.extend(metadata.get("upstream_latency_ms", []))
+
+
+async def run_session(url: str, frames, frame_seconds: float, binary: bool, deadline: float, session: Session):
+    opened = time.perf_counter()
+    try:
+        async with websockets.connect(url, max_size=None, ping_interval=None, open_timeout=30, close_timeout=5) as ws:
+            # Ждем, пока релей подключится к OpenAI
+            while True:
+                status = json.loads(await asyncio.wait_for(ws.recv(), timeout=30))
+                if status.get("type") == "error" or status.get("status") in ("rejected", "timeout"):
+                    session.error = status.get("reason") or status.get("status") or "error"
+                    return
+                if status.get("status") == "connected":
+                    break
+            session.connected = True
+            session.connect_ms = (time.perf_counter() - opened) * 1000
+            receiver = asyncio.create_task(receive_loop(ws, session))
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            index = 0
+            try:
+                while time.time() < deadline:
+                    if receiver.done():
+                        error = None if receiver.cancelled() else receiver.exception()
+                        session.error = type(error).__name__ if error else "closed"
+                        return
+                    pcm = frames[index % len(frames)]
+                    if binary:
+                        await ws.send(pcm)
+                    else:
+                        await ws.send(json.dumps({
+                            "type": "input_audio_buffer.append",
+                            "event_id": f"ts_{time.time():.6f}",
+                            "audio": base64.b64encode(pcm).decode("ascii")
+                        }, separators=(",", ":")))
+                    session.frames_sent += 1
+                    index += 1
+                    # Расписание от начала сессии: задержки отдельных отправок не накапливаются
+                    delay = started + index * frame_seconds - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    else:
+                        session.send_lag_ms = max(session.send_lag_ms, -delay * 1000)
+                session.sustained = True
+            finally:
+                receiver.cancel()
+    except Exception as e:
+        if session.error is None:
+            session.error = type(e).__name__
+
+
+async def monitor(pid, samples: dict, steady_at: float, deadline: float):
+    """Снимки CPU и памяти релея: до нагрузки, в начале и в конце устойчивого окна"""
+    samples["baseline"] = process_sample(pid)
+    await asyncio.sleep(max(0.0, steady_at - time.time()))
+    samples["steady_start"] = (time.time(), process_sample(pid))
+    await asyncio.sleep(max(0.0, deadline - 1 - time.time()))
+    samples["steady_end"] = (time.time(), process_sample(pid))
+
+
+def create_assistant(http_url: str) -> str:
+    email = f"load-{uuid.uuid4().hex[:10]}@example.com"
+    with httpx.Client(base_url=http_url, timeout=30) as client:
+        response = client.post("/api/auth/register", json={"email": email, "password": "load-test"})
+        response.raise_for_status()
+        headers = {"Authorization": f"Bearer {response.json()['token']}"}
+        client.put("/api/users/me", headers=headers, json={"openai_api_key": "sk-load-test"}).raise_for_status()
+        response = client.post("/api/assistants", headers=headers, json={"name": "load-test"})
+        response.raise_for_status()
+        return response.json()["id"]
+
+
+class DelayProxy:
+    """
+    TCP-прокси перед Postgres: данные от релея уходят в БД через delay секунд после получения,
+    ответы возвращаются сразу - каждый запрос выполняется на delay дольше (медленная или далекая БД).
+    Задержка не копится: кадры отправляются по своему времени, конвейер запросов сохраняется.
+    Работает в отдельном потоке со своим циклом событий, чтобы генератор нагрузки его не тормозил.
+    """
+
+    def __init__(self, host: str, port: int, delay: float):
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.listen_port = None
+        self.connections = 0
+        self.ready = threading.Event()
+
+    def start(self) -> int:
+        threading.Thread(target=lambda: asyncio.run(self._serve()), daemon=True).start()
+        if not self.ready.wait(10):
+            raise SystemExit("Прокси БД не запустился")
+        return self.listen_port
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.listen_port = server.sockets[0].getsockname()[1]
+        self.ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, client_reader, client_writer):
+        self.connections += 1
+        try:
+            db_reader, db_writer = await asyncio.open_connection(self.host, self.port)
+        except OSError:
+            client_writer.close()
+            return
+        await asyncio.gather(
+            self._pipe(client_reader, db_writer, self.delay),
+            self._pipe(db_reader, client_writer, 0.0),
+            return_exceptions=True
+        )
+
+    async def _pipe(self, reader, writer, delay: float):
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+
+        async def forward():
+            while True:
+                due, data = await chunks.get()
+                if data is None:
+                    return
+                await asyncio.sleep(max(0.0, due - loop.time()))
+                writer.write(data)
+                await writer.drain()
+
+        sender = asyncio.create_task(forward())
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                chunks.put_nowait((loop.time() + delay, data))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            chunks.put_nowait((0.0, None))
+            try:
+                await sender
+            except (ConnectionError, OSError):
+                pass
+            writer.close()
+
+
+def proxied_database_url(url: str, port: int) -> str:
+    """DATABASE_URL с адресом прокси вместо сервера БД (учетные данные и параметры сохраняются)"""
+    parts = urlsplit(url)
+    credentials = parts.netloc.rpartition("@")[0]
+    return urlunsplit(parts._replace(netloc=f"{credentials}@127.0.0.1:{port}" if credentials else f"127.0.0.1:{port}"))
+
+
+def spawn(args):
+    """Запускает заглушку OpenAI и релей, возвращает процессы после готовности релея"""
+    fake = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "fake_realtime.py"), "--port", str(args.fake_port), "--report-interval", "0",
+         "--turn-ms", str(args.turn_ms), "--response-ms", str(args.response_ms)],
+        stdout=subprocess.DEVNULL
+    )
+    env = dict(os.environ, REALTIME_WS_URL=f"ws://127.0.0.1:{args.fake_port}", PLAN_LIMITS=UNLIMITED_PLANS)
+    if args.db_delay_ms:
+        database_url = os.environ.get("DATABASE_URL", "")
+        parts = urlsplit(database_url)
+        if not parts.hostname:
+            raise SystemExit("--db-delay-ms: в DATABASE_URL нужен адрес сервера БД")
+        proxy = DelayProxy(parts.hostname, parts.port or 5432, args.db_delay_ms / 1000)
+        env["DATABASE_URL"] = proxied_database_url(database_url, proxy.start())
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning", "--no-access-log"],
+        cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=None if args.server_logs else subprocess.DEVNULL
+    )
+    http_url = f"http://127.0.0.1:{args.port}"
+    for _ in range(100):
+        if server.poll() is not None:
+            fake.terminate()
+            raise SystemExit("Релей завершился при запуске (проверьте DATABASE_URL)")
+        try:
+            if httpx.get(f"{http_url}/api/healthcheck", timeout=1).status_code == 200:
+                return fake, server
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    fake.terminate()
+    server.terminate()
+    raise SystemExit("Релей не запустился за 20 секунд")
+
+
+async def run_load(args, url: str, pid):
+    frame_seconds = args.frame_samples / SAMPLE_RATE
+    frames = load_audio(args.audio, args.frame_samples)
+    ramp_seconds = args.sessions / args.ramp
+    start = time.time()
+    steady_at = start + ramp_seconds + args.settle
+    deadline = steady_at + args.duration
+
+    samples = {}
+    monitor_task = asyncio.create_task(monitor(pid, samples, steady_at, deadline)) if pid else None
+    sessions = [Session() for _ in range(args.sessions)]
+    tasks = []
+    for i, session in enumerate(sessions):
+        tasks.append(asyncio.create_task(run_session(url, frames, frame_seconds, args.binary, deadline, session)))
+        await asyncio.sleep(max(0.0, start + (i + 1) / args.ramp - time.time()))
+    await asyncio.gather(*tasks)
+    if monitor_task:
+        await monitor_task
+    return sessions, samples, frame_seconds
+
+
+def build_report(args, sessions, samples, frame_seconds):
+    connected = [s for s in sessions if s.connected]
+    sustained = [s for s in sessions if s.sustained]
+    errors = {}
+    for s in sessions:
+        if s.error:
+            errors[s.error] = errors.get(s.error, 0) + 1
+    report = {
+        "sessions": args.sessions,
+        "connected": len(connected),
+        "sustained": len(sustained),
+        "errors": errors,
+        "protocol": "binary" if args.binary else "json",
+        "frame_ms": round(frame_seconds * 1000, 2),
+        "frames_sent": sum(s.frames_sent for s in sessions),
+        "frames_received": sum(s.frames_received for s in sessions),
+        "responses": sum(s.responses for s in sessions),
+        "downstream_latency_ms": percentiles([v for s in sessions for v in s.downstream_ms]),
+        "upstream_latency_ms": percentiles([v for s in sessions for v in s.upstream_ms]),
+        "connect_ms": percentiles([s.connect_ms for s in sessions if s.connect_ms is not None]),
+        "db_delay_ms": args.db_delay_ms,
+        "generator_max_send_lag_ms": round(max((s.send_lag_ms for s in sessions), default=0.0), 2),
+    }
+    if samples.get("steady_start") and samples.get("steady_end") and samples["steady_start"][1] and samples["steady_end"][1]:
+        (t0, (cpu0, rss0)), (t1, (cpu1, rss1)) = samples["steady_start"], samples["steady_end"]
+        cores = (cpu1 - cpu0) / (t1 - t0) if t1 > t0 else 0.0
+        baseline_rss = samples["baseline"][1] if samples.get("baseline") else rss0
+        report["server"] = {
+            "cpu_cores": round(cores, 3),
+            "cpu_percent_per_stream": round(cores * 100 / len(sustained), 4) if sustained else None,
+            "sessions_per_core": round(len(sustained) / cores, 1) if cores > 0 else None,
+            "rss_baseline_mb": round(baseline_rss / 2**20, 1),
+            "rss_loaded_mb": round(rss1 / 2**20, 1),
+            "memory_per_session_kb": round((rss1 - baseline_rss) / 1024 / len(sustained), 1) if sustained else None,
+        }
+    return report
+
+
+def print_report(report):
+    print(f"Сессий: {report['sessions']}, подключились: {report['connected']}, устойчивых: {report['sustained']}, "
+          f"протокол: {report['protocol']}, кадр {report['frame_ms']} мс"
+          + (f", задержка запросов к БД {report['db_delay_ms']} мс" if report["db_delay_ms"] else ""))
+    if report["errors"]:
+        print(f"Ошибки: {report['errors']}")
+    print(f"Кадров отправлено: {report['frames_sent']}, получено: {report['frames_received']}, ответов: {report['responses']}")
+    for key, title in (("downstream_latency_ms", "OpenAI -> клиент"), ("upstream_latency_ms", "клиент -> OpenAI")):
+        p = report[key]
+        if p["count"]:
+            print(f"Задержка кадров {title:17} мс: p50 {p['p50']:8.2f}  p95 {p['p95']:8.2f}  p99 {p['p99']:8.2f}  max {p['max']:8.2f}  ({p['count']} кадров)")
+    p = report["connect_ms"]
+    if p["count"]:
+        print(f"Подключение сессии мс: p50 {p['p50']:8.2f}  p95 {p['p95']:8.2f}  p99 {p['p99']:8.2f}  max {p['max']:8.2f}")
+    print(f"Макс. отставание отправки генератора: {report['generator_max_send_lag_ms']} мс (большое значение - генератор перегружен)")
+    server = report.get("server")
+    if server:
+        print(f"CPU релея: {server['cpu_cores']} ядра, на поток: {server['cpu_percent_per_stream']}% ядра, "
+              f"устойчивых сессий на ядро: {server['sessions_per_core']}")
+        print(f"Память релея: {server['rss_baseline_mb']} МБ до нагрузки, {server['rss_loaded_mb']} МБ под нагрузкой, "
+              f"{server['memory_per_session_kb']} КБ на сессию")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="ws://127.0.0.1:5050", help="адрес релея")
+    parser.add_argument("--assistant-id", help="ассистент для подключения (по умолчанию создается через API)")
+    parser.add_argument("--server-pid", type=int, help="PID процесса релея для замера CPU и памяти")
+    parser.add_argument("--spawn", action="store_true", help="запустить заглушку OpenAI и релей самостоятельно")
+    parser.add_argument("--port", type=int, default=5050, help="порт релея при --spawn")
+    parser.add_argument("--fake-port", type=int, default=8765, help="порт заглушки OpenAI при --spawn")
+    parser.add_argument("--turn-ms", type=int, default=3000, help="сколько мс аудио пользователя вызывает ответ заглушки (--spawn)")
+    parser.add_argument("--response-ms", type=int, default=2000, help="длительность ответа заглушки в мс (--spawn)")
+    parser.add_argument("--sessions", type=int, default=100, help="число одновременных сессий")
+    parser.add_argument("--ramp", type=float, default=50.0, help="новых подключений в секунду")
+    parser.add_argument("--settle", type=float, default=5.0, help="пауза после подключения всех сессий до начала замера (в секундах)")
+    parser.add_argument("--duration", type=float, default=60.0, help="длительность устойчивого окна замера (в секундах)")
+    parser.add_argument("--audio", help="WAV PCM16 24 кГц моно (по умолчанию синтетическая речь)")
+    parser.add_argument("--frame-samples", type=int, default=2048, help="размер кадра в сэмплах (как bufferSize в widget.js)")
+    parser.add_argument("--binary", action="store_true", help="бинарный протокол аудио (?audio=binary)")
+    parser.add_argument("--json-out", help="сохранить отчет в JSON для сравнения между версиями")
+    parser.add_argument("--max-p99-ms", type=float, help="код возврата 1, если p99 задержки OpenAI -> клиент выше")
+    parser.add_argument("--min-sustained", type=float, default=1.0, help="код возврата 1, если доля устойчивых сессий ниже")
+    parser.add_argument("--server-logs", action="store_true", help="выводить логи релея при --spawn")
+    parser.add_argument("--db-delay-ms", type=float, default=0.0, help="задержка каждого запроса релея к БД через TCP-прокси (--spawn)")
+    args = parser.parse_args()
+    if args.db_delay_ms and not args.spawn:
+        parser.error("--db-delay-ms работает только с --spawn (релей должен подключаться к БД через прокси)")
+
+    # Тысячи сокетов упираются в лимит файловых дескрипторов
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    processes = ()
+    pid = args.server_pid
+    base_url = args.url.rstrip("/")
+    if args.spawn:
+        processes = spawn(args)
+        pid = processes[1].pid
+        base_url = f"ws://127.0.0.1:{args.port}"
+    try:
+        assistant_id = args.assistant_id or create_assistant(base_url.replace("ws://", "http://").replace("wss://", "https://"))
+        url = f"{base_url}/ws/{assistant_id}" + ("?audio=binary" if args.binary else "")
+        sessions, samples, frame_seconds = asyncio.run(run_load(args, url, pid))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(timeout=15)
+
+    report = build_report(args, sessions, samples, frame_seconds)
+    print_report(report)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    p99 = report["downstream_latency_ms"]["p99"]
+    if args.max_p99_ms is not None and (p99 is None or p99 > args.max_p99_ms):
+        sys.exit(1)
+    if report["sustained"] < args.min_sustained * args.sessions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
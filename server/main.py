@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import base64
 import asyncio
@@ -6,12 +7,34 @@ import logging
 import traceback
 import uuid
 import time
-from datetime import datetime
-from typing import Dict, Optional, List, Any, Union
+import random
+import socket
+import hmac
+import hashlib
+import html
+import csv
+import codecs
+import multiprocessing
+import re
+import shutil
+import glob
+import zlib
+import ipaddress
+import threading
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque, OrderedDict
+from datetime import datetime, timezone
+from urllib.parse import quote, urlsplit
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from typing import Dict, Optional, List, Any, Union, NamedTuple, Callable, Tuple
 import httpx
+import asyncpg
+import ujson
+import numpy as np
 
 from fastapi import FastAPI, WebSocket, Request, WebSocketDisconnect, HTTPException, Depends, Header, Body, UploadFile, File, Form
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
@@ -19,13 +42,27 @@ from dotenv import load_dotenv
 from pydantic import BaseModel, Field, validator
 
 # Для PostgreSQL и ORM
-from sqlalchemy import create_engine, Column, String, Boolean, JSON, ForeignKey, Float, DateTime, Text, Integer
+from sqlalchemy import Column, String, Boolean, JSON, ForeignKey, Float, DateTime, Date, Text, Integer, LargeBinary, select, insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import relationship
+from sqlalchemy.dialects.postgresql import UUID, insert as pg_insert
 import sqlalchemy as sa
 from sqlalchemy.sql import func
 
+# Потоковый разбор multipart (пакет python-multipart; в старых версиях модуль называется multipart)
+try:
+    import python_multipart as multipart
+    from python_multipart.multipart import parse_options_header
+except ImportError:
+    import multipart
+    from multipart.multipart import parse_options_header
+
+# Миграции схемы БД
+from alembic.config import Config as AlembicConfig
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+
 # Для WebSocket
 import websockets
 
@@ -45,8 +82,9 @@ load_dotenv()
 # Конфигурация приложения
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 PORT = int(os.getenv('PORT', 5050))
-REALTIME_WS_URL = 'wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01'
+REALTIME_WS_URL = os.getenv('REALTIME_WS_URL', 'wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01')
 DATABASE_URL = os.getenv('DATABASE_URL')  # URL для PostgreSQL на Render
+ALEMBIC_INI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini")  # Конфигурация миграций схемы БД
 DEFAULT_SYSTEM_MESSAGE = (
     "Ты умный голосовой помощник. Отвечай на вопросы пользователя коротко, "
     "информативно и с небольшой ноткой юмора, когда это уместно. Стремись быть полезным "
@@ -60,10 +98,152 @@ WS_PING_TIMEOUT = 60   # Таймаут для ping (в секундах)
 WS_CLOSE_TIMEOUT = 30  # Таймаут для закрытия соединения (в секундах)
 WS_MAX_MSG_SIZE = 15 * 1024 * 1024  # Максимальный размер сообщения (15MB)
 MAX_RECONNECT_ATTEMPTS = 5  # Максимальное количество попыток переподключения
+RECONNECT_BASE_DELAY = float(os.getenv('RECONNECT_BASE_DELAY', 0.25))  # Задержка первой повторной попытки (удваивается, со случайным разбросом)
+RECONNECT_MAX_DELAY = float(os.getenv('RECONNECT_MAX_DELAY', 8))       # Максимальная задержка между попытками (в секундах)
+RECONNECT_HEALTHY_SECONDS = float(os.getenv('RECONNECT_HEALTHY_SECONDS', 30))  # Проработавшая столько после session.updated сессия сбрасывает счетчик попыток
+
+# Восстановление сессии OpenAI после обрыва соединения
+RESUME_TRANSCRIPT_MAX_ITEMS = int(os.getenv('RESUME_TRANSCRIPT_MAX_ITEMS', 20))    # Сколько последних реплик переносится в новую сессию
+RESUME_TRANSCRIPT_MAX_CHARS = int(os.getenv('RESUME_TRANSCRIPT_MAX_CHARS', 8000))  # Предел суммарной длины переносимых реплик
+RESUME_AUDIO_BUFFER_MS = int(os.getenv('RESUME_AUDIO_BUFFER_MS', 5000))  # Сколько последнего аудио клиента за время обрыва отправляется в новую сессию
+INPUT_TRANSCRIPTION_MODEL = os.getenv('INPUT_TRANSCRIPTION_MODEL', 'whisper-1')  # Распознавание речи пользователя для истории разговора (пусто - выключено)
+
+# Параметры server_vad, которые отправляются в OpenAI при настройке сессии
+VAD_PREFIX_PADDING_MS = 200    # Сколько аудио до начала речи OpenAI включает в ход пользователя
+VAD_SILENCE_DURATION_MS = 300  # Сколько тишины нужно OpenAI, чтобы завершить ход пользователя
+
+# Серверное подавление тишины во входном аудио (значения по умолчанию, переопределяются в audio_settings ассистента)
+SILENCE_GATE_ENABLED = os.getenv('SILENCE_GATE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+SILENCE_GATE_THRESHOLD_DBFS = float(os.getenv('SILENCE_GATE_THRESHOLD_DBFS', -50))  # Кадры тише этого уровня (RMS) считаются тишиной
+SILENCE_GATE_PRE_ROLL_MS = int(os.getenv('SILENCE_GATE_PRE_ROLL_MS', 300))          # Тишина перед речью, которая все равно отправляется
+SILENCE_GATE_HANGOVER_MS = int(os.getenv('SILENCE_GATE_HANGOVER_MS', 700))          # Тишина после речи, которая все равно отправляется
+
+# Ограниченные очереди отправки релея (на каждое соединение и направление)
+RELAY_QUEUE_MAX_BYTES = int(os.getenv('RELAY_QUEUE_MAX_BYTES', 2 * 1024 * 1024))           # Предел очереди одного направления в байтах
+RELAY_DOWNSTREAM_OVERFLOW = os.getenv('RELAY_DOWNSTREAM_OVERFLOW', 'drop_audio,coalesce_text')  # Политика очереди OpenAI -> клиент
+RELAY_UPSTREAM_OVERFLOW = os.getenv('RELAY_UPSTREAM_OVERFLOW', 'drop_audio')                # Политика очереди клиент -> OpenAI
+
+# Реестр realtime-сессий (memory - только текущий воркер, postgres - общий для всех воркеров и узлов)
+SESSION_REGISTRY_BACKEND = os.getenv('SESSION_REGISTRY_BACKEND', 'postgres')
+SESSION_HEARTBEAT_INTERVAL = float(os.getenv('SESSION_HEARTBEAT_INTERVAL', 10))  # Период продления сессий воркера в реестре (в секундах)
+
+# Лимиты тарифов (subscription_plan) для допуска realtime-сессий, 0 - без ограничения.
+# Переопределяются JSON-объектом в PLAN_LIMITS, например {"free": {"max_sessions": 3}}
+DEFAULT_PLAN_LIMITS = {
+    "free": {"max_sessions": 5, "max_sessions_per_assistant": 5, "audio_bytes_per_sec": 96000, "max_session_minutes": 15, "daily_minutes": 120},
+    "start": {"max_sessions": 20, "max_sessions_per_assistant": 10, "audio_bytes_per_sec": 96000, "max_session_minutes": 30, "daily_minutes": 1200},
+    "pro": {"max_sessions": 100, "max_sessions_per_assistant": 50, "audio_bytes_per_sec": 96000, "max_session_minutes": 60, "daily_minutes": 0},
+}
+PLAN_LIMITS_JSON = os.getenv('PLAN_LIMITS', '')
+ADMISSION_REJECT_CACHE_TTL = float(os.getenv('ADMISSION_REJECT_CACHE_TTL', 2))  # Сколько помнить отказ, не обращаясь к реестру (в секундах)
+
+# Пул заранее открытых соединений с OpenAI Realtime (на каждый API ключ)
+OPENAI_WS_POOL_SIZE = int(os.getenv('OPENAI_WS_POOL_SIZE', 1))            # Число готовых соединений на ключ (0 - пул отключен)
+OPENAI_WS_POOL_MAX_IDLE = float(os.getenv('OPENAI_WS_POOL_MAX_IDLE', 60))  # Максимальный возраст простаивающего соединения (в секундах)
+OPENAI_WS_POOL_MAX_KEYS = int(os.getenv('OPENAI_WS_POOL_MAX_KEYS', 100))   # Максимальное число ключей в пуле (LRU)
+OPENAI_WS_POOL_KEY_TTL = float(os.getenv('OPENAI_WS_POOL_KEY_TTL', 600))   # Перестаем пополнять пул ключа, который не использовался столько секунд
+
+# Настройки фоновой (write-behind) записи диалогов в БД
+CONVERSATION_QUEUE_SIZE = int(os.getenv('CONVERSATION_QUEUE_SIZE', 10000))       # Максимальный размер очереди записей
+CONVERSATION_BATCH_SIZE = int(os.getenv('CONVERSATION_BATCH_SIZE', 200))         # Максимальное число строк в одном INSERT
+CONVERSATION_FLUSH_INTERVAL_MS = int(os.getenv('CONVERSATION_FLUSH_INTERVAL_MS', 500))  # Максимальная задержка записи
+CONVERSATION_SPILL_PATH = os.getenv('CONVERSATION_SPILL_PATH', 'conversation_spill.jsonl')  # Файл для сброса при отставании БД (пусто - отбрасывать)
+
+# Настройки кэша конфигурации ассистентов на пути подключения WebSocket
+ASSISTANT_CACHE_TTL = float(os.getenv('ASSISTANT_CACHE_TTL', 60))              # Время жизни записи (в секундах)
+ASSISTANT_CACHE_MAX_SIZE = int(os.getenv('ASSISTANT_CACHE_MAX_SIZE', 10000))   # Максимальное число записей (LRU)
+# Межворкерная инвалидация кэшей через Postgres LISTEN/NOTIFY
+CACHE_INVALIDATION_NOTIFY = os.getenv('CACHE_INVALIDATION_NOTIFY', 'false').lower() in ('1', 'true', 'yes')
+CACHE_INVALIDATION_CHANNEL = 'wellcome_cache_invalidation'
+
+# Настройки кэша проверенных JWT токенов
+AUTH_CACHE_MAX_SIZE = int(os.getenv('AUTH_CACHE_MAX_SIZE', 10000))   # Максимальное число токенов в кэше (LRU)
+AUTH_CACHE_MAX_TTL = float(os.getenv('AUTH_CACHE_MAX_TTL', 300))     # Максимальное время жизни записи (не дольше exp токена)
+REVOKED_TOKENS_POLL_INTERVAL = float(os.getenv('REVOKED_TOKENS_POLL_INTERVAL', 5))  # Как часто перечитывать новые отзывы токенов из БД (в секундах)
+
+# Трассировка задержек по ходам диалога
+TURN_TRACE_SAMPLE_RATE = float(os.getenv('TURN_TRACE_SAMPLE_RATE', 0.1))  # Доля ходов, для которых сохраняется трасса (0 - выключено)
+
+# База знаний ассистентов (поиск по фрагментам документов как инструмент realtime-сессии)
+KNOWLEDGE_EMBEDDING_MODEL = os.getenv('KNOWLEDGE_EMBEDDING_MODEL', 'text-embedding-3-small')  # Модель эмбеддингов OpenAI ('hash' - локальная, без сети)
+KNOWLEDGE_EMBEDDING_DIM = int(os.getenv('KNOWLEDGE_EMBEDDING_DIM', 256))       # Размерность эмбеддингов
+KNOWLEDGE_INDEX_DIR = os.getenv('KNOWLEDGE_INDEX_DIR', 'knowledge_index')       # Каталог файлов индексов (строятся заново по данным БД)
+KNOWLEDGE_INDEX_CACHE_SIZE = int(os.getenv('KNOWLEDGE_INDEX_CACHE_SIZE', 32))   # Сколько индексов держать открытыми (LRU)
+KNOWLEDGE_INDEX_IDLE_TTL = float(os.getenv('KNOWLEDGE_INDEX_IDLE_TTL', 3600))   # Индекс без обращений закрывается через (в секундах)
+KNOWLEDGE_INDEX_CHECK_INTERVAL = float(os.getenv('KNOWLEDGE_INDEX_CHECK_INTERVAL', 5))  # Как часто сверять версию открытого индекса с БД (в секундах)
+KNOWLEDGE_IVF_MIN_CHUNKS = int(os.getenv('KNOWLEDGE_IVF_MIN_CHUNKS', 4096))     # С какого числа фрагментов индекс разбивается на кластеры
+KNOWLEDGE_IVF_PROBES = int(os.getenv('KNOWLEDGE_IVF_PROBES', 12))               # Сколько ближайших кластеров просматривает поиск
+KNOWLEDGE_SEARCH_TOP_K = int(os.getenv('KNOWLEDGE_SEARCH_TOP_K', 4))            # Фрагментов в ответе инструмента
+KNOWLEDGE_TOOL_MAX_CHARS = int(os.getenv('KNOWLEDGE_TOOL_MAX_CHARS', 4000))     # Предел длины ответа инструмента
+# Вызовы функций ассистента, выполняемые сервером (webhook и встроенные)
+TOOL_CALL_TIMEOUT = float(os.getenv('TOOL_CALL_TIMEOUT', 8))                   # Таймаут вызова по умолчанию (в секундах)
+TOOL_CALL_MAX_TIMEOUT = float(os.getenv('TOOL_CALL_MAX_TIMEOUT', 30))          # Предельный таймаут, задаваемый в описании функции
+TOOL_CALL_MAX_CONCURRENCY = int(os.getenv('TOOL_CALL_MAX_CONCURRENCY', 64))    # Одновременных вызовов на воркер
+TOOL_OUTPUT_MAX_CHARS = int(os.getenv('TOOL_OUTPUT_MAX_CHARS', 8000))          # Предел длины результата, отправляемого модели
+# Разрешить webhook по http и на внутренние адреса (loopback, частные сети) - только для разработки и тестов
+TOOL_WEBHOOK_ALLOW_PRIVATE = os.getenv('TOOL_WEBHOOK_ALLOW_PRIVATE', 'false').lower() in ('1', 'true', 'yes')
+TOOL_CACHE_MAX_TTL = float(os.getenv('TOOL_CACHE_MAX_TTL', 86400))             # Предельное время жизни результата в кэше функции (в секундах)
+TOOL_CACHE_MAX_SIZE = int(os.getenv('TOOL_CACHE_MAX_SIZE', 10000))             # Предельное число результатов в кэше одной функции
+TOOL_CACHE_DEFAULT_SIZE = int(os.getenv('TOOL_CACHE_DEFAULT_SIZE', 1000))      # Размер кэша функции, если max_size не задан
+TOOL_CACHE_ASSISTANTS = int(os.getenv('TOOL_CACHE_ASSISTANTS', 1000))          # Ассистентов с кэшем результатов на воркер (LRU)
+TOOL_CACHE_IDLE_TTL = float(os.getenv('TOOL_CACHE_IDLE_TTL', 86400))           # Кэш ассистента без вызовов удаляется через (в секундах)
+TOOL_CACHE_GENERATION_TTL = float(os.getenv('TOOL_CACHE_GENERATION_TTL', 5))   # Как часто сверять поколение кэша функций с БД (в секундах)
+KNOWLEDGE_MAX_FILE_MB = int(os.getenv('KNOWLEDGE_MAX_FILE_MB', 50))             # Предельный размер загружаемого документа
+KNOWLEDGE_INGEST_PROCESSES = int(os.getenv('KNOWLEDGE_INGEST_PROCESSES', 2))    # Процессов для разбора документов (на воркер)
+KNOWLEDGE_INGEST_BLOCK_CHARS = int(os.getenv('KNOWLEDGE_INGEST_BLOCK_CHARS', 256 * 1024))  # Текста в одном задании разбора
+KNOWLEDGE_INGEST_BATCH = int(os.getenv('KNOWLEDGE_INGEST_BATCH', 256))          # Фрагментов в пакете эмбеддинга и записи в БД
+KNOWLEDGE_CHUNK_MIN_CHARS = int(os.getenv('KNOWLEDGE_CHUNK_MIN_CHARS', 400))    # Минимальная длина фрагмента
+KNOWLEDGE_CHUNK_MAX_CHARS = int(os.getenv('KNOWLEDGE_CHUNK_MAX_CHARS', 1500))   # Максимальная длина фрагмента
+KNOWLEDGE_FILE_PART_BYTES = 1024 * 1024                                         # Исходный файл хранится в БД частями такого размера
+
+# Запись диалогов и заявок в Google Таблицу ассистента (google_sheet_id, доступ по google_sheets_token владельца)
+GOOGLE_SHEETS_API_URL = os.getenv('GOOGLE_SHEETS_API_URL', 'https://sheets.googleapis.com')  # Адрес Sheets API (в тестах - локальная заглушка)
+GOOGLE_OAUTH_TOKEN_URL = os.getenv('GOOGLE_OAUTH_TOKEN_URL', 'https://oauth2.googleapis.com/token')  # Обновление access_token по refresh_token
+GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID', '')
+GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET', '')
+GOOGLE_SHEETS_CONVERSATIONS_RANGE = os.getenv('GOOGLE_SHEETS_CONVERSATIONS_RANGE', 'A1')  # Лист для диалогов (A1 - первый лист)
+GOOGLE_SHEETS_LEADS_RANGE = os.getenv('GOOGLE_SHEETS_LEADS_RANGE', 'A1')                  # Лист для заявок (например, Заявки!A1)
+GOOGLE_SHEETS_FLUSH_INTERVAL_MS = int(os.getenv('GOOGLE_SHEETS_FLUSH_INTERVAL_MS', 2000))  # Как часто отправлять накопленные строки
+GOOGLE_SHEETS_BATCH_ROWS = int(os.getenv('GOOGLE_SHEETS_BATCH_ROWS', 500))               # Строк в одном запросе append
+GOOGLE_SHEETS_MAX_PENDING_ROWS = int(os.getenv('GOOGLE_SHEETS_MAX_PENDING_ROWS', 5000))   # Предел неотправленных строк на лист (дальше - отбрасываются)
+GOOGLE_SHEETS_MAX_RETRIES = int(os.getenv('GOOGLE_SHEETS_MAX_RETRIES', 8))               # Повторов пачки при 429/5xx до отказа от нее
+GOOGLE_SHEETS_BACKOFF_MAX = float(os.getenv('GOOGLE_SHEETS_BACKOFF_MAX', 120))           # Предельная пауза перед повтором (в секундах)
 
-# Настройка PostgreSQL
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Метрики в формате Prometheus (/metrics)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')                  # Bearer-токен для сборщика метрик (пусто - /metrics отключен)
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.05))  # Период замера задержки цикла событий (в секундах)
+
+# Сторожевой поток цикла событий: стеки обработчиков, надолго занявших цикл
+LOOP_WATCHDOG_ENABLED = os.getenv('LOOP_WATCHDOG_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+LOOP_WATCHDOG_THRESHOLD_MS = int(os.getenv('LOOP_WATCHDOG_THRESHOLD_MS', 100))  # Сколько цикл может не отвечать до снятия стека
+LOOP_WATCHDOG_BUFFER_SIZE = int(os.getenv('LOOP_WATCHDOG_BUFFER_SIZE', 100))    # Сколько последних зависаний хранить для администраторов
+
+# Администраторы сервиса (доступ к метрикам и служебным эндпоинтам)
+ADMIN_EMAILS = {email.strip().lower() for email in os.getenv('ADMIN_EMAILS', '').split(',') if email.strip()}
+
+# Настройки пула соединений с PostgreSQL
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 20))
+
+def get_async_database_url(url: str) -> str:
+    """
+    Приводит DATABASE_URL от Render (postgres://...) к формату драйвера asyncpg.
+    """
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    if url.startswith("postgresql://"):
+        url = "postgresql+asyncpg://" + url[len("postgresql://"):]
+    # asyncpg не понимает параметр sslmode из libpq
+    return url.replace("sslmode=", "ssl=")
+
+# Настройка PostgreSQL (асинхронный движок, чтобы запросы не блокировали event loop)
+engine = create_async_engine(
+    get_async_database_url(DATABASE_URL),
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True
+)
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False, autoflush=False)
 Base = declarative_base()
 
 # Модели SQLAlchemy
@@ -88,6 +268,8 @@ class User(Base):
 
 class AssistantConfig(Base):
     __tablename__ = "assistant_configs"
+    # Постраничный список ассистентов пользователя (keyset по created_at, id)
+    __table_args__ = (sa.Index("ix_assistant_configs_user_created", "user_id", "created_at", "id"),)
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"))
@@ -98,16 +280,20 @@ class AssistantConfig(Base):
     language = Column(String, default="ru")
     google_sheet_id = Column(String, nullable=True)
     functions = Column(JSON, nullable=True)
+    audio_settings = Column(JSON, nullable=True)  # Настройки обработки входного аудио (подавление тишины)
+    tool_cache_generation = Column(Integer, nullable=False, default=0, server_default="0")  # Растет при сбросе кэша функций
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
     user = relationship("User", back_populates="assistants")
-    conversations = relationship("Conversation", back_populates="assistant", cascade="all, delete-orphan")
+    conversations = relationship("Conversation", back_populates="assistant", cascade="all, delete-orphan", passive_deletes=True)
 
 
 class Conversation(Base):
     __tablename__ = "conversations"
+    # История диалогов ассистента (keyset по created_at, id в обратном порядке)
+    __table_args__ = (sa.Index("ix_conversations_assistant_created", "assistant_id", "created_at", "id"),)
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     assistant_id = Column(UUID(as_uuid=True), ForeignKey("assistant_configs.id", ondelete="CASCADE"))
@@ -120,6 +306,121 @@ class Conversation(Base):
     assistant = relationship("AssistantConfig", back_populates="conversations")
 
 
+class ConversationDailyStats(Base):
+    """Суточная сводка диалогов ассистента; обновляется писателем диалогов в одной транзакции с записью пачки"""
+    __tablename__ = "conversation_daily_stats"
+
+    assistant_id = Column(UUID(as_uuid=True), ForeignKey("assistant_configs.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)  # Сутки по UTC
+    conversations = Column(Integer, nullable=False, default=0)
+    total_duration_seconds = Column(Float, nullable=False, default=0.0)
+
+
+class KnowledgeFile(Base):
+    """Загруженный документ базы знаний; повторная загрузка документа с тем же именем заменяет прежнюю"""
+    __tablename__ = "knowledge_files"
+    __table_args__ = (sa.Index("ix_knowledge_files_assistant_name", "assistant_id", "name"),)
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    assistant_id = Column(UUID(as_uuid=True), ForeignKey("assistant_configs.id", ondelete="CASCADE"), nullable=False)
+    name = Column(String, nullable=False)
+    content_type = Column(String, nullable=True)
+    size = Column(sa.BigInteger, nullable=False, default=0)            # Получено байт (во время загрузки растет)
+    expected_size = Column(sa.BigInteger, nullable=True)               # Размер по Content-Length запроса
+    status = Column(String, nullable=False, default="uploading")       # uploading, indexing, ready, failed
+    chunks = Column(Integer, nullable=False, default=0)                # Фрагментов в документе
+    new_chunks = Column(Integer, nullable=False, default=0)            # Из них разобрано и проиндексировано заново
+    error = Column(Text, nullable=True)
+    uploaded_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class KnowledgeFilePart(Base):
+    """Часть исходного файла документа (для скачивания)"""
+    __tablename__ = "knowledge_file_parts"
+
+    file_id = Column(UUID(as_uuid=True), ForeignKey("knowledge_files.id", ondelete="CASCADE"), primary_key=True)
+    part = Column(Integer, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+
+
+class KnowledgeChunk(Base):
+    """Фрагмент документа базы знаний ассистента с эмбеддингом"""
+    __tablename__ = "knowledge_chunks"
+    __table_args__ = (sa.Index("ix_knowledge_chunks_assistant_source", "assistant_id", "source", "position"),)
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    assistant_id = Column(UUID(as_uuid=True), ForeignKey("assistant_configs.id", ondelete="CASCADE"), nullable=False)
+    file_id = Column(UUID(as_uuid=True), ForeignKey("knowledge_files.id", ondelete="CASCADE"), nullable=True, index=True)
+    content_hash = Column(String(40), nullable=True)  # sha1 текста: по нему повторная загрузка переиспользует эмбеддинг
+    source = Column(String, nullable=False)        # Документ, из которого взят фрагмент
+    position = Column(Integer, nullable=False)     # Порядковый номер фрагмента в документе
+    text = Column(Text, nullable=False)
+    embedding = Column(LargeBinary, nullable=False)  # Нормированный вектор float32
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class KnowledgeBase(Base):
+    """Версия базы знаний ассистента: по ней воркеры узнают, что файлы индекса устарели"""
+    __tablename__ = "knowledge_bases"
+
+    assistant_id = Column(UUID(as_uuid=True), ForeignKey("assistant_configs.id", ondelete="CASCADE"), primary_key=True)
+    revision = Column(Integer, nullable=False, default=1)
+    embedding_model = Column(String, nullable=False)
+    dim = Column(Integer, nullable=False)
+    chunks = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class TurnTrace(Base):
+    """Трасса задержек одного хода диалога (для доли ходов TURN_TRACE_SAMPLE_RATE), все интервалы в миллисекундах"""
+    __tablename__ = "turn_traces"
+    __table_args__ = (sa.Index("ix_turn_traces_assistant_created", "assistant_id", "created_at"),)
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    assistant_id = Column(UUID(as_uuid=True), ForeignKey("assistant_configs.id", ondelete="CASCADE"))
+    # Без внешнего ключа: диалог и трасса пишутся разными фоновыми писателями в произвольном порядке
+    conversation_id = Column(UUID(as_uuid=True), nullable=True)
+    speech_ms = Column(Float, nullable=True)            # speech_started -> speech_stopped (речь пользователя)
+    response_created_ms = Column(Float, nullable=True)  # speech_stopped -> response.created
+    first_audio_ms = Column(Float, nullable=True)       # speech_stopped -> первый response.audio.delta от OpenAI
+    relay_queue_ms = Column(Float, nullable=True)       # Ожидание первого аудиокадра в очереди релея к клиенту
+    client_send_ms = Column(Float, nullable=True)       # Отправка первого аудиокадра в сокет клиента
+    total_ms = Column(Float, nullable=True)             # speech_stopped -> первый аудиокадр отправлен клиенту
+    response_done_ms = Column(Float, nullable=True)     # speech_stopped -> response.done
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+
+    jti = Column(String, primary_key=True)
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"))
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class RelaySession(Base):
+    __tablename__ = "relay_sessions"
+
+    id = Column(UUID(as_uuid=True), primary_key=True)
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    assistant_id = Column(UUID(as_uuid=True), ForeignKey("assistant_configs.id", ondelete="CASCADE"), index=True)
+    worker = Column(String, nullable=False, index=True)  # Воркер, который обслуживает сессию
+    client_host = Column(String, nullable=True)
+    kill_requested = Column(Boolean, default=False)
+    started_at = Column(DateTime(timezone=True), server_default=func.now())
+    last_seen_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+
+class SessionUsage(Base):
+    __tablename__ = "session_usage"
+
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)  # Сутки по UTC
+    seconds = Column(Float, nullable=False, default=0.0)
+
+
 # Допустимые голоса с русскими названиями для интерфейса
 AVAILABLE_VOICES = ["alloy", "ash", "ballad", "coral", "echo", "sage", "shimmer", "verse"]
 VOICE_NAMES = {
@@ -208,12 +509,9 @@ if not OPENAI_API_KEY:
     logger.warning('Отсутствует ключ API OpenAI по умолчанию. Пользователи должны будут предоставить свои ключи.')
 
 # Функция для получения сессии БД
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # Схемы данных
 
@@ -238,7 +536,27 @@ class UserUpdate(BaseModel):
 class TokenData(BaseModel):
     sub: str
     exp: int
+    jti: Optional[str] = None
+    
+# Настройки серверной обработки входного аудио ассистента (не заданные поля берутся из окружения)
+class AudioSettings(BaseModel):
+    silence_gate: Optional[bool] = None             # Не пересылать тишину в OpenAI
+    silence_threshold_dbfs: Optional[float] = None  # Порог тишины по RMS, дБFS
+    pre_roll_ms: Optional[int] = None               # Тишина перед речью, которая все равно отправляется
+    hangover_ms: Optional[int] = None               # Тишина после речи, которая все равно отправляется
+    
+    @validator('silence_threshold_dbfs')
+    def validate_threshold(cls, v):
+        if v is not None and not -100 <= v <= 0:
+            raise ValueError('Порог тишины должен быть в диапазоне от -100 до 0 дБFS')
+        return v
     
+    @validator('pre_roll_ms', 'hangover_ms')
+    def validate_duration(cls, v):
+        if v is not None and not 0 <= v <= 5000:
+            raise ValueError('Длительность должна быть в диапазоне от 0 до 5000 мс')
+        return v
+
 # Конфигурация ассистента
 class AssistantCreate(BaseModel):
     name: str
@@ -248,12 +566,18 @@ class AssistantCreate(BaseModel):
     language: str = "ru"
     google_sheet_id: Optional[str] = None
     functions: Optional[List[Dict[str, Any]]] = None
+    audio_settings: Optional[AudioSettings] = None
     
     @validator('voice')
     def validate_voice(cls, v):
         if v not in AVAILABLE_VOICES:
             raise ValueError(f'Голос должен быть одним из {", ".join(AVAILABLE_VOICES)}')
         return v
+    
+    @validator('functions')
+    def validate_functions(cls, v):
+        validate_function_handlers(v)
+        return v
 
 class AssistantUpdate(BaseModel):
     name: Optional[str] = None
@@ -263,6 +587,7 @@ class AssistantUpdate(BaseModel):
     language: Optional[str] = None
     google_sheet_id: Optional[str] = None
     functions: Optional[List[Dict[str, Any]]] = None
+    audio_settings: Optional[AudioSettings] = None
     is_active: Optional[bool] = None
     
     @validator('voice')
@@ -270,10 +595,454 @@ class AssistantUpdate(BaseModel):
         if v is not None and v not in AVAILABLE_VOICES:
             raise ValueError(f'Голос должен быть одним из {", ".join(AVAILABLE_VOICES)}')
         return v
+    
+    @validator('functions')
+    def validate_functions(cls, v):
+        validate_function_handlers(v)
+        return v
+
+# Ответы API с конфигурацией ассистента
+ASSISTANT_FIELDS = (
+    "id", "user_id", "name", "description", "system_prompt", "voice", "language",
+    "google_sheet_id", "functions", "audio_settings", "is_active", "created_at", "updated_at"
+)
+ASSISTANT_LIST_MAX_LIMIT = 200  # Максимальный размер страницы списка ассистентов
+
+# Ответы API с историей диалогов
+CONVERSATION_FIELDS = ("id", "assistant_id", "user_message", "assistant_message", "duration_seconds", "client_info", "created_at")
+CONVERSATION_PAGE_SIZE = 50        # Размер страницы истории по умолчанию
+CONVERSATION_PAGE_MAX_LIMIT = 200  # Максимальный размер страницы истории
+CONVERSATION_STATS_MAX_DAYS = 366  # Максимальный период суточной статистики
+
+def serialize_assistant(assistant, fields = ASSISTANT_FIELDS) -> Dict[str, Any]:
+    """Ассистент (модель или строка выборки с нужными колонками) в словарь для JSON-ответа"""
+    return serialize_row(assistant, fields)
+
+def serialize_row(row, fields) -> Dict[str, Any]:
+    """Модель или строка выборки в словарь для JSON-ответа (UUID и даты - строками)"""
+    data = {}
+    for field in fields:
+        value = getattr(row, field)
+        if isinstance(value, uuid.UUID):
+            value = str(value)
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        data[field] = value
+    return data
+
+def parse_assistant_fields(fields: Optional[str], exclude: Optional[str]) -> tuple:
+    """Проекция полей списка ассистентов из параметров fields/exclude (id присутствует всегда)"""
+    selected = set(ASSISTANT_FIELDS)
+    requested = set()
+    if fields:
+        selected = {field.strip() for field in fields.split(",") if field.strip()}
+        requested |= selected
+    if exclude:
+        excluded = {field.strip() for field in exclude.split(",") if field.strip()}
+        requested |= excluded
+        selected -= excluded
+    unknown = requested - set(ASSISTANT_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестные поля: {', '.join(sorted(unknown))}")
+    selected.add("id")
+    return tuple(field for field in ASSISTANT_FIELDS if field in selected)
+
+def make_etag(*parts) -> str:
+    """Слабый ETag из версии данных (например, id и времени последнего изменения)"""
+    digest = hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()
+    return f'W/"{digest[:24]}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Проверка заголовка If-None-Match (слабое сравнение)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag.removeprefix("W/") in tags
+
+def cached_json_response(payload, etag: str, headers: Optional[Dict[str, str]] = None) -> Response:
+    """JSON-ответ (сериализация ujson) с ETag; браузер перепроверяет его через If-None-Match"""
+    return Response(
+        content=ujson.dumps(payload, ensure_ascii=False),
+        media_type="application/json",
+        headers={"ETag": etag, "Cache-Control": "private, no-cache", **(headers or {})}
+    )
+
+def not_modified_response(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+def encode_keyset_cursor(created_at: datetime, row_id) -> str:
+    """Курсор keyset-пагинации: позиция (created_at, id) последней строки страницы"""
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{row_id}".encode()).decode().rstrip("=")
+
+def decode_keyset_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.split("|")
+        return datetime.fromisoformat(created_at), uuid.UUID(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
 
 # Хранилище активных соединений клиент <-> OpenAI
 client_connections = {}
 
+# Предсериализованный шаблон события append для бинарных аудиокадров от виджета
+# (бинарный протокол включается параметром ?audio=binary при подключении к /ws/{assistant_id})
+AUDIO_APPEND_PREFIX = '{"type":"input_audio_buffer.append","audio":"'
+AUDIO_APPEND_SUFFIX = '"}'
+
+# События, которые релей разбирает полностью; остальные (в том числе аудио) пересылаются без JSON-парсинга
+CLIENT_EVENTS_TO_PARSE = {
+    "ping",
+    "relay.audio_format"
+}
+OPENAI_EVENTS_TO_PARSE = {
+    "response.text.delta",
+    "response.text.done",
+    "response.done",
+    "input_audio_buffer.committed",
+    "conversation.item.input_audio_transcription.completed",
+    "response.function_call_arguments.done"
+}
+
+def sniff_event_type(message: str) -> Optional[str]:
+    """
+    Быстро извлекает значение поля type верхнего уровня из начала JSON-сообщения
+    без полного разбора. Возвращает None, если тип не удалось надежно определить.
+    """
+    head = message[:160]
+    key = head.find('"type"')
+    # Поле должно принадлежать объекту верхнего уровня: до него не должно быть вложенных объектов
+    if key == -1 or head.find('{', 1, key) != -1:
+        return None
+    colon = head.find(':', key + 6)
+    if colon == -1 or head[key + 6:colon].strip():
+        return None
+    quote = head.find('"', colon + 1)
+    if quote == -1 or head[colon + 1:quote].strip():
+        return None
+    end = head.find('"', quote + 1)
+    if end == -1:
+        return None
+    # Экранирование в значении: кавычка могла быть частью строки, тип определит полный разбор
+    value = head[quote + 1:end]
+    return None if '\\' in value else value
+
+def extract_string_field(message: str, field: str) -> Optional[str]:
+    """
+    Достает строковое значение поля без полного разбора JSON.
+    Подходит только для значений без экранирования (base64, идентификаторы):
+    для остальных возвращает None.
+    """
+    quoted = f'"{field}"'
+    key = message.find(quoted)
+    while key != -1:
+        key_end = key + len(quoted)
+        colon = message.find(':', key_end)
+        if colon != -1 and not message[key_end:colon].strip():
+            break
+        # Совпадение оказалось значением другого поля (например, "event_id":"audio") - ищем ключ дальше
+        key = message.find(quoted, key_end)
+    if key == -1:
+        return None
+    quote = message.find('"', colon + 1)
+    if quote == -1 or message[colon + 1:quote].strip():
+        return None
+    end = message.find('"', quote + 1)
+    if end == -1:
+        return None
+    value = message[quote + 1:end]
+    return None if '\\' in value else value
+
+def extract_audio_delta(message: str) -> Optional[str]:
+    """Достает base64-строку delta из response.audio.delta без полного разбора JSON"""
+    return extract_string_field(message, "delta")
+
+# Формат аудио, который объявляет send_session_update для OpenAI: PCM16, 24 кГц, моно
+TARGET_SAMPLE_RATE = 24000
+SUPPORTED_INPUT_SAMPLE_RATES = {8000, 11025, 16000, 22050, 24000, 32000, 44100, 48000, 96000}
+AUDIO_ENCODINGS = {"pcm16": np.dtype('<i2'), "float32": np.dtype('<f4')}
+AUDIO_LOWPASS_CUTOFF_HZ = 10900  # Срез ФНЧ перед понижением частоты: полоса задерживания начинается ниже 12 кГц (Найквист 24 кГц)
+
+def design_lowpass(sample_rate: int, cutoff_hz: float) -> np.ndarray:
+    """КИХ-фильтр нижних частот: sinc с окном Блэкмана, переходная полоса около 2 кГц при любой частоте входа"""
+    taps = int(64 * sample_rate / TARGET_SAMPLE_RATE) | 1
+    n = np.arange(taps) - (taps - 1) / 2
+    fc = cutoff_hz / sample_rate
+    kernel = 2 * fc * np.sinc(2 * fc * n) * np.blackman(taps)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+class AudioConverter:
+    """
+    Потоковое преобразование входного аудио клиента в PCM16 24 кГц моно.
+    Принимает PCM16 или Float32 с любой распространенной частотой и числом каналов,
+    сводит каналы в моно и передискретизирует линейной интерполяцией. При понижении
+    частоты перед интерполяцией работает КИХ-фильтр нижних частот: без него шум микрофона
+    и шипящие выше 12 кГц отражались бы в полосу речи. Между кадрами сохраняется состояние
+    (хвост входа фильтра, последний сэмпл и дробная позиция), поэтому на стыках кадров
+    не возникает щелчков. Все операции векторизованы в NumPy.
+    """
+
+    def __init__(self, sample_rate: int = TARGET_SAMPLE_RATE, channels: int = 1, encoding: str = "pcm16"):
+        if sample_rate not in SUPPORTED_INPUT_SAMPLE_RATES:
+            raise ValueError(f"Неподдерживаемая частота дискретизации: {sample_rate}")
+        if not 1 <= channels <= 8:
+            raise ValueError(f"Неподдерживаемое число каналов: {channels}")
+        if encoding not in AUDIO_ENCODINGS:
+            raise ValueError(f"Неподдерживаемый формат аудио: {encoding}")
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.encoding = encoding
+        self.dtype = AUDIO_ENCODINGS[encoding]
+        self.frame_bytes = self.dtype.itemsize * channels
+        # Если формат уже совпадает с целевым, данные пересылаются без изменений
+        self.passthrough = sample_rate == TARGET_SAMPLE_RATE and channels == 1 and encoding == "pcm16"
+        self.step = sample_rate / TARGET_SAMPLE_RATE  # Входных сэмплов на один выходной
+        self.position = 0.0      # Позиция следующего выходного сэмпла относительно начала кадра
+        self.last_sample = None  # Последний сэмпл предыдущего кадра для интерполяции на стыке
+        self.lowpass = design_lowpass(sample_rate, AUDIO_LOWPASS_CUTOFF_HZ) if self.step > 1 else None
+        self.lowpass_tail = None  # Последние len(lowpass) - 1 входных сэмплов предыдущего кадра
+
+    def convert(self, data) -> bytes:
+        """Преобразует кадр (bytes или memoryview) в PCM16 24 кГц моно"""
+        if self.passthrough:
+            return data if isinstance(data, bytes) else bytes(data)
+        
+        # Отбрасываем неполный последний сэмпл, чтобы не копировать буфер
+        usable = len(data) - len(data) % self.frame_bytes
+        if usable == 0:
+            return b""
+        samples = np.frombuffer(memoryview(data)[:usable], dtype=self.dtype)
+        
+        if self.channels > 1:
+            samples = samples.reshape(-1, self.channels).mean(axis=1, dtype=np.float32)
+        else:
+            samples = samples.astype(np.float32)
+        if self.encoding == "pcm16":
+            samples *= 1.0 / 32768.0
+        
+        if self.lowpass is not None:
+            samples = self._lowpass(samples)
+        if self.step != 1.0:
+            samples = self._resample(samples)
+        
+        np.clip(samples, -1.0, 1.0, out=samples)
+        return (samples * 32767.0).astype('<i2').tobytes()
+
+    def _lowpass(self, samples: np.ndarray) -> np.ndarray:
+        history = self.lowpass_tail
+        if history is None:
+            # Первый кадр: до начала потока считаем сигнал равным первому сэмплу (без ступеньки от нуля)
+            history = np.full(len(self.lowpass) - 1, samples[0], dtype=np.float32)
+        buffer = np.concatenate((history, samples))
+        self.lowpass_tail = buffer[-(len(self.lowpass) - 1):]
+        return np.convolve(buffer, self.lowpass, mode="valid").astype(np.float32)
+
+    def _resample(self, samples: np.ndarray) -> np.ndarray:
+        previous = samples[0] if self.last_sample is None else self.last_sample
+        # Индекс 0 в buffer - последний сэмпл предыдущего кадра
+        buffer = np.empty(len(samples) + 1, dtype=np.float32)
+        buffer[0] = previous
+        buffer[1:] = samples
+        positions = np.arange(self.position, len(samples) - 1 + 1e-9, self.step, dtype=np.float64)
+        self.last_sample = samples[-1]
+        if len(positions) == 0:
+            self.position -= len(samples)
+            return np.empty(0, dtype=np.float32)
+        self.position = positions[-1] + self.step - len(samples)
+        return np.interp(positions + 1.0, np.arange(len(buffer), dtype=np.float64), buffer).astype(np.float32)
+
+PCM16_BYTES_PER_MS = TARGET_SAMPLE_RATE * 2 // 1000  # Байт PCM16 24 кГц моно на миллисекунду
+
+class SilenceGate:
+    """
+    Серверное подавление тишины во входном аудио (PCM16 24 кГц моно).
+    Кадры с уровнем (RMS) ниже порога не пересылаются в OpenAI. Чтобы server_vad работал
+    как прежде, последние pre_roll_ms тишины держатся в буфере и отправляются перед речью
+    (покрывают prefix_padding_ms), а после речи еще hangover_ms тишины пересылается
+    без изменений (чтобы OpenAI дождался silence_duration_ms и завершил ход).
+    """
+
+    def __init__(self, threshold_dbfs: float, pre_roll_ms: int, hangover_ms: int):
+        self.threshold_dbfs = threshold_dbfs
+        threshold = 32768.0 * 10 ** (threshold_dbfs / 20)
+        self.threshold_energy = threshold * threshold  # Порог среднего квадрата сэмпла
+        self.pre_roll_bytes = pre_roll_ms * PCM16_BYTES_PER_MS
+        self.hangover_bytes = hangover_ms * PCM16_BYTES_PER_MS
+        self.pre_roll = deque()      # (сообщение, байт PCM) - придержанные кадры тишины
+        self.pre_roll_pcm = 0        # Длительность буфера pre-roll в байтах PCM
+        self.hangover_left = 0       # Сколько еще байт тишины пропустить после речи
+        self.sent_since_commit = False
+        self.dropped_since_commit = False
+        # Статистика сессии
+        self.frames_in = 0
+        self.frames_dropped = 0
+        self.bytes_in = 0
+        self.bytes_saved = 0
+
+    def is_silent(self, pcm: bytes) -> bool:
+        samples = np.frombuffer(memoryview(pcm)[:len(pcm) - len(pcm) % 2], dtype='<i2').astype(np.float32)
+        if len(samples) == 0:
+            return True
+        return float(np.dot(samples, samples)) / len(samples) < self.threshold_energy
+
+    def process(self, pcm: bytes, message: str) -> List[str]:
+        """Возвращает сообщения для отправки в OpenAI (пустой список - кадр придержан как тишина)"""
+        self.frames_in += 1
+        self.bytes_in += len(message)
+
+        if not self.is_silent(pcm):
+            # Речь: сначала отправляем придержанную тишину, чтобы сохранить начало фразы
+            outgoing = [held for held, _ in self.pre_roll]
+            outgoing.append(message)
+            self.pre_roll.clear()
+            self.pre_roll_pcm = 0
+            self.hangover_left = self.hangover_bytes
+            self.sent_since_commit = True
+            return outgoing
+
+        if self.hangover_left > 0:
+            self.hangover_left -= len(pcm)
+            self.sent_since_commit = True
+            return [message]
+
+        # Тишина: держим последние pre_roll_ms, более старые кадры отбрасываем
+        self.pre_roll.append((message, len(pcm)))
+        self.pre_roll_pcm += len(pcm)
+        while self.pre_roll and self.pre_roll_pcm - self.pre_roll[0][1] >= self.pre_roll_bytes:
+            self._drop_oldest()
+        return []
+
+    def allow_commit(self) -> bool:
+        """
+        Решает, пересылать ли input_audio_buffer.commit. Если все аудио с прошлого commit
+        было отброшено или придержано как тишина, буфер OpenAI пуст и commit вернул бы ошибку.
+        """
+        allowed = self.sent_since_commit or not (self.dropped_since_commit or self.pre_roll)
+        self.sent_since_commit = False
+        self.dropped_since_commit = False
+        return allowed
+
+    def reset(self):
+        """Сброс состояния после input_audio_buffer.clear"""
+        while self.pre_roll:
+            self._drop_oldest()
+        self.hangover_left = 0
+        self.sent_since_commit = False
+        self.dropped_since_commit = False
+
+    def _drop_oldest(self):
+        message, pcm_size = self.pre_roll.popleft()
+        self.pre_roll_pcm -= pcm_size
+        self.frames_dropped += 1
+        self.bytes_saved += len(message)
+        self.dropped_since_commit = True
+
+    def get_stats(self) -> Dict[str, Any]:
+        # Придержанные кадры, которые так и не были отправлены, тоже считаются сэкономленными
+        bytes_saved = self.bytes_saved + sum(len(message) for message, _ in self.pre_roll)
+        return {
+            "frames_in": self.frames_in,
+            "frames_dropped": self.frames_dropped + len(self.pre_roll),
+            "bytes_in": self.bytes_in,
+            "bytes_saved": bytes_saved
+        }
+
+def create_silence_gate(audio_settings: Optional[Dict[str, Any]]) -> Optional[SilenceGate]:
+    """Создает подавитель тишины по настройкам ассистента (None - подавление выключено)"""
+    settings = audio_settings or {}
+    if not settings.get("silence_gate", SILENCE_GATE_ENABLED):
+        return None
+    threshold_dbfs = settings.get("silence_threshold_dbfs", SILENCE_GATE_THRESHOLD_DBFS)
+    # Буферы не короче параметров server_vad, иначе OpenAI обрежет начало речи или не завершит ход
+    pre_roll_ms = max(settings.get("pre_roll_ms", SILENCE_GATE_PRE_ROLL_MS), VAD_PREFIX_PADDING_MS)
+    hangover_ms = max(settings.get("hangover_ms", SILENCE_GATE_HANGOVER_MS), VAD_SILENCE_DURATION_MS + 100)
+    return SilenceGate(threshold_dbfs, pre_roll_ms, hangover_ms)
+
+# Суммарная статистика подавления тишины по завершенным сессиям воркера
+silence_gate_totals = {"sessions": 0, "frames_in": 0, "frames_dropped": 0, "bytes_in": 0, "bytes_saved": 0}
+
+def get_silence_gate_stats() -> Dict[str, Any]:
+    stats = dict(silence_gate_totals)
+    stats["bytes_saved_per_session"] = stats["bytes_saved"] // stats["sessions"] if stats["sessions"] else 0
+    stats["saved_ratio"] = round(stats["bytes_saved"] / stats["bytes_in"], 4) if stats["bytes_in"] else 0.0
+    active = [connection["silence_gate"].get_stats() for connection in client_connections.values() if connection.get("silence_gate")]
+    stats["active_sessions"] = len(active)
+    stats["active_bytes_saved"] = sum(session["bytes_saved"] for session in active)
+    return stats
+
+class ConversationTranscript:
+    """
+    Короткая история разговора для восстановления сессии OpenAI после обрыва соединения.
+    Хранит последние реплики в порядке ходов: реплика пользователя занимает место при
+    input_audio_buffer.committed, а текст получает позже, когда приходит распознавание
+    (conversation.item.input_audio_transcription.completed). Старые реплики вытесняются
+    по числу (max_items) и суммарной длине (max_chars).
+    """
+
+    def __init__(self, max_items: int, max_chars: int):
+        self.max_items = max_items
+        self.max_chars = max_chars
+        self.items = deque()  # {"item_id", "role", "text"}
+
+    def add_user_item(self, item_id: Optional[str]):
+        self.items.append({"item_id": item_id, "role": "user", "text": None})
+        self._trim()
+
+    def set_user_text(self, item_id: Optional[str], text: str):
+        for item in reversed(self.items):
+            if item["item_id"] == item_id and item["role"] == "user":
+                item["text"] = text
+                break
+        else:
+            self.items.append({"item_id": item_id, "role": "user", "text": text})
+        self._trim()
+
+    def add_assistant_text(self, text: str):
+        self.items.append({"item_id": None, "role": "assistant", "text": text})
+        self._trim()
+
+    def _trim(self):
+        while len(self.items) > self.max_items:
+            self.items.popleft()
+        while len(self.items) > 1 and sum(len(item["text"] or "") for item in self.items) > self.max_chars:
+            self.items.popleft()
+
+    def to_events(self) -> List[str]:
+        """События conversation.item.create для переноса истории в новую сессию OpenAI"""
+        events = []
+        for item in self.items:
+            if not item["text"]:
+                continue  # Распознавание реплики не успело прийти до обрыва
+            content_type = "input_text" if item["role"] == "user" else "text"
+            events.append(json.dumps({
+                "type": "conversation.item.create",
+                "item": {
+                    "type": "message",
+                    "role": item["role"],
+                    "content": [{"type": content_type, "text": item["text"]}]
+                }
+            }, ensure_ascii=False))
+        return events
+
+def response_output_text(response: Dict[str, Any]) -> str:
+    """Текст ответа ассистента из response.done (транскрипт аудио или текст)"""
+    parts = []
+    for item in response.get("output") or []:
+        if item.get("type") != "message":
+            continue
+        for content in item.get("content") or []:
+            text = content.get("transcript") or content.get("text")
+            if text:
+                parts.append(text)
+    return " ".join(parts)
+
+def reconnect_delay(attempt: int) -> float:
+    """Задержка перед попыткой: первые быстрее секунды, дальше вдвое больше, со случайным разбросом"""
+    delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
 # Отслеживаемые события от OpenAI для подробного логирования
 LOG_EVENT_TYPES = [
     'response.done',
@@ -283,10 +1052,293 @@ LOG_EVENT_TYPES = [
     'session.updated'
 ]
 
+# Метрики в формате Prometheus. Все обновления выполняются в потоке цикла событий,
+# поэтому значения хранятся в обычных атрибутах без блокировок. Горячие циклы релея
+# получают нужную серию один раз и на каждом кадре только увеличивают ее значение.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+class CounterValue:
+    """Серия счетчика или измерителя"""
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+class HistogramValue:
+    """Серия гистограммы: число наблюдений в каждой корзине, сумма и количество"""
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Последняя корзина - +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+def format_labels(names, values) -> str:
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return ",".join(pairs)
+
+class Metric:
+    """Семейство метрик: по серии на каждое сочетание значений меток"""
+
+    def __init__(self, kind: str, name: str, documentation: str, labelnames=(), buckets=None, callback: Optional[Callable] = None):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) if buckets else None
+        self.callback = callback  # Для измерителей, значение которых вычисляется при сборе
+        self.series = {}
+
+    def labels(self, *values):
+        """Возвращает серию для значений меток (создается при первом обращении)"""
+        series = self.series.get(values)
+        if series is None:
+            series = HistogramValue(self.buckets) if self.kind == "histogram" else CounterValue()
+            self.series[values] = series
+        return series
+
+    def render(self, const_names, const_values) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        names = tuple(const_names) + self.labelnames
+        if self.callback is not None:
+            lines.append(f"{self.name}{{{format_labels(const_names, const_values)}}} {self.callback()}")
+            return lines
+        for values, series in list(self.series.items()):
+            labels = format_labels(names, tuple(const_values) + values)
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{{{labels}}} {series.value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series.sum}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """Набор метрик воркера и их вывод в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def _register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Metric:
+        return self._register(Metric("counter", name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames=(), callback: Optional[Callable] = None) -> Metric:
+        return self._register(Metric("gauge", name, documentation, labelnames, callback=callback))
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Metric:
+        return self._register(Metric("histogram", name, documentation, labelnames, buckets=buckets))
+
+    def render(self, const_labels: Dict[str, str]) -> str:
+        """Все метрики с общими метками (например, worker), по которым различаются воркеры"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(tuple(const_labels), tuple(const_labels.values())))
+        return "\n".join(lines) + "\n"
+
+metrics_registry = MetricsRegistry()
+
+relay_active_sessions = metrics_registry.gauge(
+    "relay_active_sessions", "Активные realtime-сессии воркера", callback=lambda: len(client_connections))
+relay_frames = metrics_registry.counter(
+    "relay_frames_total", "Кадры, полученные релеем (upstream - от клиента, downstream - от OpenAI)", ("direction",))
+relay_bytes = metrics_registry.counter(
+    "relay_bytes_total", "Объем кадров, полученных релеем, в байтах (для текстовых кадров - в символах)", ("direction",))
+openai_connect_seconds = metrics_registry.histogram(
+    "openai_connect_seconds", "Время получения соединения с OpenAI (pool=hit - из пула)", ("pool",))
+openai_session_update_seconds = metrics_registry.histogram(
+    "openai_session_update_seconds", "Время от отправки session.update до получения session.updated")
+speech_stop_to_audio_seconds = metrics_registry.histogram(
+    "relay_speech_stop_to_first_audio_seconds", "Время от конца речи пользователя до первого аудио ответа")
+relay_reconnects = metrics_registry.counter(
+    "relay_reconnects_total", "Попытки переподключения к OpenAI по причинам (code - код закрытия WebSocket)", ("cause", "code"))
+db_write_seconds = metrics_registry.histogram(
+    "db_write_seconds", "Длительность записей в БД по операциям", ("operation",))
+event_loop_lag_seconds = metrics_registry.histogram(
+    "event_loop_lag_seconds", "Задержка пробуждения задачи цикла событий относительно расписания", buckets=LOOP_LAG_BUCKETS)
+
+tool_call_seconds = metrics_registry.histogram(
+    "tool_call_seconds", "Выполнение вызовов функций ассистента сервером (status: ok, error, timeout, cached)",
+    ("function", "status"), buckets=LATENCY_BUCKETS)
+tool_cache_requests = metrics_registry.counter(
+    "tool_cache_requests_total", "Вызовы кэшируемых функций (result: hit - из кэша, shared - ожидание такого же вызова, miss)",
+    ("assistant", "result"))
+tool_cache_saved_seconds = metrics_registry.counter(
+    "tool_cache_saved_seconds_total", "Сэкономленное кэшем функций время (длительность вызовов, которые не выполнялись)",
+    ("assistant",))
+
+google_sheets_append_seconds = metrics_registry.histogram(
+    "google_sheets_append_seconds", "Запросы append к Google Sheets API (status - код ответа или error)", ("status",))
+google_sheets_rows = metrics_registry.counter(
+    "google_sheets_rows_total", "Строки для Google Таблиц (result: appended, dropped - переполнение или исчерпаны повторы, rejected - отклонены API)",
+    ("result",))
+
+knowledge_search_seconds = metrics_registry.histogram(
+    "knowledge_search_seconds", "Поиск по базе знаний (stage=embed - эмбеддинг запроса, search - поиск по индексу)",
+    ("stage",), buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 0.5, 1.0))
+
+event_loop_stalls = metrics_registry.counter(
+    "event_loop_stalls_total", "Зависания цикла событий дольше LOOP_WATCHDOG_THRESHOLD_MS")
+event_loop_stall_seconds = metrics_registry.histogram(
+    "event_loop_stall_seconds", "Длительность зависаний цикла событий", buckets=LATENCY_BUCKETS)
+
+class EventLoopWatchdog:
+    """
+    Замер задержки цикла событий и поиск обработчиков, которые его блокируют.
+    Задача в цикле просыпается каждые interval секунд и отмечает время пробуждения;
+    опоздание пробуждения попадает в гистограмму задержки. Отдельный поток раз в
+    четверть порога проверяет эту отметку: если цикл не отвечает дольше threshold,
+    поток снимает стек потока цикла (sys._current_frames) и текущую задачу asyncio.
+    Пока зависание длится, сохраняются до max_stacks различных стеков; длительность
+    дописывается, когда цикл снова отвечает. Зависания хранятся в кольцевом буфере.
+    Накладные расходы - одно пробуждение задачи за interval и проверка отметки
+    времени в потоке, поэтому сторож включен и в продакшене.
+    """
+
+    def __init__(self, interval: float, threshold_ms: int, buffer_size: int, enabled: bool = True, max_stacks: int = 5):
+        self.interval = interval
+        self.threshold = threshold_ms / 1000
+        self.enabled = enabled
+        self.max_stacks = max_stacks
+        self.stalls = deque(maxlen=buffer_size)
+        self.lag_series = event_loop_lag_seconds.labels()
+        self.stall_series = event_loop_stall_seconds.labels()
+        self.stall_counter = event_loop_stalls.labels()  # Увеличивается только из потока сторожа
+        self.task = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_tick = time.monotonic()
+        self.current_stall = None  # Зависание, которое длится сейчас (заполняет поток сторожа)
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.loop = asyncio.get_running_loop()
+            self.loop_thread_id = threading.get_ident()
+            self.last_tick = time.monotonic()
+            self.task = asyncio.create_task(self._tick_forever())
+        if self.enabled and (self.thread is None or not self.thread.is_alive()):
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._watch, name="event-loop-watchdog", daemon=True)
+            self.thread.start()
+
+    async def stop(self):
+        self.stopping.set()
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.thread:
+            await asyncio.to_thread(self.thread.join, 1.0)
+            self.thread = None
+
+    async def _tick_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.lag_series.observe(lag)
+            self.last_lag = lag
+            if lag > self.max_lag:
+                self.max_lag = lag
+            now = time.monotonic()
+            stall = self.current_stall
+            if stall is not None:
+                # Цикл снова отвечает - фиксируем длительность зависания
+                duration = now - stall["tick"]
+                stall["duration_ms"] = round(duration * 1000, 1)
+                self.stall_series.observe(duration)
+                self.current_stall = None
+                logger.warning(f"Цикл событий не отвечал {stall['duration_ms']} мс, задача: {stall['task']}, "
+                               f"место: {stall['stacks'][0][-1] if stall['stacks'][0] else '-'}")
+            self.last_tick = now
+
+    def _watch(self):
+        poll = self.threshold / 4
+        while not self.stopping.wait(poll):
+            tick = self.last_tick
+            if time.monotonic() - tick < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = [f"{os.path.basename(entry.filename)}:{entry.lineno} {entry.name}: {entry.line}"
+                     for entry in traceback.extract_stack(frame, limit=20)]
+            del frame
+            if self.last_tick != tick:
+                continue  # Цикл ответил, пока снимался стек
+            stall = self.current_stall
+            if stall is None or stall["tick"] != tick:
+                stall = {
+                    "detected_at": datetime.now(timezone.utc).isoformat(),
+                    "tick": tick,
+                    "task": self._current_task_name(),
+                    "duration_ms": None,  # Заполняется, когда цикл снова ответит
+                    "stacks": [stack]
+                }
+                self.current_stall = stall
+                self.stalls.append(stall)
+                self.stall_counter.inc()
+            elif len(stall["stacks"]) < self.max_stacks and stack != stall["stacks"][-1]:
+                stall["stacks"].append(stack)
+
+    def _current_task_name(self) -> Optional[str]:
+        try:
+            task = asyncio.current_task(self.loop)
+        except RuntimeError:
+            return None
+        if task is None:
+            return None
+        coro = task.get_coro()
+        return f"{task.get_name()} ({getattr(coro, '__qualname__', type(coro).__name__)})"
+
+    def get_stalls(self) -> List[Dict[str, Any]]:
+        """Последние зависания, новые первыми"""
+        return [{key: value for key, value in stall.items() if key != "tick"} for stall in reversed(self.stalls)]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "threshold_ms": round(self.threshold * 1000),
+            "last_lag_ms": round(self.last_lag * 1000, 2),
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "stalls": int(self.stall_counter.value),
+        }
+
+loop_watchdog = EventLoopWatchdog(LOOP_LAG_INTERVAL, LOOP_WATCHDOG_THRESHOLD_MS, LOOP_WATCHDOG_BUFFER_SIZE, LOOP_WATCHDOG_ENABLED)
+
 # Утилиты для JWT токенов
 def create_jwt_token(user_id: str, expires_delta_minutes: int = 60*24) -> str:
     expire = datetime.utcnow() + timedelta(minutes=expires_delta_minutes)
-    to_encode = {"sub": str(user_id), "exp": expire}
+    to_encode = {"sub": str(user_id), "exp": expire, "jti": uuid.uuid4().hex}
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm="HS256")
     return encoded_jwt
 
@@ -297,97 +1349,3064 @@ def decode_jwt_token(token: str) -> TokenData:
         exp = payload.get("exp")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid token")
-        return TokenData(sub=user_id, exp=exp)
+        return TokenData(sub=user_id, exp=exp, jti=payload.get("jti"))
     except PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 # Зависимость для проверки аутентификации
 security = HTTPBearer()
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db = Depends(get_db)):
-    token_data = decode_jwt_token(credentials.credentials)
+class UserSnapshot(NamedTuple):
+    """Неизменяемый снимок пользователя, который можно безопасно хранить в кэше между запросами"""
+    id: uuid.UUID
+    email: str
+    first_name: Optional[str]
+    last_name: Optional[str]
+    company_name: Optional[str]
+    openai_api_key: Optional[str]
+    subscription_plan: Optional[str]
+    google_sheets_authorized: Optional[bool]
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+
+    @classmethod
+    def from_user(cls, user: "User") -> "UserSnapshot":
+        return cls(*(getattr(user, field) for field in cls._fields))
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db = Depends(get_db)) -> UserSnapshot:
+    token = credentials.credentials
     
-    # Проверяем существование пользователя в базе данных
-    user = db.query(User).filter(User.id == token_data.sub).first()
-    if not user:
+    # Уже проверенный токен: без декодирования JWT и без запроса к БД
+    cached = auth_cache.get(token)
+    if cached is not _CACHE_MISS:
+        return cached[0]
+    
+    token_data = decode_jwt_token(token)
+    if token_data.jti and is_token_revoked(token_data.jti):
+        raise HTTPException(status_code=401, detail="Token revoked")
+    
+    # Проверяем существование пользователя и (тем же запросом) отзыв токена на другом воркере
+    revoked = sa.exists().where(RevokedToken.jti == token_data.jti) if token_data.jti else sa.false()
+    result = await db.execute(select(User, revoked).where(User.id == token_data.sub))
+    row = result.first()
+    if not row:
         raise HTTPException(status_code=401, detail="Invalid user")
+    user, is_revoked = row
+    if is_revoked:
+        revoke_token_locally(f"{token_data.jti}:{token_data.exp}")
+        raise HTTPException(status_code=401, detail="Token revoked")
     
-    return user
+    snapshot = UserSnapshot.from_user(user)
+    # Запись живет не дольше срока действия токена
+    ttl = min(token_data.exp - time.time(), AUTH_CACHE_MAX_TTL)
+    if ttl > 0:
+        auth_cache.set(token, (snapshot, token_data.jti), ttl=ttl)
+    
+    return snapshot
 
-# Функция для создания таблиц при запуске приложения
-def create_tables():
-    try:
-        Base.metadata.create_all(bind=engine)
-        logger.info("Таблицы в базе данных созданы успешно")
-    except Exception as e:
-        logger.error(f"Ошибка при создании таблиц: {str(e)}")
+async def get_admin_user(current_user: UserSnapshot = Depends(get_current_user)):
+    """Зависимость для служебных эндпоинтов: доступ только администраторам из ADMIN_EMAILS"""
+    if (current_user.email or "").lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="Недостаточно прав")
+    return current_user
 
-async def create_openai_connection(api_key=None):
+# Проверка версии схемы при запуске приложения. Схему меняют только миграции Alembic,
+# которые выполняются один раз при деплое до запуска воркеров:
+#     alembic -c server/alembic.ini upgrade head
+async def verify_schema_version():
+    expected = set(ScriptDirectory.from_config(AlembicConfig(ALEMBIC_INI_PATH)).get_heads())
+    async with engine.connect() as conn:
+        current = set(await conn.run_sync(lambda sync_conn: MigrationContext.configure(sync_conn).get_current_heads()))
+    if current != expected:
+        message = (f"Версия схемы БД {', '.join(sorted(current)) or 'отсутствует'}, ожидается {', '.join(sorted(expected))}. "
+                   f"Выполните: alembic -c server/alembic.ini upgrade head")
+        logger.error(message)
+        raise RuntimeError(message)
+    logger.info(f"Схема базы данных актуальна (версия {', '.join(sorted(current))})")
+
+async def rollup_conversation_stats(db, batch: List[Dict[str, Any]]):
+    """Добавляет пачку диалогов в суточную сводку (ConversationDailyStats)"""
+    totals = {}
+    for record in batch:
+        if not record.get("assistant_id"):
+            continue
+        # Записи, дозаписанные с диска, содержат id строками - приводим ключ к одному виду
+        key = (str(record["assistant_id"]), record["created_at"].astimezone(timezone.utc).date())
+        count, duration = totals.get(key, (0, 0.0))
+        totals[key] = (count + 1, duration + (record.get("duration_seconds") or 0.0))
+    if not totals:
+        return
+    # Одинаковый порядок строк у всех воркеров исключает взаимные блокировки
+    statement = pg_insert(ConversationDailyStats).values([
+        {"assistant_id": assistant_id, "day": day, "conversations": count, "total_duration_seconds": duration}
+        for (assistant_id, day), (count, duration) in sorted(totals.items())
+    ])
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=[ConversationDailyStats.assistant_id, ConversationDailyStats.day],
+        set_={
+            "conversations": ConversationDailyStats.conversations + statement.excluded.conversations,
+            "total_duration_seconds": ConversationDailyStats.total_duration_seconds + statement.excluded.total_duration_seconds
+        }
+    ))
+
+class ConversationWriter:
     """
-    Создание нового соединения с OpenAI API с улучшенной обработкой ошибок.
+    Фоновая запись диалогов в БД (write-behind).
+    Задачи соединений кладут записи в ограниченную очередь, а отдельная задача
+    забирает их пачками и записывает одним многострочным INSERT каждые
+    batch_size записей или flush_interval миллисекунд. Если БД отстает и очередь
+    переполнена (или запись пачки не удалась), записи сбрасываются в файл на диск
+    и дозаписываются после восстановления БД.
+    on_batch(db, batch) выполняется в той же транзакции, что и INSERT пачки
+    (например, для обновления сводных таблиц).
     """
-    try:
-        key_to_use = api_key or OPENAI_API_KEY
-        if not key_to_use:
-            raise ValueError("API ключ OpenAI не предоставлен")
-            
-        # Заголовки для авторизации в OpenAI API
-        headers = [
-            ("Authorization", f"Bearer {key_to_use}"),
-            ("OpenAI-Beta", "realtime=v1"),
-            ("User-Agent", "WellcomeAI/1.0")
-        ]
-        
-        # Увеличенные буферы для более надежной передачи аудио
-        openai_ws = await websockets.connect(
-            REALTIME_WS_URL,
-            extra_headers=headers,  # Используем extra_headers вместо additional_headers
-            max_size=15 * 1024 * 1024,  # 15MB max message size
-            ping_interval=30,  # Увеличиваем интервал пинга для большей стабильности
-            ping_timeout=120,  # Увеличиваем таймаут пинга
-            close_timeout=15    # Увеличиваем таймаут закрытия
-        )
-        logger.info("Создано новое соединение с OpenAI")
-        return openai_ws
-    except websockets.exceptions.InvalidStatusCode as e:
-        if e.status_code == 401:
-            logger.error(f"Ошибка авторизации при подключении к OpenAI: {e.status_code}")
-            raise ValueError("Недействительный API ключ OpenAI")
-        elif e.status_code == 429:
-            logger.error(f"Ограничение скорости запросов OpenAI: {e.status_code}")
-            raise ValueError("Превышен лимит запросов OpenAI. Пожалуйста, попробуйте позже.")
-        else:
-            logger.error(f"Ошибка статуса HTTP при подключении к OpenAI: {e.status_code}")
-            raise
-    except Exception as e:
-        logger.error(f"Ошибка при создании соединения с OpenAI: {str(e)}")
-        raise
 
-async def send_session_update(openai_ws, voice=DEFAULT_VOICE, system_message=DEFAULT_SYSTEM_MESSAGE, functions=None):
-    """Отправляет настройки сессии в WebSocket OpenAI"""
-    
-    # Логируем используемый системный промпт для отладки
-    logger.info(f"Используем системный промпт: {system_message[:100]}...")
-    
-    # Настройка определения завершения речи
-    turn_detection = {
-        "type": "server_vad",
-        "threshold": 0.25,                 # Чувствительность определения голоса
-        "prefix_padding_ms": 200,          # Начальное время записи
-        "silence_duration_ms": 300,        # Время ожидания тишины
-        "create_response": True            # Автоматически создавать ответ при завершении речи
-    }
-    
-    # Подготавливаем инструменты (functions)
-    tools = []
-    if functions:
-        for func in functions:
-            tools.append({
+    def __init__(self, table, maxsize: int, batch_size: int, flush_interval_ms: int, spill_path: Optional[str] = None,
+                 on_batch: Optional[Callable] = None):
+        self.table = table
+        self.on_batch = on_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.spill_path = spill_path or None
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.task = None
+        # Метрики
+        self.stats = {
+            "submitted": 0,
+            "written": 0,
+            "batches": 0,
+            "spilled": 0,
+            "dropped": 0,
+            "rejected": 0,
+            "failed_flushes": 0,
+            "max_queue_depth": 0,
+            "last_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    def submit(self, record: Dict[str, Any]) -> bool:
+        """Неблокирующая постановка записи в очередь. Возвращает False, если запись не попала в очередь"""
+        record.setdefault("id", uuid.uuid4())
+        record.setdefault("created_at", datetime.now(timezone.utc))
+        self.stats["submitted"] += 1
+        try:
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            # БД не успевает - сбрасываем запись на диск или отбрасываем
+            self._spill([record])
+            return False
+        depth = self.queue.qsize()
+        if depth > self.stats["max_queue_depth"]:
+            self.stats["max_queue_depth"] = depth
+        return True
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0):
+        """Останавливает запись и сбрасывает оставшиеся записи в БД (или на диск)"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        for i in range(0, len(batch), self.batch_size):
+            chunk = batch[i:i + self.batch_size]
+            try:
+                await asyncio.wait_for(self._insert(chunk), timeout=timeout)
+            except Exception as e:
+                logger.error(f"Ошибка при записи диалогов во время остановки: {str(e)}")
+                self._spill(chunk)
+
+    def get_stats(self) -> Dict[str, Any]:
+        batches = self.stats["batches"]
+        return {
+            **self.stats,
+            "queue_depth": self.queue.qsize(),
+            "avg_flush_ms": round(self.stats["total_flush_ms"] / batches, 2) if batches else 0.0,
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Ждем первую запись, затем добираем пачку до batch_size или до истечения интервала
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                while not self.queue.empty() and len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+                remaining = deadline - loop.time()
+                if len(batch) >= self.batch_size or remaining <= 0:
+                    break
+                await asyncio.sleep(min(remaining, 0.05))
+            try:
+                await self._insert(batch)
+            except asyncio.CancelledError:
+                self._spill(batch)
+                raise
+            except sa.exc.IntegrityError:
+                # Например, ассистент удален во время сессии - пишем построчно и отбрасываем некорректные строки
+                await self._insert_rows_individually(batch)
+            except Exception as e:
+                self.stats["failed_flushes"] += 1
+                logger.error(f"Ошибка при пакетной записи диалогов в БД: {str(e)}")
+                self._spill(batch)
+                continue
+            # БД снова доступна - дозаписываем то, что было сброшено на диск
+            if self.spill_path and self.queue.qsize() < self.queue.maxsize // 2:
+                await self._replay_spill()
+
+    async def _insert(self, batch: List[Dict[str, Any]]):
+        start = time.perf_counter()
+        async with SessionLocal() as db:
+            await db.execute(insert(self.table).values(batch))
+            if self.on_batch:
+                await self.on_batch(db, batch)
+            await db.commit()
+        elapsed = time.perf_counter() - start
+        db_write_seconds.labels(f"insert_{self.table.name}").observe(elapsed)
+        elapsed_ms = elapsed * 1000
+        self.stats["written"] += len(batch)
+        self.stats["batches"] += 1
+        self.stats["last_flush_ms"] = round(elapsed_ms, 2)
+        self.stats["total_flush_ms"] += elapsed_ms
+        logger.debug(f"Записано диалогов в БД: {len(batch)} за {elapsed_ms:.1f} мс")
+
+    async def _insert_rows_individually(self, batch: List[Dict[str, Any]]):
+        for record in batch:
+            try:
+                await self._insert([record])
+            except sa.exc.IntegrityError as e:
+                self.stats["rejected"] += 1
+                logger.warning(f"Запись диалога отклонена БД: {str(e.orig)}")
+            except Exception as e:
+                logger.error(f"Ошибка при построчной записи диалога: {str(e)}")
+                self._spill([record])
+
+    def _spill(self, records: List[Dict[str, Any]]):
+        if not self.spill_path:
+            self.stats["dropped"] += len(records)
+            logger.warning(f"Отброшено записей диалогов: {len(records)} (БД не успевает)")
+            return
+        try:
+            with open(self.worker_spill_path(), "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, default=str, ensure_ascii=False) + "\n")
+            self.stats["spilled"] += len(records)
+        except Exception as e:
+            self.stats["dropped"] += len(records)
+            logger.error(f"Не удалось сбросить диалоги на диск: {str(e)}")
+
+    def worker_spill_path(self, pid: Optional[int] = None) -> str:
+        """Файл сброса воркера: у каждого процесса свой, поэтому воркеры не пишут в один файл"""
+        return f"{self.spill_path}.{pid or os.getpid()}"
+
+    def _spill_files(self) -> List[str]:
+        """
+        Файлы для дозаписи: свои (в том числе недописанный .replay после сбоя) и оставшиеся
+        от завершившихся воркеров, а также общий файл версий без суффикса процесса
+        """
+        own = self.worker_spill_path()
+        paths = [own + ".replay", own]
+        if os.path.exists(self.spill_path):
+            paths.append(self.spill_path)
+        for path in glob.glob(glob.escape(self.spill_path) + ".*"):
+            pid = path[len(self.spill_path) + 1:].split(".")[0]
+            if pid.isdigit() and int(pid) != os.getpid() and not is_process_alive(int(pid)):
+                paths.append(path)
+        return [path for path in paths if os.path.exists(path)]
+
+    async def _replay_spill(self):
+        try:
+            paths = self._spill_files()
+        except Exception as e:
+            logger.error(f"Не удалось найти сброшенные диалоги: {str(e)}")
+            return
+        for path in paths:
+            # Файл забирается переименованием: если другой воркер успел раньше, пропускаем его
+            replay_path = self.worker_spill_path() + ".replay"
+            try:
+                if path != replay_path:
+                    os.replace(path, replay_path)
+                records = await asyncio.to_thread(self._load_spill, replay_path)
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logger.error(f"Не удалось прочитать сброшенные диалоги {path}: {str(e)}")
+                return
+            for i in range(0, len(records), self.batch_size):
+                chunk = records[i:i + self.batch_size]
+                try:
+                    await self._insert(chunk)
+                except sa.exc.IntegrityError:
+                    await self._insert_rows_individually(chunk)
+                except Exception as e:
+                    logger.error(f"Ошибка при дозаписи сброшенных диалогов: {str(e)}")
+                    self._spill(records[i:])
+                    break
+            try:
+                os.remove(replay_path)
+            except OSError as e:
+                # Оставшийся файл дозапишется еще раз; записи с теми же id отсеет IntegrityError
+                logger.error(f"Не удалось удалить файл дозаписанных диалогов {replay_path}: {str(e)}")
+                return
+            logger.info(f"Дозаписано сброшенных на диск диалогов: {len(records)} (из {path})")
+
+    @staticmethod
+    def _load_spill(path: str) -> List[Dict[str, Any]]:
+        records = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                record["id"] = uuid.UUID(record["id"])
+                record["created_at"] = datetime.fromisoformat(record["created_at"])
+                records.append(record)
+        return records
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+# Единый писатель диалогов для воркера (CONVERSATION_SPILL_PATH - префикс, у каждого воркера файл <путь>.<pid>)
+conversation_writer = ConversationWriter(
+    Conversation.__table__,
+    maxsize=CONVERSATION_QUEUE_SIZE,
+    batch_size=CONVERSATION_BATCH_SIZE,
+    flush_interval_ms=CONVERSATION_FLUSH_INTERVAL_MS,
+    spill_path=CONVERSATION_SPILL_PATH,
+    on_batch=rollup_conversation_stats
+)
+
+# Трассы ходов - выборочные данные, поэтому при отставании БД они отбрасываются, а не сбрасываются на диск
+turn_trace_writer = ConversationWriter(
+    TurnTrace.__table__,
+    maxsize=CONVERSATION_QUEUE_SIZE,
+    batch_size=CONVERSATION_BATCH_SIZE,
+    flush_interval_ms=CONVERSATION_FLUSH_INTERVAL_MS
+)
+
+# Интервалы трассы хода и их описание для API задержек
+TURN_TRACE_FIELDS = {
+    "speech_ms": "Речь пользователя (speech_started -> speech_stopped)",
+    "response_created_ms": "Начало ответа OpenAI (speech_stopped -> response.created)",
+    "first_audio_ms": "Первое аудио от OpenAI (speech_stopped -> response.audio.delta)",
+    "relay_queue_ms": "Ожидание первого аудиокадра в очереди релея",
+    "client_send_ms": "Отправка первого аудиокадра клиенту",
+    "total_ms": "Конец речи -> первое аудио отправлено клиенту",
+    "response_done_ms": "Конец речи -> response.done",
+}
+
+def start_turn_trace() -> Optional[Dict[str, Any]]:
+    """Начинает трассу хода с вероятностью TURN_TRACE_SAMPLE_RATE; отметки времени - time.perf_counter()"""
+    if TURN_TRACE_SAMPLE_RATE <= 0 or random.random() >= TURN_TRACE_SAMPLE_RATE:
+        return None
+    return {"speech_started": time.perf_counter()}
+
+def on_turn_audio_sent(trace: Dict[str, Any], queued: Optional[float], sending: Optional[float]):
+    """
+    Первый аудиокадр хода отправлен клиенту (вызывается задачей relay_sender). Если кадр
+    был отброшен очередью, это время отправки следующего за ним аудиокадра; None - аудио
+    хода клиенту так и не ушло (соединение закрыто), трасса записывается без этих интервалов.
+    """
+    if queued is None:
+        trace["undelivered"] = True
+    else:
+        trace["relay_queue"] = queued
+        trace["client_send"] = sending
+        trace["delivered"] = time.perf_counter()
+    # response.done уже получен, а трасса ждала только отправки первого аудио
+    if trace.get("finished"):
+        submit_turn_trace(trace)
+
+def finish_turn_trace(trace: Dict[str, Any], assistant_id: str, conversation_id: uuid.UUID):
+    """Завершает трассу по response.done; если первое аудио еще в очереди к клиенту, запись откладывается"""
+    trace["response_done"] = time.perf_counter()
+    trace["assistant_id"] = assistant_id
+    trace["conversation_id"] = conversation_id
+    trace["finished"] = True
+    if "first_audio" not in trace or "delivered" in trace or trace.get("undelivered"):
+        submit_turn_trace(trace)
+
+def submit_turn_trace(trace: Dict[str, Any]):
+    stopped = trace["speech_stopped"]
+
+    def since_stop(key: str) -> Optional[float]:
+        return round((trace[key] - stopped) * 1000, 1) if key in trace else None
+
+    def duration(key: str) -> Optional[float]:
+        return round(trace[key] * 1000, 1) if key in trace else None
+
+    turn_trace_writer.submit({
+        "assistant_id": trace["assistant_id"],
+        "conversation_id": trace["conversation_id"],
+        "speech_ms": round((stopped - trace["speech_started"]) * 1000, 1),
+        "response_created_ms": since_stop("response_created"),
+        "first_audio_ms": since_stop("first_audio"),
+        "relay_queue_ms": duration("relay_queue"),
+        "client_send_ms": duration("client_send"),
+        "total_ms": since_stop("delivered"),
+        "response_done_ms": since_stop("response_done"),
+    })
+
+_CACHE_MISS = object()
+
+class TTLCache:
+    """
+    Ограниченный кэш с вытеснением по LRU и временем жизни записей.
+    Рассчитан на использование из одного event loop, поэтому обходится без блокировок.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=_CACHE_MISS):
+        entry = self.data.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        self.data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        entry = self.data.pop(key, None)
+        return entry[1] if entry else None
+
+    def pop_where(self, predicate: Callable[[Any], bool]) -> int:
+        """Удаляет все записи, значение которых удовлетворяет условию"""
+        keys = [key for key, (_, value) in self.data.items() if predicate(value)]
+        for key in keys:
+            del self.data[key]
+        return len(keys)
+
+    def clear(self):
+        self.data.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+class CacheInvalidationBus:
+    """
+    Рассылка инвалидаций кэшей. Локальные обработчики вызываются сразу,
+    а при включенном CACHE_INVALIDATION_NOTIFY событие рассылается остальным
+    воркерам и узлам через Postgres NOTIFY и принимается через LISTEN.
+    """
+
+    def __init__(self, channel: str, enabled: bool):
+        self.channel = channel
+        self.enabled = enabled
+        self.origin = None
+        self.handlers = {}  # kind -> [callback(key)]
+        self.connection = None
+        self.task = None
+        self.stats = {"published": 0, "received": 0, "errors": 0}
+
+    def subscribe(self, kind: str, handler: Callable[[str], Any]):
+        self.handlers.setdefault(kind, []).append(handler)
+
+    async def publish(self, kind: str, key: str):
+        """Инвалидирует запись локально и оповещает остальные воркеры"""
+        self._dispatch(kind, str(key))
+        if not self.enabled:
+            return
+        payload = json.dumps({"kind": kind, "key": str(key), "origin": self.origin})
+        try:
+            async with engine.connect() as conn:
+                await conn.execute(sa.text("SELECT pg_notify(:channel, :payload)"), {"channel": self.channel, "payload": payload})
+                await conn.commit()
+            self.stats["published"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Не удалось разослать инвалидацию кэша {kind}:{key}: {str(e)}")
+
+    def start(self):
+        self.origin = uuid.uuid4().hex
+        if self.enabled and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self._listen_forever())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "enabled": self.enabled, "listening": self.connection is not None and not self.connection.is_closed()}
+
+    def _dispatch(self, kind: str, key: str):
+        for handler in self.handlers.get(kind, []):
+            try:
+                handler(key)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика инвалидации {kind}: {str(e)}")
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            message = json.loads(payload)
+        except json.JSONDecodeError:
+            return
+        if message.get("origin") == self.origin:
+            return
+        self.stats["received"] += 1
+        self._dispatch(message.get("kind"), message.get("key"))
+
+    async def _listen_forever(self):
+        """Держит отдельное соединение asyncpg с LISTEN и переподключается при обрыве"""
+        while True:
+            try:
+                self.connection = await asyncpg.connect(DATABASE_URL)
+                await self.connection.add_listener(self.channel, self._on_notify)
+                logger.info(f"Подписка на инвалидации кэша через канал {self.channel}")
+                while not self.connection.is_closed():
+                    await asyncio.sleep(5)
+                logger.warning("Соединение LISTEN для инвалидации кэша закрыто")
+            except asyncio.CancelledError:
+                if self.connection and not self.connection.is_closed():
+                    await self.connection.close()
+                raise
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка подписки на инвалидации кэша: {str(e)}")
+            # Пока подписка не работала, могли пропустить инвалидации - сбрасываем локальные данные
+            self._dispatch("*", "")
+            await asyncio.sleep(5)
+
+cache_bus = CacheInvalidationBus(CACHE_INVALIDATION_CHANNEL, CACHE_INVALIDATION_NOTIFY)
+
+class ResolvedAssistant(NamedTuple):
+    """Все, что нужно для открытия realtime-сессии ассистента"""
+    assistant_id: str
+    user_id: Optional[str]
+    system_prompt: str
+    voice: str
+    functions: Optional[List[Dict[str, Any]]]
+    is_active: bool
+    owner_found: bool
+    api_key: Optional[str]  # Ключ владельца (без подстановки ключа по умолчанию)
+    audio_settings: Optional[Dict[str, Any]] = None
+    subscription_plan: Optional[str] = None  # Тариф владельца (для лимитов допуска сессий)
+    knowledge_chunks: int = 0  # Фрагментов в базе знаний (0 - инструмент поиска не подключается)
+    google_sheet_id: Optional[str] = None  # Таблица для записи диалогов и заявок (только если владелец дал доступ)
+
+# Кэш конфигурации ассистентов для пути подключения WebSocket (None - ассистент не найден)
+assistant_cache = TTLCache(max_size=ASSISTANT_CACHE_MAX_SIZE, ttl=ASSISTANT_CACHE_TTL)
+cache_bus.subscribe("assistant", assistant_cache.pop)
+cache_bus.subscribe("user", lambda user_id: assistant_cache.pop_where(lambda a: a is not None and a.user_id == user_id))
+cache_bus.subscribe("*", lambda _: assistant_cache.clear())
+
+# Кэш проверенных JWT токенов: token -> (UserSnapshot, jti)
+auth_cache = TTLCache(max_size=AUTH_CACHE_MAX_SIZE, ttl=AUTH_CACHE_MAX_TTL)
+# Отозванные токены: jti -> exp (unix time). Хранятся в памяти, чтобы проверка не требовала запроса к БД
+revoked_tokens = {}
+
+def is_token_revoked(jti: str) -> bool:
+    exp = revoked_tokens.get(jti)
+    if exp is None:
+        return False
+    if exp < time.time():
+        # Токен и так истек - запись больше не нужна
+        del revoked_tokens[jti]
+        return False
+    return True
+
+def revoke_token_locally(key: str):
+    """Добавляет токен в список отозванных. Ключ имеет вид jti:exp"""
+    jti, _, exp = key.partition(":")
+    revoked_tokens[jti] = float(exp or 0)
+    auth_cache.pop_where(lambda entry: entry[1] == jti)
+
+async def load_revoked_tokens():
+    """Загружает действующие отзывы токенов из БД (при запуске и после обрыва LISTEN)"""
+    try:
+        async with SessionLocal() as db:
+            result = await db.execute(select(RevokedToken.jti, RevokedToken.expires_at).where(RevokedToken.expires_at > func.now()))
+            for jti, expires_at in result.all():
+                revoked_tokens[jti] = expires_at.timestamp()
+        logger.info(f"Загружено отозванных токенов: {len(revoked_tokens)}")
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке отозванных токенов: {str(e)}")
+
+async def load_recent_revoked_tokens():
+    """
+    Подхватывает отзывы токенов, сделанные на других воркерах. Окно запроса с запасом
+    покрывает транзакции выхода, которые начались раньше, а зафиксированы позже опроса.
+    """
+    async with SessionLocal() as db:
+        result = await db.execute(select(RevokedToken.jti, RevokedToken.expires_at).where(
+            RevokedToken.created_at > func.now() - timedelta(seconds=REVOKED_TOKENS_POLL_INTERVAL + 60),
+            RevokedToken.expires_at > func.now()
+        ))
+        for jti, expires_at in result.all():
+            if jti not in revoked_tokens:
+                revoke_token_locally(f"{jti}:{expires_at.timestamp()}")
+
+async def poll_revoked_tokens():
+    """
+    Опрос отзывов не зависит от CACHE_INVALIDATION_NOTIFY: без него закэшированный токен,
+    отозванный на другом воркере, действует здесь не дольше REVOKED_TOKENS_POLL_INTERVAL
+    """
+    while True:
+        await asyncio.sleep(REVOKED_TOKENS_POLL_INTERVAL)
+        try:
+            await load_recent_revoked_tokens()
+        except Exception as e:
+            logger.error(f"Ошибка при опросе отозванных токенов: {str(e)}")
+
+revocation_poll_task = None
+
+revoked_reload_tasks = set()  # Перечитывание отзывов после обрыва LISTEN (ссылки держатся до завершения)
+
+def on_revoked_reload_done(task: asyncio.Task):
+    revoked_reload_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Ошибка при перечитывании отозванных токенов: {str(task.exception())}")
+
+def reset_auth_cache(_):
+    # Пока LISTEN не работал, могли быть пропущены отзывы токенов - перечитываем их из БД
+    auth_cache.clear()
+    task = asyncio.create_task(load_revoked_tokens())
+    revoked_reload_tasks.add(task)
+    task.add_done_callback(on_revoked_reload_done)
+
+cache_bus.subscribe("user", lambda user_id: auth_cache.pop_where(lambda entry: str(entry[0].id) == user_id))
+cache_bus.subscribe("revoke", revoke_token_locally)
+cache_bus.subscribe("*", reset_auth_cache)
+
+async def get_resolved_assistant(assistant_id: str) -> Optional[ResolvedAssistant]:
+    """Read-through получение конфигурации ассистента и API ключа владельца"""
+    resolved = assistant_cache.get(assistant_id)
+    if resolved is not _CACHE_MISS:
+        return resolved
+    
+    async with SessionLocal() as db:
+        result = await db.execute(select(AssistantConfig).where(AssistantConfig.id == assistant_id))
+        assistant = result.scalars().first()
+        user = None
+        knowledge_chunks = 0
+        if assistant:
+            result = await db.execute(select(User).where(User.id == assistant.user_id))
+            user = result.scalars().first()
+            result = await db.execute(select(KnowledgeBase.chunks).where(KnowledgeBase.assistant_id == assistant.id))
+            knowledge_chunks = result.scalar() or 0
+    
+    resolved = None
+    if assistant:
+        resolved = ResolvedAssistant(
+            assistant_id=str(assistant.id),
+            user_id=str(assistant.user_id) if assistant.user_id else None,
+            system_prompt=assistant.system_prompt,
+            voice=assistant.voice,
+            functions=assistant.functions,
+            is_active=assistant.is_active,
+            owner_found=user is not None,
+            api_key=user.openai_api_key if user else None,
+            audio_settings=assistant.audio_settings,
+            subscription_plan=user.subscription_plan if user else None,
+            knowledge_chunks=knowledge_chunks,
+            google_sheet_id=assistant.google_sheet_id if user and user.google_sheets_authorized and user.google_sheets_token else None
+        )
+    assistant_cache.set(assistant_id, resolved)
+    return resolved
+
+# Общий HTTP-клиент с пулом соединений для внешних API (эмбеддинги и т.п.)
+# (keep-alive на все соединения: при всплеске одновременных вызовов функций соединения не пересоздаются)
+http_client = httpx.AsyncClient(timeout=httpx.Timeout(10.0, connect=5.0), limits=httpx.Limits(max_connections=100, max_keepalive_connections=100))
+
+SHEETS_CELL_MAX_CHARS = 50000  # Предел длины ячейки Google Таблиц
+
+class SheetsAppendError(Exception):
+    """Ошибка записи в Google Таблицу; retry - пачку стоит повторить позже (retry_after - пауза от API)"""
+
+    def __init__(self, message: str, retry: bool = False, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry = retry
+        self.retry_after = retry_after
+
+class SheetBuffer:
+    """Неотправленные строки одного листа таблицы"""
+    __slots__ = ("user_id", "rows", "sending", "retry_at", "attempts", "full")
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id  # Владелец ассистента, чьим токеном пишутся строки
+        self.rows = []
+        self.sending = False
+        self.retry_at = 0.0     # time.monotonic(), раньше которого лист не отправляется
+        self.attempts = 0       # Неудачных попыток подряд
+        self.full = False
+
+class GoogleSheetsWriter:
+    """
+    Фоновая дозапись строк в Google Таблицы ассистентов.
+    append() не блокирует и не обращается к сети: строка попадает в буфер своего листа,
+    а задача раз в flush_interval отправляет накопленные строки каждого листа одним
+    запросом values:append (до batch_rows строк) через общий http_client. Листы
+    отправляются независимо, но каждый не более чем одним запросом одновременно, чтобы
+    строки не перемешивались. При 429, 5xx и сетевых ошибках пачка возвращается в начало
+    буфера, а лист откладывается с экспоненциальной задержкой (или на Retry-After);
+    relay этого не ждет. access_token берется из google_sheets_token владельца и
+    обновляется по refresh_token, если заданы GOOGLE_CLIENT_ID и GOOGLE_CLIENT_SECRET.
+    """
+
+    def __init__(self, api_url: str, flush_interval_ms: int, batch_rows: int, max_pending_rows: int,
+                 max_retries: int, backoff_max: float):
+        self.api_url = api_url.rstrip("/")
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_rows = batch_rows
+        self.max_pending_rows = max_pending_rows
+        self.max_retries = max_retries
+        self.backoff_max = backoff_max
+        self.buffers = {}        # (sheet_id, range) -> SheetBuffer
+        self.tokens = {}         # user_id -> google_sheets_token
+        self.token_loading = {}  # user_id -> задача получения токена (одна на пользователя)
+        self.sending = set()     # Выполняющиеся отправки листов
+        self.task = None
+        self.stats = {
+            "submitted": 0,
+            "appended": 0,
+            "requests": 0,
+            "throttled": 0,
+            "retries": 0,
+            "dropped": 0,
+            "rejected": 0,
+            "token_refreshes": 0,
+        }
+
+    def append(self, user_id: str, sheet_id: str, sheet_range: str, row: List[Any]) -> bool:
+        """Неблокирующая постановка строки. Возвращает False, если буфер листа переполнен"""
+        self.stats["submitted"] += 1
+        buffer = self.buffers.get((sheet_id, sheet_range))
+        if buffer is None:
+            buffer = self.buffers[(sheet_id, sheet_range)] = SheetBuffer(str(user_id))
+        buffer.user_id = str(user_id)
+        if len(buffer.rows) >= self.max_pending_rows:
+            self._count("dropped", 1)
+            if not buffer.full:
+                buffer.full = True
+                logger.warning(f"Буфер листа {sheet_range} таблицы {sheet_id} переполнен, новые строки отбрасываются")
+            return False
+        buffer.rows.append(row)
+        return True
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0):
+        """Останавливает отправку и один раз, без повторов, пытается дописать оставшиеся строки"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        try:
+            await asyncio.wait_for(self._flush_all(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.error("Не удалось дописать строки в Google Таблицы за время остановки")
+        left = sum(len(buffer.rows) for buffer in self.buffers.values())
+        if left:
+            self._count("dropped", left)
+            logger.warning(f"При остановке не записано в Google Таблицы строк: {left}")
+        self.buffers.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            **self.stats,
+            "sheets": len(self.buffers),
+            "pending_rows": sum(len(buffer.rows) for buffer in self.buffers.values()),
+            "backing_off": sum(1 for buffer in self.buffers.values() if buffer.retry_at > now),
+            "in_flight": len(self.sending),
+        }
+
+    def forget_token(self, user_id: str):
+        self.tokens.pop(user_id, None)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            now = time.monotonic()
+            for key, buffer in list(self.buffers.items()):
+                if buffer.sending or buffer.retry_at > now:
+                    continue
+                if not buffer.rows:
+                    del self.buffers[key]
+                    continue
+                buffer.sending = True
+                task = asyncio.create_task(self._send(key, buffer, retry=True))
+                self.sending.add(task)
+                task.add_done_callback(self.sending.discard)
+
+    async def _flush_all(self):
+        if self.sending:
+            await asyncio.gather(*self.sending, return_exceptions=True)
+        sends = []
+        for key, buffer in self.buffers.items():
+            if buffer.rows:
+                buffer.sending = True
+                sends.append(self._send(key, buffer, retry=False))
+        await asyncio.gather(*sends, return_exceptions=True)
+
+    async def _send(self, key, buffer: SheetBuffer, retry: bool):
+        """Отправляет строки листа пачками; неполная пачка ждет следующего интервала (кроме остановки)"""
+        sheet_id, sheet_range = key
+        try:
+            while buffer.rows:
+                batch = buffer.rows[:self.batch_rows]
+                del buffer.rows[:len(batch)]
+                try:
+                    await self._append_rows(buffer.user_id, sheet_id, sheet_range, batch)
+                except asyncio.CancelledError:
+                    buffer.rows[:0] = batch
+                    raise
+                except Exception as e:
+                    error = e
+                    if not isinstance(e, SheetsAppendError):
+                        # Непредвиденная ошибка (БД, ответ OAuth, токен) - пачка не теряется, а повторяется позже
+                        logger.error(f"Ошибка записи в таблицу {sheet_id}: {type(e).__name__}: {str(e)}")
+                        error = SheetsAppendError(f"{type(e).__name__}: {str(e)}", retry=True)
+                    if not error.retry:
+                        self._count("rejected", len(batch))
+                        logger.warning(f"Google Sheets отклонил {len(batch)} строк для таблицы {sheet_id}: {str(error)}")
+                        break
+                    buffer.rows[:0] = batch
+                    if not retry:
+                        break
+                    buffer.attempts += 1
+                    if buffer.attempts > self.max_retries:
+                        del buffer.rows[:len(batch)]
+                        buffer.attempts = 0
+                        self._count("dropped", len(batch))
+                        logger.error(f"Строки для таблицы {sheet_id} отброшены после {self.max_retries} повторов: {str(error)}")
+                        break
+                    delay = min(self.backoff_max, self.flush_interval * 2 ** buffer.attempts) * random.uniform(0.5, 1.0)
+                    buffer.retry_at = time.monotonic() + max(delay, error.retry_after or 0)
+                    self.stats["retries"] += 1
+                    logger.info(f"Запись в таблицу {sheet_id} отложена на {buffer.retry_at - time.monotonic():.1f} с: {str(error)}")
+                    break
+                buffer.attempts = 0
+                buffer.full = False
+                self._count("appended", len(batch))
+                if retry and len(buffer.rows) < self.batch_rows:
+                    break
+        finally:
+            buffer.sending = False
+
+    async def _append_rows(self, user_id: str, sheet_id: str, sheet_range: str, rows: List[List[Any]]):
+        access_token = await self._access_token(user_id)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await http_client.post(
+                f"{self.api_url}/v4/spreadsheets/{quote(sheet_id, safe='')}/values/{quote(sheet_range, safe='')}:append",
+                params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+                json={"values": rows},
+                headers={"Authorization": f"Bearer {access_token}"}
+            )
+            status = str(response.status_code)
+        except httpx.HTTPError as e:
+            raise SheetsAppendError(f"Sheets API недоступен: {type(e).__name__}", retry=True)
+        finally:
+            self.stats["requests"] += 1
+            google_sheets_append_seconds.labels(status).observe(time.perf_counter() - start)
+        if response.status_code == 401:
+            # Токен отозван или истек раньше срока: обновляем его, а если обновить нечем - повторять
+            # с тем же токеном бессмысленно (следующая пачка перечитает токен из БД)
+            token = self.tokens.pop(user_id, None)
+            if token and self._can_refresh(token):
+                self.tokens[user_id] = {**token, "expires_at": 0}
+                raise SheetsAppendError("access_token отклонен", retry=True)
+            raise SheetsAppendError("access_token отклонен, нужна повторная авторизация Google")
+        if response.status_code == 429 or response.status_code >= 500:
+            if response.status_code == 429:
+                self.stats["throttled"] += 1
+            retry_after = response.headers.get("retry-after")
+            raise SheetsAppendError(f"Sheets API ответил {response.status_code}", retry=True,
+                                    retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None)
+        if response.status_code >= 400:
+            raise SheetsAppendError(f"Sheets API ответил {response.status_code}: {response.text[:200]}")
+
+    def _can_refresh(self, token: Dict[str, Any]) -> bool:
+        return bool(token.get("refresh_token") and GOOGLE_CLIENT_ID and GOOGLE_CLIENT_SECRET)
+
+    def _expiring(self, token: Dict[str, Any]) -> bool:
+        if not self._can_refresh(token):
+            return False
+        try:
+            return float(token.get("expires_at") or 0) < time.time() + 60
+        except (TypeError, ValueError):
+            return True  # Непонятный срок - надежнее обновить токен
+
+    async def _access_token(self, user_id: str) -> str:
+        token = self.tokens.get(user_id)
+        if token is not None and not self._expiring(token):
+            return token["access_token"]
+        task = self.token_loading.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._obtain_token(user_id, token))
+            self.token_loading[user_id] = task
+            task.add_done_callback(lambda _: self.token_loading.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def _obtain_token(self, user_id: str, token: Optional[Dict[str, Any]]) -> str:
+        if token is None:
+            async with SessionLocal() as db:
+                result = await db.execute(select(User.google_sheets_token, User.google_sheets_authorized).where(User.id == user_id))
+                row = result.first()
+            token = row[0] if row is not None and row[1] else None
+            if isinstance(token, str):
+                token = {"access_token": token}
+            if not isinstance(token, dict) or not token.get("access_token"):
+                raise SheetsAppendError("владелец ассистента не подключил Google Таблицы")
+        if self._expiring(token):
+            token = await self._refresh_token(user_id, token)
+        self.tokens[user_id] = token
+        return token["access_token"]
+
+    async def _refresh_token(self, user_id: str, token: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            response = await http_client.post(GOOGLE_OAUTH_TOKEN_URL, data={
+                "client_id": GOOGLE_CLIENT_ID,
+                "client_secret": GOOGLE_CLIENT_SECRET,
+                "refresh_token": token["refresh_token"],
+                "grant_type": "refresh_token"
+            })
+        except httpx.HTTPError as e:
+            raise SheetsAppendError(f"не удалось обновить токен Google: {type(e).__name__}", retry=True)
+        if response.status_code >= 500 or response.status_code == 429:
+            raise SheetsAppendError(f"обновление токена Google: ответ {response.status_code}", retry=True)
+        if response.status_code >= 400:
+            raise SheetsAppendError(f"токен Google отозван ({response.status_code}), нужна повторная авторизация")
+        try:
+            data = response.json()
+            token = {**token, "access_token": str(data["access_token"]), "expires_at": time.time() + float(data.get("expires_in", 3600))}
+        except (ValueError, TypeError, KeyError):
+            raise SheetsAppendError(f"некорректный ответ при обновлении токена Google: {response.text[:200]}", retry=True)
+        self.stats["token_refreshes"] += 1
+        try:
+            async with SessionLocal() as db:
+                await db.execute(sa.update(User).where(User.id == user_id).values(google_sheets_token=token))
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Не удалось сохранить обновленный токен Google пользователя {user_id}: {str(e)}")
+        return token
+
+    def _count(self, result: str, rows: int):
+        self.stats[result] += rows
+        google_sheets_rows.labels(result).inc(rows)
+
+def sheet_cell(value: Any) -> Any:
+    """Значение ячейки для записи как есть (RAW): числа без изменений, остальное - строкой"""
+    if value is None:
+        return ""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    if not isinstance(value, str):
+        value = json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else str(value)
+    return value[:SHEETS_CELL_MAX_CHARS]
+
+def conversation_sheet_row(conversation_id, user_message: str, assistant_message: str, duration: float) -> List[Any]:
+    return [
+        "Диалог",
+        datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        str(conversation_id),
+        sheet_cell(user_message),
+        sheet_cell(assistant_message),
+        round(duration, 1)
+    ]
+
+# Единый писатель Google Таблиц для воркера
+sheets_writer = GoogleSheetsWriter(
+    GOOGLE_SHEETS_API_URL,
+    flush_interval_ms=GOOGLE_SHEETS_FLUSH_INTERVAL_MS,
+    batch_rows=GOOGLE_SHEETS_BATCH_ROWS,
+    max_pending_rows=GOOGLE_SHEETS_MAX_PENDING_ROWS,
+    max_retries=GOOGLE_SHEETS_MAX_RETRIES,
+    backoff_max=GOOGLE_SHEETS_BACKOFF_MAX
+)
+cache_bus.subscribe("user", sheets_writer.forget_token)
+cache_bus.subscribe("*", lambda _: sheets_writer.tokens.clear())
+
+def hash_embeddings(texts: List[str], dim: int) -> np.ndarray:
+    """
+    Детерминированный локальный эмбеддинг без сети (feature hashing слов и триграмм символов).
+    Находит фрагменты по общим словам и их частям; используется в тестах и бенчмарках,
+    а также когда KNOWLEDGE_EMBEDDING_MODEL=hash.
+    """
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in re.findall(r"\w+", text.lower()):
+            features = [word] + [word[i:i + 3] for i in range(len(word) - 2)] if len(word) > 3 else [word]
+            for feature in features:
+                h = zlib.crc32(feature.encode())
+                vectors[row, h % dim] += 1.0 if h & 0x80000000 else -1.0
+    return normalize_rows(vectors)
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+async def embed_texts(texts: List[str], model: str, dim: int, api_key: Optional[str] = None) -> np.ndarray:
+    """Нормированные эмбеддинги текстов (матрица len(texts) x dim, float32)"""
+    if model == "hash":
+        if len(texts) <= 8:
+            return hash_embeddings(texts, dim)
+        # Пакет при загрузке документа считается в пуле процессов: в потоке он держал бы GIL цикла событий
+        return await asyncio.get_running_loop().run_in_executor(get_ingest_pool(), hash_embeddings, texts, dim)
+    key_to_use = api_key or OPENAI_API_KEY
+    if not key_to_use:
+        raise ValueError("API ключ OpenAI не предоставлен")
+    vectors = []
+    for i in range(0, len(texts), 256):
+        response = await http_client.post(
+            "https://api.openai.com/v1/embeddings",
+            headers={"Authorization": f"Bearer {key_to_use}"},
+            json={"model": model, "input": texts[i:i + 256], "dimensions": dim}
+        )
+        response.raise_for_status()
+        vectors.extend(item["embedding"] for item in sorted(response.json()["data"], key=lambda item: item["index"]))
+    return normalize_rows(np.array(vectors, dtype=np.float32))
+
+def write_knowledge_index(directory: str, ids: np.ndarray, vectors: np.ndarray, seed: int = 0):
+    """
+    Записывает индекс на диск: vectors.npy (нормированные эмбеддинги), ids.npy (id фрагментов, 16 байт)
+    и offsets.npy. Начиная с KNOWLEDGE_IVF_MIN_CHUNKS фрагментов строки группируются по кластерам
+    сферического k-means (centroids.npy), и строки кластера лежат в файле подряд: поиск читает
+    только несколько непрерывных участков вместо всей матрицы.
+    """
+    os.makedirs(directory, exist_ok=True)
+    count = len(vectors)
+    if count >= KNOWLEDGE_IVF_MIN_CHUNKS:
+        rng = np.random.default_rng(seed)
+        lists = int(np.sqrt(count))
+        sample = vectors[rng.choice(count, size=min(count, lists * 64), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=lists, replace=False)].copy()
+        for _ in range(10):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = normalize_rows(sums)
+        assignment = np.concatenate([
+            np.argmax(vectors[i:i + 16384] @ centroids.T, axis=1) for i in range(0, count, 16384)
+        ])
+        order = np.argsort(assignment, kind="stable")
+        vectors, ids = vectors[order], ids[order]
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=lists))])
+        np.save(os.path.join(directory, "centroids.npy"), centroids)
+    else:
+        offsets = np.array([0, count])
+    np.save(os.path.join(directory, "vectors.npy"), np.ascontiguousarray(vectors, dtype=np.float32))
+    np.save(os.path.join(directory, "ids.npy"), ids)
+    np.save(os.path.join(directory, "offsets.npy"), offsets.astype(np.int64))
+
+class KnowledgeIndex:
+    """
+    Индекс эмбеддингов базы знаний одного ассистента. Файлы открываются через np.load(mmap_mode='r'):
+    память занимают только прочитанные страницы, и они общие для всех воркеров узла.
+    """
+
+    def __init__(self, directory: str, model: str, revision: int):
+        self.directory = directory
+        self.model = model
+        self.revision = revision
+        self.checked_at = time.monotonic()  # Когда версия индекса последний раз сверялась с БД
+        self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"))
+        centroids_path = os.path.join(directory, "centroids.npy")
+        self.centroids = np.load(centroids_path) if os.path.exists(centroids_path) else None
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, query: np.ndarray, k: int, probes: int = KNOWLEDGE_IVF_PROBES) -> List[tuple]:
+        """Top-k фрагментов по косинусной близости: [(id фрагмента, оценка)], лучшие первыми"""
+        if len(self.vectors) == 0:
+            return []
+        if self.centroids is None:
+            ranges = [(0, len(self.vectors))]
+        else:
+            probes = min(probes, len(self.centroids))
+            nearest = np.argpartition(-(self.centroids @ query), probes - 1)[:probes]
+            ranges = [(self.offsets[c], self.offsets[c + 1]) for c in nearest if self.offsets[c + 1] > self.offsets[c]]
+        scores = np.concatenate([self.vectors[start:end] @ query for start, end in ranges])
+        rows = np.concatenate([np.arange(start, end) for start, end in ranges])
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(uuid.UUID(bytes=self.ids[rows[i]].tobytes()), float(scores[i])) for i in top]
+
+# Открытые индексы: assistant_id -> KnowledgeIndex (None - у ассистента нет базы знаний)
+knowledge_indexes = TTLCache(max_size=KNOWLEDGE_INDEX_CACHE_SIZE, ttl=KNOWLEDGE_INDEX_IDLE_TTL)
+knowledge_loading = {}  # assistant_id -> задача загрузки (одна на ассистента, даже при одновременных запросах)
+cache_bus.subscribe("knowledge", knowledge_indexes.pop)
+cache_bus.subscribe("knowledge", assistant_cache.pop)  # Число фрагментов входит в ResolvedAssistant
+cache_bus.subscribe("assistant", knowledge_indexes.pop)
+cache_bus.subscribe("*", lambda _: knowledge_indexes.clear())
+
+async def get_knowledge_index(assistant_id: str) -> Optional[KnowledgeIndex]:
+    """
+    Индекс базы знаний ассистента; при первом обращении открывается (или строится по данным БД).
+    Открытый индекс не реже раза в KNOWLEDGE_INDEX_CHECK_INTERVAL сверяет версию с БД: база знаний
+    могла измениться на другом воркере, а уведомления об инвалидации (NOTIFY) могут быть выключены.
+    """
+    index = knowledge_indexes.get(assistant_id)
+    if index is not _CACHE_MISS and (index is None or time.monotonic() - index.checked_at < KNOWLEDGE_INDEX_CHECK_INTERVAL):
+        return index
+    task = knowledge_loading.get(assistant_id)
+    if task is None:
+        task = asyncio.create_task(load_knowledge_index(assistant_id, index if index is not _CACHE_MISS else None))
+        knowledge_loading[assistant_id] = task
+        task.add_done_callback(lambda _: knowledge_loading.pop(assistant_id, None))
+    return await asyncio.shield(task)
+
+async def load_knowledge_index(assistant_id: str, current: Optional[KnowledgeIndex] = None) -> Optional[KnowledgeIndex]:
+    """Открывает индекс текущей версии базы знаний; current - открытый индекс, если версия не изменилась"""
+    async with SessionLocal() as db:
+        try:
+            result = await db.execute(select(KnowledgeBase).where(KnowledgeBase.assistant_id == assistant_id))
+        except Exception as e:
+            if current is None:
+                raise
+            # БД недоступна: ищем по открытому индексу и сверимся позже
+            logger.error(f"Ошибка при проверке версии базы знаний ассистента {assistant_id}: {str(e)}")
+            current.checked_at = time.monotonic()
+            return current
+        knowledge = result.scalars().first()
+        if knowledge is None or not knowledge.chunks:
+            # Базу знаний могут создать на другом воркере - отсутствие перепроверяется так же часто
+            knowledge_indexes.set(assistant_id, None, ttl=KNOWLEDGE_INDEX_CHECK_INTERVAL)
+            return None
+        if current is not None and current.revision == knowledge.revision:
+            current.checked_at = time.monotonic()
+            return current
+        directory = os.path.join(KNOWLEDGE_INDEX_DIR, str(assistant_id), str(knowledge.revision))
+        if not os.path.exists(os.path.join(directory, "offsets.npy")):
+            start = time.perf_counter()
+            result = await db.execute(select(KnowledgeChunk.id, KnowledgeChunk.embedding).where(
+                KnowledgeChunk.assistant_id == assistant_id
+            ))
+            rows = result.all()
+            await asyncio.to_thread(build_knowledge_index_files, directory, rows, knowledge.dim)
+            logger.info(f"Индекс базы знаний ассистента {assistant_id} (версия {knowledge.revision}, "
+                        f"{len(rows)} фрагментов) построен за {(time.perf_counter() - start) * 1000:.0f} мс")
+    index = await asyncio.to_thread(KnowledgeIndex, directory, knowledge.embedding_model, knowledge.revision)
+    knowledge_indexes.set(assistant_id, index)
+    return index
+
+def build_knowledge_index_files(directory: str, rows, dim: int):
+    """Строит файлы индекса во временном каталоге и атомарно переименовывает его (воркеры могут строить одновременно)"""
+    ids = np.frombuffer(b"".join(row[0].bytes for row in rows), dtype=np.uint8).reshape(-1, 16)
+    vectors = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(-1, dim)
+    staging = f"{directory}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    write_knowledge_index(staging, ids, vectors)
+    try:
+        os.rename(staging, directory)
+    except OSError:
+        # Другой воркер успел построить эту версию индекса
+        shutil.rmtree(staging, ignore_errors=True)
+    # Файлы прежних версий больше не нужны (открытые отображения остаются доступными до закрытия)
+    parent = os.path.dirname(directory)
+    for name in os.listdir(parent):
+        if name != os.path.basename(directory) and "." not in name:
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+async def bump_knowledge_revision(db, assistant_id, embedding_model: str, dim: int):
+    """Новая версия базы знаний после изменения фрагментов (вызывается в транзакции изменения)"""
+    count = (await db.execute(select(func.count()).where(KnowledgeChunk.assistant_id == assistant_id))).scalar()
+    statement = pg_insert(KnowledgeBase).values(assistant_id=assistant_id, revision=1, embedding_model=embedding_model, dim=dim, chunks=count)
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=[KnowledgeBase.assistant_id],
+        set_={
+            "revision": KnowledgeBase.revision + 1,
+            "embedding_model": embedding_model,
+            "dim": dim,
+            "chunks": count,
+            "updated_at": func.now()
+        }
+    ))
+
+async def search_knowledge(assistant_id: str, query: str, k: int = KNOWLEDGE_SEARCH_TOP_K, api_key: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Поиск фрагментов базы знаний ассистента, ближайших к запросу"""
+    index = await get_knowledge_index(assistant_id)
+    if index is None or not query.strip():
+        return []
+    start = time.perf_counter()
+    vector = (await embed_texts([query], index.model, index.vectors.shape[1], api_key))[0]
+    embedded = time.perf_counter()
+    found = index.search(vector, k)
+    knowledge_search_seconds.labels("embed").observe(embedded - start)
+    knowledge_search_seconds.labels("search").observe(time.perf_counter() - embedded)
+    if not found:
+        return []
+    async with SessionLocal() as db:
+        result = await db.execute(select(KnowledgeChunk.id, KnowledgeChunk.source, KnowledgeChunk.text).where(
+            KnowledgeChunk.id.in_([chunk_id for chunk_id, _ in found])
+        ))
+        chunks = {row.id: row for row in result.all()}
+    return [
+        {"id": str(chunk_id), "source": chunks[chunk_id].source, "text": chunks[chunk_id].text, "score": round(score, 4)}
+        for chunk_id, score in found if chunk_id in chunks
+    ]
+
+# Инструмент realtime-сессии для ассистентов с базой знаний
+KNOWLEDGE_TOOL_NAME = "search_knowledge"
+KNOWLEDGE_TOOL = {
+    "type": "function",
+    "name": KNOWLEDGE_TOOL_NAME,
+    "description": "Поиск в базе знаний компании (документы, прайс-листы, условия, FAQ). "
+                   "Используй перед ответом на вопросы о компании, ее услугах и правилах.",
+    "parameters": {
+        "type": "object",
+        "properties": {"query": {"type": "string", "description": "Поисковый запрос своими словами"}},
+        "required": ["query"]
+    }
+}
+
+# Выполнение вызовов функций ассистента на сервере. Функция из AssistantConfig.functions
+# выполняется relay, если в ее описании есть обработчик, например:
+#   {"name": "get_order", "description": "...", "parameters": {...},
+#    "handler": {"type": "webhook", "url": "https://example.com/hook", "headers": {...}, "timeout": 5}}
+#   {"name": "now", ..., "handler": {"type": "builtin", "name": "current_time"}}
+#   {"name": "save_lead", ..., "handler": {"type": "builtin"}} - заявка (name, phone, email, comment) в Google Таблицу
+# Функции без обработчика, как и раньше, только пересылаются клиенту.
+# Результаты справочных функций можно кэшировать (по выбранным аргументам, ttl в секундах):
+#   {"name": "get_price", ..., "handler": {...}, "cache": {"ttl": 300, "key": ["sku"], "max_size": 500}}
+
+class ToolCallError(Exception):
+    """Ошибка выполнения функции: текст уходит модели как результат вызова"""
+
+
+class ToolCall(NamedTuple):
+    """Вызов функции моделью"""
+    client_id: str
+    assistant_id: str
+    call_id: str
+    name: str
+    spec: Dict[str, Any]  # Описание функции из AssistantConfig.functions (с обработчиком)
+    api_key: Optional[str]
+
+
+async def builtin_search_knowledge(call: ToolCall, arguments: Dict[str, Any]):
+    found = await search_knowledge(call.assistant_id, str(arguments.get("query", "")), api_key=call.api_key)
+    parts, size = [], 0
+    for chunk in found:
+        if size + len(chunk["text"]) > KNOWLEDGE_TOOL_MAX_CHARS and parts:
+            break
+        parts.append({"source": chunk["source"], "text": chunk["text"]})
+        size += len(chunk["text"])
+    return {"results": parts} if parts else {"results": [], "note": "Ничего не найдено"}
+
+
+async def builtin_current_time(call: ToolCall, arguments: Dict[str, Any]):
+    name = arguments.get("timezone") or call.spec["handler"].get("timezone") or "Europe/Moscow"
+    try:
+        zone = ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ToolCallError(f"Неизвестный часовой пояс: {name}")
+    now = datetime.now(zone)
+    return {"datetime": now.isoformat(timespec="seconds"), "timezone": name, "weekday": now.strftime("%A")}
+
+
+LEAD_FIELDS = ("name", "phone", "email", "comment")  # Столбцы заявки; остальные аргументы пишутся JSON в последний столбец
+
+
+async def builtin_save_lead(call: ToolCall, arguments: Dict[str, Any]):
+    assistant = await get_resolved_assistant(call.assistant_id)
+    if assistant is None or not assistant.google_sheet_id:
+        raise ToolCallError("Google Таблица для заявок не подключена")
+    extra = {key: value for key, value in arguments.items() if key not in LEAD_FIELDS}
+    row = ["Заявка", datetime.now(timezone.utc).isoformat(timespec="seconds"), call.client_id]
+    row += [sheet_cell(arguments.get(field)) for field in LEAD_FIELDS]
+    row.append(sheet_cell(extra) if extra else "")
+    # Строка уходит в таблицу в фоне вместе с остальными: модель не ждет Sheets API
+    if not sheets_writer.append(assistant.user_id, assistant.google_sheet_id, GOOGLE_SHEETS_LEADS_RANGE, row):
+        raise ToolCallError("Не удалось сохранить заявку, попробуйте позже")
+    return {"saved": True}
+
+
+# Встроенные функции: имя -> async (вызов, аргументы) -> результат
+BUILTIN_TOOLS = {
+    KNOWLEDGE_TOOL_NAME: builtin_search_knowledge,
+    "current_time": builtin_current_time,
+    "save_lead": builtin_save_lead,
+}
+
+
+def is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%")[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global
+
+
+def check_webhook_url(url: Any):
+    """Проверка адреса webhook без обращения к DNS: https и не IP внутренней сети"""
+    parsed = urlsplit(str(url or ""))
+    if parsed.scheme != "https" and not (TOOL_WEBHOOK_ALLOW_PRIVATE and parsed.scheme == "http"):
+        raise ValueError("Адрес webhook должен начинаться с https://")
+    if not parsed.hostname:
+        raise ValueError("В адресе webhook нет имени хоста")
+    if TOOL_WEBHOOK_ALLOW_PRIVATE:
+        return parsed
+    try:
+        internal = not is_public_address(parsed.hostname)
+    except ValueError:
+        # Имя, а не IP: адреса проверяются после разрешения в resolve_webhook_url
+        internal = parsed.hostname == "localhost" or parsed.hostname.endswith((".localhost", ".local", ".internal"))
+    if internal:
+        raise ValueError("Адрес webhook не может указывать во внутреннюю сеть")
+    return parsed
+
+
+async def resolve_webhook_url(url: str):
+    """
+    Разрешает имя хоста webhook и проверяет все его адреса: ни один не должен быть
+    loopback, частным, link-local (169.254.169.254) или иным не публичным.
+    Возвращает разобранный адрес и IP, к которому нужно подключаться.
+    """
+    parsed = check_webhook_url(url)
+    try:
+        # IP в адресе уже проверен check_webhook_url
+        return parsed, str(ipaddress.ip_address(parsed.hostname))
+    except ValueError:
+        pass
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            parsed.hostname, parsed.port or (443 if parsed.scheme == "https" else 80), type=socket.SOCK_STREAM
+        )
+    except socket.gaierror:
+        raise ValueError(f"Не удалось разрешить имя хоста webhook {parsed.hostname}")
+    addresses = [info[4][0] for info in infos]
+    if not addresses:
+        raise ValueError(f"Не удалось разрешить имя хоста webhook {parsed.hostname}")
+    if not TOOL_WEBHOOK_ALLOW_PRIVATE and not all(is_public_address(address) for address in addresses):
+        raise ValueError("Адрес webhook не может указывать во внутреннюю сеть")
+    return parsed, addresses[0]
+
+
+async def check_function_webhooks(functions: Optional[List[Dict[str, Any]]]):
+    """Проверка адресов webhook с разрешением имен (при сохранении функций ассистента)"""
+    for function in functions or []:
+        handler = function.get("handler")
+        if isinstance(handler, dict) and handler.get("type") == "webhook":
+            try:
+                await resolve_webhook_url(handler["url"])
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f'Функция {function.get("name")}: {str(e)}')
+
+
+async def run_webhook_tool(call: ToolCall, arguments: Dict[str, Any]):
+    """POST на адрес обработчика; ответ (JSON или текст) становится результатом вызова"""
+    handler = call.spec["handler"]
+    try:
+        parsed, address = await resolve_webhook_url(handler["url"])
+    except ValueError as e:
+        raise ToolCallError(str(e))
+    # Подключаемся к проверенному IP, а не разрешаем имя еще раз (иначе DNS мог бы подменить адрес
+    # между проверкой и запросом); имя хоста остается в Host и SNI, сертификат проверяется по нему
+    host = f"[{address}]" if ":" in address else address
+    response = await http_client.post(
+        parsed._replace(netloc=f"{host}:{parsed.port}" if parsed.port else host).geturl(),
+        extensions={"sni_hostname": parsed.hostname},
+        json={
+            "name": call.name,
+            "arguments": arguments,
+            "call_id": call.call_id,
+            "assistant_id": call.assistant_id,
+            "client_id": call.client_id
+        },
+        headers={**(handler.get("headers") or {}), "Host": parsed.netloc.rpartition("@")[2]},
+        timeout=tool_call_timeout(call.spec)
+    )
+    if response.status_code >= 400:
+        raise ToolCallError(f"Сервис функции ответил ошибкой {response.status_code}")
+    try:
+        return response.json()
+    except ValueError:
+        return response.text
+
+
+async def run_builtin_tool(call: ToolCall, arguments: Dict[str, Any]):
+    builtin = BUILTIN_TOOLS.get(call.spec["handler"].get("name") or call.name)
+    if builtin is None:
+        raise ToolCallError(f"Встроенная функция {call.name} не найдена")
+    return await builtin(call, arguments)
+
+
+# Обработчики вызовов по типу: handler.type -> async (вызов, аргументы) -> результат
+TOOL_HANDLERS = {
+    "webhook": run_webhook_tool,
+    "builtin": run_builtin_tool,
+}
+
+
+def tool_call_timeout(spec: Dict[str, Any]) -> float:
+    return min(float(spec["handler"].get("timeout") or TOOL_CALL_TIMEOUT), TOOL_CALL_MAX_TIMEOUT)
+
+
+def validate_function_handlers(functions: Optional[List[Dict[str, Any]]]):
+    """Проверка обработчиков в описаниях функций ассистента (для валидаторов схем)"""
+    for function in functions or []:
+        handler = function.get("handler")
+        if handler is None:
+            continue
+        if not isinstance(handler, dict) or handler.get("type") not in TOOL_HANDLERS:
+            raise ValueError(f'Тип обработчика функции должен быть одним из {", ".join(TOOL_HANDLERS)}')
+        if handler["type"] == "webhook":
+            try:
+                check_webhook_url(handler.get("url"))
+            except ValueError as e:
+                raise ValueError(f'Функция {function.get("name")}: {str(e)}')
+        if handler["type"] == "builtin" and (handler.get("name") or function.get("name")) not in BUILTIN_TOOLS:
+            raise ValueError(f'Встроенная функция должна быть одной из {", ".join(BUILTIN_TOOLS)}')
+        timeout = handler.get("timeout")
+        if timeout is not None and (not isinstance(timeout, (int, float)) or not 0 < timeout <= TOOL_CALL_MAX_TIMEOUT):
+            raise ValueError(f'Таймаут функции должен быть от 0 до {TOOL_CALL_MAX_TIMEOUT:g} секунд')
+        cache = function.get("cache")
+        if cache is None:
+            continue
+        if not isinstance(cache, dict):
+            raise ValueError('Настройки кэша функции должны быть объектом {"ttl", "key", "max_size"}')
+        ttl = cache.get("ttl")
+        if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or not 0 < ttl <= TOOL_CACHE_MAX_TTL:
+            raise ValueError(f'Время жизни кэша функции (ttl) должно быть от 0 до {TOOL_CACHE_MAX_TTL:g} секунд')
+        key = cache.get("key")
+        if key is not None and (not isinstance(key, list) or not all(isinstance(field, str) for field in key)):
+            raise ValueError('Ключ кэша функции (key) должен быть списком имен аргументов')
+        max_size = cache.get("max_size")
+        if max_size is not None and (isinstance(max_size, bool) or not isinstance(max_size, int) or not 0 < max_size <= TOOL_CACHE_MAX_SIZE):
+            raise ValueError(f'Размер кэша функции (max_size) должен быть от 1 до {TOOL_CACHE_MAX_SIZE}')
+
+
+def build_tool_specs(functions: Optional[List[Dict[str, Any]]], knowledge: bool) -> Dict[str, Dict[str, Any]]:
+    """Функции сессии, которые выполняет сервер: имя -> описание с обработчиком"""
+    specs = {
+        function["name"]: function
+        for function in functions or []
+        if isinstance(function.get("handler"), dict) and function["handler"].get("type") in TOOL_HANDLERS
+    }
+    if knowledge:
+        specs[KNOWLEDGE_TOOL_NAME] = {"name": KNOWLEDGE_TOOL_NAME, "handler": {"type": "builtin"}}
+    return specs
+
+
+class ToolCallTracker:
+    """
+    Вызовы функций одной сессии OpenAI. Результат каждого вызова отправляется сразу
+    (conversation.item.create), а response.create - один раз, когда завершились все вызовы
+    ответа и пришел его response.done: иначе параллельные вызовы запустили бы несколько
+    ответов, а response.create во время активного ответа OpenAI отклоняет.
+    """
+
+    def __init__(self, client_id: str):
+        self.client_id = client_id
+        self.pending = {}  # response_id -> call_id незавершенных вызовов
+        self.done = {}     # response_id -> статус response.done
+
+    def start(self, call: ToolCall, response_id: str, arguments: Optional[str]):
+        self.pending.setdefault(response_id, set()).add(call.call_id)
+        task = asyncio.create_task(self._run(call, response_id, arguments))
+        tool_call_tasks.add(task)
+        task.add_done_callback(tool_call_tasks.discard)
+
+    def response_done(self, response_id: str, status: Optional[str]):
+        if response_id in self.pending:
+            self.done[response_id] = status
+            self._continue(response_id)
+
+    async def _run(self, call: ToolCall, response_id: str, arguments: Optional[str]):
+        output = await execute_tool_call(call, arguments)
+        connection = client_connections.get(self.client_id)
+        if connection is None or connection.get("tool_calls") is not self:
+            # Сессия OpenAI сменилась (переподключение): вызова в ней уже нет
+            return
+        connection["queues"]["upstream"].put(json.dumps({
+            "type": "conversation.item.create",
+            "item": {"type": "function_call_output", "call_id": call.call_id, "output": output}
+        }, ensure_ascii=False), "tool")
+        self.pending[response_id].discard(call.call_id)
+        self._continue(response_id)
+
+    def _continue(self, response_id: str):
+        if self.pending.get(response_id) or response_id not in self.done:
+            return
+        del self.pending[response_id]
+        # Прерванный пользователем ответ не продолжаем: модель ответит на новую реплику
+        if self.done.pop(response_id) != "cancelled":
+            client_connections[self.client_id]["queues"]["upstream"].put(json.dumps({"type": "response.create"}), "tool")
+
+
+tool_call_tasks = set()  # Выполняющиеся вызовы функций (ссылки держатся до завершения)
+tool_call_slots = asyncio.Semaphore(TOOL_CALL_MAX_CONCURRENCY)
+
+
+async def call_tool_handler(call: ToolCall, arguments: Dict[str, Any]) -> str:
+    """Вызов обработчика функции с ограничением параллельности и таймаутом"""
+    async with tool_call_slots:
+        result = await asyncio.wait_for(
+            TOOL_HANDLERS[call.spec["handler"]["type"]](call, arguments),
+            timeout=tool_call_timeout(call.spec)
+        )
+    return result if isinstance(result, str) else json.dumps(result, ensure_ascii=False)
+
+
+def tool_cache_key(config: Dict[str, Any], arguments: Dict[str, Any]) -> str:
+    """Канонический вид аргументов (только поля из key, если он задан): порядок и пробелы не влияют"""
+    fields = config.get("key")
+    if fields is not None:
+        arguments = {field: arguments.get(field) for field in fields}
+    return json.dumps(arguments, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+
+def tool_spec_hash(spec: Dict[str, Any]) -> str:
+    """Отпечаток обработчика и настроек кэша: после их изменения прежние результаты не совпадут по ключу"""
+    canonical = json.dumps({"handler": spec.get("handler"), "cache": spec.get("cache")}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()[:16]
+
+
+async def load_tool_cache_generation(assistant_id: str) -> Optional[int]:
+    async with SessionLocal() as db:
+        result = await db.execute(select(AssistantConfig.tool_cache_generation).where(AssistantConfig.id == assistant_id))
+        return result.scalar()
+
+
+class ToolResultCache:
+    """
+    Кэш результатов функций одного ассистента: по TTLCache на функцию (LRU и время жизни
+    из настроек cache в ее описании) и не больше одного выполняющегося вызова на ключ -
+    одинаковые вызовы из разных сессий ждут его результат. Кэшируются только успешные вызовы.
+
+    Ключ включает отпечаток обработчика функции. Не реже раза в TOOL_CACHE_GENERATION_TTL
+    кэш сверяет поколение из БД (растет при сбросе через API на любом воркере) и при
+    расхождении сбрасывает результаты - это не зависит от CACHE_INVALIDATION_NOTIFY.
+    """
+
+    def __init__(self, assistant_id: str):
+        self.assistant_id = assistant_id
+        self.functions = {}  # имя функции -> TTLCache: ключ -> (результат, длительность вызова в секундах)
+        self.loading = {}    # (имя функции, ключ) -> задача вызова
+        self.stats = {}      # имя функции -> счетчики попаданий и сэкономленного времени
+        self.generation = None   # Поколение из БД, к которому относятся результаты
+        self.checked_at = 0.0    # Когда поколение сверялось с БД (time.monotonic)
+        self.checking = None     # Выполняющаяся сверка (одна на все одновременные вызовы)
+
+    async def check_generation(self):
+        if time.monotonic() - self.checked_at < TOOL_CACHE_GENERATION_TTL:
+            return
+        if self.checking is None:
+            self.checking = asyncio.create_task(self._load_generation())
+        await asyncio.shield(self.checking)
+
+    async def _load_generation(self):
+        try:
+            generation = await load_tool_cache_generation(self.assistant_id)
+            if generation is not None and generation != self.generation:
+                self.clear()
+                self.generation = generation
+        except Exception as e:
+            # БД недоступна: работаем с текущими результатами и повторим сверку позже
+            logger.error(f"Ошибка при проверке поколения кэша функций ассистента {self.assistant_id}: {str(e)}")
+        finally:
+            self.checked_at = time.monotonic()
+            self.checking = None
+
+    def function_cache(self, name: str, config: Dict[str, Any]) -> TTLCache:
+        ttl = float(config["ttl"])
+        max_size = int(config.get("max_size") or TOOL_CACHE_DEFAULT_SIZE)
+        results = self.functions.get(name)
+        if results is None or results.ttl != ttl or results.max_size != max_size:
+            results = self.functions[name] = TTLCache(max_size, ttl)
+        return results
+
+    async def call(self, call: ToolCall, arguments: Dict[str, Any]) -> Tuple[str, str]:
+        """Результат вызова и его статус для метрик (cached - без обращения к обработчику)"""
+        await self.check_generation()
+        results = self.function_cache(call.name, call.spec["cache"])
+        key = f"{tool_spec_hash(call.spec)}:{tool_cache_key(call.spec['cache'], arguments)}"
+        entry = results.get(key)
+        if entry is not _CACHE_MISS:
+            self._record(call.name, "hit", entry[1])
+            return entry[0], "cached"
+        task = self.loading.get((call.name, key))
+        if task is not None:
+            start = time.perf_counter()
+            output, elapsed = await asyncio.shield(task)
+            # Своего вызова не было, но часть его длительности сессия все же прождала
+            self._record(call.name, "shared", max(elapsed - (time.perf_counter() - start), 0.0))
+            return output, "cached"
+        task = asyncio.create_task(self._run(call, arguments, results, key))
+        self.loading[(call.name, key)] = task
+        tool_call_tasks.add(task)
+        task.add_done_callback(lambda done: self._forget((call.name, key), done))
+        self._record(call.name, "miss", 0.0)
+        output, _ = await asyncio.shield(task)
+        return output, "ok"
+
+    async def _run(self, call: ToolCall, arguments: Dict[str, Any], results: TTLCache, key: str) -> Tuple[str, float]:
+        start = time.perf_counter()
+        output = await call_tool_handler(call, arguments)
+        elapsed = time.perf_counter() - start
+        results.set(key, (output, elapsed))
+        return output, elapsed
+
+    def _forget(self, loading_key, task: asyncio.Task):
+        tool_call_tasks.discard(task)
+        if self.loading.get(loading_key) is task:
+            del self.loading[loading_key]
+
+    def _record(self, name: str, result: str, saved: float):
+        stats = self.stats.setdefault(name, {"hits": 0, "shared": 0, "misses": 0, "saved_seconds": 0.0})
+        stats["misses" if result == "miss" else "hits" if result == "hit" else "shared"] += 1
+        stats["saved_seconds"] += saved
+        tool_cache_requests.labels(self.assistant_id, result).inc()
+        if saved:
+            tool_cache_saved_seconds.labels(self.assistant_id).inc(saved)
+
+    def clear(self):
+        """Сбрасывает результаты (счетчики сохраняются); выполняющиеся вызовы в кэш уже не попадут"""
+        self.functions.clear()
+        self.loading.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        functions = {}
+        for name, stats in self.stats.items():
+            total = stats["hits"] + stats["shared"] + stats["misses"]
+            results = self.functions.get(name)
+            functions[name] = {
+                "size": len(results.data) if results is not None else 0,
+                "ttl": results.ttl if results is not None else None,
+                "max_size": results.max_size if results is not None else None,
+                "hits": stats["hits"],
+                "shared": stats["shared"],
+                "misses": stats["misses"],
+                "hit_rate": round((stats["hits"] + stats["shared"]) / total, 4) if total else 0.0,
+                "saved_ms": round(stats["saved_seconds"] * 1000, 1),
+            }
+        return {
+            "hits": sum(item["hits"] for item in functions.values()),
+            "shared": sum(item["shared"] for item in functions.values()),
+            "misses": sum(item["misses"] for item in functions.values()),
+            "saved_ms": round(sum(item["saved_ms"] for item in functions.values()), 1),
+            "functions": functions,
+        }
+
+
+# Кэши результатов функций по ассистентам (время жизни продлевается при каждом вызове)
+tool_result_caches = TTLCache(max_size=TOOL_CACHE_ASSISTANTS, ttl=TOOL_CACHE_IDLE_TTL)
+
+
+def get_tool_result_cache(assistant_id: str) -> ToolResultCache:
+    cache = tool_result_caches.get(assistant_id)
+    if cache is _CACHE_MISS:
+        cache = ToolResultCache(assistant_id)
+    tool_result_caches.set(assistant_id, cache)
+    return cache
+
+
+def reset_tool_result_cache(assistant_id: str):
+    """Функции или их обработчики могли измениться: прежние результаты больше не используются"""
+    entry = tool_result_caches.data.get(assistant_id)
+    if entry is not None:
+        entry[1].clear()
+        entry[1].checked_at = 0.0  # Новое поколение перечитывается при следующем вызове
+
+
+def reset_all_tool_result_caches(_=None):
+    for _, cache in tool_result_caches.data.values():
+        cache.clear()
+
+
+cache_bus.subscribe("assistant", reset_tool_result_cache)
+cache_bus.subscribe("tool_cache", reset_tool_result_cache)
+cache_bus.subscribe("*", reset_all_tool_result_caches)
+
+
+async def execute_tool_call(call: ToolCall, arguments: Optional[str]) -> str:
+    """Выполняет вызов обработчиком функции; ошибки и таймаут тоже возвращаются модели результатом"""
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        parsed = json.loads(arguments or "{}")
+        if not isinstance(parsed, dict):
+            raise ToolCallError("Аргументы функции должны быть объектом JSON")
+        if isinstance(call.spec.get("cache"), dict):
+            output, status = await get_tool_result_cache(str(call.assistant_id)).call(call, parsed)
+        else:
+            output = await call_tool_handler(call, parsed)
+    except asyncio.TimeoutError:
+        status = "timeout"
+        output = json.dumps({"error": "Функция не ответила вовремя"}, ensure_ascii=False)
+    except (ToolCallError, json.JSONDecodeError) as e:
+        status = "error"
+        output = json.dumps({"error": str(e)}, ensure_ascii=False)
+    except Exception as e:
+        status = "error"
+        logger.error(f"Ошибка выполнения функции {call.name} для клиента {call.client_id}: {str(e)}")
+        output = json.dumps({"error": "Функция временно недоступна"}, ensure_ascii=False)
+    elapsed = time.perf_counter() - start
+    tool_call_seconds.labels(call.name, status).observe(elapsed)
+    logger.info(f"[Функция] {call.name} для клиента {call.client_id}: {status}, {elapsed * 1000:.0f} мс")
+    if len(output) > TOOL_OUTPUT_MAX_CHARS:
+        output = output[:TOOL_OUTPUT_MAX_CHARS]
+    return output
+
+# Загрузка документов в базу знаний: форматы по расширению имени файла
+KNOWLEDGE_FILE_KINDS = {
+    ".txt": "text",
+    ".md": "markdown",
+    ".markdown": "markdown",
+    ".html": "html",
+    ".htm": "html",
+    ".csv": "csv",
+}
+
+HTML_DROP_RE = re.compile(r"<(script|style|noscript|template)\b.*?</\1\s*>|<!--.*?-->", re.IGNORECASE | re.DOTALL)
+HTML_BLOCK_RE = re.compile(r"<\s*/?\s*(p|div|br|li|ul|ol|tr|table|h[1-6]|section|article|header|footer|blockquote|pre|hr)\b[^>]*>", re.IGNORECASE)
+HTML_TAG_RE = re.compile(r"<[^>]*>")
+MARKDOWN_LINK_RE = re.compile(r"!?\[([^\]]*)\]\([^)]*\)")
+MARKDOWN_MARKUP_RE = re.compile(r"^\s{0,3}(#{1,6}\s+|>\s?|[-*+]\s+|\d+\.\s+)|[*_`~]{1,3}", re.MULTILINE)
+SENTENCE_END_RE = re.compile(r"(?<=[.!?…])\s+")
+PARAGRAPH_RE = re.compile(r"\n\s*\n")
+
+def normalize_document_text(raw: str, kind: str, csv_state: Optional[tuple]) -> tuple:
+    """
+    Приводит блок документа к простому тексту с абзацами через пустую строку.
+    Для CSV каждая строка становится абзацем "колонка: значение; ..."; csv_state
+    (разделитель, заголовок) определяется по первому блоку и передается в следующие.
+    """
+    if kind == "html":
+        raw = HTML_DROP_RE.sub(" ", raw)
+        raw = HTML_BLOCK_RE.sub("\n\n", raw)
+        raw = html.unescape(HTML_TAG_RE.sub(" ", raw))
+    elif kind == "markdown":
+        raw = MARKDOWN_MARKUP_RE.sub("", MARKDOWN_LINK_RE.sub(r"\1", raw))
+    elif kind == "csv":
+        lines = raw.splitlines()
+        if csv_state is None:
+            try:
+                delimiter = csv.Sniffer().sniff("\n".join(lines[:20]), delimiters=",;\t").delimiter
+            except csv.Error:
+                delimiter = ","
+            rows = csv.reader(lines, delimiter=delimiter)
+            csv_state = (delimiter, [column.strip() for column in next(rows, [])])
+        else:
+            rows = csv.reader(lines, delimiter=csv_state[0])
+        header = csv_state[1]
+        paragraphs = []
+        for row in rows:
+            cells = [
+                f"{header[i]}: {value.strip()}" if i < len(header) and header[i] else value.strip()
+                for i, value in enumerate(row) if value.strip()
+            ]
+            if cells:
+                paragraphs.append("; ".join(cells))
+        return "\n\n" + "\n\n".join(paragraphs), csv_state
+    lines = [" ".join(line.split()) for line in raw.replace("\r\n", "\n").replace("\r", "\n").split("\n")]
+    return "\n".join(lines), csv_state
+
+def split_long_paragraph(paragraph: str, limit: int) -> List[str]:
+    """Делит абзац длиннее limit по границам предложений (предложение длиннее limit - по limit символов)"""
+    pieces, current = [], ""
+    for sentence in SENTENCE_END_RE.split(paragraph):
+        while len(sentence) > limit:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(sentence[:limit])
+            sentence = sentence[limit:]
+        if current and len(current) + len(sentence) + 1 > limit:
+            pieces.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        pieces.append(current)
+    return pieces
+
+def chunk_document_block(tail: str, raw: str, kind: str, csv_state: Optional[tuple], final: bool,
+                         min_chars: int = KNOWLEDGE_CHUNK_MIN_CHARS, max_chars: int = KNOWLEDGE_CHUNK_MAX_CHARS) -> tuple:
+    """
+    Нормализует и режет на фрагменты очередной блок документа (выполняется в пуле процессов).
+
+    Фрагмент набирается из целых абзацев и закрывается после абзаца, хэш которого делится
+    на 4 (при длине не меньше min_chars), или перед превышением max_chars. Границы зависят
+    только от содержимого: правка в середине документа меняет лишь ближайшие фрагменты,
+    остальные при повторной загрузке совпадают по хэшу.
+
+    tail - незакрытый фрагмент и неполный последний абзац предыдущего блока. Возвращает
+    ([(sha1, текст)], новый tail, csv_state); при final=True tail пуст.
+    """
+    text, csv_state = normalize_document_text(raw, kind, csv_state)
+    paragraphs = [paragraph.strip() for paragraph in PARAGRAPH_RE.split(tail + ("\n\n" if kind == "csv" else "\n") + text)]
+    partial = "" if final else paragraphs.pop()
+    if len(partial) > max_chars:
+        # Документ без пустых строк: копить один абзац до конца файла нельзя
+        pieces = split_long_paragraph(partial, max_chars)
+        partial = pieces.pop()
+        paragraphs.extend(pieces)
+    chunks, current, size = [], [], 0
+    for paragraph in paragraphs:
+        if not paragraph:
+            continue
+        for piece in split_long_paragraph(paragraph, max_chars) if len(paragraph) > max_chars else [paragraph]:
+            if current and size + len(piece) > max_chars:
+                chunks.append("\n\n".join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece) + 2
+            if size >= min_chars and zlib.crc32(piece.encode()) % 4 == 0:
+                chunks.append("\n\n".join(current))
+                current, size = [], 0
+    if final:
+        if current:
+            chunks.append("\n\n".join(current))
+        tail = ""
+    else:
+        tail = "\n\n".join(current + [partial])
+    return [(hashlib.sha1(chunk.encode()).hexdigest(), chunk) for chunk in chunks], tail, csv_state
+
+def document_block_cut(buffer: str, kind: str) -> int:
+    """Позиция, до которой буфер можно отдать в разбор, не разрезая строку (для HTML - тег и скрипт)"""
+    if kind == "html":
+        lower = buffer.lower()
+        opened = max(lower.rfind("<script"), lower.rfind("<style"), lower.rfind("<!--"))
+        closed = max(lower.rfind("</script"), lower.rfind("</style"), lower.rfind("-->"))
+        end = opened if opened > closed else len(buffer)
+        cut = buffer.rfind(">", 0, end) + 1
+    else:
+        cut = buffer.rfind("\n") + 1
+    return cut or len(buffer)
+
+_ingest_pool = None
+
+def get_ingest_pool() -> ProcessPoolExecutor:
+    """
+    Пул процессов для разбора документов; создается при первой загрузке (spawn - безопасно
+    при работающих потоках). Процессы пула работают с пониженным приоритетом, чтобы разбор
+    большого документа не отнимал процессор у цикла событий relay.
+    """
+    global _ingest_pool
+    if _ingest_pool is None:
+        _ingest_pool = ProcessPoolExecutor(
+            max_workers=KNOWLEDGE_INGEST_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=os.nice,
+            initargs=(10,)
+        )
+    return _ingest_pool
+
+class MultipartFileStream:
+    """
+    Потоковый разбор multipart/form-data: возвращает данные поля-файла по мере поступления
+    кусков тела запроса, не собирая файл целиком ни в памяти, ни во временном файле.
+    """
+
+    def __init__(self, content_type: str, field_name: str = "file"):
+        _, params = parse_options_header(content_type)
+        boundary = params.get(b"boundary")
+        if not boundary:
+            raise ValueError("В запросе нет boundary multipart")
+        self.field_name = field_name
+        self.filename = None
+        self.finished = False
+        self._in_file = False
+        self._header_field = b""
+        self._header_value = b""
+        self._headers = {}
+        self._data = []
+        self.parser = multipart.MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        """Передает кусок тела запроса; возвращает прочитанные из него байты файла"""
+        self.parser.write(chunk)
+        data, self._data = self._data, []
+        return data
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_part_data(self, data, start, end):
+        if self._in_file:
+            self._data.append(bytes(data[start:end]))
+
+    def _on_part_end(self):
+        if self._in_file:
+            self._in_file = False
+            self.finished = True
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, params = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if params.get(b"name", b"").decode("utf-8", "replace") == self.field_name and b"filename" in params and not self.finished:
+            self.filename = params[b"filename"].decode("utf-8", "replace")
+            self.content_type = self._headers.get(b"content-type", b"").decode("latin-1") or None
+            self._in_file = True
+
+def make_text_decoder(sample: bytes):
+    """Инкрементальный декодер по первым байтам файла: UTF-8 (с BOM или без), иначе cp1251"""
+    try:
+        codecs.getincrementaldecoder("utf-8")("strict").decode(sample, final=False)
+        return codecs.getincrementaldecoder("utf-8-sig")("replace")
+    except UnicodeDecodeError:
+        return codecs.getincrementaldecoder("cp1251")("replace")
+
+async def update_knowledge_file(file_id, **values):
+    """Обновляет состояние загрузки отдельной короткой транзакцией (его видят все воркеры)"""
+    async with SessionLocal() as db:
+        await db.execute(sa.update(KnowledgeFile).where(KnowledgeFile.id == file_id).values(**values))
+        await db.commit()
+
+MOVE_KNOWLEDGE_CHUNKS_SQL = sa.text("""
+    UPDATE knowledge_chunks AS c SET file_id = :file_id, position = m.position
+    FROM unnest(CAST(:hashes AS varchar[]), CAST(:positions AS integer[])) AS m(content_hash, position)
+    WHERE c.file_id = ANY(:previous_files) AND c.content_hash = m.content_hash
+""").bindparams(sa.bindparam("previous_files", type_=sa.ARRAY(UUID(as_uuid=True))))
+
+class KnowledgeIngestion:
+    """
+    Загрузка документа в базу знаний в одной транзакции db. Фрагменты, уже проиндексированные
+    в прежней версии документа с тем же именем (совпал хэш текста), переносятся вместе
+    с эмбеддингом; новые эмбеддятся и записываются пакетами по KNOWLEDGE_INGEST_BATCH.
+    """
+
+    def __init__(self, db, knowledge_file: KnowledgeFile, embedding_model: str, dim: int, api_key: Optional[str]):
+        self.db = db
+        self.file = knowledge_file
+        self.embedding_model = embedding_model
+        self.dim = dim
+        self.api_key = api_key
+        self.previous_files = []  # Прежние версии документа с тем же именем
+        self.previous = set()  # sha1 их фрагментов
+        self.seen = set()
+        self.moved = []
+        self.pending = []
+        self.position = 0
+        self.new_chunks = 0
+
+    async def load_previous(self):
+        result = await self.db.execute(select(KnowledgeFile.id).where(
+            KnowledgeFile.assistant_id == self.file.assistant_id,
+            KnowledgeFile.name == self.file.name,
+            KnowledgeFile.status == "ready"
+        ))
+        self.previous_files = result.scalars().all()
+        if not self.previous_files:
+            return
+        # Курсором по частям: десятки тысяч строк за один раз заметно задержали бы цикл событий
+        result = await self.db.stream_scalars(
+            select(KnowledgeChunk.content_hash)
+            .where(KnowledgeChunk.file_id.in_(self.previous_files))
+            .execution_options(yield_per=KNOWLEDGE_INGEST_BATCH * 4)
+        )
+        async for hashes in result.partitions():
+            self.previous.update(hashes)
+            await asyncio.sleep(0)
+
+    async def add(self, chunks: List[tuple]):
+        for content_hash, text in chunks:
+            if content_hash in self.seen:
+                # Повторяющийся текст (колонтитулы, шаблонные абзацы) индексируется один раз
+                continue
+            self.seen.add(content_hash)
+            if content_hash in self.previous:
+                self.moved.append((content_hash, self.position))
+            else:
+                self.pending.append((content_hash, text, self.position))
+            self.position += 1
+        if len(self.pending) >= KNOWLEDGE_INGEST_BATCH or len(self.moved) >= KNOWLEDGE_INGEST_BATCH:
+            await self.flush()
+
+    async def flush(self):
+        if self.moved:
+            # Перенос в новую версию документа; прежняя версия удаляется вместе с оставшимися фрагментами
+            await self.db.execute(MOVE_KNOWLEDGE_CHUNKS_SQL, {
+                "file_id": self.file.id,
+                "previous_files": self.previous_files,
+                "hashes": [content_hash for content_hash, _ in self.moved],
+                "positions": [position for _, position in self.moved]
+            })
+            self.moved = []
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        vectors = await embed_texts([text for _, text, _ in batch], self.embedding_model, self.dim, self.api_key)
+        await self.db.execute(insert(KnowledgeChunk.__table__), [
+            {
+                "id": uuid.uuid4(),
+                "assistant_id": self.file.assistant_id,
+                "file_id": self.file.id,
+                "content_hash": content_hash,
+                "source": self.file.name,
+                "position": position,
+                "text": text,
+                "embedding": vector.tobytes()
+            }
+            for (content_hash, text, position), vector in zip(batch, vectors)
+        ])
+        self.new_chunks += len(batch)
+
+    async def finish(self):
+        """Удаляет прежние версии документа и поднимает версию базы знаний"""
+        await self.flush()
+        await self.db.execute(sa.text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {"key": f"knowledge:{self.file.assistant_id}"})
+        # Незавершенные загрузки того же документа не трогаем, кроме зависших (воркер остановился)
+        await self.db.execute(sa.delete(KnowledgeFile).where(
+            KnowledgeFile.assistant_id == self.file.assistant_id,
+            KnowledgeFile.name == self.file.name,
+            KnowledgeFile.id != self.file.id,
+            sa.or_(KnowledgeFile.status.in_(("ready", "failed")), KnowledgeFile.updated_at < func.now() - timedelta(hours=1))
+        ))
+        await self.db.execute(sa.update(KnowledgeFile).where(KnowledgeFile.id == self.file.id).values(
+            status="ready", size=self.file.size, chunks=self.position, new_chunks=self.new_chunks
+        ))
+        await bump_knowledge_revision(self.db, self.file.assistant_id, self.embedding_model, self.dim)
+
+async def ingest_knowledge_stream(stream, db, knowledge_file: KnowledgeFile, upload: MultipartFileStream,
+                                  first_data: List[bytes], api_key: Optional[str]) -> KnowledgeFile:
+    """
+    Принимает остаток тела запроса (stream - начатый request.stream()) и индексирует документ по мере поступления: байты пишутся
+    в БД частями, текст блоками по KNOWLEDGE_INGEST_BLOCK_CHARS разбирается в пуле процессов.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_ingest_pool()
+    kind = KNOWLEDGE_FILE_KINDS[os.path.splitext(knowledge_file.name)[1].lower()]
+    max_bytes = KNOWLEDGE_MAX_FILE_MB * 1024 * 1024
+
+    result = await db.execute(select(KnowledgeBase.embedding_model, KnowledgeBase.dim).where(
+        KnowledgeBase.assistant_id == knowledge_file.assistant_id
+    ))
+    model, dim = result.first() or (KNOWLEDGE_EMBEDDING_MODEL, KNOWLEDGE_EMBEDDING_DIM)
+    ingestion = KnowledgeIngestion(db, knowledge_file, model, dim, api_key)
+    await ingestion.load_previous()
+
+    decoder = None
+    sample = b""
+    part = bytearray()
+    part_number = 0
+    text = ""
+    tail = ""
+    csv_state = None
+    last_progress = time.monotonic()
+
+    async def receive():
+        for data in first_data:
+            yield data
+        async for chunk in stream:
+            for data in upload.feed(chunk):
+                yield data
+
+    async for data in receive():
+        knowledge_file.size += len(data)
+        if knowledge_file.size > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Файл больше {KNOWLEDGE_MAX_FILE_MB} МБ")
+        part += data
+        if len(part) >= KNOWLEDGE_FILE_PART_BYTES:
+            await db.execute(insert(KnowledgeFilePart).values(file_id=knowledge_file.id, part=part_number, data=bytes(part)))
+            part_number += 1
+            part = bytearray()
+        if decoder is None:
+            sample += data
+            if len(sample) < 64 * 1024:
+                continue
+            decoder, data = make_text_decoder(sample), sample
+        text += decoder.decode(data)
+        if len(text) >= KNOWLEDGE_INGEST_BLOCK_CHARS:
+            cut = document_block_cut(text, kind)
+            block, text = text[:cut], text[cut:]
+            chunks, tail, csv_state = await loop.run_in_executor(pool, chunk_document_block, tail, block, kind, csv_state, False)
+            await ingestion.add(chunks)
+        if time.monotonic() - last_progress >= 1.0:
+            await update_knowledge_file(knowledge_file.id, size=knowledge_file.size, chunks=ingestion.position, new_chunks=ingestion.new_chunks)
+            last_progress = time.monotonic()
+
+    if not upload.finished:
+        raise HTTPException(status_code=400, detail="Файл загружен не полностью")
+    if part:
+        await db.execute(insert(KnowledgeFilePart).values(file_id=knowledge_file.id, part=part_number, data=bytes(part)))
+    if decoder is None:
+        decoder = make_text_decoder(sample)
+        text = decoder.decode(sample)
+    text += decoder.decode(b"", final=True)
+    chunks, _, _ = await loop.run_in_executor(pool, chunk_document_block, tail, text, kind, csv_state, True)
+    await ingestion.add(chunks)
+    await update_knowledge_file(knowledge_file.id, status="indexing", size=knowledge_file.size, chunks=ingestion.position, new_chunks=ingestion.new_chunks)
+    await ingestion.finish()
+    await db.commit()
+    knowledge_file.chunks = ingestion.position
+    knowledge_file.new_chunks = ingestion.new_chunks
+    logger.info(f"Документ {knowledge_file.name} ассистента {knowledge_file.assistant_id}: {knowledge_file.size} байт, "
+                f"{ingestion.position} фрагментов, из них новых {ingestion.new_chunks}")
+    return knowledge_file
+
+def serialize_knowledge_file(knowledge_file) -> Dict[str, Any]:
+    return {
+        "id": str(knowledge_file.id),
+        "name": knowledge_file.name,
+        "size": knowledge_file.size,
+        "status": knowledge_file.status,
+        "chunks": knowledge_file.chunks,
+        "new_chunks": knowledge_file.new_chunks,
+        "uploaded_at": knowledge_file.uploaded_at.isoformat() if knowledge_file.uploaded_at else None
+    }
+
+async def create_openai_connection(api_key=None):
+    """
+    Создание нового соединения с OpenAI API с улучшенной обработкой ошибок.
+    """
+    try:
+        key_to_use = api_key or OPENAI_API_KEY
+        if not key_to_use:
+            raise ValueError("API ключ OpenAI не предоставлен")
+            
+        # Заголовки для авторизации в OpenAI API
+        headers = [
+            ("Authorization", f"Bearer {key_to_use}"),
+            ("OpenAI-Beta", "realtime=v1"),
+            ("User-Agent", "WellcomeAI/1.0")
+        ]
+        
+        # Увеличенные буферы для более надежной передачи аудио
+        openai_ws = await websockets.connect(
+            REALTIME_WS_URL,
+            extra_headers=headers,  # Используем extra_headers вместо additional_headers
+            max_size=15 * 1024 * 1024,  # 15MB max message size
+            ping_interval=30,  # Увеличиваем интервал пинга для большей стабильности
+            ping_timeout=120,  # Увеличиваем таймаут пинга
+            close_timeout=15    # Увеличиваем таймаут закрытия
+        )
+        logger.info("Создано новое соединение с OpenAI")
+        return openai_ws
+    except websockets.exceptions.InvalidStatusCode as e:
+        if e.status_code == 401:
+            logger.error(f"Ошибка авторизации при подключении к OpenAI: {e.status_code}")
+            raise ValueError("Недействительный API ключ OpenAI")
+        elif e.status_code == 429:
+            logger.error(f"Ограничение скорости запросов OpenAI: {e.status_code}")
+            raise ValueError("Превышен лимит запросов OpenAI. Пожалуйста, попробуйте позже.")
+        else:
+            logger.error(f"Ошибка статуса HTTP при подключении к OpenAI: {e.status_code}")
+            raise
+    except Exception as e:
+        logger.error(f"Ошибка при создании соединения с OpenAI: {str(e)}")
+        raise
+
+class RealtimeConnectionPool:
+    """
+    Пул заранее открытых соединений с OpenAI Realtime для каждого API ключа.
+    При подключении клиента соединение берется из пула (TLS и WebSocket рукопожатие
+    уже выполнены), а пул пополняется в фоне. Простаивающие дольше max_idle
+    соединения закрываются, ключи без подключений дольше key_ttl забываются.
+    """
+
+    def __init__(self, size: int, max_idle: float, max_keys: int, key_ttl: float):
+        self.size = size
+        self.max_idle = max_idle
+        self.max_keys = max_keys
+        self.key_ttl = key_ttl
+        self.idle = OrderedDict()  # api_key -> deque[(opened_at, openai_ws)]
+        self.last_used = {}        # api_key -> время последнего подключения
+        self.refills = {}          # api_key -> задача пополнения
+        self.closing = set()       # Задачи закрытия вытесненных соединений
+        self.reaper_task = None
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "opened": 0,
+            "discarded": 0,
+            "refill_errors": 0,
+            "ready_count": 0,
+            "ready_total_ms": 0.0,
+            "ready_hit_total_ms": 0.0,
+            "ready_max_ms": 0.0,
+            "last_ready_ms": 0.0,
+        }
+
+    async def acquire(self, api_key: str):
+        """Возвращает открытое соединение с OpenAI и флаг попадания в пул"""
+        if self.size <= 0:
+            return await create_openai_connection(api_key), False
+        
+        self.last_used[api_key] = time.monotonic()
+        openai_ws = None
+        idle = self.idle.get(api_key)
+        if idle is not None:
+            self.idle.move_to_end(api_key)
+            while idle:
+                opened_at, candidate = idle.popleft()
+                if candidate.open and time.monotonic() - opened_at < self.max_idle:
+                    openai_ws = candidate
+                    break
+                self._discard(candidate)
+        
+        hit = openai_ws is not None
+        if hit:
+            self.stats["hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            openai_ws = await create_openai_connection(api_key)
+        
+        self._schedule_refill(api_key)
+        return openai_ws, hit
+
+    def record_ready(self, elapsed: float, hit: bool):
+        """Учитывает время от начала подключения до отправки настроек сессии"""
+        elapsed_ms = elapsed * 1000
+        self.stats["ready_count"] += 1
+        self.stats["ready_total_ms"] += elapsed_ms
+        if hit:
+            self.stats["ready_hit_total_ms"] += elapsed_ms
+        self.stats["last_ready_ms"] = round(elapsed_ms, 2)
+        self.stats["ready_max_ms"] = round(max(self.stats["ready_max_ms"], elapsed_ms), 2)
+
+    def start(self):
+        if self.size > 0 and (self.reaper_task is None or self.reaper_task.done()):
+            self.reaper_task = asyncio.create_task(self._reap_forever())
+
+    async def stop(self):
+        if self.reaper_task:
+            self.reaper_task.cancel()
+            self.reaper_task = None
+        for task in self.refills.values():
+            task.cancel()
+        self.refills.clear()
+        sockets = [openai_ws for idle in self.idle.values() for _, openai_ws in idle]
+        self.idle.clear()
+        await asyncio.gather(*(openai_ws.close() for openai_ws in sockets), *self.closing, return_exceptions=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        count = self.stats["ready_count"]
+        hits = self.stats["hits"]
+        misses_ready = count - hits
+        return {
+            **self.stats,
+            "keys": len(self.idle),
+            "idle_connections": sum(len(idle) for idle in self.idle.values()),
+            "avg_ready_ms": round(self.stats["ready_total_ms"] / count, 2) if count else 0.0,
+            "avg_ready_hit_ms": round(self.stats["ready_hit_total_ms"] / hits, 2) if hits else 0.0,
+            "avg_ready_miss_ms": round((self.stats["ready_total_ms"] - self.stats["ready_hit_total_ms"]) / misses_ready, 2) if misses_ready > 0 else 0.0,
+        }
+
+    def _discard(self, openai_ws):
+        self.stats["discarded"] += 1
+        task = asyncio.create_task(openai_ws.close())
+        self.closing.add(task)
+        task.add_done_callback(self.closing.discard)
+
+    def _schedule_refill(self, api_key: str):
+        task = self.refills.get(api_key)
+        if task is None or task.done():
+            self.refills[api_key] = asyncio.create_task(self._refill(api_key))
+
+    async def _refill(self, api_key: str):
+        idle = self.idle.setdefault(api_key, deque())
+        self.idle.move_to_end(api_key)
+        # Вытесняем давно не использовавшиеся ключи
+        while len(self.idle) > self.max_keys:
+            old_key, old_idle = self.idle.popitem(last=False)
+            self.last_used.pop(old_key, None)
+            for _, openai_ws in old_idle:
+                self._discard(openai_ws)
+        try:
+            while len(idle) < self.size and self.idle.get(api_key) is idle:
+                openai_ws = await create_openai_connection(api_key)
+                idle.append((time.monotonic(), openai_ws))
+                self.stats["opened"] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Не повторяем сразу, чтобы не создавать лишнюю нагрузку при неверном ключе или лимитах
+            self.stats["refill_errors"] += 1
+            logger.warning(f"Не удалось пополнить пул соединений OpenAI: {str(e)}")
+
+    async def _reap_forever(self):
+        interval = max(1.0, min(self.max_idle / 2, 15.0))
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for api_key in list(self.idle):
+                idle = self.idle[api_key]
+                fresh = []
+                for opened_at, openai_ws in idle:
+                    if openai_ws.open and now - opened_at < self.max_idle:
+                        fresh.append((opened_at, openai_ws))
+                    else:
+                        self._discard(openai_ws)
+                # Меняем содержимое на месте: задача пополнения держит ссылку на ту же очередь
+                idle.clear()
+                idle.extend(fresh)
+                if now - self.last_used.get(api_key, 0) > self.key_ttl:
+                    # Ключ давно не использовался - освобождаем соединения
+                    for _, openai_ws in self.idle.pop(api_key):
+                        self._discard(openai_ws)
+                    self.last_used.pop(api_key, None)
+                elif len(fresh) < self.size:
+                    self._schedule_refill(api_key)
+
+openai_pool = RealtimeConnectionPool(
+    size=OPENAI_WS_POOL_SIZE,
+    max_idle=OPENAI_WS_POOL_MAX_IDLE,
+    max_keys=OPENAI_WS_POOL_MAX_KEYS,
+    key_ttl=OPENAI_WS_POOL_KEY_TTL
+)
+
+RELAY_OVERFLOW_POLICIES = {"drop_audio", "coalesce_text", "disconnect"}
+
+def parse_overflow_policy(value: str) -> set:
+    """Разбирает политику переполнения вида "drop_audio,coalesce_text" (disconnect - только отключение)"""
+    policy = {item.strip() for item in value.split(",") if item.strip()}
+    unknown = policy - RELAY_OVERFLOW_POLICIES
+    if unknown:
+        logger.warning(f"Неизвестные политики переполнения очереди релея: {', '.join(sorted(unknown))}")
+    return policy & RELAY_OVERFLOW_POLICIES - {"disconnect"}
+
+RELAY_DOWNSTREAM_POLICY = parse_overflow_policy(RELAY_DOWNSTREAM_OVERFLOW)
+RELAY_UPSTREAM_POLICY = parse_overflow_policy(RELAY_UPSTREAM_OVERFLOW)
+
+class RelayQueueOverflow(Exception):
+    """Очередь отправки релея переполнена, и политика не позволяет освободить место"""
+
+class RelaySendQueue:
+    """
+    Ограниченная очередь отправки одного направления релея (клиент -> OpenAI или OpenAI -> клиент).
+    Чтение из одного сокета больше не ждет записи в другой: сообщения кладутся в очередь,
+    а отдельная задача отправляет их получателю. При превышении max_bytes применяется политика:
+    drop_audio - отбрасываются самые старые аудиокадры, coalesce_text - текстовые дельты
+    склеиваются в одну; если место освободить не удалось, соединение разрывается.
+    """
+
+    def __init__(self, name: str, max_bytes: int, policy: set):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.items = deque()  # (сообщение, вид: audio/text/control/tool, размер); tool - результаты вызовов функций сессии OpenAI
+        self.size = 0
+        self.traced = None    # (сообщение, время постановки, callback) - кадр, для которого замеряется время в очереди и отправки
+                              # (сообщение None - замер ждет следующего аудиокадра: отмеченный кадр отброшен)
+        self.ready = asyncio.Event()
+        self.stats = {
+            "sent": 0,
+            "high_water_bytes": 0,
+            "high_water_items": 0,
+            "dropped_audio": 0,
+            "dropped_audio_bytes": 0,
+            "coalesced_text": 0,
+        }
+
+    def put(self, message, kind: str = "control", on_sent: Optional[Callable] = None):
+        """
+        Ставит сообщение в очередь без ожидания; RelayQueueOverflow - место освободить не удалось.
+        on_sent(время в очереди, время отправки) вызывается после отправки этого сообщения; если
+        аудиокадр отброшен, замер переходит к следующему аудиокадру, а если отправить так ничего
+        и не удалось (очередь закрыта), вызывается on_sent(None, None).
+        """
+        if kind == "text" and "coalesce_text" in self.policy and self.items and self._coalesce(message):
+            if self.size > self.max_bytes and "drop_audio" in self.policy:
+                self._drop_audio(self.size - self.max_bytes)
+            return
+
+        size = len(message)
+        if self.size + size > self.max_bytes and "drop_audio" in self.policy:
+            self._drop_audio(self.size + size - self.max_bytes)
+        # Сообщение больше всего предела все равно пропускаем, если очередь пуста
+        if self.items and self.size + size > self.max_bytes:
+            if kind == "audio" and "drop_audio" in self.policy:
+                # В очереди только служебные события - новый аудиокадр отбрасываем сам
+                self.stats["dropped_audio"] += 1
+                self.stats["dropped_audio_bytes"] += size
+                if on_sent is not None:
+                    self._trace(None, on_sent)
+                return
+            raise RelayQueueOverflow(f"Очередь {self.name} переполнена: {self.size} байт в {len(self.items)} сообщениях")
+
+        self.items.append((message, kind, size))
+        self.size += size
+        if on_sent is not None:
+            self._trace(message, on_sent)
+        elif kind == "audio" and self.traced is not None and self.traced[0] is None:
+            self.traced = (message, self.traced[1], self.traced[2])
+        if self.size > self.stats["high_water_bytes"]:
+            self.stats["high_water_bytes"] = self.size
+        if len(self.items) > self.stats["high_water_items"]:
+            self.stats["high_water_items"] = len(self.items)
+        self.ready.set()
+
+    async def get(self):
+        while not self.items:
+            self.ready.clear()
+            await self.ready.wait()
+        message, _, size = self.items.popleft()
+        self.size -= size
+        self.stats["sent"] += 1
+        return message
+
+    async def drain(self, timeout: float):
+        """Ждет, пока отправляющая задача не разберет очередь (не дольше timeout)"""
+        deadline = time.monotonic() + timeout
+        while self.items and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    def clear(self):
+        self.items.clear()
+        self.size = 0
+        traced, self.traced = self.traced, None
+        if traced is not None:
+            # Аудио хода клиенту так и не ушло - трасса записывается без времени отправки
+            traced[2](None, None)
+
+    def _trace(self, message, on_sent: Callable):
+        if self.traced is not None:
+            # Кадр прежнего хода еще не отправлен - его трасса записывается без времени отправки
+            self.traced[2](None, None)
+        self.traced = (message, time.perf_counter(), on_sent)
+
+    def hand_off_trace(self, traced: tuple):
+        """Замер отброшенного или неотправленного кадра переходит к следующему аудиокадру (время постановки сохраняется)"""
+        if self.traced is not None and self.traced[2] is not traced[2]:
+            # Очередь уже замеряет кадр следующего хода
+            traced[2](None, None)
+            return
+        following = next((message for message, kind, _ in self.items if kind == "audio"), None)
+        self.traced = (following, traced[1], traced[2])
+
+    def drop_kind(self, kind: str) -> int:
+        """Удаляет из очереди все сообщения вида kind; возвращает их число"""
+        kept = deque(item for item in self.items if item[1] != kind)
+        dropped = len(self.items) - len(kept)
+        if dropped:
+            self.items = kept
+            self.size = sum(size for _, _, size in kept)
+            if self.traced is not None and self.traced[0] is not None and not any(message is self.traced[0] for message, _, _ in kept):
+                self.hand_off_trace(self.traced)
+        return dropped
+
+    def trim_audio(self, max_bytes: int):
+        """Оставляет в очереди не больше max_bytes самых свежих аудиокадров"""
+        audio_bytes = sum(size for _, kind, size in self.items if kind == "audio")
+        if audio_bytes > max_bytes:
+            self._drop_audio(audio_bytes - max_bytes)
+
+    def _drop_audio(self, needed: int):
+        # Самые старые аудиокадры устарели сильнее всего - отбрасываем их первыми
+        kept = deque()
+        traced = self.traced
+        dropped_traced = False
+        for message, kind, size in self.items:
+            if needed > 0 and kind == "audio":
+                needed -= size
+                self.size -= size
+                self.stats["dropped_audio"] += 1
+                self.stats["dropped_audio_bytes"] += size
+                dropped_traced = dropped_traced or (traced is not None and message is traced[0])
+            else:
+                kept.append((message, kind, size))
+        self.items = kept
+        if dropped_traced:
+            self.hand_off_trace(traced)
+
+    def _coalesce(self, message: str) -> bool:
+        """Дописывает текстовую дельту к последней дельте в очереди, если они из одного элемента ответа"""
+        tail_message, tail_kind, tail_size = self.items[-1]
+        if tail_kind != "text":
+            return False
+        tail = ujson.loads(tail_message)
+        delta = ujson.loads(message)
+        for field in ("type", "response_id", "item_id", "content_index"):
+            if tail.get(field) != delta.get(field):
+                return False
+        tail["delta"] = tail.get("delta", "") + delta.get("delta", "")
+        merged = ujson.dumps(tail, ensure_ascii=False)
+        self.items[-1] = (merged, "text", len(merged))
+        self.size += len(merged) - tail_size
+        self.stats["coalesced_text"] += 1
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "queued_bytes": self.size, "queued_items": len(self.items)}
+
+async def relay_sender(queue: RelaySendQueue, send: Callable, client_id: str):
+    """Отправляет сообщения из очереди релея; медленный получатель задерживает только эту задачу"""
+    error_count = 0
+    max_errors = 5
+    last_error_time = time.time()
+
+    while True:
+        message = await queue.get()
+        traced = queue.traced
+        if traced is not None and traced[0] is message:
+            queue.traced = None
+            dequeued_at = time.perf_counter()
+        else:
+            traced = None
+        try:
+            await send(message)
+            error_count = 0
+            if traced is not None:
+                traced[2](dequeued_at - traced[1], time.perf_counter() - dequeued_at)
+        except websockets.exceptions.ConnectionClosed:
+            if traced is not None:
+                traced[2](None, None)
+            raise
+        except Exception as send_error:
+            if traced is not None:
+                queue.hand_off_trace(traced)
+            error_count += 1
+            current_time = time.time()
+
+            # Если много ошибок за короткий период, лучше прервать соединение
+            if error_count >= max_errors and (current_time - last_error_time) < 10:
+                logger.error(f"Слишком много ошибок отправки ({queue.name}) для клиента {client_id}: {error_count} за последние 10 секунд")
+                raise
+
+            last_error_time = current_time
+            logger.error(f"Ошибка при отправке сообщения ({queue.name}) для клиента {client_id}: {str(send_error)}")
+
+async def send_to_client(client_ws: WebSocket, message):
+    if isinstance(message, str):
+        await client_ws.send_text(message)
+    else:
+        await client_ws.send_bytes(message)
+
+# Суммарная статистика очередей релея по завершенным соединениям воркера
+relay_queue_totals = {"connections": 0, "dropped_audio": 0, "dropped_audio_bytes": 0, "coalesced_text": 0, "overflow_disconnects": 0, "max_high_water_bytes": 0}
+
+def get_relay_queue_stats() -> Dict[str, Any]:
+    stats = dict(relay_queue_totals)
+    active = []
+    for client_id, connection in list(client_connections.items()):
+        queues = connection.get("queues")
+        if queues:
+            active.append({"client_id": client_id, **{direction: queue.get_stats() for direction, queue in queues.items()}})
+    # Соединения с наибольшим пиком заполнения очередей
+    active.sort(key=lambda entry: max(entry["upstream"]["high_water_bytes"], entry["downstream"]["high_water_bytes"]), reverse=True)
+    stats["active_connections"] = len(active)
+    stats["queued_bytes"] = sum(entry["upstream"]["queued_bytes"] + entry["downstream"]["queued_bytes"] for entry in active)
+    stats["top_connections"] = active[:20]
+    return stats
+
+async def close_local_session(session_id: str, reason: str, reason_code: str = "killed") -> bool:
+    """Завершает сессию, если ее обслуживает текущий воркер"""
+    connection = client_connections.get(session_id)
+    if connection is None:
+        return False
+    connection["active"] = False
+    client_ws = connection["client_ws"]
+    try:
+        await client_ws.send_json({"type": "connection_status", "status": "terminated", "reason": reason_code, "message": reason})
+        # Код 1000 - виджет не будет переподключаться
+        await client_ws.close(code=1000, reason=reason)
+    except Exception as e:
+        logger.debug(f"Не удалось закрыть соединение сессии {session_id}: {str(e)}")
+    logger.info(f"Сессия {session_id} завершена: {reason}")
+    return True
+
+class PlanLimits(NamedTuple):
+    """Лимиты тарифа (0 - без ограничения)"""
+    max_sessions: int = 0                # Одновременных разговоров на владельца
+    max_sessions_per_assistant: int = 0  # Одновременных разговоров на ассистента
+    audio_bytes_per_sec: int = 0         # Входящий аудиопоток одной сессии (PCM16)
+    max_session_minutes: float = 0       # Длительность одного разговора
+    daily_minutes: float = 0             # Минут разговоров владельца за сутки (UTC)
+
+def load_plan_limits() -> Dict[str, PlanLimits]:
+    plans = {name: dict(limits) for name, limits in DEFAULT_PLAN_LIMITS.items()}
+    if PLAN_LIMITS_JSON:
+        try:
+            for name, overrides in json.loads(PLAN_LIMITS_JSON).items():
+                plans.setdefault(name, {}).update(overrides)
+        except (ValueError, AttributeError) as e:
+            logger.error(f"Некорректное значение PLAN_LIMITS, используются лимиты по умолчанию: {str(e)}")
+    return {name: PlanLimits(**{field: limits[field] for field in PlanLimits._fields if field in limits}) for name, limits in plans.items()}
+
+plan_limits = load_plan_limits()
+
+def get_plan_limits(plan: Optional[str]) -> PlanLimits:
+    """Лимиты тарифа пользователя; неизвестные тарифы ограничиваются как free"""
+    return plan_limits.get(plan or "free") or plan_limits.get("free", PlanLimits())
+
+def check_plan_limits(limits: PlanLimits, user_sessions: int, assistant_sessions: int, used_seconds: float) -> Optional[str]:
+    """Возвращает код превышенного лимита или None, если сессию можно открыть"""
+    if limits.max_sessions and user_sessions >= limits.max_sessions:
+        return "max_sessions"
+    if limits.max_sessions_per_assistant and assistant_sessions >= limits.max_sessions_per_assistant:
+        return "max_sessions_per_assistant"
+    if limits.daily_minutes and used_seconds >= limits.daily_minutes * 60:
+        return "daily_minutes"
+    return None
+
+class MemorySessionRegistry:
+    """
+    Реестр сессий в памяти воркера. Лимиты и список сессий действуют только
+    в пределах текущего процесса (подходит для запуска с одним воркером).
+    """
+
+    def __init__(self):
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.sessions = {}  # session_id -> описание сессии
+        self.usage = {}     # (user_id, дата UTC) -> секунд разговоров завершенных сессий
+        self.stats = {"registered": 0, "rejected": 0, "killed": 0, "errors": 0}
+
+    async def register(self, session_id: str, user_id: str, assistant_id: str, client_host: Optional[str], limits: PlanLimits):
+        """
+        Регистрирует сессию, если она укладывается в лимиты тарифа.
+        Возвращает (код превышенного лимита или None, секунд разговоров владельца за сегодня).
+        """
+        now = time.time()
+        user_sessions = [session for session in self.sessions.values() if session["user_id"] == user_id]
+        assistant_sessions = sum(1 for session in user_sessions if session["assistant_id"] == assistant_id)
+        used_seconds = self.usage.get((user_id, datetime.now(timezone.utc).date()), 0.0)
+        used_seconds += sum(now - session["started"] for session in user_sessions)
+        reason = check_plan_limits(limits, len(user_sessions), assistant_sessions, used_seconds)
+        if reason:
+            self.stats["rejected"] += 1
+            return reason, used_seconds
+        self.sessions[session_id] = {
+            "session_id": session_id,
+            "user_id": user_id,
+            "assistant_id": assistant_id,
+            "worker": self.worker,
+            "client_host": client_host,
+            "started": now,
+            "started_at": datetime.now(timezone.utc).isoformat()
+        }
+        self.stats["registered"] += 1
+        return None, used_seconds
+
+    async def unregister(self, session_id: str):
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return
+        today = datetime.now(timezone.utc).date()
+        key = (session["user_id"], today)
+        self.usage[key] = self.usage.get(key, 0.0) + time.time() - session["started"]
+        # Учет за прошлые сутки больше не нужен
+        for stale in [usage_key for usage_key in self.usage if usage_key[1] != today]:
+            del self.usage[stale]
+
+    async def list_sessions(self, user_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        return [
+            {key: value for key, value in session.items() if key != "started"}
+            for session in self.sessions.values() if user_id is None or session["user_id"] == user_id
+        ]
+
+    async def request_kill(self, session_id: str) -> bool:
+        if session_id not in self.sessions:
+            return False
+        self.stats["killed"] += 1
+        await close_local_session(session_id, "Сессия завершена администратором")
+        return True
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "backend": "memory", "worker": self.worker, "local_sessions": len(self.sessions)}
+
+class PostgresSessionRegistry(MemorySessionRegistry):
+    """
+    Общий реестр сессий всех воркеров и узлов в таблице relay_sessions.
+    Лимиты тарифа проверяются под advisory-блокировкой владельца, поэтому соблюдаются
+    при одновременных подключениях к разным воркерам. Каждый воркер периодически
+    продлевает свои записи; записи, которые не продлевались три периода (упавший воркер),
+    не учитываются и удаляются. Минуты завершенных разговоров копятся в session_usage.
+    Запрос на завершение сессии чужого воркера сохраняется в таблице и доставляется
+    через шину инвалидаций (или при следующем продлении).
+    Горячие циклы релея по-прежнему работают только с локальным client_connections.
+    """
+
+    def __init__(self, heartbeat_interval: float):
+        super().__init__()
+        # PID может повториться после перезапуска контейнера, поэтому добавляем случайный суффикс
+        self.worker = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.heartbeat_interval = heartbeat_interval
+        self.task = None
+
+    def _fresh_since(self):
+        return func.now() - timedelta(seconds=self.heartbeat_interval * 3)
+
+    async def register(self, session_id: str, user_id: str, assistant_id: str, client_host: Optional[str], limits: PlanLimits):
+        used_seconds = 0.0
+        start = time.perf_counter()
+        async with SessionLocal() as db:
+            if limits.max_sessions or limits.max_sessions_per_assistant or limits.daily_minutes:
+                # Сериализуем регистрацию сессий одного владельца на всех воркерах
+                await db.execute(sa.text("SELECT pg_advisory_xact_lock(hashtext(:user_id))"), {"user_id": user_id})
+                result = await db.execute(select(
+                    func.count(),
+                    func.count().filter(RelaySession.assistant_id == assistant_id),
+                    func.coalesce(func.sum(sa.extract("epoch", func.now() - RelaySession.started_at)), 0)
+                ).where(
+                    RelaySession.user_id == user_id,
+                    RelaySession.last_seen_at > self._fresh_since()
+                ))
+                user_sessions, assistant_sessions, live_seconds = result.one()
+                used_seconds = float(live_seconds)
+                if limits.daily_minutes:
+                    result = await db.execute(select(SessionUsage.seconds).where(
+                        SessionUsage.user_id == user_id,
+                        SessionUsage.day == func.timezone("UTC", func.now()).cast(sa.Date)
+                    ))
+                    used_seconds += result.scalar() or 0.0
+                reason = check_plan_limits(limits, user_sessions, assistant_sessions, used_seconds)
+                if reason:
+                    await db.rollback()
+                    db_write_seconds.labels("session_register").observe(time.perf_counter() - start)
+                    self.stats["rejected"] += 1
+                    return reason, used_seconds
+            await db.execute(insert(RelaySession).values(
+                id=session_id,
+                user_id=user_id,
+                assistant_id=assistant_id,
+                worker=self.worker,
+                client_host=client_host
+            ))
+            await db.commit()
+        db_write_seconds.labels("session_register").observe(time.perf_counter() - start)
+        self.sessions[session_id] = {"user_id": user_id}
+        self.stats["registered"] += 1
+        return None, used_seconds
+
+    async def unregister(self, session_id: str):
+        if self.sessions.pop(session_id, None) is None:
+            return
+        try:
+            # Удаление доводим до конца, даже если задачу обработчика соединения отменили
+            await asyncio.shield(self._delete(session_id))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Запись удалит следующее продление сессий воркера
+            self.stats["errors"] += 1
+            logger.error(f"Не удалось удалить сессию {session_id} из реестра: {str(e)}")
+
+    async def _delete(self, session_id: str):
+        """Удаляет сессию и добавляет ее длительность к минутам владельца за сегодня"""
+        start = time.perf_counter()
+        async with SessionLocal() as db:
+            result = await db.execute(
+                sa.delete(RelaySession).where(RelaySession.id == session_id)
+                .returning(RelaySession.user_id, sa.extract("epoch", func.now() - RelaySession.started_at))
+            )
+            row = result.first()
+            if row is not None and row[0] is not None:
+                statement = pg_insert(SessionUsage).values(
+                    user_id=row[0],
+                    day=func.timezone("UTC", func.now()).cast(sa.Date),
+                    seconds=float(row[1])
+                )
+                await db.execute(statement.on_conflict_do_update(
+                    index_elements=[SessionUsage.user_id, SessionUsage.day],
+                    set_={"seconds": SessionUsage.seconds + statement.excluded.seconds}
+                ))
+            await db.commit()
+        db_write_seconds.labels("session_unregister").observe(time.perf_counter() - start)
+
+    async def list_sessions(self, user_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        query = select(RelaySession).where(RelaySession.last_seen_at > self._fresh_since()).order_by(RelaySession.started_at)
+        if user_id is not None:
+            query = query.where(RelaySession.user_id == user_id)
+        async with SessionLocal() as db:
+            result = await db.execute(query)
+            return [{
+                "session_id": str(session.id),
+                "user_id": str(session.user_id) if session.user_id else None,
+                "assistant_id": str(session.assistant_id) if session.assistant_id else None,
+                "worker": session.worker,
+                "client_host": session.client_host,
+                "started_at": session.started_at.isoformat() if session.started_at else None,
+                "last_seen_at": session.last_seen_at.isoformat() if session.last_seen_at else None
+            } for session in result.scalars().all()]
+
+    async def request_kill(self, session_id: str) -> bool:
+        async with SessionLocal() as db:
+            result = await db.execute(
+                sa.update(RelaySession).where(RelaySession.id == session_id).values(kill_requested=True).returning(RelaySession.worker)
+            )
+            worker = result.scalar()
+            await db.commit()
+        if worker is None:
+            return False
+        self.stats["killed"] += 1
+        if worker == self.worker:
+            await close_local_session(session_id, "Сессия завершена администратором")
+        else:
+            await cache_bus.publish("kill", session_id)
+        return True
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._heartbeat_forever())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        # Сессии этого воркера больше не обслуживаются
+        try:
+            async with SessionLocal() as db:
+                await db.execute(sa.delete(RelaySession).where(RelaySession.worker == self.worker))
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Не удалось удалить сессии воркера {self.worker} из реестра: {str(e)}")
+        self.sessions.clear()
+
+    async def heartbeat(self):
+        """Продлевает записи своих сессий, исполняет запросы на завершение и удаляет устаревшие записи"""
+        local_ids = list(self.sessions)
+        to_kill = []
+        start = time.perf_counter()
+        async with SessionLocal() as db:
+            if local_ids:
+                result = await db.execute(
+                    sa.update(RelaySession).where(RelaySession.id.in_(local_ids))
+                    .values(last_seen_at=func.now())
+                    .returning(RelaySession.id, RelaySession.kill_requested)
+                )
+                to_kill = [str(session_id) for session_id, kill_requested in result.all() if kill_requested]
+            # Записи этого воркера без живой сессии (не удалились при закрытии) и записи упавших воркеров
+            await db.execute(sa.delete(RelaySession).where(RelaySession.worker == self.worker, RelaySession.id.not_in(local_ids)))
+            await db.execute(sa.delete(RelaySession).where(RelaySession.last_seen_at <= self._fresh_since()))
+            await db.commit()
+        db_write_seconds.labels("session_heartbeat").observe(time.perf_counter() - start)
+        for session_id in to_kill:
+            await close_local_session(session_id, "Сессия завершена администратором")
+
+    async def _heartbeat_forever(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка продления сессий воркера в реестре: {str(e)}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**super().get_stats(), "backend": "postgres"}
+
+if SESSION_REGISTRY_BACKEND == "postgres":
+    session_registry = PostgresSessionRegistry(SESSION_HEARTBEAT_INTERVAL)
+else:
+    session_registry = MemorySessionRegistry()
+
+session_kill_tasks = set()  # Завершения сессий по запросам других воркеров (ссылки держатся до завершения)
+
+def kill_local_session(session_id: str):
+    """Запрос на завершение сессии от другого воркера"""
+    task = asyncio.create_task(close_local_session(session_id, "Сессия завершена администратором"))
+    session_kill_tasks.add(task)
+    task.add_done_callback(session_kill_tasks.discard)
+
+cache_bus.subscribe("kill", kill_local_session)
+
+class TokenBucket:
+    """Ограничение скорости: rate единиц в секунду с запасом capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self, amount: float) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+class AdmissionDecision(NamedTuple):
+    reason: Optional[str]   # Код превышенного лимита (None - сессия допущена)
+    limits: PlanLimits
+    session_seconds: float  # Сколько может длиться сессия (0 - без ограничения)
+
+ADMISSION_REJECTIONS = {
+    "max_sessions": "Превышено число одновременных разговоров по тарифу. Попробуйте позже",
+    "max_sessions_per_assistant": "Превышено число одновременных разговоров с этим ассистентом. Попробуйте позже",
+    "daily_minutes": "Исчерпан дневной лимит минут разговоров по тарифу",
+}
+
+class AdmissionController:
+    """
+    Допуск realtime-сессий по лимитам тарифа владельца ассистента: одновременные сессии
+    на владельца и на ассистента, минуты разговоров за сутки и длительность одной сессии
+    (проверяются атомарно в реестре сессий), а также скорость входящего аудио (token bucket
+    на сессию). Отказ запоминается на несколько секунд, поэтому поток переподключений
+    с утекшего кода встраивания не нагружает реестр.
+    """
+
+    def __init__(self, registry, reject_cache_ttl: float):
+        self.registry = registry
+        self.rejections = TTLCache(max_size=10000, ttl=reject_cache_ttl)
+        self.stats = {
+            "admitted": 0,
+            "rejected": 0,
+            "rejected_cached": 0,
+            "errors": 0,
+            "throttled_frames": 0,
+            "throttled_bytes": 0,
+            "reasons": {},
+            "latency_count": 0,
+            "latency_total_ms": 0.0,
+            "latency_max_ms": 0.0,
+        }
+
+    async def admit(self, session_id: str, assistant: "ResolvedAssistant", client_host: Optional[str]) -> AdmissionDecision:
+        started = time.perf_counter()
+        limits = get_plan_limits(assistant.subscription_plan)
+        try:
+            cache_key = f"{assistant.user_id}:{assistant.assistant_id}"
+            reason = self.rejections.get(cache_key)
+            if reason is not _CACHE_MISS:
+                self.stats["rejected_cached"] += 1
+                return self._reject(reason, limits)
+            
+            try:
+                reason, used_seconds = await self.registry.register(session_id, assistant.user_id, assistant.assistant_id, client_host, limits)
+            except Exception as e:
+                # Недоступность реестра не должна мешать разговору
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка проверки лимитов для сессии {session_id}: {str(e)}")
+                reason, used_seconds = None, 0.0
+            
+            if reason:
+                self.rejections.set(cache_key, reason)
+                return self._reject(reason, limits)
+            
+            self.stats["admitted"] += 1
+            session_seconds = limits.max_session_minutes * 60
+            if limits.daily_minutes:
+                remaining = max(limits.daily_minutes * 60 - used_seconds, 0.0)
+                session_seconds = min(session_seconds, remaining) if session_seconds else remaining
+            return AdmissionDecision(None, limits, session_seconds)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.stats["latency_count"] += 1
+            self.stats["latency_total_ms"] += elapsed_ms
+            self.stats["latency_max_ms"] = max(self.stats["latency_max_ms"], elapsed_ms)
+
+    def _reject(self, reason: str, limits: PlanLimits) -> AdmissionDecision:
+        self.stats["rejected"] += 1
+        self.stats["reasons"][reason] = self.stats["reasons"].get(reason, 0) + 1
+        return AdmissionDecision(reason, limits, 0.0)
+
+    def create_audio_bucket(self, limits: PlanLimits) -> Optional[TokenBucket]:
+        """Ограничитель входящего аудио сессии (запас - две секунды потока)"""
+        if not limits.audio_bytes_per_sec:
+            return None
+        return TokenBucket(limits.audio_bytes_per_sec, limits.audio_bytes_per_sec * 2)
+
+    def record_throttled(self, size: int):
+        self.stats["throttled_frames"] += 1
+        self.stats["throttled_bytes"] += size
+
+    def get_stats(self) -> Dict[str, Any]:
+        count = self.stats["latency_count"]
+        return {
+            **self.stats,
+            "reasons": dict(self.stats["reasons"]),
+            "latency_avg_ms": round(self.stats["latency_total_ms"] / count, 3) if count else 0.0
+        }
+
+admission_controller = AdmissionController(session_registry, ADMISSION_REJECT_CACHE_TTL)
+
+async def send_session_update(openai_ws, voice=DEFAULT_VOICE, system_message=DEFAULT_SYSTEM_MESSAGE, functions=None, knowledge=False):
+    """Отправляет настройки сессии в WebSocket OpenAI"""
+    
+    # Логируем используемый системный промпт для отладки
+    logger.info(f"Используем системный промпт: {system_message[:100]}...")
+    
+    # Настройка определения завершения речи
+    turn_detection = {
+        "type": "server_vad",
+        "threshold": 0.25,                 # Чувствительность определения голоса
+        "prefix_padding_ms": VAD_PREFIX_PADDING_MS,      # Начальное время записи
+        "silence_duration_ms": VAD_SILENCE_DURATION_MS,  # Время ожидания тишины
+        "create_response": True            # Автоматически создавать ответ при завершении речи
+    }
+    
+    # Подготавливаем инструменты (functions)
+    tools = []
+    if functions:
+        for func in functions:
+            tools.append({
                 "type": "function",
                 "name": func.get("name"),
                 "description": func.get("description"),
                 "parameters": func.get("parameters")
             })
+    if knowledge:
+        # База знаний подключается инструментом, а не текстом в instructions
+        tools.append(KNOWLEDGE_TOOL)
     
     # Подготавливаем настройки сессии
     session_update = {
@@ -399,6 +4418,8 @@ async def send_session_update(openai_ws, voice=DEFAULT_VOICE, system_message=DEF
             "voice": voice,                       # Голос ассистента
             "instructions": system_message,       # Системное сообщение из БД
             "modalities": ["text", "audio"],      # Поддерживаемые модальности
+            # Распознавание речи пользователя: текст реплик нужен для истории и восстановления сессии
+            "input_audio_transcription": {"model": INPUT_TRANSCRIPTION_MODEL} if INPUT_TRANSCRIPTION_MODEL else None,
             "temperature": 0.7,                   # Температура генерации
             "max_response_output_tokens": 500,    # Лимит токенов для ответа
             "tools": tools,                       # Инструменты (функции)
@@ -431,12 +4452,12 @@ async def register_user(user: UserCreate, db = Depends(get_db)):
     """Регистрация нового пользователя"""
     try:
         # Проверяем, не существует ли уже пользователь с таким email
-        existing_user = db.query(User).filter(User.email == user.email).first()
+        result = await db.execute(select(User).where(User.email == user.email))
+        existing_user = result.scalars().first()
         if existing_user:
             raise HTTPException(status_code=400, detail="Пользователь с таким email уже существует")
             
         # Хешируем пароль
-        import hashlib
         hashed_password = hashlib.sha256(user.password.encode()).hexdigest()
         
         # Создаем пользователя в базе данных
@@ -450,8 +4471,8 @@ async def register_user(user: UserCreate, db = Depends(get_db)):
         )
         
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
         
         # Создаем и возвращаем JWT токен
         token = create_jwt_token(str(new_user.id))
@@ -481,11 +4502,11 @@ async def login_user(user: UserLogin, db = Depends(get_db)):
     """Вход пользователя"""
     try:
         # Хешируем пароль для сравнения
-        import hashlib
         hashed_password = hashlib.sha256(user.password.encode()).hexdigest()
         
         # Ищем пользователя в базе
-        db_user = db.query(User).filter(User.email == user.email).first()
+        result = await db.execute(select(User).where(User.email == user.email))
+        db_user = result.scalars().first()
         
         if not db_user:
             raise HTTPException(status_code=401, detail="Неверный email или пароль")
@@ -498,25 +4519,11 @@ async def login_user(user: UserLogin, db = Depends(get_db)):
         token = create_jwt_token(str(db_user.id))
         
         # Получаем список помощников пользователя
-        assistants = db.query(AssistantConfig).filter(AssistantConfig.user_id == db_user.id).all()
+        result = await db.execute(select(AssistantConfig).where(AssistantConfig.user_id == db_user.id))
+        assistants = result.scalars().all()
         
         # Преобразуем данные ассистентов для JSON
-        assistants_list = []
-        for assistant in assistants:
-            assistants_list.append({
-                "id": str(assistant.id),
-                "user_id": str(assistant.user_id),
-                "name": assistant.name,
-                "description": assistant.description,
-                "system_prompt": assistant.system_prompt,
-                "voice": assistant.voice,
-                "language": assistant.language,
-                "google_sheet_id": assistant.google_sheet_id,
-                "functions": assistant.functions,
-                "is_active": assistant.is_active,
-                "created_at": assistant.created_at.isoformat() if assistant.created_at else None,
-                "updated_at": assistant.updated_at.isoformat() if assistant.updated_at else None
-            })
+        assistants_list = [serialize_assistant(assistant) for assistant in assistants]
         
         # Преобразуем UUID в строку для JSON
         user_dict = {
@@ -539,8 +4546,28 @@ async def login_user(user: UserLogin, db = Depends(get_db)):
         logger.error(f"Ошибка при входе пользователя: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
 
+@app.post("/api/auth/logout")
+async def logout_user(credentials: HTTPAuthorizationCredentials = Depends(security), db = Depends(get_db)):
+    """Выход пользователя: отзыв текущего токена"""
+    token_data = decode_jwt_token(credentials.credentials)
+    if not token_data.jti:
+        raise HTTPException(status_code=400, detail="Токен не поддерживает отзыв")
+    try:
+        db.add(RevokedToken(
+            jti=token_data.jti,
+            user_id=token_data.sub,
+            expires_at=datetime.fromtimestamp(token_data.exp, tz=timezone.utc)
+        ))
+        await db.commit()
+    except sa.exc.IntegrityError:
+        # Токен уже отозван
+        await db.rollback()
+    
+    await cache_bus.publish("revoke", f"{token_data.jti}:{token_data.exp}")
+    return {"message": "Токен отозван"}
+
 @app.get("/api/users/me")
-async def get_current_user_info(current_user: User = Depends(get_current_user)):
+async def get_current_user_info(current_user: UserSnapshot = Depends(get_current_user)):
     """Получение информации о текущем пользователе"""
     user_dict = {
         "id": str(current_user.id),
@@ -556,9 +4583,15 @@ async def get_current_user_info(current_user: User = Depends(get_current_user)):
     return user_dict
 
 @app.put("/api/users/me")
-async def update_current_user_info(user_update: UserUpdate, current_user: User = Depends(get_current_user), db = Depends(get_db)):
+async def update_current_user_info(user_update: UserUpdate, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
     """Обновление информации о текущем пользователе"""
     try:
+        # Загружаем пользователя из БД (current_user - снимок из кэша)
+        result = await db.execute(select(User).where(User.id == current_user.id))
+        current_user = result.scalars().first()
+        if not current_user:
+            raise HTTPException(status_code=401, detail="Invalid user")
+        
         # Получаем только установленные поля (не None)
         update_data = user_update.dict(exclude_unset=True)
         
@@ -574,9 +4607,13 @@ async def update_current_user_info(user_update: UserUpdate, current_user: User =
             logger.info(f"Установлено свойство {key} = {value}")
         
         # Сохраняем изменения
-        db.commit()
+        await db.commit()
+        await db.refresh(current_user)
         logger.info(f"Изменения сохранены в базу данных для пользователя {current_user.id}")
         
+        # Сбрасываем закэшированные API ключ, настройки ассистентов и снимки пользователя в кэше токенов
+        await cache_bus.publish("user", current_user.id)
+        
         # Возвращаем обновленные данные
         user_dict = {
             "id": str(current_user.id),
@@ -592,141 +4629,589 @@ async def update_current_user_info(user_update: UserUpdate, current_user: User =
         }
         
         return user_dict
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении пользователя: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=f"Ошибка при обновлении пользователя: {str(e)}")
+
+# API для управления помощниками
+@app.post("/api/assistants", status_code=201)
+async def create_assistant(assistant: AssistantCreate, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
+    """Создание нового голосового помощника"""
+    try:
+        # Проверяем, есть ли API ключ у пользователя
+        api_key = current_user.openai_api_key or OPENAI_API_KEY
+        if not api_key:
+            raise HTTPException(status_code=400, detail="Требуется API ключ OpenAI")
+        await check_function_webhooks(assistant.functions)
+        
+        # Создаем помощника в базе данных
+        new_assistant = AssistantConfig(
+            user_id=current_user.id,
+            name=assistant.name,
+            description=assistant.description,
+            system_prompt=assistant.system_prompt,
+            voice=assistant.voice,
+            language=assistant.language,
+            google_sheet_id=assistant.google_sheet_id,
+            functions=assistant.functions,
+            audio_settings=assistant.audio_settings.dict(exclude_none=True) if assistant.audio_settings else None,
+            is_active=True
+        )
+        
+        db.add(new_assistant)
+        await db.commit()
+        await db.refresh(new_assistant)
+        
+        # Преобразуем данные для JSON ответа
+        return serialize_assistant(new_assistant)
+        
+    except Exception as e:
+        logger.error(f"Ошибка при создании помощника: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+@app.get("/api/assistants")
+async def get_user_assistants(
+    fields: Optional[str] = None,
+    exclude: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    current_user: UserSnapshot = Depends(get_current_user),
+    db = Depends(get_db)
+):
+    """
+    Получение списка помощников пользователя.
+    fields/exclude - проекция полей через запятую (например, exclude=system_prompt,functions);
+    limit/cursor - постраничная выдача, курсор следующей страницы возвращается в заголовке X-Next-Cursor.
+    """
+    try:
+        columns = parse_assistant_fields(fields, exclude)
+        position = decode_keyset_cursor(cursor) if cursor else None
+        if limit is not None:
+            limit = max(1, min(limit, ASSISTANT_LIST_MAX_LIMIT))
+        
+        # Версия списка: число ассистентов и время последнего изменения; если не изменилась - 304 без выборки строк
+        result = await db.execute(select(
+            func.count(),
+            func.max(func.coalesce(AssistantConfig.updated_at, AssistantConfig.created_at))
+        ).where(AssistantConfig.user_id == current_user.id))
+        count, last_modified = result.one()
+        etag = make_etag(current_user.id, count, last_modified, ",".join(columns), cursor, limit)
+        if etag_matches(if_none_match, etag):
+            return not_modified_response(etag)
+        
+        # Выбираем только нужные колонки (плюс ключ сортировки для курсора)
+        selected = set(columns) | {"created_at"}
+        query = select(*[getattr(AssistantConfig, field) for field in ASSISTANT_FIELDS if field in selected]).where(
+            AssistantConfig.user_id == current_user.id
+        ).order_by(AssistantConfig.created_at, AssistantConfig.id)
+        if position:
+            query = query.where(sa.tuple_(AssistantConfig.created_at, AssistantConfig.id) > sa.tuple_(*position))
+        if limit is not None:
+            query = query.limit(limit + 1)
+        result = await db.execute(query)
+        rows = result.all()
+        
+        headers = {}
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            headers["X-Next-Cursor"] = encode_keyset_cursor(rows[-1].created_at, rows[-1].id)
+        
+        return cached_json_response([serialize_assistant(row, columns) for row in rows], etag, headers)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Ошибка при получении списка помощников: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+@app.get("/api/assistants/{assistant_id}")
+async def get_assistant(
+    assistant_id: str,
+    if_none_match: Optional[str] = Header(None),
+    current_user: UserSnapshot = Depends(get_current_user),
+    db = Depends(get_db)
+):
+    """Получение информации о конкретном помощнике (с ETag по времени последнего изменения)"""
+    try:
+        # Добавляем логирование
+        logger.info(f"Запрос на получение ассистента с ID: {assistant_id}, пользователь: {current_user.id}")
+        
+        # Проверяем, существует ли помощник и принадлежит ли он пользователю (без загрузки промпта и функций)
+        result = await db.execute(select(AssistantConfig.created_at, AssistantConfig.updated_at).where(
+            AssistantConfig.id == assistant_id,
+            AssistantConfig.user_id == current_user.id
+        ))
+        version = result.first()
+        
+        if not version:
+            logger.error(f"Ассистент не найден: {assistant_id}")
+            raise HTTPException(status_code=404, detail="Помощник не найден")
+        
+        etag = make_etag(assistant_id, version.updated_at or version.created_at)
+        if etag_matches(if_none_match, etag):
+            return not_modified_response(etag)
+        
+        result = await db.execute(select(AssistantConfig).where(AssistantConfig.id == assistant_id))
+        assistant = result.scalars().first()
+        if not assistant:
+            raise HTTPException(status_code=404, detail="Помощник не найден")
+        
+        logger.info(f"Данные ассистента успешно получены: {assistant.id}")
+        return cached_json_response(serialize_assistant(assistant), etag)
+        
+    except HTTPException as he:
+        raise he
     except Exception as e:
-        logger.error(f"Ошибка при обновлении пользователя: {str(e)}")
+        logger.error(f"Ошибка при получении информации о помощнике: {str(e)}")
         logger.error(traceback.format_exc())
-        raise HTTPException(status_code=500, detail=f"Ошибка при обновлении пользователя: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
 
-# API для управления помощниками
-@app.post("/api/assistants", status_code=201)
-async def create_assistant(assistant: AssistantCreate, current_user: User = Depends(get_current_user), db = Depends(get_db)):
-    """Создание нового голосового помощника"""
+@app.get("/api/assistants/{assistant_id}/latency")
+async def get_assistant_latency(assistant_id: str, hours: int = 24, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
+    """Перцентили p50/p95/p99 задержек ходов диалога помощника за последние hours часов (по выборке трасс)"""
     try:
-        # Проверяем, есть ли API ключ у пользователя
-        api_key = current_user.openai_api_key or OPENAI_API_KEY
-        if not api_key:
-            raise HTTPException(status_code=400, detail="Требуется API ключ OpenAI")
+        result = await db.execute(select(AssistantConfig.id).where(
+            AssistantConfig.id == assistant_id,
+            AssistantConfig.user_id == current_user.id
+        ))
+        if result.scalar() is None:
+            raise HTTPException(status_code=404, detail="Помощник не найден")
         
-        # Создаем помощника в базе данных
-        new_assistant = AssistantConfig(
-            user_id=current_user.id,
-            name=assistant.name,
-            description=assistant.description,
-            system_prompt=assistant.system_prompt,
-            voice=assistant.voice,
-            language=assistant.language,
-            google_sheet_id=assistant.google_sheet_id,
-            functions=assistant.functions,
-            is_active=True
-        )
+        hours = max(1, min(hours, 24 * 30))
+        quantiles = (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+        columns = [func.count()]
+        for field in TURN_TRACE_FIELDS:
+            column = getattr(TurnTrace, field)
+            columns.extend(func.percentile_cont(q).within_group(column) for _, q in quantiles)
+        result = await db.execute(select(*columns).where(
+            TurnTrace.assistant_id == assistant_id,
+            TurnTrace.created_at > func.now() - timedelta(hours=hours)
+        ))
+        row = result.one()
         
-        db.add(new_assistant)
-        db.commit()
-        db.refresh(new_assistant)
+        breakdown = {}
+        values = iter(row[1:])
+        for field, description in TURN_TRACE_FIELDS.items():
+            breakdown[field] = {"description": description}
+            for name, _ in quantiles:
+                value = next(values)
+                breakdown[field][name] = round(value, 1) if value is not None else None
         
-        # Преобразуем данные для JSON ответа
-        assistant_dict = {
-            "id": str(new_assistant.id),
-            "user_id": str(new_assistant.user_id),
-            "name": new_assistant.name,
-            "description": new_assistant.description,
-            "system_prompt": new_assistant.system_prompt,
-            "voice": new_assistant.voice,
-            "language": new_assistant.language,
-            "google_sheet_id": new_assistant.google_sheet_id,
-            "functions": new_assistant.functions,
-            "is_active": new_assistant.is_active,
-            "created_at": new_assistant.created_at.isoformat() if new_assistant.created_at else None,
-            "updated_at": new_assistant.updated_at.isoformat() if new_assistant.updated_at else None
+        return {
+            "assistant_id": assistant_id,
+            "hours": hours,
+            "sample_rate": TURN_TRACE_SAMPLE_RATE,
+            "turns": row[0],
+            "breakdown": breakdown
         }
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Ошибка при получении задержек помощника: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+@app.get("/api/assistants/{assistant_id}/conversations")
+async def get_assistant_conversations(
+    assistant_id: str,
+    limit: int = CONVERSATION_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    search: Optional[str] = None,
+    current_user: UserSnapshot = Depends(get_current_user),
+    db = Depends(get_db)
+):
+    """
+    История диалогов помощника, новые сначала.
+    since/until - границы по времени, search - подстрока в репликах;
+    курсор следующей страницы возвращается в заголовке X-Next-Cursor.
+    """
+    try:
+        result = await db.execute(select(AssistantConfig.id).where(
+            AssistantConfig.id == assistant_id,
+            AssistantConfig.user_id == current_user.id
+        ))
+        if result.scalar() is None:
+            raise HTTPException(status_code=404, detail="Помощник не найден")
+        
+        limit = max(1, min(limit, CONVERSATION_PAGE_MAX_LIMIT))
+        query = select(*[getattr(Conversation, field) for field in CONVERSATION_FIELDS]).where(
+            Conversation.assistant_id == assistant_id
+        ).order_by(Conversation.created_at.desc(), Conversation.id.desc()).limit(limit + 1)
+        if cursor:
+            query = query.where(sa.tuple_(Conversation.created_at, Conversation.id) < sa.tuple_(*decode_keyset_cursor(cursor)))
+        if since:
+            query = query.where(Conversation.created_at >= since)
+        if until:
+            query = query.where(Conversation.created_at < until)
+        if search:
+            pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            query = query.where(sa.or_(Conversation.user_message.ilike(pattern), Conversation.assistant_message.ilike(pattern)))
+        result = await db.execute(query)
+        rows = result.all()
         
-        return assistant_dict
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers["X-Next-Cursor"] = encode_keyset_cursor(rows[-1].created_at, rows[-1].id)
         
+        return Response(
+            content=ujson.dumps([serialize_row(row, CONVERSATION_FIELDS) for row in rows], ensure_ascii=False),
+            media_type="application/json",
+            headers=headers
+        )
+    except HTTPException as he:
+        raise he
     except Exception as e:
-        logger.error(f"Ошибка при создании помощника: {str(e)}")
+        logger.error(f"Ошибка при получении истории диалогов: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
 
-@app.get("/api/assistants")
-async def get_user_assistants(current_user: User = Depends(get_current_user), db = Depends(get_db)):
-    """Получение списка помощников пользователя"""
+@app.get("/api/assistants/{assistant_id}/conversations/stats")
+async def get_assistant_conversation_stats(assistant_id: str, days: int = 30, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
+    """Число диалогов и их длительность по суткам (UTC) за последние days дней - из суточной сводки"""
     try:
-        assistants = db.query(AssistantConfig).filter(AssistantConfig.user_id == current_user.id).all()
+        result = await db.execute(select(AssistantConfig.id).where(
+            AssistantConfig.id == assistant_id,
+            AssistantConfig.user_id == current_user.id
+        ))
+        if result.scalar() is None:
+            raise HTTPException(status_code=404, detail="Помощник не найден")
         
-        # Преобразуем данные для JSON ответа
-        result = []
-        for assistant in assistants:
-            result.append({
-                "id": str(assistant.id),
-                "user_id": str(assistant.user_id),
-                "name": assistant.name,
-                "description": assistant.description,
-                "system_prompt": assistant.system_prompt,
-                "voice": assistant.voice,
-                "language": assistant.language,
-                "google_sheet_id": assistant.google_sheet_id,
-                "functions": assistant.functions,
-                "is_active": assistant.is_active,
-                "created_at": assistant.created_at.isoformat() if assistant.created_at else None,
-                "updated_at": assistant.updated_at.isoformat() if assistant.updated_at else None
+        days = max(1, min(days, CONVERSATION_STATS_MAX_DAYS))
+        first_day = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+        result = await db.execute(select(
+            ConversationDailyStats.day,
+            ConversationDailyStats.conversations,
+            ConversationDailyStats.total_duration_seconds
+        ).where(
+            ConversationDailyStats.assistant_id == assistant_id,
+            ConversationDailyStats.day >= first_day
+        ).order_by(ConversationDailyStats.day))
+        
+        daily = []
+        total_conversations = 0
+        total_duration = 0.0
+        for day, conversations, duration in result.all():
+            daily.append({
+                "day": day.isoformat(),
+                "conversations": conversations,
+                "total_duration_seconds": round(duration, 1),
+                "avg_duration_seconds": round(duration / conversations, 1) if conversations else None
             })
+            total_conversations += conversations
+            total_duration += duration
         
-        return result
+        return {
+            "assistant_id": assistant_id,
+            "days": days,
+            "conversations": total_conversations,
+            "total_duration_seconds": round(total_duration, 1),
+            "avg_duration_seconds": round(total_duration / total_conversations, 1) if total_conversations else None,
+            "daily": daily
+        }
+    except HTTPException as he:
+        raise he
     except Exception as e:
-        logger.error(f"Ошибка при получении списка помощников: {str(e)}")
+        logger.error(f"Ошибка при получении статистики диалогов: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
 
-@app.get("/api/assistants/{assistant_id}")
-async def get_assistant(assistant_id: str, current_user: User = Depends(get_current_user), db = Depends(get_db)):
-    """Получение информации о конкретном помощнике"""
+@app.get("/api/assistants/{assistant_id}/tool-cache")
+async def get_assistant_tool_cache(assistant_id: str, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
+    """Попадания в кэш результатов функций помощника и сэкономленное время (на текущем воркере)"""
     try:
-        # Добавляем логирование
-        logger.info(f"Запрос на получение ассистента с ID: {assistant_id}, пользователь: {current_user.id}")
+        result = await db.execute(select(AssistantConfig.id).where(
+            AssistantConfig.id == assistant_id,
+            AssistantConfig.user_id == current_user.id
+        ))
+        if result.scalar() is None:
+            raise HTTPException(status_code=404, detail="Помощник не найден")
         
-        # Проверяем, существует ли помощник и принадлежит ли он пользователю
-        assistant = db.query(AssistantConfig).filter(
+        entry = tool_result_caches.data.get(assistant_id)
+        stats = entry[1].get_stats() if entry is not None else {"hits": 0, "shared": 0, "misses": 0, "saved_ms": 0.0, "functions": {}}
+        return {"assistant_id": assistant_id, "worker": session_registry.worker, **stats}
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики кэша функций: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+@app.delete("/api/assistants/{assistant_id}/tool-cache")
+async def clear_assistant_tool_cache(assistant_id: str, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
+    """
+    Сбрасывает закэшированные результаты функций помощника (например, после смены цен):
+    на текущем воркере сразу, на остальных - не позже чем через TOOL_CACHE_GENERATION_TTL
+    (или сразу, если включены уведомления об инвалидации)
+    """
+    try:
+        result = await db.execute(
+            sa.update(AssistantConfig)
+            .where(AssistantConfig.id == assistant_id, AssistantConfig.user_id == current_user.id)
+            .values(tool_cache_generation=AssistantConfig.tool_cache_generation + 1)
+            .returning(AssistantConfig.tool_cache_generation)
+        )
+        generation = result.scalar()
+        if generation is None:
+            raise HTTPException(status_code=404, detail="Помощник не найден")
+        await db.commit()
+        
+        await cache_bus.publish("tool_cache", assistant_id)
+        return {"message": "Кэш функций сброшен", "assistant_id": assistant_id, "generation": generation}
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Ошибка при сбросе кэша функций: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+@app.get("/api/assistants/{assistant_id}/knowledge")
+async def get_assistant_knowledge(assistant_id: str, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
+    """Состояние базы знаний помощника"""
+    try:
+        result = await db.execute(select(AssistantConfig.id).where(
             AssistantConfig.id == assistant_id,
             AssistantConfig.user_id == current_user.id
-        ).first()
+        ))
+        if result.scalar() is None:
+            raise HTTPException(status_code=404, detail="Помощник не найден")
         
-        if not assistant:
-            logger.error(f"Ассистент не найден: {assistant_id}")
+        result = await db.execute(select(KnowledgeBase).where(KnowledgeBase.assistant_id == assistant_id))
+        knowledge = result.scalars().first()
+        result = await db.execute(
+            select(KnowledgeChunk.source, func.count()).where(KnowledgeChunk.assistant_id == assistant_id).group_by(KnowledgeChunk.source)
+        )
+        index = knowledge_indexes.get(assistant_id, None)
+        return {
+            "assistant_id": assistant_id,
+            "revision": knowledge.revision if knowledge else 0,
+            "embedding_model": knowledge.embedding_model if knowledge else KNOWLEDGE_EMBEDDING_MODEL,
+            "dim": knowledge.dim if knowledge else KNOWLEDGE_EMBEDDING_DIM,
+            "chunks": knowledge.chunks if knowledge else 0,
+            "sources": [{"source": source, "chunks": count} for source, count in result.all()],
+            "updated_at": knowledge.updated_at.isoformat() if knowledge and knowledge.updated_at else None,
+            "loaded": index is not None,
+            "clusters": len(index.centroids) if index is not None and index.centroids is not None else 0
+        }
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Ошибка при получении базы знаний: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+@app.get("/api/assistants/{assistant_id}/knowledge/search")
+async def search_assistant_knowledge(assistant_id: str, q: str, k: int = KNOWLEDGE_SEARCH_TOP_K, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
+    """Проверка поиска по базе знаний: те же фрагменты получает ассистент через инструмент search_knowledge"""
+    try:
+        result = await db.execute(select(AssistantConfig.id).where(
+            AssistantConfig.id == assistant_id,
+            AssistantConfig.user_id == current_user.id
+        ))
+        if result.scalar() is None:
             raise HTTPException(status_code=404, detail="Помощник не найден")
-            
-        # Преобразуем данные для JSON ответа
-        assistant_dict = {
-            "id": str(assistant.id),
-            "user_id": str(assistant.user_id),
-            "name": assistant.name,
-            "description": assistant.description,
-            "system_prompt": assistant.system_prompt,
-            "voice": assistant.voice,
-            "language": assistant.language,
-            "google_sheet_id": assistant.google_sheet_id,
-            "functions": assistant.functions,
-            "is_active": assistant.is_active,
-            "created_at": assistant.created_at.isoformat() if assistant.created_at else None,
-            "updated_at": assistant.updated_at.isoformat() if assistant.updated_at else None
+        
+        start = time.perf_counter()
+        results = await search_knowledge(assistant_id, q, max(1, min(k, 50)), api_key=current_user.openai_api_key)
+        return {"query": q, "results": results, "elapsed_ms": round((time.perf_counter() - start) * 1000, 2)}
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Ошибка поиска по базе знаний: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+
+@app.get("/api/assistants/{assistant_id}/files")
+async def get_assistant_files(assistant_id: str, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
+    """Документы базы знаний помощника"""
+    try:
+        result = await db.execute(select(AssistantConfig.id).where(
+            AssistantConfig.id == assistant_id,
+            AssistantConfig.user_id == current_user.id
+        ))
+        if result.scalar() is None:
+            raise HTTPException(status_code=404, detail="Помощник не найден")
+        
+        result = await db.execute(select(KnowledgeFile).where(
+            KnowledgeFile.assistant_id == assistant_id
+        ).order_by(KnowledgeFile.uploaded_at.desc()))
+        return [serialize_knowledge_file(knowledge_file) for knowledge_file in result.scalars().all()]
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Ошибка при получении документов: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+@app.post("/api/assistants/{assistant_id}/files", status_code=201)
+async def upload_assistant_file(assistant_id: str, request: Request, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
+    """
+    Загрузка документа в базу знаний (multipart, поле file). Документ разбирается по мере
+    поступления; ход загрузки виден в GET /api/assistants/{assistant_id}/files/{file_id}
+    """
+    knowledge_file = None
+    try:
+        result = await db.execute(select(AssistantConfig.id).where(
+            AssistantConfig.id == assistant_id,
+            AssistantConfig.user_id == current_user.id
+        ))
+        if result.scalar() is None:
+            raise HTTPException(status_code=404, detail="Помощник не найден")
+        
+        content_type = request.headers.get("content-type", "")
+        if not content_type.startswith("multipart/form-data"):
+            raise HTTPException(status_code=400, detail="Ожидается multipart/form-data с полем file")
+        upload = MultipartFileStream(content_type)
+        
+        # Читаем тело до заголовков поля file: по имени файла определяется формат
+        stream = request.stream()
+        first_data = []
+        async for chunk in stream:
+            first_data = upload.feed(chunk)
+            if upload.filename is not None:
+                break
+        if not upload.filename:
+            raise HTTPException(status_code=400, detail="В запросе нет файла (поле file)")
+        name = os.path.basename(upload.filename.replace("\\", "/")).strip()[:255]
+        if os.path.splitext(name)[1].lower() not in KNOWLEDGE_FILE_KINDS:
+            raise HTTPException(
+                status_code=415,
+                detail=f"Формат не поддерживается. Допустимые форматы: {', '.join(sorted(KNOWLEDGE_FILE_KINDS))}"
+            )
+        expected_size = request.headers.get("content-length")
+        if expected_size and int(expected_size) > KNOWLEDGE_MAX_FILE_MB * 1024 * 1024 + 64 * 1024:
+            raise HTTPException(status_code=413, detail=f"Файл больше {KNOWLEDGE_MAX_FILE_MB} МБ")
+        
+        # Запись о документе создается отдельной транзакцией, чтобы ход загрузки был виден сразу
+        async with SessionLocal() as progress_db:
+            knowledge_file = KnowledgeFile(
+                assistant_id=uuid.UUID(assistant_id),
+                name=name,
+                content_type=upload.content_type,
+                size=0,
+                expected_size=int(expected_size) if expected_size else None,
+                status="uploading",
+                chunks=0,
+                new_chunks=0
+            )
+            progress_db.add(knowledge_file)
+            await progress_db.commit()
+            await progress_db.refresh(knowledge_file)
+        
+        await ingest_knowledge_stream(stream, db, knowledge_file, upload, first_data, current_user.openai_api_key)
+        await cache_bus.publish("knowledge", assistant_id)
+        knowledge_file.status = "ready"
+        return serialize_knowledge_file(knowledge_file)
+    except HTTPException as he:
+        if knowledge_file is not None:
+            await db.rollback()
+            await update_knowledge_file(knowledge_file.id, status="failed", size=knowledge_file.size, error=he.detail)
+        raise he
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке документа: {str(e)}")
+        if knowledge_file is not None:
+            await db.rollback()
+            await update_knowledge_file(knowledge_file.id, status="failed", size=knowledge_file.size, error=str(e))
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+async def get_owned_knowledge_file(db, assistant_id: str, file_id: str, user_id) -> KnowledgeFile:
+    result = await db.execute(select(KnowledgeFile).join(
+        AssistantConfig, AssistantConfig.id == KnowledgeFile.assistant_id
+    ).where(
+        KnowledgeFile.id == file_id,
+        KnowledgeFile.assistant_id == assistant_id,
+        AssistantConfig.user_id == user_id
+    ))
+    knowledge_file = result.scalars().first()
+    if not knowledge_file:
+        raise HTTPException(status_code=404, detail="Документ не найден")
+    return knowledge_file
+
+@app.get("/api/assistants/{assistant_id}/files/{file_id}")
+async def get_assistant_file_status(assistant_id: str, file_id: str, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
+    """Состояние загрузки документа: получено байт, фрагментов, из них новых, ошибка"""
+    try:
+        knowledge_file = await get_owned_knowledge_file(db, assistant_id, file_id, current_user.id)
+        progress = None
+        if knowledge_file.status == "ready":
+            progress = 100
+        elif knowledge_file.expected_size:
+            progress = min(99, int(knowledge_file.size * 100 / knowledge_file.expected_size))
+        return {
+            **serialize_knowledge_file(knowledge_file),
+            "expected_size": knowledge_file.expected_size,
+            "progress": progress,
+            "error": knowledge_file.error,
+            "updated_at": knowledge_file.updated_at.isoformat() if knowledge_file.updated_at else None
         }
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Ошибка при получении состояния документа: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+@app.get("/api/assistants/{assistant_id}/files/{file_id}/download")
+async def download_assistant_file(assistant_id: str, file_id: str, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
+    """Скачивание исходного файла документа (части читаются из БД по одной)"""
+    try:
+        knowledge_file = await get_owned_knowledge_file(db, assistant_id, file_id, current_user.id)
+        if knowledge_file.status != "ready":
+            raise HTTPException(status_code=409, detail="Документ еще не загружен")
         
-        logger.info(f"Данные ассистента успешно получены: {assistant.id}")
-        return assistant_dict
+        async def read_parts():
+            async with SessionLocal() as parts_db:
+                part = 0
+                while True:
+                    result = await parts_db.execute(select(KnowledgeFilePart.data).where(
+                        KnowledgeFilePart.file_id == knowledge_file.id,
+                        KnowledgeFilePart.part == part
+                    ))
+                    data = result.scalar()
+                    if data is None:
+                        return
+                    yield data
+                    part += 1
         
+        fallback_name = knowledge_file.name.encode("ascii", "replace").decode().replace("?", "_").replace('"', "_")
+        return StreamingResponse(read_parts(), media_type=knowledge_file.content_type or "application/octet-stream", headers={
+            "Content-Length": str(knowledge_file.size),
+            "Content-Disposition": f'attachment; filename="{fallback_name}"; filename*=UTF-8\'\'{quote(knowledge_file.name)}'
+        })
     except HTTPException as he:
         raise he
     except Exception as e:
-        logger.error(f"Ошибка при получении информации о помощнике: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.error(f"Ошибка при скачивании документа: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+@app.delete("/api/assistants/{assistant_id}/files/{file_id}")
+async def delete_assistant_file(assistant_id: str, file_id: str, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
+    """Удаление документа из базы знаний"""
+    try:
+        knowledge_file = await get_owned_knowledge_file(db, assistant_id, file_id, current_user.id)
+        await db.execute(sa.text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {"key": f"knowledge:{knowledge_file.assistant_id}"})
+        await db.delete(knowledge_file)
+        await db.flush()
+        result = await db.execute(select(KnowledgeBase.embedding_model, KnowledgeBase.dim).where(KnowledgeBase.assistant_id == assistant_id))
+        knowledge = result.first()
+        if knowledge:
+            await bump_knowledge_revision(db, knowledge_file.assistant_id, knowledge.embedding_model, knowledge.dim)
+        await db.commit()
+        await cache_bus.publish("knowledge", assistant_id)
+        return {"message": "Документ удален", "id": file_id}
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Ошибка при удалении документа: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
 
 @app.put("/api/assistants/{assistant_id}")
-async def update_assistant(assistant_id: str, assistant_update: AssistantUpdate, current_user: User = Depends(get_current_user), db = Depends(get_db)):
+async def update_assistant(assistant_id: str, assistant_update: AssistantUpdate, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
     """Обновление информации о помощнике"""
     try:
         # Проверяем, существует ли помощник и принадлежит ли он пользователю
-        assistant = db.query(AssistantConfig).filter(
+        result = await db.execute(select(AssistantConfig).where(
             AssistantConfig.id == assistant_id,
             AssistantConfig.user_id == current_user.id
-        ).first()
+        ))
+        assistant = result.scalars().first()
         
         if not assistant:
             raise HTTPException(status_code=404, detail="Помощник не найден")
@@ -736,31 +5221,21 @@ async def update_assistant(assistant_id: str, assistant_update: AssistantUpdate,
         
         if not update_data:
             return {"message": "Нет данных для обновления"}
+        await check_function_webhooks(update_data.get("functions"))
             
         # Обновляем данные в базе
         for key, value in update_data.items():
             setattr(assistant, key, value)
             
-        db.commit()
-        db.refresh(assistant)
+        await db.commit()
+        await db.refresh(assistant)
         
-        # Преобразуем данные для JSON ответа
-        assistant_dict = {
-            "id": str(assistant.id),
-            "user_id": str(assistant.user_id),
-            "name": assistant.name,
-            "description": assistant.description,
-            "system_prompt": assistant.system_prompt,
-            "voice": assistant.voice,
-            "language": assistant.language,
-            "google_sheet_id": assistant.google_sheet_id,
-            "functions": assistant.functions,
-            "is_active": assistant.is_active,
-            "created_at": assistant.created_at.isoformat() if assistant.created_at else None,
-            "updated_at": assistant.updated_at.isoformat() if assistant.updated_at else None
-        }
+        # Сбрасываем закэшированную конфигурацию ассистента
+        await cache_bus.publish("assistant", assistant.id)
         
-        return assistant_dict
+        # Преобразуем данные для JSON ответа (ETag совпадает с тем, что вернет GET)
+        etag = make_etag(assistant_id, assistant.updated_at or assistant.created_at)
+        return cached_json_response(serialize_assistant(assistant), etag)
         
     except HTTPException as he:
         raise he
@@ -769,21 +5244,25 @@ async def update_assistant(assistant_id: str, assistant_update: AssistantUpdate,
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
 
 @app.delete("/api/assistants/{assistant_id}")
-async def delete_assistant(assistant_id: str, current_user: User = Depends(get_current_user), db = Depends(get_db)):
+async def delete_assistant(assistant_id: str, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
     """Удаление помощника"""
     try:
         # Проверяем, существует ли помощник и принадлежит ли он пользователю
-        assistant = db.query(AssistantConfig).filter(
+        result = await db.execute(select(AssistantConfig).where(
             AssistantConfig.id == assistant_id,
             AssistantConfig.user_id == current_user.id
-        ).first()
+        ))
+        assistant = result.scalars().first()
         
         if not assistant:
             raise HTTPException(status_code=404, detail="Помощник не найден")
             
         # Удаляем помощника из базы
-        db.delete(assistant)
-        db.commit()
+        await db.delete(assistant)
+        await db.commit()
+        await cache_bus.publish("assistant", assistant_id)
+        # Файлы индекса базы знаний (фрагменты удалены каскадно вместе с помощником)
+        await asyncio.to_thread(shutil.rmtree, os.path.join(KNOWLEDGE_INDEX_DIR, str(assistant_id)), True)
         
         return {"message": "Помощник успешно удален", "id": assistant_id}
         
@@ -794,14 +5273,15 @@ async def delete_assistant(assistant_id: str, current_user: User = Depends(get_c
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
 
 @app.get("/api/assistants/{assistant_id}/embed-code")
-async def get_assistant_embed_code(assistant_id: str, current_user: User = Depends(get_current_user), db = Depends(get_db)):
+async def get_assistant_embed_code(assistant_id: str, current_user: UserSnapshot = Depends(get_current_user), db = Depends(get_db)):
     """Получение кода для встраивания голосового помощника на сайт"""
     try:
         # Проверяем, существует ли помощник и принадлежит ли он пользователю
-        assistant = db.query(AssistantConfig).filter(
+        result = await db.execute(select(AssistantConfig).where(
             AssistantConfig.id == assistant_id,
             AssistantConfig.user_id == current_user.id
-        ).first()
+        ))
+        assistant = result.scalars().first()
         
         if not assistant:
             raise HTTPException(status_code=404, detail="Помощник не найден")
@@ -834,14 +5314,29 @@ async def get_assistant_embed_code(assistant_id: str, current_user: User = Depen
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
 
 # Новая функция для обработки WebSocket соединения с повторными попытками
-async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant_id: str, db):
+async def wait_before_retry(delay: float, client_tasks: List[asyncio.Task]) -> bool:
+    """Пауза перед повторным подключением к OpenAI. False - клиент за это время отключился"""
+    if not client_tasks:
+        await asyncio.sleep(delay)
+        return True
+    done, _ = await asyncio.wait(client_tasks, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+    return not done
+
+async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant_id: str, client_id: str):
     """
     Обработка WebSocket-соединения с повторными попытками при ошибке.
     Реализует механизм повторного подключения к OpenAI API при сбоях соединения.
     """
-    client_id = id(websocket)
     max_reconnect_attempts = MAX_RECONNECT_ATTEMPTS
     reconnect_attempt = 0
+    session_started = None  # Когда запущены задачи текущей сессии OpenAI (time.monotonic)
+    admission = None  # Решение о допуске сессии (принимается один раз на соединение клиента)
+    # Задачи стороны клиента (чтение от клиента, отправка клиенту, heartbeat) переживают переподключения
+    # к OpenAI: аудио клиента во время обрыва копится в очереди upstream, а не теряется
+    client_tasks = []
+    openai_tasks = []  # Задачи текущего соединения с OpenAI (чтение от OpenAI, отправка в OpenAI)
+    # Бинарный протокол аудио: сырые PCM16 кадры вместо base64 в JSON (включается клиентом)
+    binary_audio = websocket.query_params.get("audio") == "binary"
     
     logger.info(f"Начало обработки WebSocket соединения для клиента {client_id} с ассистентом {assistant_id}")
     
@@ -863,8 +5358,8 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
     
     while reconnect_attempt <= max_reconnect_attempts:
         try:
-            # Получаем информацию о помощнике из базы данных
-            assistant = db.query(AssistantConfig).filter(AssistantConfig.id == assistant_id).first()
+            # Получаем информацию о помощнике (из кэша или из базы данных)
+            assistant = await get_resolved_assistant(assistant_id)
             
             if not assistant:
                 logger.error(f"Ассистент {assistant_id} не найден в базе данных")
@@ -884,9 +5379,8 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
                 
             # Получаем API ключ пользователя
             user_id = assistant.user_id
-            user = db.query(User).filter(User.id == user_id).first()
             
-            if not user:
+            if not assistant.owner_found:
                 logger.error(f"Пользователь {user_id} не найден в базе данных")
                 await websocket.send_json({
                     "type": "error",
@@ -895,7 +5389,7 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
                 break
                 
             # Используем API ключ пользователя или дефолтный
-            openai_api_key = user.openai_api_key or OPENAI_API_KEY
+            openai_api_key = assistant.api_key or OPENAI_API_KEY
             
             if not openai_api_key:
                 logger.error("API ключ OpenAI не найден")
@@ -904,6 +5398,24 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
                     "error": {"message": "API ключ OpenAI не настроен"}
                 })
                 break
+            
+            # Допуск сессии по лимитам тарифа владельца (до открытия соединения с OpenAI)
+            if admission is None:
+                admission = await admission_controller.admit(client_id, assistant, websocket.client.host if websocket.client else None)
+                if admission.reason:
+                    logger.warning(f"Сессия для ассистента {assistant_id} отклонена: {admission.reason}")
+                    # Лимит одновременных сессий может освободиться, дневной - нет
+                    retry_after = None if admission.reason == "daily_minutes" else 10
+                    await websocket.send_json({
+                        "type": "connection_status",
+                        "status": "rejected",
+                        "reason": admission.reason,
+                        "message": ADMISSION_REJECTIONS[admission.reason],
+                        "retry_after": retry_after,
+                        "limits": admission.limits._asdict()
+                    })
+                    await websocket.close(code=1013 if retry_after else 1000, reason=admission.reason)
+                    break
                 
             # Хранение информации об этом клиенте
             client_connections[client_id] = {
@@ -913,12 +5425,36 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
                 "voice": assistant.voice,
                 "system_message": assistant.system_prompt,
                 "functions": assistant.functions,
+                # Функции, выполняемые сервером, и их вызовы в текущей сессии OpenAI
+                "tool_specs": build_tool_specs(assistant.functions, assistant.knowledge_chunks > 0),
+                "tool_calls": ToolCallTracker(client_id),
+                "api_key": assistant.api_key,
+                "google_sheet_id": assistant.google_sheet_id,
                 "user_id": str(user_id),
                 "assistant_id": str(assistant_id),
-                "tasks": [],     # Для хранения задач
-                "reconnecting": False,  # Флаг, указывающий на пересоздание соединения
+                "binary_audio": binary_audio,  # Аудио передается бинарными кадрами
+                # Преобразователь входного аудио (сохраняется между переподключениями к OpenAI)
+                "audio_converter": client_connections.get(client_id, {}).get("audio_converter"),
+                # Подавитель тишины во входном аудио (тоже переживает переподключения)
+                "silence_gate": client_connections[client_id]["silence_gate"] if client_id in client_connections else create_silence_gate(assistant.audio_settings),
+                # Ограничения тарифа: время окончания сессии и скорость входящего аудио
+                "deadline": client_connections[client_id]["deadline"] if client_id in client_connections else (
+                    time.time() + admission.session_seconds if admission.session_seconds else None
+                ),
+                "audio_bucket": client_connections[client_id]["audio_bucket"] if client_id in client_connections else admission_controller.create_audio_bucket(admission.limits),
+                # Очереди отправки по направлениям (клиент тот же, поэтому очереди переживают переподключения)
+                "queues": client_connections[client_id]["queues"] if client_id in client_connections else {
+                    "upstream": RelaySendQueue("клиент -> OpenAI", RELAY_QUEUE_MAX_BYTES, RELAY_UPSTREAM_POLICY),
+                    "downstream": RelaySendQueue("OpenAI -> клиент", RELAY_QUEUE_MAX_BYTES, RELAY_DOWNSTREAM_POLICY)
+                },
+                "tasks": client_tasks,  # Для хранения задач
+                "reconnecting": bool(client_tasks),  # Флаг, указывающий на пересоздание соединения
                 "last_ping_time": time.time(),  # Время последнего ping
-                "conversation": {
+                # История разговора для переноса в новую сессию OpenAI после обрыва
+                "transcript": client_connections[client_id]["transcript"] if client_id in client_connections else ConversationTranscript(
+                    RESUME_TRANSCRIPT_MAX_ITEMS, RESUME_TRANSCRIPT_MAX_CHARS
+                ),
+                "conversation": client_connections[client_id]["conversation"] if client_id in client_connections else {
                     "user_message": "",
                     "assistant_message": "",
                     "start_time": time.time()
@@ -935,12 +5471,14 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
             except Exception as e:
                 logger.error(f"Ошибка при отправке статуса подключения: {str(e)}")
             
-            # Устанавливаем соединение с OpenAI с таймаутом
+            # Устанавливаем соединение с OpenAI с таймаутом (по возможности берем готовое из пула)
             try:
-                openai_ws = await asyncio.wait_for(
-                    create_openai_connection(openai_api_key),
+                connect_started = time.perf_counter()
+                openai_ws, pool_hit = await asyncio.wait_for(
+                    openai_pool.acquire(openai_api_key),
                     timeout=20.0
                 )
+                openai_connect_seconds.labels("hit" if pool_hit else "miss").observe(time.perf_counter() - connect_started)
                 
                 client_connections[client_id]["openai_ws"] = openai_ws
                 logger.info(f"Соединение с OpenAI установлено для клиента {client_id}")
@@ -950,7 +5488,8 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
                     await websocket.send_json({
                         "type": "connection_status",
                         "status": "connected",
-                        "message": "Соединение с OpenAI установлено"
+                        "resumed": bool(client_tasks),
+                        "message": "Соединение с OpenAI восстановлено" if client_tasks else "Соединение с OpenAI установлено"
                     })
                 except Exception as e:
                     logger.error(f"Ошибка при отправке статуса успешного подключения: {str(e)}")
@@ -958,25 +5497,52 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
                 # Добавляем более подробное логирование системного промпта
                 logger.info(f"Для ассистента {assistant_id} используется промпт: {assistant.system_prompt[:100]}...")
                 
-                # Отправляем настройки сессии в OpenAI
+                # Отправляем настройки сессии в OpenAI (ответ session.updated ловит forward_openai_to_client)
+                client_connections[client_id]["session_update_sent_at"] = time.perf_counter()
                 await send_session_update(
                     openai_ws, 
                     voice=assistant.voice, 
                     system_message=assistant.system_prompt,
-                    functions=assistant.functions
+                    functions=assistant.functions,
+                    knowledge=assistant.knowledge_chunks > 0
                 )
+                openai_pool.record_ready(time.perf_counter() - connect_started, pool_hit)
                 
-                # Создаем три задачи: две для обмена сообщениями и одну для heartbeat
-                client_to_openai = asyncio.create_task(forward_client_to_openai(websocket, openai_ws, client_id))
-                openai_to_client = asyncio.create_task(forward_openai_to_client(openai_ws, websocket, client_id, db))
-                heartbeat_task = asyncio.create_task(heartbeat_check(websocket, client_id))
+                queues = client_connections[client_id]["queues"]
+                if client_tasks:
+                    # Восстановление после обрыва: до аудио переносим историю разговора в новую сессию,
+                    # затем отправляем только последние RESUME_AUDIO_BUFFER_MS аудио, накопленного за время обрыва
+                    replay = client_connections[client_id]["transcript"].to_events()
+                    for event in replay:
+                        await openai_ws.send(event)
+                    # Результаты функций и продолжения ответов прежней сессии: таких call_id в новой сессии нет
+                    dropped_tool_events = queues["upstream"].drop_kind("tool")
+                    queues["upstream"].trim_audio(RESUME_AUDIO_BUFFER_MS * PCM16_BYTES_PER_MS * 4 // 3)
+                    logger.info(f"Сессия клиента {client_id} восстановлена: реплик перенесено {len(replay)}, "
+                                f"событий функций прежней сессии отброшено {dropped_tool_events}, "
+                                f"аудио в очереди {queues['upstream'].size} байт")
+                
+                # Задачи соединения с OpenAI: чтение от OpenAI и отправка в OpenAI
+                openai_tasks = [
+                    asyncio.create_task(forward_openai_to_client(openai_ws, websocket, client_id)),
+                    asyncio.create_task(relay_sender(queues["upstream"], openai_ws.send, client_id))
+                ]
+                session_started = time.monotonic()
+                # Задачи стороны клиента создаются один раз: чтение от клиента, отправка клиенту и heartbeat
+                if not client_tasks:
+                    client_tasks = [
+                        asyncio.create_task(forward_client_to_openai(websocket, client_id)),
+                        asyncio.create_task(relay_sender(queues["downstream"], lambda message: send_to_client(websocket, message), client_id)),
+                        asyncio.create_task(heartbeat_check(websocket, client_id))
+                    ]
                 
                 # Сохраняем задачи для возможности отмены
-                client_connections[client_id]["tasks"] = [client_to_openai, openai_to_client, heartbeat_task]
+                client_connections[client_id]["tasks"] = client_tasks + openai_tasks
+                client_connections[client_id]["reconnecting"] = False
                 
                 # Ждем, пока одна из задач не завершится
                 done, pending = await asyncio.wait(
-                    [client_to_openai, openai_to_client, heartbeat_task],
+                    client_tasks + openai_tasks,
                     return_when=asyncio.FIRST_COMPLETED
                 )
                 
@@ -986,12 +5552,14 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
                         task.result()  # Вызовет исключение, если задача завершилась с ошибкой
                     except websockets.exceptions.ConnectionClosed as e:
                         logger.warning(f"Соединение закрыто: {e.code}, {e.reason}")
-                        # Если это было нормальное закрытие, выходим из цикла
-                        if e.code == 1000 or e.code == 1001:
+                        # Клиент отключился или OpenAI закрыл соединение штатно - выходим из цикла
+                        if task in client_tasks or e.code == 1000 or e.code == 1001:
                             reconnect_attempt = max_reconnect_attempts + 1  # Принудительно завершаем цикл
                         # Иначе продолжим с повторной попыткой
                         else:
                             raise  # Передадим исключение для обработки в блоке except
+                    except RelayQueueOverflow:
+                        raise
                     except Exception as e:
                         logger.error(f"Задача завершилась с ошибкой: {str(e)}")
                         logger.error(traceback.format_exc())
@@ -1019,6 +5587,7 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
                 # Увеличиваем счетчик попыток и пробуем снова
                 reconnect_attempt += 1
                 if reconnect_attempt <= max_reconnect_attempts:
+                    relay_reconnects.labels("connect_timeout", "").inc()
                     logger.info(f"Попытка переподключения {reconnect_attempt}/{max_reconnect_attempts}")
                     # Уведомляем клиента о повторной попытке
                     try:
@@ -1032,9 +5601,10 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
                     except Exception as e:
                         logger.error(f"Ошибка при отправке статуса переподключения: {str(e)}")
                     
-                    # Экспоненциальная задержка перед повторной попыткой
-                    delay = 2 ** (reconnect_attempt - 1)
-                    await asyncio.sleep(delay)
+                    # Экспоненциальная задержка со случайным разбросом перед повторной попыткой
+                    if not await wait_before_retry(reconnect_delay(reconnect_attempt), client_tasks):
+                        logger.info(f"Клиент {client_id} отключился во время переподключения")
+                        break
                 else:
                     # Исчерпаны все попытки
                     logger.error(f"Исчерпаны все попытки подключения для клиента {client_id}")
@@ -1052,15 +5622,29 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
         except websockets.exceptions.ConnectionClosed as e:
             logger.warning(f"Соединение WebSocket закрыто для клиента {client_id}: {e.code}, {e.reason}")
             
+            # Задачи оборванного соединения с OpenAI больше не нужны; задачи клиента продолжают работать
+            for task in openai_tasks:
+                task.cancel()
+            if client_id in client_connections:
+                client_connections[client_id]["reconnecting"] = True
+            
             # Проверяем, было ли закрытие "чистым"
             if e.code == 1000 or e.code == 1001:
                 logger.info(f"Соединение закрыто нормально, код: {e.code}")
                 break
             
+            # Сессия, которая настроилась и проработала RECONNECT_HEALTHY_SECONDS, была здоровой:
+            # обрыв после нее считается первым, а не продолжением прежней серии попыток
+            if (session_started is not None and time.monotonic() - session_started >= RECONNECT_HEALTHY_SECONDS
+                    and client_connections.get(client_id, {}).get("session_updated")):
+                reconnect_attempt = 0
+            session_started = None
+            
             # Увеличиваем счетчик попыток
             reconnect_attempt += 1
             
             if reconnect_attempt <= max_reconnect_attempts:
+                relay_reconnects.labels("openai_closed", str(e.code)).inc()
                 logger.info(f"Попытка переподключения {reconnect_attempt}/{max_reconnect_attempts} после разрыва соединения")
                 try:
                     await websocket.send_json({
@@ -1075,9 +5659,10 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
                     # Если не можем отправить сообщение клиенту, прекращаем попытки
                     break
                 
-                # Экспоненциальная задержка перед повторной попыткой
-                delay = 2 ** (reconnect_attempt - 1)
-                await asyncio.sleep(delay)
+                # Экспоненциальная задержка со случайным разбросом перед повторной попыткой
+                if not await wait_before_retry(reconnect_delay(reconnect_attempt), client_tasks):
+                    logger.info(f"Клиент {client_id} отключился во время переподключения")
+                    break
             else:
                 logger.error(f"Исчерпаны все попытки переподключения для клиента {client_id}")
                 try:
@@ -1091,6 +5676,16 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
                     logger.error(f"Не удалось отправить сообщение об исчерпании попыток: {str(send_err)}")
                 break
                 
+        except RelayQueueOverflow as e:
+            # Получатель не успевает забирать данные - разрываем соединение, чтобы память на сокет оставалась ограниченной
+            logger.warning(f"Соединение с клиентом {client_id} разорвано: {str(e)}")
+            relay_queue_totals["overflow_disconnects"] += 1
+            try:
+                await websocket.close(code=1013, reason="Клиент не успевает получать данные")
+            except Exception as close_err:
+                logger.debug(f"Не удалось закрыть соединение с клиентом {client_id}: {str(close_err)}")
+            break
+            
         except Exception as e:
             logger.error(f"Необработанная ошибка в WebSocket обработчике для клиента {client_id}: {str(e)}")
             logger.error(traceback.format_exc())
@@ -1111,7 +5706,7 @@ async def handle_websocket_connection_with_retry(websocket: WebSocket, assistant
     # Очистка ресурсов
     await cleanup_connection(client_id)
 
-async def heartbeat_check(websocket: WebSocket, client_id: int):
+async def heartbeat_check(websocket: WebSocket, client_id: str):
     """
     Отправляет периодические пинги клиенту для проверки жизнеспособности соединения.
     """
@@ -1121,6 +5716,12 @@ async def heartbeat_check(websocket: WebSocket, client_id: int):
         logger.info(f"Запущена задача проверки соединения для клиента {client_id}")
         
         while client_id in client_connections and client_connections[client_id]["active"]:
+            # Проверяем лимит длительности сессии по тарифу
+            deadline = client_connections[client_id].get("deadline")
+            if deadline and time.time() >= deadline:
+                await close_local_session(client_id, "Достигнут лимит длительности разговора по тарифу", "session_limit")
+                break
+            
             try:
                 # Отправляем ping-сообщение через WebSocket
                 await websocket.send_json({
@@ -1140,8 +5741,8 @@ async def heartbeat_check(websocket: WebSocket, client_id: int):
                     1006, "Соединение потеряно: ошибка при отправке ping"
                 )
                 
-            # Ждем до следующей проверки
-            await asyncio.sleep(ping_interval)
+            # Ждем до следующей проверки (или до окончания сессии по тарифу, если оно раньше)
+            await asyncio.sleep(min(ping_interval, deadline - time.time()) if deadline else ping_interval)
             
     except websockets.exceptions.ConnectionClosed:
         logger.warning(f"Соединение закрыто в heartbeat_check для клиента {client_id}")
@@ -1150,10 +5751,13 @@ async def heartbeat_check(websocket: WebSocket, client_id: int):
         logger.error(f"Ошибка в задаче heartbeat_check для клиента {client_id}: {str(e)}")
         logger.error(traceback.format_exc())
         raise
-async def cleanup_connection(client_id: int):
+async def cleanup_connection(client_id: str):
     """Очистка ресурсов при завершении соединения"""
     logger.info(f"Очистка ресурсов для клиента {client_id}")
     
+    # Сначала убираем сессию из реестра, чтобы она не учитывалась в лимитах владельца
+    await session_registry.unregister(client_id)
+    
     # Закрываем соединение с OpenAI, если оно существует
     if client_id in client_connections and client_connections[client_id]["openai_ws"]:
         try:
@@ -1169,6 +5773,27 @@ async def cleanup_connection(client_id: int):
                 task.cancel()
                 logger.info(f"Задача отменена для клиента {client_id}")
     
+    # Учитываем статистику подавления тишины за сессию
+    silence_gate = client_connections.get(client_id, {}).get("silence_gate")
+    if silence_gate is not None:
+        stats = silence_gate.get_stats()
+        silence_gate_totals["sessions"] += 1
+        for key, value in stats.items():
+            silence_gate_totals[key] += value
+        if stats["bytes_in"]:
+            logger.info(f"Подавление тишины для клиента {client_id}: не отправлено {stats['bytes_saved']} из {stats['bytes_in']} байт "
+                        f"({stats['bytes_saved'] * 100 // stats['bytes_in']}%)")
+    
+    # Учитываем статистику очередей отправки
+    queues = client_connections.get(client_id, {}).get("queues")
+    if queues:
+        relay_queue_totals["connections"] += 1
+        for queue in queues.values():
+            for key in ("dropped_audio", "dropped_audio_bytes", "coalesced_text"):
+                relay_queue_totals[key] += queue.stats[key]
+            relay_queue_totals["max_high_water_bytes"] = max(relay_queue_totals["max_high_water_bytes"], queue.stats["high_water_bytes"])
+            queue.clear()
+    
     # Удаляем информацию о клиенте
     if client_id in client_connections:
         client_connections[client_id]["active"] = False
@@ -1176,40 +5801,67 @@ async def cleanup_connection(client_id: int):
         logger.info(f"Информация о клиенте {client_id} удалена")
 
 # Улучшенная функция для пересылки сообщений от клиента к OpenAI
-async def forward_client_to_openai(client_ws: WebSocket, openai_ws, client_id: int):
+async def forward_client_to_openai(client_ws: WebSocket, client_id: str):
     """
-    Пересылает сообщения от клиента (браузера) к API OpenAI.
-    Улучшена обработка ошибок и надежность передачи данных.
+    Пересылает сообщения от клиента (браузера) к API OpenAI через очередь upstream.
+    Задача работает все время соединения с клиентом: пока соединение с OpenAI
+    восстанавливается, сообщения клиента копятся в очереди.
     """
     try:
         logger.info(f"Запущена задача пересылки данных от клиента {client_id} к OpenAI")
         
-        # Счетчик ошибок для обнаружения частых проблем
-        error_count = 0
-        max_errors = 5
-        last_error_time = time.time()
+        # Серии метрик берем один раз, на кадре только увеличиваем значения
+        frames_metric = relay_frames.labels("upstream")
+        bytes_metric = relay_bytes.labels("upstream")
         
         while client_id in client_connections and client_connections[client_id]["active"]:
-            # Получаем данные от клиента
+            # Получаем данные от клиента (текстовый или бинарный кадр)
             try:
-                message = await client_ws.receive_text()
+                received = await client_ws.receive()
             except WebSocketDisconnect:
                 logger.info(f"Клиент {client_id} отключился")
                 break
             
+            if received["type"] == "websocket.disconnect":
+                logger.info(f"Клиент {client_id} отключился")
+                break
+            
+            audio_bytes = received.get("bytes")
+            message = received.get("text")
+            
             # Проверяем, что сообщение не пустое
-            if not message:
+            if not message and not audio_bytes:
                 continue
+            
+            frames_metric.inc()
+            bytes_metric.inc(len(audio_bytes) if audio_bytes else len(message))
                 
-            # Проверяем, что клиент не в процессе переподключения
-            if client_id in client_connections and client_connections[client_id].get("reconnecting", False):
-                logger.debug(f"Сообщение от клиента {client_id} проигнорировано - идет переподключение")
-                continue
+            # Преобразователь формата аудио, если клиент объявил формат, отличный от PCM16 24 кГц моно
+            audio_converter = client_connections[client_id].get("audio_converter") if client_id in client_connections else None
+            silence_gate = client_connections[client_id].get("silence_gate") if client_id in client_connections else None
+            audio_bucket = client_connections[client_id].get("audio_bucket") if client_id in client_connections else None
+            upstream = client_connections[client_id]["queues"]["upstream"] if client_id in client_connections else None
             
-            # Парсим JSON
             try:
-                data = json.loads(message)
-                msg_type = data.get("type", "unknown")
+                pcm = None  # Аудиоданные кадра append в формате PCM16 24 кГц моно, если уже декодированы
+                if audio_bytes:
+                    # Бинарный кадр - сырые аудиоданные: приводим к PCM16 24 кГц моно
+                    if audio_converter is not None:
+                        audio_bytes = audio_converter.convert(audio_bytes)
+                        if not audio_bytes:
+                            continue
+                    # Оборачиваем в событие append по готовому шаблону без JSON-парсинга
+                    msg_type = "input_audio_buffer.append"
+                    pcm = audio_bytes
+                    message = AUDIO_APPEND_PREFIX + base64.b64encode(audio_bytes).decode("ascii") + AUDIO_APPEND_SUFFIX
+                    data = None
+                else:
+                    # Определяем тип по началу кадра; полностью разбираем только нужные релею события
+                    msg_type = sniff_event_type(message)
+                    data = None
+                    if msg_type is None or msg_type in CLIENT_EVENTS_TO_PARSE:
+                        data = ujson.loads(message)
+                        msg_type = data.get("type", "unknown")
                 
                 # Обработка ping-сообщений для поддержания соединения
                 if msg_type == "ping":
@@ -1229,50 +5881,74 @@ async def forward_client_to_openai(client_ws: WebSocket, openai_ws, client_id: i
                     except Exception as e:
                         logger.error(f"Ошибка отправки pong-ответа: {str(e)}")
                 
+                # Клиент объявляет формат своего аудио (событие релея, в OpenAI не пересылается)
+                if msg_type == "relay.audio_format":
+                    try:
+                        audio_converter = AudioConverter(
+                            sample_rate=int(data.get("sample_rate", TARGET_SAMPLE_RATE)),
+                            channels=int(data.get("channels", 1)),
+                            encoding=data.get("encoding", "pcm16")
+                        )
+                        client_connections[client_id]["audio_converter"] = audio_converter
+                        logger.info(f"Клиент {client_id} передает аудио: {audio_converter.sample_rate} Гц, "
+                                    f"каналов: {audio_converter.channels}, формат: {audio_converter.encoding}")
+                    except (ValueError, TypeError) as e:
+                        await client_ws.send_json({
+                            "type": "error",
+                            "error": {"message": f"Неподдерживаемый формат аудио: {str(e)}"}
+                        })
+                    continue
+                
+                # Аудио в JSON-формате тоже приводим к PCM16 24 кГц моно, если формат клиента отличается
+                if msg_type == "input_audio_buffer.append" and audio_converter is not None and not audio_converter.passthrough:
+                    audio_base64 = extract_string_field(message, "audio")
+                    if audio_base64:
+                        converted = audio_converter.convert(base64.b64decode(audio_base64))
+                        if not converted:
+                            continue
+                        pcm = converted
+                        message = AUDIO_APPEND_PREFIX + base64.b64encode(converted).decode("ascii") + AUDIO_APPEND_SUFFIX
+                
+                # Ограничение скорости входящего аудио по тарифу (клиент шлет быстрее реального времени)
+                if msg_type == "input_audio_buffer.append" and audio_bucket is not None:
+                    audio_size = len(pcm) if pcm is not None else len(message) * 3 // 4
+                    if not audio_bucket.consume(audio_size):
+                        admission_controller.record_throttled(audio_size)
+                        continue
+                
+                # Подавление тишины: тихие кадры не отправляем, перед речью досылаем придержанные
+                outgoing = [message]
+                if silence_gate is not None:
+                    if msg_type == "input_audio_buffer.append":
+                        if pcm is None:
+                            audio_base64 = extract_string_field(message, "audio")
+                            pcm = base64.b64decode(audio_base64) if audio_base64 else b""
+                        outgoing = silence_gate.process(pcm, message)
+                        if not outgoing:
+                            continue
+                    elif msg_type == "input_audio_buffer.commit":
+                        if not silence_gate.allow_commit():
+                            logger.debug(f"commit от клиента {client_id} не отправлен - после прошлого commit была только тишина")
+                            continue
+                    elif msg_type == "input_audio_buffer.clear":
+                        silence_gate.reset()
+                
                 # Не логируем аппенд аудио буфера для уменьшения шума в логах
                 if msg_type != "input_audio_buffer.append":
                     logger.debug(f"[Клиент {client_id} -> OpenAI] {msg_type}")
                 
-                # Захватываем транскрипцию для логов
-                if msg_type == "conversation.item.input_audio_transcription.completed" and "transcript" in data:
-                    client_connections[client_id]["conversation"]["user_message"] = data["transcript"]
-                
-                # Проверяем состояние соединения с OpenAI перед отправкой
-                if not openai_ws:
-                    logger.error(f"Соединение с OpenAI отсутствует для клиента {client_id}")
-                    raise websockets.exceptions.ConnectionClosed(
-                        1006, "Соединение с OpenAI отсутствует"
-                    )
-                
-                # Отправляем сообщение в OpenAI с обработкой ошибок
-                try:
-                    await openai_ws.send(message)
-                    
-                    # Сбрасываем счетчик ошибок при успешной отправке
-                    error_count = 0
-                    
-                except websockets.exceptions.ConnectionClosed as e:
-                    logger.error(f"Соединение с OpenAI закрыто при отправке: {e.code}, {e.reason}")
-                    raise  # Пробрасываем ошибку для обработки на уровень выше
-                    
-                except Exception as send_error:
-                    error_count += 1
-                    current_time = time.time()
-                    
-                    # Если много ошибок за короткий период, лучше прервать соединение
-                    if error_count >= max_errors and (current_time - last_error_time) < 10:
-                        logger.error(f"Слишком много ошибок отправки для клиента {client_id}: {error_count} за последние 10 секунд")
-                        raise websockets.exceptions.ConnectionClosed(
-                            1006, "Слишком много ошибок отправки"
-                        )
-                    
-                    last_error_time = current_time
-                    logger.error(f"Ошибка при отправке сообщения в OpenAI: {str(send_error)}")
+                # Ставим сообщение в очередь отправки в OpenAI (отправляет задача relay_sender)
+                kind = "audio" if msg_type == "input_audio_buffer.append" else "control"
+                if msg_type == "conversation.item.create" and '"function_call_output"' in message:
+                    # Результат функции клиента относится к вызову текущей сессии OpenAI
+                    kind = "tool"
+                for outgoing_message in outgoing:
+                    upstream.put(outgoing_message, kind)
                 
-            except json.JSONDecodeError as e:
+            except ValueError as e:
                 logger.error(f"Получены некорректные данные от клиента {client_id}: {str(e)}")
-            except websockets.exceptions.ConnectionClosed:
-                # Пробрасываем ошибку закрытия соединения для обработки на уровень выше
+            except (websockets.exceptions.ConnectionClosed, RelayQueueOverflow):
+                # Пробрасываем ошибку для обработки на уровень выше
                 raise
             except Exception as e:
                 logger.error(f"Ошибка при обработке сообщения от клиента {client_id}: {str(e)}")
@@ -1282,12 +5958,14 @@ async def forward_client_to_openai(client_ws: WebSocket, openai_ws, client_id: i
         logger.warning(f"Соединение закрыто в forward_client_to_openai для клиента {client_id}: {e.code}, {e.reason}")
         # Пробрасываем ошибку для обработки на уровень выше
         raise
+    except RelayQueueOverflow:
+        raise
     except Exception as e:
         logger.error(f"Ошибка в задаче forward_client_to_openai для клиента {client_id}: {str(e)}")
         logger.error(traceback.format_exc())
         raise
 
-async def forward_openai_to_client(openai_ws, client_ws: WebSocket, client_id: int, db = None):
+async def forward_openai_to_client(openai_ws, client_ws: WebSocket, client_id: str):
     """
     Пересылает сообщения от API OpenAI клиенту (браузеру).
     Улучшена обработка ошибок и надежность передачи данных.
@@ -1298,19 +5976,37 @@ async def forward_openai_to_client(openai_ws, client_ws: WebSocket, client_id: i
         # Для сбора текстового ответа
         response_text = ""
         
-        # Счетчик ошибок для обнаружения частых проблем
-        error_count = 0
-        max_errors = 5
-        last_error_time = time.time()
+        # Отдаем аудио клиенту бинарными кадрами, если он подключился по бинарному протоколу
+        binary_audio = client_connections.get(client_id, {}).get("binary_audio", False)
+        
+        # Очередь отправки клиенту: медленный клиент не останавливает чтение из OpenAI
+        downstream = client_connections[client_id]["queues"]["downstream"]
+        
+        # Метрики: серии берем один раз, отметки времени для задержек храним в локальных переменных
+        frames_metric = relay_frames.labels("downstream")
+        bytes_metric = relay_bytes.labels("downstream")
+        session_update_sent_at = client_connections[client_id].get("session_update_sent_at")
+        speech_stopped_at = None
+        
+        # Трасса задержек текущего хода (только для выборки ходов)
+        trace = None
+        
+        # История разговора для восстановления сессии после обрыва
+        transcript = client_connections[client_id]["transcript"]
         
         async for openai_message in openai_ws:
             if client_id not in client_connections or not client_connections[client_id]["active"]:
                 logger.info(f"Клиент {client_id} больше не активен, завершаем обработку сообщений от OpenAI")
                 break
+            
+            frames_metric.inc()
+            bytes_metric.inc(len(openai_message))
                 
             try:
                 # Парсим JSON от OpenAI
                 message_to_send = openai_message  # Предполагаем, что отправим как есть
+                kind = "control"
+                on_sent = None
                 
                 if isinstance(openai_message, str):
                     # Логируем для отладки
@@ -1318,12 +6014,47 @@ async def forward_openai_to_client(openai_ws, client_ws: WebSocket, client_id: i
                         logger.debug(f"Получено сообщение от OpenAI: {openai_message}")
                     
                     try:
-                        # Попытка распарсить JSON
-                        response = json.loads(openai_message)
+                        # Определяем тип по началу кадра; аудио и прочие события пересылаются без разбора
+                        msg_type = sniff_event_type(openai_message)
+                        response = {}
+                        if msg_type is None or msg_type in OPENAI_EVENTS_TO_PARSE:
+                            response = ujson.loads(openai_message)
+                            msg_type = response.get('type')
+                        
+                        if msg_type == 'response.audio.delta':
+                            kind = "audio"
+                            if speech_stopped_at is not None:
+                                speech_stop_to_audio_seconds.labels().observe(time.perf_counter() - speech_stopped_at)
+                                speech_stopped_at = None
+                            if trace is not None and "speech_stopped" in trace and "first_audio" not in trace:
+                                trace["first_audio"] = time.perf_counter()
+                                on_sent = lambda queued, sending, trace=trace: on_turn_audio_sent(trace, queued, sending)
+                        elif msg_type in ('response.audio_transcript.delta', 'response.text.delta'):
+                            kind = "text"
+                        elif msg_type == 'input_audio_buffer.speech_started':
+                            # Новый ход; незавершенная трасса прерванного ответа отбрасывается
+                            trace = start_turn_trace()
+                        elif msg_type == 'input_audio_buffer.speech_stopped':
+                            speech_stopped_at = time.perf_counter()
+                            if trace is not None:
+                                trace["speech_stopped"] = speech_stopped_at
+                        elif msg_type == 'response.created':
+                            if trace is not None and "speech_stopped" in trace:
+                                trace.setdefault("response_created", time.perf_counter())
+                        elif msg_type == 'session.updated' and session_update_sent_at is not None:
+                            openai_session_update_seconds.labels().observe(time.perf_counter() - session_update_sent_at)
+                            session_update_sent_at = None
+                            client_connections[client_id]["session_updated"] = True  # Новая сессия OpenAI приняла настройки
+                        
+                        # Бинарный протокол: аудио отдаем клиенту сырыми PCM16 без base64 и JSON
+                        if binary_audio and msg_type == 'response.audio.delta':
+                            audio_delta = extract_audio_delta(openai_message)
+                            if audio_delta is not None:
+                                message_to_send = base64.b64decode(audio_delta)
                         
                         # Логируем определенные типы событий
-                        if response.get('type') in LOG_EVENT_TYPES:
-                            logger.info(f"[OpenAI -> Клиент {client_id}] {response.get('type')}")
+                        if msg_type in LOG_EVENT_TYPES:
+                            logger.info(f"[OpenAI -> Клиент {client_id}] {msg_type}")
                         
                         # Собираем текст ответа для логирования
                         if response.get('type') == 'response.text.delta' and 'delta' in response:
@@ -1334,13 +6065,42 @@ async def forward_openai_to_client(openai_ws, client_ws: WebSocket, client_id: i
                                 assistant_id = client_connections[client_id]["assistant_id"]
                                 logger.info(f"Ассистент {assistant_id} начал отвечать: {response['delta'][:30]}...")
                             
+                        # Реплики пользователя: место в истории при фиксации аудио, текст - после распознавания
+                        if msg_type == 'input_audio_buffer.committed':
+                            transcript.add_user_item(response.get('item_id'))
+                        elif msg_type == 'conversation.item.input_audio_transcription.completed' and response.get('transcript'):
+                            transcript.set_user_text(response.get('item_id'), response['transcript'])
+                            client_connections[client_id]["conversation"]["user_message"] = response['transcript']
+                        elif msg_type == 'response.function_call_arguments.done':
+                            # Функции с обработчиком выполняются на сервере в фоне, не задерживая пересылку событий
+                            spec = client_connections[client_id]["tool_specs"].get(response.get('name'))
+                            if spec is not None:
+                                client_connections[client_id]["tool_calls"].start(ToolCall(
+                                    client_id=client_id,
+                                    assistant_id=client_connections[client_id]["assistant_id"],
+                                    call_id=response.get('call_id'),
+                                    name=response.get('name'),
+                                    spec=spec,
+                                    api_key=client_connections[client_id]["api_key"]
+                                ), response.get('response_id'), response.get('arguments'))
+                        
                         # Сохраняем полный ответ при завершении
                         if response.get('type') == 'response.text.done' and 'text' in response:
                             response_text = response['text']
                             client_connections[client_id]["conversation"]["assistant_message"] = response_text
                             
                         # Сохраняем разговор в базу данных при завершении ответа
-                        if response.get('type') == 'response.done' and db:
+                        if response.get('type') == 'response.done':
+                            client_connections[client_id]["tool_calls"].response_done(
+                                (response.get('response') or {}).get('id'), (response.get('response') or {}).get('status')
+                            )
+                            # Текст ответа (для голосовых ответов - транскрипт аудио) попадает в историю разговора
+                            output_text = response_output_text(response.get('response') or {})
+                            if output_text:
+                                transcript.add_assistant_text(output_text)
+                                if not client_connections[client_id]["conversation"].get("assistant_message"):
+                                    client_connections[client_id]["conversation"]["assistant_message"] = output_text
+                            
                             # Рассчитываем длительность разговора
                             start_time = client_connections[client_id]["conversation"].get("start_time", time.time())
                             duration = time.time() - start_time
@@ -1351,20 +6111,26 @@ async def forward_openai_to_client(openai_ws, client_ws: WebSocket, client_id: i
                             user_message = client_connections[client_id]["conversation"].get("user_message", "")
                             assistant_message = client_connections[client_id]["conversation"].get("assistant_message", "")
                             
-                            # Записываем в базу данных
-                            try:
-                                conversation = Conversation(
-                                    assistant_id=assistant_id,
-                                    user_message=user_message,
-                                    assistant_message=assistant_message,
-                                    duration_seconds=duration,
-                                    client_info={}
+                            # Ставим запись в очередь фоновой записи, чтобы не задерживать пересылку аудио
+                            conversation_id = uuid.uuid4()
+                            conversation_writer.submit({
+                                "id": conversation_id,
+                                "assistant_id": assistant_id,
+                                "user_message": user_message,
+                                "assistant_message": assistant_message,
+                                "duration_seconds": duration,
+                                "client_info": {}
+                            })
+                            logger.info(f"Диалог поставлен в очередь записи для клиента {client_id}")
+                            if client_connections[client_id].get("google_sheet_id"):
+                                sheets_writer.append(
+                                    user_id, client_connections[client_id]["google_sheet_id"], GOOGLE_SHEETS_CONVERSATIONS_RANGE,
+                                    conversation_sheet_row(conversation_id, user_message, assistant_message, duration)
                                 )
-                                db.add(conversation)
-                                db.commit()
-                                logger.info(f"Диалог записан в базу данных для клиента {client_id}")
-                            except Exception as db_error:
-                                logger.error(f"Ошибка при записи разговора в базу данных: {str(db_error)}")
+                            
+                            if trace is not None and "speech_stopped" in trace:
+                                finish_turn_trace(trace, assistant_id, conversation_id)
+                                trace = None
                             
                             # Сбрасываем данные разговора для следующего
                             client_connections[client_id]["conversation"] = {
@@ -1372,54 +6138,27 @@ async def forward_openai_to_client(openai_ws, client_ws: WebSocket, client_id: i
                                 "assistant_message": "",
                                 "start_time": time.time()
                             }
-                    except json.JSONDecodeError:
+                    except ValueError:
                         logger.warning(f"Не удалось распарсить JSON от OpenAI: {openai_message[:100]}...")
                         # Продолжаем, отправляя сообщение как есть
                 
-                # Безопасно отправляем сообщение клиенту
-                try:
-                    if isinstance(openai_message, str):
-                        await client_ws.send_text(openai_message)
-                    else:
-                        await client_ws.send_bytes(openai_message)
-                    
-                    # Сбрасываем счетчик ошибок при успешной отправке
-                    error_count = 0
-                    
-                except Exception as send_error:
-                    error_count += 1
-                    current_time = time.time()
-                    
-                    # Если много ошибок за короткий период, лучше прервать соединение
-                    if error_count >= max_errors and (current_time - last_error_time) < 10:
-                        logger.error(f"Слишком много ошибок отправки клиенту {client_id}: {error_count} за последние 10 секунд")
-                        break
-                    
-                    last_error_time = current_time
-                    logger.error(f"Ошибка при отправке сообщения клиенту {client_id}: {str(send_error)}")
+                # Ставим сообщение в очередь отправки клиенту (отправляет задача relay_sender)
+                downstream.put(message_to_send, kind, on_sent)
                 
+            except RelayQueueOverflow:
+                raise
             except Exception as e:
                 logger.error(f"Ошибка при обработке сообщения от OpenAI для клиента {client_id}: {str(e)}")
                 logger.error(traceback.format_exc())
+        
+        # OpenAI закрыл соединение штатно - даем клиенту получить уже поставленные в очередь сообщения
+        await downstream.drain(timeout=5.0)
     
     except websockets.exceptions.ConnectionClosed as e:
         logger.warning(f"Соединение с OpenAI закрыто для клиента {client_id}: {e.code}, {e.reason}")
-        try:
-            # Сообщаем клиенту о закрытии соединения
-            try:
-                await client_ws.send_json({
-                    "type": "error",
-                    "error": {
-                        "message": f"Соединение с OpenAI прервано: {e.reason}"
-                    }
-                })
-            except Exception:
-                # Если не удалось отправить, то соединение возможно уже закрыто
-                logger.debug(f"Не удалось отправить уведомление - соединение с клиентом {client_id} закрыто")
-        except Exception as send_err:
-            logger.error(f"Не удалось отправить уведомление о закрытии соединения клиенту {client_id}: {str(send_err)}")
-        
-        # Пробрасываем ошибку для обработки на уровень выше
+        # Клиента о переподключении уведомляет обработчик соединения, сессия будет восстановлена
+        raise
+    except RelayQueueOverflow:
         raise
     except Exception as e:
         logger.error(f"Ошибка в задаче forward_openai_to_client для клиента {client_id}: {str(e)}")
@@ -1428,18 +6167,18 @@ async def forward_openai_to_client(openai_ws, client_ws: WebSocket, client_id: i
 
 # WebSocket для голосовых помощников - улучшенная версия с использованием функции с повторными попытками
 @app.websocket("/ws/{assistant_id}")
-async def websocket_assistant(websocket: WebSocket, assistant_id: str, db = Depends(get_db)):
+async def websocket_assistant(websocket: WebSocket, assistant_id: str):
     """
     WebSocket-эндпоинт для взаимодействия с голосовым помощником.
     Использует улучшенный обработчик с механизмом повторных попыток.
     """
-    # Генерируем уникальный ID для клиента
-    client_id = id(websocket)
+    # Генерируем уникальный ID сессии (он же ключ в client_connections и в реестре сессий)
+    client_id = str(uuid.uuid4())
     logger.info(f"Новый запрос WebSocket соединения от клиента {client_id} для помощника {assistant_id}")
     
     try:
         # Используем улучшенную функцию для обработки соединения с повторными попытками
-        await handle_websocket_connection_with_retry(websocket, assistant_id, db)
+        await handle_websocket_connection_with_retry(websocket, assistant_id, client_id)
     except Exception as e:
         logger.error(f"Ошибка в верхнем уровне обработки WebSocket для клиента {client_id}: {str(e)}")
         logger.error(traceback.format_exc())
@@ -1449,23 +6188,34 @@ async def websocket_assistant(websocket: WebSocket, assistant_id: str, db = Depe
         logger.info(f"WebSocket-соединение с клиентом {client_id} полностью закрыто")
 
 # Основной маршрут для возврата HTML-интерфейса
+# HTML-страницы из static меняются только при деплое, поэтому читаем их с диска один раз
+static_pages = {}
+
+def load_static_page(path: str, fallback_path: Optional[str] = None) -> str:
+    if not os.path.exists(path) and fallback_path:
+        path = fallback_path
+    if not os.path.exists(path):
+        # Если файл не найден в static, создаем заглушку
+        logger.warning(f"Файл {path} не найден, создаем заглушку")
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(DEFAULT_HTML_CONTENT)
+    with open(path, "r", encoding="utf-8") as file:
+        return file.read()
+
+async def read_static_page(path: str, fallback_path: Optional[str] = None) -> str:
+    """Содержимое страницы; первое чтение выполняется в потоке, чтобы не блокировать цикл событий"""
+    content = static_pages.get(path)
+    if content is None:
+        content = await asyncio.to_thread(load_static_page, path, fallback_path)
+        static_pages[path] = content
+    return content
+
 @app.get("/")
 async def index_page():
     """Возвращает HTML страницу с интерфейсом"""
     try:
-        index_path = os.path.join(static_dir, "index.html")
-        if os.path.exists(index_path):
-            with open(index_path, "r", encoding="utf-8") as file:
-                content = file.read()
-            return HTMLResponse(content=content)
-        else:
-            # Если файл не найден в static, создаем заглушку
-            logger.warning(f"Файл {index_path} не найден, создаем заглушку")
-            with open(index_path, "w", encoding="utf-8") as file:
-                file.write(DEFAULT_HTML_CONTENT)
-            with open(index_path, "r", encoding="utf-8") as file:
-                content = file.read()
-            return HTMLResponse(content=content)
+        content = await read_static_page(os.path.join(static_dir, "index.html"))
+        return HTMLResponse(content=content)
     except Exception as e:
         logger.error(f"Ошибка при отдаче главной страницы: {str(e)}")
         return HTMLResponse(
@@ -1477,15 +6227,9 @@ async def index_page():
 @app.get("/widget")
 async def widget_page():
     """Возвращает HTML страницу с виджетом для встраивания"""
-    widget_path = os.path.join(static_dir, "widget.html")
-    
-    # Если файл виджета не существует, используем стандартный index.html
-    if not os.path.exists(widget_path):
-        widget_path = os.path.join(static_dir, "index.html")
-    
     try:
-        with open(widget_path, "r", encoding="utf-8") as file:
-            content = file.read()
+        # Если файл виджета не существует, используем стандартный index.html
+        content = await read_static_page(os.path.join(static_dir, "widget.html"), os.path.join(static_dir, "index.html"))
         return HTMLResponse(content=content)
     except Exception as e:
         logger.error(f"Ошибка при отдаче виджета: {str(e)}")
@@ -1495,17 +6239,127 @@ async def widget_page():
         )
 
 # Проверка соединения для тестирования
+@app.get("/api/sessions")
+async def get_user_sessions(current_user: UserSnapshot = Depends(get_current_user)):
+    """Активные разговоры с ассистентами пользователя на всех воркерах"""
+    try:
+        return await session_registry.list_sessions(user_id=str(current_user.id))
+    except Exception as e:
+        logger.error(f"Ошибка при получении списка сессий: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+@app.get("/api/admin/sessions")
+async def get_all_sessions(admin: UserSnapshot = Depends(get_admin_user)):
+    """Все активные разговоры на всех воркерах (только для администраторов)"""
+    try:
+        return await session_registry.list_sessions()
+    except Exception as e:
+        logger.error(f"Ошибка при получении списка сессий: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+@app.delete("/api/admin/sessions/{session_id}")
+async def kill_session(session_id: str, admin: UserSnapshot = Depends(get_admin_user)):
+    """Принудительное завершение разговора на любом воркере (только для администраторов)"""
+    try:
+        try:
+            uuid.UUID(session_id)
+        except ValueError:
+            raise HTTPException(status_code=404, detail="Сессия не найдена")
+        
+        if not await session_registry.request_kill(session_id):
+            raise HTTPException(status_code=404, detail="Сессия не найдена")
+        
+        logger.info(f"Администратор {admin.email} завершил сессию {session_id}")
+        return {"message": "Сессия завершается", "session_id": session_id}
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Ошибка при завершении сессии: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+@app.get("/api/admin/loop-stalls")
+async def get_loop_stalls(admin: UserSnapshot = Depends(get_admin_user)):
+    """Последние зависания цикла событий текущего воркера со стеками (только для администраторов)"""
+    return {
+        "worker": session_registry.worker,
+        **loop_watchdog.get_stats(),
+        "items": loop_watchdog.get_stalls()
+    }
+
 @app.get("/api/healthcheck")
 async def healthcheck():
     """Эндпоинт для проверки работоспособности сервера"""
     return {"status": "ok", "timestamp": time.time()}
 
+# Служебные метрики воркера (только для администраторов)
+@app.get("/api/metrics")
+async def get_metrics(admin: UserSnapshot = Depends(get_admin_user)):
+    """Возвращает метрики фоновых подсистем текущего воркера"""
+    return {
+        "pid": os.getpid(),
+        "conversation_writer": conversation_writer.get_stats(),
+        "turn_trace_writer": turn_trace_writer.get_stats(),
+        "google_sheets": sheets_writer.get_stats(),
+        "assistant_cache": assistant_cache.get_stats(),
+        "auth_cache": auth_cache.get_stats(),
+        "knowledge_indexes": knowledge_indexes.get_stats(),
+        "tool_result_caches": tool_result_caches.get_stats(),
+        "revoked_tokens": len(revoked_tokens),
+        "cache_invalidation": cache_bus.get_stats(),
+        "openai_pool": openai_pool.get_stats(),
+        "silence_gate": get_silence_gate_stats(),
+        "relay_queues": get_relay_queue_stats(),
+        "sessions": session_registry.get_stats(),
+        "admission": admission_controller.get_stats(),
+        "event_loop": loop_watchdog.get_stats()
+    }
+
+# Метрики воркера для Prometheus (у каждого воркера свои значения, различаются меткой worker)
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(authorization: Optional[str] = Header(None)):
+    """Метрики релея в текстовом формате Prometheus"""
+    # Без токена эндпоинт закрыт: метрики раскрывают число сессий и нагрузку, открывать их по забытой настройке нельзя
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest((authorization or "").encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        raise HTTPException(status_code=401, detail="Неверный токен метрик")
+    return PlainTextResponse(metrics_registry.render({"worker": session_registry.worker}), media_type=PROMETHEUS_CONTENT_TYPE)
+
 # Событие при запуске приложения
 @app.on_event("startup")
 async def startup_event():
-    create_tables()
+    await verify_schema_version()
+    await load_revoked_tokens()
+    global revocation_poll_task
+    revocation_poll_task = asyncio.create_task(poll_revoked_tokens())
+    conversation_writer.start()
+    turn_trace_writer.start()
+    sheets_writer.start()
+    cache_bus.start()
+    openai_pool.start()
+    session_registry.start()
+    loop_watchdog.start()
     logger.info("Приложение запущено успешно")
 
+# Событие при остановке приложения
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Сбрасываем очередь диалогов в БД и закрываем пул соединений
+    await conversation_writer.stop()
+    await turn_trace_writer.stop()
+    await sheets_writer.stop()
+    await cache_bus.stop()
+    if revocation_poll_task is not None:
+        revocation_poll_task.cancel()
+    await openai_pool.stop()
+    await session_registry.stop()
+    await loop_watchdog.stop()
+    await http_client.aclose()
+    if _ingest_pool is not None:
+        _ingest_pool.shutdown(wait=False, cancel_futures=True)
+    await engine.dispose()
+    logger.info("Приложение остановлено")
+
 # Запуск приложения с uvicorn при запуске файла напрямую
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,65 @@
+"""
+Окружение Alembic: миграции выполняются через тот же асинхронный движок (asyncpg),
+что и приложение; метаданные моделей берутся из main для autogenerate.
+"""
+import asyncio
+import os
+import sys
+from logging.config import fileConfig
+
+from alembic import context
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import create_async_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import Base, DATABASE_URL, get_async_database_url
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
+
+target_metadata = Base.metadata
+
+
+def run_migrations_offline():
+    """Генерация SQL без подключения к БД (alembic upgrade head --sql)"""
+    context.configure(
+        url=get_async_database_url(DATABASE_URL),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+MIGRATIONS_LOCK = "SELECT pg_advisory_lock(hashtext('alembic_migrations'))"
+MIGRATIONS_UNLOCK = "SELECT pg_advisory_unlock(hashtext('alembic_migrations'))"
+
+
+def do_run_migrations(connection):
+    # Миграции могут запустить одновременно несколько экземпляров сервиса - выполняет один, остальные ждут.
+    # Блокировка сессионная: индексы строятся CONCURRENTLY вне транзакции миграции
+    connection.execute(sa.text(MIGRATIONS_LOCK))
+    connection.commit()
+    try:
+        context.configure(connection=connection, target_metadata=target_metadata)
+        with context.begin_transaction():
+            context.run_migrations()
+    finally:
+        connection.execute(sa.text(MIGRATIONS_UNLOCK))
+        connection.commit()
+
+
+async def run_migrations_online():
+    engine = create_async_engine(get_async_database_url(DATABASE_URL))
+    async with engine.connect() as connection:
+        await connection.run_sync(do_run_migrations)
+    await engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    asyncio.run(run_migrations_online())
@@ -0,0 +1,127 @@
+"""Начальная схема: таблицы, которые раньше создавал create_all при запуске воркера
+
+Все операции идемпотентны (IF NOT EXISTS), поэтому ревизия применяется и к базам,
+созданным до появления миграций: существующие таблицы не пересоздаются.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import UUID
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "users",
+        sa.Column("id", UUID(as_uuid=True), primary_key=True),
+        sa.Column("email", sa.String(), nullable=False, unique=True),
+        sa.Column("password_hash", sa.String(), nullable=False),
+        sa.Column("first_name", sa.String(), nullable=True),
+        sa.Column("last_name", sa.String(), nullable=True),
+        sa.Column("company_name", sa.String(), nullable=True),
+        sa.Column("openai_api_key", sa.String(), nullable=True),
+        sa.Column("subscription_plan", sa.String(), nullable=True),
+        sa.Column("google_sheets_token", sa.JSON(), nullable=True),
+        sa.Column("google_sheets_authorized", sa.Boolean(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=True),
+        if_not_exists=True,
+    )
+    op.create_table(
+        "assistant_configs",
+        sa.Column("id", UUID(as_uuid=True), primary_key=True),
+        sa.Column("user_id", UUID(as_uuid=True), sa.ForeignKey("users.id", ondelete="CASCADE")),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("description", sa.String(), nullable=True),
+        sa.Column("system_prompt", sa.Text(), nullable=False),
+        sa.Column("voice", sa.String(), nullable=True),
+        sa.Column("language", sa.String(), nullable=True),
+        sa.Column("google_sheet_id", sa.String(), nullable=True),
+        sa.Column("functions", sa.JSON(), nullable=True),
+        sa.Column("audio_settings", sa.JSON(), nullable=True),
+        sa.Column("is_active", sa.Boolean(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=True),
+        if_not_exists=True,
+    )
+    # Колонка появилась после первых развертываний, когда таблица уже существовала
+    op.execute("ALTER TABLE assistant_configs ADD COLUMN IF NOT EXISTS audio_settings JSON")
+    op.create_table(
+        "conversations",
+        sa.Column("id", UUID(as_uuid=True), primary_key=True),
+        sa.Column("assistant_id", UUID(as_uuid=True), sa.ForeignKey("assistant_configs.id", ondelete="CASCADE")),
+        sa.Column("user_message", sa.Text(), nullable=True),
+        sa.Column("assistant_message", sa.Text(), nullable=True),
+        sa.Column("duration_seconds", sa.Float(), nullable=True),
+        sa.Column("client_info", sa.JSON(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        if_not_exists=True,
+    )
+    op.create_table(
+        "conversation_daily_stats",
+        sa.Column("assistant_id", UUID(as_uuid=True), sa.ForeignKey("assistant_configs.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("day", sa.Date(), primary_key=True),
+        sa.Column("conversations", sa.Integer(), nullable=False),
+        sa.Column("total_duration_seconds", sa.Float(), nullable=False),
+        if_not_exists=True,
+    )
+    op.create_table(
+        "turn_traces",
+        sa.Column("id", UUID(as_uuid=True), primary_key=True),
+        sa.Column("assistant_id", UUID(as_uuid=True), sa.ForeignKey("assistant_configs.id", ondelete="CASCADE")),
+        sa.Column("conversation_id", UUID(as_uuid=True), nullable=True),
+        sa.Column("speech_ms", sa.Float(), nullable=True),
+        sa.Column("response_created_ms", sa.Float(), nullable=True),
+        sa.Column("first_audio_ms", sa.Float(), nullable=True),
+        sa.Column("relay_queue_ms", sa.Float(), nullable=True),
+        sa.Column("client_send_ms", sa.Float(), nullable=True),
+        sa.Column("total_ms", sa.Float(), nullable=True),
+        sa.Column("response_done_ms", sa.Float(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        if_not_exists=True,
+    )
+    op.create_index("ix_turn_traces_assistant_created", "turn_traces", ["assistant_id", "created_at"], if_not_exists=True)
+    op.create_table(
+        "revoked_tokens",
+        sa.Column("jti", sa.String(), primary_key=True),
+        sa.Column("user_id", UUID(as_uuid=True), sa.ForeignKey("users.id", ondelete="CASCADE")),
+        sa.Column("expires_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        if_not_exists=True,
+    )
+    op.create_index("ix_revoked_tokens_expires_at", "revoked_tokens", ["expires_at"], if_not_exists=True)
+    op.create_table(
+        "relay_sessions",
+        sa.Column("id", UUID(as_uuid=True), primary_key=True),
+        sa.Column("user_id", UUID(as_uuid=True), sa.ForeignKey("users.id", ondelete="CASCADE")),
+        sa.Column("assistant_id", UUID(as_uuid=True), sa.ForeignKey("assistant_configs.id", ondelete="CASCADE")),
+        sa.Column("worker", sa.String(), nullable=False),
+        sa.Column("client_host", sa.String(), nullable=True),
+        sa.Column("kill_requested", sa.Boolean(), nullable=True),
+        sa.Column("started_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column("last_seen_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        if_not_exists=True,
+    )
+    op.create_index("ix_relay_sessions_user_id", "relay_sessions", ["user_id"], if_not_exists=True)
+    op.create_index("ix_relay_sessions_worker", "relay_sessions", ["worker"], if_not_exists=True)
+    op.create_index("ix_relay_sessions_last_seen_at", "relay_sessions", ["last_seen_at"], if_not_exists=True)
+    op.create_table(
+        "session_usage",
+        sa.Column("user_id", UUID(as_uuid=True), sa.ForeignKey("users.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("day", sa.Date(), primary_key=True),
+        sa.Column("seconds", sa.Float(), nullable=False),
+        if_not_exists=True,
+    )
+
+
+def downgrade():
+    for table in ("session_usage", "relay_sessions", "revoked_tokens", "turn_traces",
+                  "conversation_daily_stats", "conversations", "assistant_configs", "users"):
+        op.drop_table(table)
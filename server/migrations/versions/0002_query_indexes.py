@@ -0,0 +1,48 @@
+"""Индексы для горячих запросов API и заполнение суточной сводки диалогов
+
+- assistant_configs (user_id, created_at, id): список ассистентов пользователя
+  (вход, дашборд) и его keyset-пагинация;
+- conversations (assistant_id, created_at, id): история диалогов ассистента и
+  удаление диалогов каскадом вместе с ассистентом;
+- relay_sessions (assistant_id): каскадное удаление сессий ассистента.
+Поиск пользователя по email при входе уже обслуживает уникальный индекс users_email_key.
+
+Индексы строятся CONCURRENTLY, чтобы не блокировать запись в работающие таблицы.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ("ix_assistant_configs_user_created", "assistant_configs", ["user_id", "created_at", "id"]),
+    ("ix_conversations_assistant_created", "conversations", ["assistant_id", "created_at", "id"]),
+    ("ix_relay_sessions_assistant_id", "relay_sessions", ["assistant_id"]),
+]
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, if_not_exists=True, postgresql_concurrently=True)
+    # Суточная сводка заполняется по уже записанным диалогам, если она еще пуста
+    op.execute("""
+        INSERT INTO conversation_daily_stats (assistant_id, day, conversations, total_duration_seconds)
+        SELECT assistant_id, (created_at AT TIME ZONE 'UTC')::date, count(*), coalesce(sum(duration_seconds), 0)
+        FROM conversations
+        WHERE assistant_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM conversation_daily_stats)
+        GROUP BY 1, 2
+        ON CONFLICT DO NOTHING
+    """)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, if_exists=True, postgresql_concurrently=True)
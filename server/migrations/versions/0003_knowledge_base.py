@@ -0,0 +1,46 @@
+"""База знаний ассистентов: фрагменты документов с эмбеддингами и версия индекса
+
+Файлы поискового индекса строятся воркерами по этим таблицам; версия в
+knowledge_bases сообщает, что файлы на диске устарели.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import UUID
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "knowledge_chunks",
+        sa.Column("id", UUID(as_uuid=True), primary_key=True),
+        sa.Column("assistant_id", UUID(as_uuid=True), sa.ForeignKey("assistant_configs.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("source", sa.String(), nullable=False),
+        sa.Column("position", sa.Integer(), nullable=False),
+        sa.Column("text", sa.Text(), nullable=False),
+        sa.Column("embedding", sa.LargeBinary(), nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    op.create_index("ix_knowledge_chunks_assistant_source", "knowledge_chunks", ["assistant_id", "source", "position"])
+    op.create_table(
+        "knowledge_bases",
+        sa.Column("assistant_id", UUID(as_uuid=True), sa.ForeignKey("assistant_configs.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("revision", sa.Integer(), nullable=False),
+        sa.Column("embedding_model", sa.String(), nullable=False),
+        sa.Column("dim", sa.Integer(), nullable=False),
+        sa.Column("chunks", sa.Integer(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+
+
+def downgrade():
+    op.drop_table("knowledge_bases")
+    op.drop_index("ix_knowledge_chunks_assistant_source", table_name="knowledge_chunks")
+    op.drop_table("knowledge_chunks")
@@ -0,0 +1,56 @@
+"""Документы базы знаний: загруженные файлы, их исходные байты и связь фрагментов с файлом
+
+Фрагменты получают file_id и content_hash (sha1 текста): при повторной загрузке
+документа неизмененные фрагменты переносятся вместе с эмбеддингом.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import UUID
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "knowledge_files",
+        sa.Column("id", UUID(as_uuid=True), primary_key=True),
+        sa.Column("assistant_id", UUID(as_uuid=True), sa.ForeignKey("assistant_configs.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("content_type", sa.String(), nullable=True),
+        sa.Column("size", sa.BigInteger(), nullable=False),
+        sa.Column("expected_size", sa.BigInteger(), nullable=True),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("chunks", sa.Integer(), nullable=False),
+        sa.Column("new_chunks", sa.Integer(), nullable=False),
+        sa.Column("error", sa.Text(), nullable=True),
+        sa.Column("uploaded_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column("updated_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    op.create_index("ix_knowledge_files_assistant_name", "knowledge_files", ["assistant_id", "name"])
+    op.create_table(
+        "knowledge_file_parts",
+        sa.Column("file_id", UUID(as_uuid=True), sa.ForeignKey("knowledge_files.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("part", sa.Integer(), primary_key=True),
+        sa.Column("data", sa.LargeBinary(), nullable=False),
+    )
+    op.add_column("knowledge_chunks", sa.Column(
+        "file_id", UUID(as_uuid=True), sa.ForeignKey("knowledge_files.id", ondelete="CASCADE"), nullable=True
+    ))
+    op.add_column("knowledge_chunks", sa.Column("content_hash", sa.String(40), nullable=True))
+    op.create_index("ix_knowledge_chunks_file_id", "knowledge_chunks", ["file_id"])
+
+
+def downgrade():
+    op.drop_index("ix_knowledge_chunks_file_id", table_name="knowledge_chunks")
+    op.drop_column("knowledge_chunks", "content_hash")
+    op.drop_column("knowledge_chunks", "file_id")
+    op.drop_table("knowledge_file_parts")
+    op.drop_index("ix_knowledge_files_assistant_name", table_name="knowledge_files")
+    op.drop_table("knowledge_files")
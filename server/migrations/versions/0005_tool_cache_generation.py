@@ -0,0 +1,25 @@
+"""Поколение кэша результатов функций ассистента
+
+DELETE /api/assistants/{id}/tool-cache увеличивает assistant_configs.tool_cache_generation;
+воркеры периодически сверяют его со своим кэшем и сбрасывают результаты прежнего
+поколения, даже если уведомления об инвалидации (NOTIFY) выключены.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("assistant_configs", sa.Column("tool_cache_generation", sa.Integer(), nullable=False, server_default="0"))
+
+
+def downgrade():
+    op.drop_column("assistant_configs", "tool_cache_generation")
@@ -210,16 +210,36 @@
     }
   };
 
+  // Получение протокола передачи аудио ('json' по умолчанию или 'binary')
+  const getAudioProtocol = () => {
+    const scriptTags = document.querySelectorAll('script');
+    for (let i = 0; i < scriptTags.length; i++) {
+      // Проверяем атрибут
+      if (scriptTags[i].hasAttribute('data-audio-protocol')) {
+        return scriptTags[i].getAttribute('data-audio-protocol') === 'binary' ? 'binary' : 'json';
+      }
+      
+      // Проверяем dataset
+      if (scriptTags[i].dataset && scriptTags[i].dataset.audioProtocol) {
+        return scriptTags[i].dataset.audioProtocol === 'binary' ? 'binary' : 'json';
+      }
+    }
+    
+    return 'json';
+  };
+
   // Определяем URL сервера и ID ассистента
   const SERVER_URL = getServerUrl();
   const ASSISTANT_ID = getAssistantId();
   const WIDGET_POSITION = getWidgetPosition();
+  const BINARY_AUDIO = getAudioProtocol() === 'binary';
   
   // Формируем WebSocket URL с указанием ID ассистента
-  const WS_URL = SERVER_URL.replace(/^http/, 'ws') + '/ws/' + ASSISTANT_ID;
+  // В бинарном режиме аудио передается сырыми PCM16 кадрами, а JSON остается управляющим каналом
+  const WS_URL = SERVER_URL.replace(/^http/, 'ws') + '/ws/' + ASSISTANT_ID + (BINARY_AUDIO ? '?audio=binary' : '');
   
   widgetLog(`Configuration: Server URL: ${SERVER_URL}, Assistant ID: ${ASSISTANT_ID}, Position: ${WIDGET_POSITION.vertical}-${WIDGET_POSITION.horizontal}`);
-  widgetLog(`WebSocket URL: ${WS_URL}`);
+  widgetLog(`WebSocket URL: ${WS_URL}, audio protocol: ${BINARY_AUDIO ? 'binary' : 'json'}`);
 
   // Создаем стили для виджета
   function createStyles() {
@@ -750,6 +770,7 @@
     let isConnected = false;
     let isWidgetOpen = false;
     let connectionFailedPermanently = false;
+    let rejectedRetryDelay = 0; // Задержка переподключения, если сервер отклонил сессию по лимитам тарифа
     let pingInterval = null;
     let lastPingTime = Date.now();
     let lastPongTime = Date.now();
@@ -1000,11 +1021,25 @@
         widgetLog("Доступ к микрофону получен");
         
         // Создаем AudioContext с нужной частотой дискретизации
-        audioContext = new (window.AudioContext || window.webkitAudioContext)({ sampleRate: 24000 });
-        widgetLog(`AudioContext создан с частотой ${audioContext.sampleRate} Гц`);
+        const AudioContextClass = window.AudioContext || window.webkitAudioContext;
+        audioContext = new AudioContextClass({ sampleRate: 24000 });
         
         // Создаем обработчик аудиопотока
-        const streamSource = audioContext.createMediaStreamSource(mediaStream);
+        let streamSource;
+        try {
+          streamSource = audioContext.createMediaStreamSource(mediaStream);
+        } catch (rateError) {
+          // Браузер не умеет пересчитывать частоту микрофона - работаем на родной частоте,
+          // передискретизацию в 24 кГц выполнит сервер
+          widgetLog(`Частота 24000 Гц недоступна для микрофона: ${rateError.message}`, "warn");
+          audioContext.close();
+          audioContext = new AudioContextClass();
+          streamSource = audioContext.createMediaStreamSource(mediaStream);
+        }
+        widgetLog(`AudioContext создан с частотой ${audioContext.sampleRate} Гц`);
+        
+        // Сообщаем серверу фактический формат аудио
+        sendAudioFormat();
         
         // Выбираем размер буфера
         const bufferSize = 2048; // Меньший размер буфера для меньшей задержки
@@ -1050,13 +1085,18 @@
             
             // Отправляем данные через WebSocket
             try {
-              const message = JSON.stringify({
-                type: "input_audio_buffer.append",
-                event_id: `audio_${Date.now()}`,
-                audio: arrayBufferToBase64(pcm16Data.buffer)
-              });
-              
-              websocket.send(message);
+              if (BINARY_AUDIO) {
+                // Бинарный кадр: сервер сам обернет его в input_audio_buffer.append
+                websocket.send(pcm16Data.buffer);
+              } else {
+                const message = JSON.stringify({
+                  type: "input_audio_buffer.append",
+                  event_id: `audio_${Date.now()}`,
+                  audio: arrayBufferToBase64(pcm16Data.buffer)
+                });
+                
+                websocket.send(message);
+              }
               hasSentAudioInCurrentSegment = true;
               
               // Отмечаем наличие аудиоданных
@@ -1120,6 +1160,18 @@
       }
     }
     
+    // Сообщает серверу формат аудио микрофона (PCM16, фактическая частота AudioContext)
+    function sendAudioFormat() {
+      if (!audioContext || !websocket || websocket.readyState !== WebSocket.OPEN) return;
+      
+      websocket.send(JSON.stringify({
+        type: "relay.audio_format",
+        sample_rate: audioContext.sampleRate,
+        channels: 1,
+        encoding: "pcm16"
+      }));
+    }
+    
     // Функция для отправки аудиобуфера
     function commitAudioBuffer() {
       if (!isListening || !websocket || websocket.readyState !== WebSocket.OPEN || isReconnecting) return;
@@ -1191,6 +1243,18 @@
       return btoa(binary);
     }
     
+    // Объединение бинарных фрагментов аудио в один ArrayBuffer
+    function concatArrayBuffers(buffers) {
+      const totalLength = buffers.reduce((sum, buffer) => sum + buffer.byteLength, 0);
+      const result = new Uint8Array(totalLength);
+      let offset = 0;
+      for (const buffer of buffers) {
+        result.set(new Uint8Array(buffer), offset);
+        offset += buffer.byteLength;
+      }
+      return result.buffer;
+    }
+    
     // Преобразование Base64 в ArrayBuffer
     function base64ToArrayBuffer(base64) {
       try {
@@ -1288,12 +1352,12 @@
       return wavBuffer;
     }
     
-    // Добавить аудио в очередь воспроизведения
-    function addAudioToPlaybackQueue(audioBase64) {
-      if (!audioBase64 || typeof audioBase64 !== 'string') return;
+    // Добавить аудио в очередь воспроизведения (строка Base64 или ArrayBuffer с PCM16)
+    function addAudioToPlaybackQueue(audioChunk) {
+      if (!audioChunk || (typeof audioChunk !== 'string' && !(audioChunk instanceof ArrayBuffer))) return;
       
       // Добавляем аудио в очередь
-      audioPlaybackQueue.push(audioBase64);
+      audioPlaybackQueue.push(audioChunk);
       
       // Если не запущено воспроизведение, запускаем
       if (!isPlayingAudio) {
@@ -1328,11 +1392,11 @@
       mainCircle.classList.add('speaking');
       mainCircle.classList.remove('listening');
       
-      const audioBase64 = audioPlaybackQueue.shift();
+      const audioChunk = audioPlaybackQueue.shift();
       
       try {
-        // Декодируем Base64 в ArrayBuffer
-        const audioData = base64ToArrayBuffer(audioBase64);
+        // Декодируем Base64 в ArrayBuffer (в бинарном режиме данные уже в ArrayBuffer)
+        const audioData = typeof audioChunk === 'string' ? base64ToArrayBuffer(audioChunk) : audioChunk;
         
         // Проверяем размер данных
         if (audioData.byteLength === 0) {
@@ -1542,6 +1606,9 @@
           lastPingTime = Date.now();
           lastPongTime = Date.now();
           
+          // Новое соединение - повторно сообщаем формат аудио, если микрофон уже инициализирован
+          sendAudioFormat();
+          
           // Скрываем ошибку соединения, если она была показана
           hideConnectionError();
           
@@ -1558,6 +1625,13 @@
         
         websocket.onmessage = function(event) {
           try {
+            // Бинарный кадр - фрагмент аудио ответа (PCM16) в бинарном режиме
+            if (event.data instanceof ArrayBuffer) {
+              lastPongTime = Date.now();
+              audioChunksBuffer.push(event.data);
+              return;
+            }
+            
             // Обработка возможных бинарных данных
             if (event.data instanceof Blob) {
               // Обработка бинарных данных, если нужно
@@ -1606,6 +1680,16 @@
                   if (isWidgetOpen) {
                     startListening();
                   }
+                } else if (data.status === 'rejected' || data.status === 'terminated') {
+                  // Сервер отклонил или завершил сессию (лимиты тарифа, администратор)
+                  if (data.status === 'rejected' && data.retry_after) {
+                    rejectedRetryDelay = data.retry_after * 1000;
+                  } else {
+                    connectionFailedPermanently = true;
+                  }
+                  if (isWidgetOpen) {
+                    showConnectionError(data.message);
+                  }
                 }
                 return;
               }
@@ -1669,7 +1753,9 @@
               // Аудио готово для воспроизведения
               if (data.type === 'response.audio.done') {
                 if (audioChunksBuffer.length > 0) {
-                  const fullAudio = audioChunksBuffer.join('');
+                  const fullAudio = typeof audioChunksBuffer[0] === 'string'
+                    ? audioChunksBuffer.join('')
+                    : concatArrayBuffers(audioChunksBuffer);
                   addAudioToPlaybackQueue(fullAudio);
                   audioChunksBuffer = [];
                 }
@@ -1721,14 +1807,17 @@
           }
           
           // Не пытаемся переподключаться, если соединение было закрыто нормально
-          if (event.code === 1000 || event.code === 1001) {
+          if (event.code === 1000 || event.code === 1001 || connectionFailedPermanently) {
             isReconnecting = false;
             widgetLog('Clean WebSocket close, not reconnecting');
             return;
           }
           
           // Вызываем функцию переподключения с экспоненциальной задержкой
-          reconnectWithDelay();
+          // (или с задержкой, которую сервер указал при отказе в сессии)
+          const retryDelay = rejectedRetryDelay;
+          rejectedRetryDelay = 0;
+          reconnectWithDelay(retryDelay);
         };
         
         websocket.onerror = function(error) {
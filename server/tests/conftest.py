@@ -0,0 +1,42 @@
+"""
+Общие настройки тестов.
+
+main.py при импорте требует DATABASE_URL; тесты без БД работают и с недоступной базой
+(движок подключается лениво), а тесты с фикстурой db пропускаются, если PostgreSQL
+недоступна или не мигрирована (alembic -c server/alembic.ini upgrade head).
+
+    DATABASE_URL=postgresql://... python -m pytest -q server/tests
+
+Тесты выполняются во временном рабочем каталоге: main.py при импорте создает в
+текущем каталоге static/index.html, а файлы сброса диалогов и индексов базы знаний
+по умолчанию тоже пишутся туда.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/wellcome_test")
+os.chdir(tempfile.mkdtemp(prefix="wellcome-tests-"))
+
+import main
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def db():
+    """Проверяет доступность мигрированной БД, иначе тест пропускается"""
+    try:
+        await main.verify_schema_version()
+    except Exception as e:
+        pytest.skip(f"PostgreSQL недоступна: {e}")
+    async with main.SessionLocal() as session:
+        yield session
+    # У каждого теста свой цикл событий: соединения пула к нему привязаны
+    await main.engine.dispose()
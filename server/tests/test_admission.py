@@ -0,0 +1,119 @@
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+def assistant(user_id: str = "user-1", assistant_id: str = "assistant-1") -> main.ResolvedAssistant:
+    return main.ResolvedAssistant(assistant_id=assistant_id, user_id=user_id, system_prompt="-", voice="alloy", functions=None,
+                                  is_active=True, owner_found=True, api_key=None, subscription_plan="test")
+
+
+@pytest.fixture
+def controller(monkeypatch):
+    """Допуск с реестром в памяти и тарифом test; отказы кэшируются на 5 секунд"""
+    limits = main.PlanLimits(max_sessions=2, max_sessions_per_assistant=1, max_session_minutes=5, daily_minutes=10)
+    monkeypatch.setitem(main.plan_limits, "test", limits)
+    return main.AdmissionController(main.MemorySessionRegistry(), reject_cache_ttl=5)
+
+
+def test_check_plan_limits_order_and_zero_means_unlimited():
+    limits = main.PlanLimits(max_sessions=2, max_sessions_per_assistant=1, daily_minutes=10)
+    assert main.check_plan_limits(limits, 1, 0, 599) is None
+    assert main.check_plan_limits(limits, 2, 1, 600) == "max_sessions"
+    assert main.check_plan_limits(limits, 1, 1, 600) == "max_sessions_per_assistant"
+    assert main.check_plan_limits(limits, 1, 0, 600) == "daily_minutes"
+    assert main.check_plan_limits(main.PlanLimits(), 1000, 1000, 10 ** 9) is None
+
+
+async def test_register_counts_running_and_finished_sessions():
+    registry = main.MemorySessionRegistry()
+    limits = main.PlanLimits(max_sessions=2, max_sessions_per_assistant=1, daily_minutes=10)
+    assert await registry.register("s1", "user-1", "assistant-1", None, limits) == (None, 0.0)
+    registry.sessions["s1"]["started"] -= 120
+
+    # Идущая сессия учитывается и в лимите ассистента, и в минутах за сутки
+    reason, used_seconds = await registry.register("s2", "user-1", "assistant-1", None, limits)
+    assert reason == "max_sessions_per_assistant" and 120 <= used_seconds < 121
+    reason, used_seconds = await registry.register("s2", "user-1", "assistant-2", None, limits)
+    assert reason is None and 120 <= used_seconds < 121
+    assert (await registry.register("s3", "user-1", "assistant-3", None, limits))[0] == "max_sessions"
+    assert (await registry.register("s3", "user-2", "assistant-3", None, limits))[0] is None
+
+    # Завершенные сессии копятся в usage до исчерпания дневного лимита
+    await registry.unregister("s1")
+    await registry.unregister("s2")
+    assert 120 <= registry.usage[("user-1", main.datetime.now(main.timezone.utc).date())] < 121
+    registry.usage[("user-1", main.datetime.now(main.timezone.utc).date())] = 600
+    assert (await registry.register("s4", "user-1", "assistant-1", None, limits))[0] == "daily_minutes"
+    assert registry.stats == {"registered": 3, "rejected": 3, "killed": 0, "errors": 0}
+
+
+async def test_session_length_bounded_by_remaining_daily_minutes(controller):
+    registry = controller.registry
+    today = main.datetime.now(main.timezone.utc).date()
+    decision = await controller.admit("s1", assistant(), None)
+    assert decision.reason is None and decision.session_seconds == 300
+    await registry.unregister("s1")
+
+    # Осталось 2 минуты из 10 - сессия короче max_session_minutes
+    registry.usage[("user-1", today)] = 480
+    decision = await controller.admit("s2", assistant(), None)
+    assert decision.reason is None and 119 < decision.session_seconds <= 120
+    await registry.unregister("s2")
+
+    # Без ограничения длительности сессия длится до конца дневного лимита
+    main.plan_limits["test"] = main.plan_limits["test"]._replace(max_session_minutes=0)
+    registry.usage[("user-1", today)] = 30
+    decision = await controller.admit("s3", assistant(), None)
+    assert 569 < decision.session_seconds <= 570
+
+
+async def test_rejection_cached_without_registry_calls(controller):
+    assert (await controller.admit("s1", assistant(), None)).reason is None
+    assert (await controller.admit("s2", assistant(), None)).reason == "max_sessions_per_assistant"
+
+    # Повторные подключения в течение reject_cache_ttl отклоняются без обращения к реестру
+    await controller.registry.unregister("s1")
+    for n in range(5):
+        assert (await controller.admit(f"s{n + 3}", assistant(), None)).reason == "max_sessions_per_assistant"
+    assert controller.registry.stats["rejected"] == 1
+    assert controller.stats["rejected"] == 6 and controller.stats["rejected_cached"] == 5
+    assert controller.stats["reasons"] == {"max_sessions_per_assistant": 6}
+    # Кэш по паре владелец-ассистент: другой ассистент того же владельца проверяется в реестре
+    assert (await controller.admit("s9", assistant(assistant_id="assistant-2"), None)).reason is None
+
+    # Отказ истек - решение снова принимает реестр
+    key = "user-1:assistant-1"
+    controller.rejections.data[key] = (main.time.monotonic() - 1, controller.rejections.data[key][1])
+    assert (await controller.admit("s10", assistant(), None)).reason is None
+    assert controller.stats["admitted"] == 3
+
+
+async def test_registry_failure_admits_session(controller, monkeypatch):
+    async def broken(*args):
+        raise RuntimeError("registry down")
+
+    monkeypatch.setattr(controller.registry, "register", broken)
+    decision = await controller.admit("s1", assistant(), None)
+    assert decision.reason is None and decision.session_seconds == 300
+    assert controller.stats["errors"] == 1 and controller.stats["latency_count"] == 1
+
+
+def test_audio_bucket_throttles_beyond_burst():
+    controller = main.AdmissionController(main.MemorySessionRegistry(), reject_cache_ttl=5)
+    assert controller.create_audio_bucket(main.PlanLimits()) is None
+    bucket = controller.create_audio_bucket(main.PlanLimits(audio_bytes_per_sec=48000))
+    assert bucket.capacity == 96000
+
+    # Запас - две секунды потока; дальше кадры отклоняются, пока bucket не пополнится
+    assert all(bucket.consume(4800) for _ in range(20))
+    assert not bucket.consume(4800)
+    bucket.updated -= 0.05
+    assert not bucket.consume(4800)  # За 50 мс накопилось 2400 байт
+    bucket.updated -= 0.05
+    assert bucket.consume(4800)
+    # Долгая пауза не дает запаса больше capacity
+    bucket.updated -= 60
+    assert bucket.consume(96000) and not bucket.consume(100)
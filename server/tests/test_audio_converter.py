@@ -0,0 +1,38 @@
+import numpy as np
+
+import main
+
+
+def tone(frequency: float, sample_rate: int, seconds: float = 1.0, amplitude: float = 0.5) -> bytes:
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    return (amplitude * np.sin(2 * np.pi * frequency * t) * 32767).astype('<i2').tobytes()
+
+
+def rms(data: bytes, skip: int = 1000) -> float:
+    samples = np.frombuffer(data, dtype='<i2')[skip:] / 32768
+    return float(np.sqrt(np.mean(samples ** 2)))
+
+
+def test_content_above_nyquist_suppressed_when_downsampling():
+    # Без ФНЧ тон 15 кГц при 48 -> 24 кГц отражается в 9 кГц почти без ослабления (RMS ~0.35)
+    for sample_rate in (48000, 44100, 96000):
+        converter = main.AudioConverter(sample_rate)
+        assert rms(converter.convert(tone(15000, sample_rate))) < 0.005
+    # Речевая полоса проходит без изменений
+    for frequency in (1000, 8000):
+        assert abs(rms(main.AudioConverter(48000).convert(tone(frequency, 48000))) - 0.5 / np.sqrt(2)) < 0.01
+
+
+def test_frame_boundaries_do_not_change_output():
+    rng = np.random.default_rng(1)
+    for sample_rate in (48000, 44100, 16000):
+        data = (rng.standard_normal(sample_rate) * 4000).astype('<i2').tobytes()
+        whole = np.frombuffer(main.AudioConverter(sample_rate).convert(data), dtype='<i2')
+
+        # Кадры произвольной длины, включая короче фильтра: хвост фильтра и позиция переносятся между ними
+        converter = main.AudioConverter(sample_rate)
+        cuts = np.cumsum(rng.integers(1, 1500, size=200)) * 2
+        chunks = [data[start:end] for start, end in zip([0, *cuts], [*cuts, len(data)]) if start < len(data)]
+        chunked = np.frombuffer(b"".join(converter.convert(chunk) for chunk in chunks), dtype='<i2')
+        assert len(chunked) == len(whole) and abs(len(whole) - main.TARGET_SAMPLE_RATE) <= 1
+        assert np.max(np.abs(chunked.astype(np.int32) - whole)) <= 1
@@ -0,0 +1,61 @@
+import time
+import uuid
+from datetime import datetime, timezone
+
+import httpx
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+async def register(client: httpx.AsyncClient) -> dict:
+    response = await client.post("/api/auth/register", json={"email": f"test-{uuid.uuid4().hex[:12]}@example.com", "password": "test"})
+    response.raise_for_status()
+    return response.json()
+
+
+async def test_token_revoked_on_another_worker_is_rejected(db):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+        user = await register(client)
+        headers = {"Authorization": f"Bearer {user['token']}"}
+        assert (await client.get("/api/users/me", headers=headers)).status_code == 200
+        token_data = main.decode_jwt_token(user["token"])
+
+        # Другой воркер записал отзыв в БД, но NOTIFY выключен: локальный кэш о нем не знает
+        db.add(main.RevokedToken(jti=token_data.jti, user_id=uuid.UUID(user["user"]["id"]),
+                                 expires_at=datetime.fromtimestamp(token_data.exp, tz=timezone.utc)))
+        await db.commit()
+        assert main.auth_cache.get(user["token"]) is not main._CACHE_MISS
+
+        await main.load_recent_revoked_tokens()
+        assert (await client.get("/api/users/me", headers=headers)).status_code == 401
+        await db.execute(main.sa.delete(main.User).where(main.User.id == uuid.UUID(user["user"]["id"])))
+        await db.commit()
+
+
+async def test_revoked_token_rejected_on_cache_miss(db):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+        user = await register(client)
+        headers = {"Authorization": f"Bearer {user['token']}"}
+        token_data = main.decode_jwt_token(user["token"])
+        db.add(main.RevokedToken(jti=token_data.jti, user_id=uuid.UUID(user["user"]["id"]),
+                                 expires_at=datetime.fromtimestamp(token_data.exp, tz=timezone.utc)))
+        await db.commit()
+        main.auth_cache.clear()
+        assert (await client.get("/api/users/me", headers=headers)).status_code == 401
+        await db.execute(main.sa.delete(main.User).where(main.User.id == uuid.UUID(user["user"]["id"])))
+        await db.commit()
+
+
+async def test_metrics_closed_without_token(monkeypatch):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+        monkeypatch.setattr(main, "METRICS_TOKEN", "")
+        assert (await client.get("/metrics")).status_code == 404
+        assert (await client.get("/metrics", headers={"Authorization": "Bearer "})).status_code == 404
+
+        monkeypatch.setattr(main, "METRICS_TOKEN", "secret")
+        assert (await client.get("/metrics", headers={"Authorization": "Bearer wrong"})).status_code == 401
+        response = await client.get("/metrics", headers={"Authorization": "Bearer secret"})
+        assert response.status_code == 200 and "# TYPE" in response.text
@@ -0,0 +1,73 @@
+import json
+import os
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+import sqlalchemy as sa
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+def make_record(text: str) -> dict:
+    return {
+        "id": uuid.uuid4(), "assistant_id": None, "user_message": text, "assistant_message": "",
+        "duration_seconds": 1.0, "client_info": {}, "created_at": datetime.now(timezone.utc)
+    }
+
+
+def dead_pid() -> int:
+    pid = 4_000_000
+    while main.is_process_alive(pid):
+        pid += 1
+    return pid
+
+
+@pytest.fixture
+def writer(tmp_path):
+    return main.ConversationWriter(main.Conversation.__table__, maxsize=100, batch_size=10, flush_interval_ms=10,
+                                   spill_path=str(tmp_path / "spill.jsonl"))
+
+
+async def test_replay_takes_own_and_dead_workers_spill_files(db, writer, tmp_path):
+    own = make_record("свой воркер")
+    orphan = make_record("завершившийся воркер")
+    writer._spill([own])
+    with open(writer.worker_spill_path(dead_pid()), "w", encoding="utf-8") as f:
+        f.write(json.dumps(orphan, default=str, ensure_ascii=False) + "\n")
+
+    await writer._replay_spill()
+
+    result = await db.execute(sa.select(main.Conversation.user_message).where(main.Conversation.id.in_([own["id"], orphan["id"]])))
+    assert sorted(result.scalars().all()) == sorted([own["user_message"], orphan["user_message"]])
+    assert os.listdir(tmp_path) == []
+    await db.execute(sa.delete(main.Conversation).where(main.Conversation.id.in_([own["id"], orphan["id"]])))
+    await db.commit()
+
+
+async def test_live_worker_spill_file_left_alone(db, writer, tmp_path):
+    other = writer.worker_spill_path(os.getppid())
+    with open(other, "w", encoding="utf-8") as f:
+        f.write(json.dumps(make_record("живой воркер"), default=str, ensure_ascii=False) + "\n")
+    await writer._replay_spill()
+    assert os.listdir(tmp_path) == [os.path.basename(other)]
+
+
+async def test_failed_cleanup_does_not_stop_writer(db, writer, monkeypatch):
+    record = make_record("повтор")
+    writer._spill([record])
+
+    def failing_remove(path):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(main.os, "remove", failing_remove)
+    await writer._replay_spill()  # Ошибка удаления логируется, а не прерывает задачу записи
+    monkeypatch.undo()
+    # Повторная дозапись того же файла не создает дубликатов
+    await writer._replay_spill()
+    result = await db.execute(sa.select(sa.func.count()).where(main.Conversation.id == record["id"]))
+    assert result.scalar() == 1
+    await db.execute(sa.delete(main.Conversation).where(main.Conversation.id == record["id"]))
+    await db.commit()
@@ -0,0 +1,53 @@
+import json
+
+import main
+
+
+def test_sniff_top_level_type():
+    assert main.sniff_event_type('{"type":"input_audio_buffer.append","audio":"AAAA"}') == "input_audio_buffer.append"
+    assert main.sniff_event_type('{ "event_id": "e1", "type" : "ping" }') == "ping"
+    assert main.sniff_event_type('{"audio":"AAAA"}') is None
+
+
+def test_sniff_nested_object_before_type():
+    # type вложенного объекта не должен определить тип события: нужен полный разбор
+    message = json.dumps({"item": {"type": "function_call_output", "output": "{}"}, "type": "conversation.item.create"})
+    assert main.sniff_event_type(message) is None
+    assert main.sniff_event_type('{"session":{"type":"realtime"},"type":"session.update"}') is None
+
+
+def test_sniff_type_as_value():
+    assert main.sniff_event_type('{"name":"type","type":"ping"}') is None
+    assert main.sniff_event_type('{"tags":["type"],"type":"ping"}') is None
+    assert main.sniff_event_type('{"field":"type"}') is None
+
+
+def test_sniff_type_beyond_window():
+    # Тип за пределами первых 160 символов не ищется: вызывающий код разберет сообщение целиком
+    message = '{"event_id":"' + "e" * 200 + '","type":"ping"}'
+    assert main.sniff_event_type(message) is None
+    # Ключ в окне, но значение обрезано его границей
+    message = '{"event_id":"' + "e" * 130 + '","type":"response.function_call_arguments.done"}'
+    assert message.find('"type"') < 160 < message.find('"type"') + 30
+    assert main.sniff_event_type(message) is None
+    assert json.loads(message)["type"] == "response.function_call_arguments.done"
+
+
+def test_sniff_escaped_quotes():
+    assert main.sniff_event_type('{"type":"pi\\"ng"}') is None
+    # Внутри строки кавычки экранированы, поэтому "type" в тексте не принимается за ключ
+    message = '{"text":"say \\"type\\": \\"ping\\"","type":"conversation.item.create"}'
+    assert main.sniff_event_type(message) == json.loads(message)["type"]
+    assert main.sniff_event_type('{"note":"a \\"quoted\\" word","type":"ping"}') == "ping"
+
+
+def test_extract_string_field():
+    assert main.extract_string_field('{"type":"input_audio_buffer.append","audio":"QUJD"}', "audio") == "QUJD"
+    assert main.extract_audio_delta('{"type":"response.audio.delta","item_id":"i1","delta" : "QUJD"}') == "QUJD"
+    # Имя поля встречается раньше как значение другого поля
+    assert main.extract_string_field('{"event_id":"audio","type":"input_audio_buffer.append","audio":"QUJD"}', "audio") == "QUJD"
+    assert main.extract_string_field('{"event_id":"audio","type":"input_audio_buffer.commit"}', "audio") is None
+    # Не строка или значение с экранированием - None, а не обрезанная строка
+    assert main.extract_string_field('{"audio":null}', "audio") is None
+    assert main.extract_string_field('{"delta":"say \\"hi\\""}', "delta") is None
+    assert main.extract_string_field('{"delta":"QUJD', "delta") is None
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import subprocess
+import sys
+import uuid
+
+import numpy as np
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+DOCUMENTS = [
+    "Доставка по Москве занимает один день, по России - от трех до семи дней.",
+    "Вернуть товар можно в течение 14 дней с сохранением чека и упаковки.",
+    "Оплата картой, наличными курьеру или по счету для юридических лиц.",
+    "Гарантия на технику - один год, на аккумуляторы - шесть месяцев.",
+    "Офис работает с девяти до восемнадцати, в субботу до пятнадцати.",
+]
+
+
+def build_index(directory, texts, dim: int = 256) -> tuple:
+    ids = [uuid.uuid4() for _ in texts]
+    vectors = main.hash_embeddings(texts, dim)
+    main.write_knowledge_index(str(directory), np.frombuffer(b"".join(i.bytes for i in ids), dtype=np.uint8).reshape(-1, 16), vectors)
+    return main.KnowledgeIndex(str(directory), "hash", 1), ids, vectors
+
+
+def test_hash_embeddings_stable_across_processes():
+    # Векторы хранятся в БД и на диске: другой процесс (и другой PYTHONHASHSEED) должен получить те же
+    digest = hashlib.sha1(main.hash_embeddings(DOCUMENTS, 256).tobytes()).hexdigest()
+    assert hashlib.sha1(main.hash_embeddings(list(DOCUMENTS), 256).tobytes()).hexdigest() == digest
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    code = ("import hashlib, sys, main, test_knowledge; "
+            "print(hashlib.sha1(main.hash_embeddings(test_knowledge.DOCUMENTS, 256).tobytes()).hexdigest())")
+    env = {**os.environ, "PYTHONHASHSEED": "12345", "PYTHONPATH": os.pathsep.join([server, os.path.dirname(os.path.abspath(__file__))])}
+    output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True).stdout
+    assert output.strip().splitlines()[-1] == digest
+    norms = np.linalg.norm(main.hash_embeddings(DOCUMENTS + [""], 256), axis=1)
+    assert np.allclose(norms[:-1], 1.0) and norms[-1] == 0.0
+
+
+def test_search_ranks_matching_chunk_first(tmp_path):
+    index, ids, _ = build_index(tmp_path / "1", DOCUMENTS)
+    query = main.hash_embeddings(["сколько дней длится доставка по России"], 256)[0]
+    found = index.search(query, 3)
+    assert [chunk_id for chunk_id, _ in found][0] == ids[0]
+    scores = [score for _, score in found]
+    assert scores == sorted(scores, reverse=True) and len(found) == 3
+    assert index.search(main.hash_embeddings(["гарантия на аккумуляторы"], 256)[0], 1)[0][0] == ids[3]
+
+
+def test_clustered_search_matches_exact_ranking(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "KNOWLEDGE_IVF_MIN_CHUNKS", 64)
+    texts = [f"Товар {n}: артикул SKU-{n}, цвет {['красный', 'синий', 'зеленый'][n % 3]}, склад {n % 7}" for n in range(400)]
+    index, ids, vectors = build_index(tmp_path / "1", texts)
+    assert index.centroids is not None
+    query = main.hash_embeddings(["артикул SKU-123"], 256)[0]
+    exact = np.argsort(-(vectors @ query))[:5]
+    found = index.search(query, 5, probes=len(index.centroids))
+    assert [chunk_id for chunk_id, _ in found] == [ids[i] for i in exact]
+    # Кластер фрагмента всегда среди просматриваемых: фрагмент находит сам себя
+    assert index.search(vectors[123], 1)[0][0] == ids[123]
+
+
+async def test_open_index_reloaded_after_change_on_another_worker(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "KNOWLEDGE_INDEX_DIR", str(tmp_path))
+    user = main.User(email=f"test-{uuid.uuid4().hex[:12]}@example.com", password_hash="-")
+    assistant = main.AssistantConfig(user=user, name="Тест", system_prompt="-")
+    db.add_all([user, assistant])
+    await db.flush()
+
+    def chunk(position: int) -> main.KnowledgeChunk:
+        text = DOCUMENTS[position]
+        return main.KnowledgeChunk(assistant_id=assistant.id, source="faq.txt", position=position, text=text,
+                                   embedding=main.hash_embeddings([text], 64)[0].tobytes())
+
+    db.add_all([chunk(0), chunk(1)])
+    await db.flush()
+    await main.bump_knowledge_revision(db, assistant.id, "hash", 64)
+    await db.commit()
+    assistant_id = str(assistant.id)
+    index = await main.get_knowledge_index(assistant_id)
+    assert index.revision == 1 and len(index) == 2
+
+    # Другой воркер добавил фрагмент; уведомление сюда не дошло, открытый индекс остался в кэше
+    db.add(chunk(3))
+    await db.flush()
+    await main.bump_knowledge_revision(db, assistant.id, "hash", 64)
+    await db.commit()
+    assert await main.get_knowledge_index(assistant_id) is index
+    index.checked_at -= main.KNOWLEDGE_INDEX_CHECK_INTERVAL
+    fresh = await main.get_knowledge_index(assistant_id)
+    assert fresh.revision == 2 and len(fresh) == 3
+    found = await main.search_knowledge(assistant_id, "гарантия на аккумуляторы", k=1)
+    assert found[0]["text"] == DOCUMENTS[3]
+
+    # Версия не изменилась - проверка оставляет тот же индекс
+    fresh.checked_at -= main.KNOWLEDGE_INDEX_CHECK_INTERVAL
+    assert await main.get_knowledge_index(assistant_id) is fresh
+    main.knowledge_indexes.pop(assistant_id)
+    await db.execute(main.sa.delete(main.User).where(main.User.id == user.id))
+    await db.commit()
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import sys
+
+import pytest
+import websockets
+
+import main
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+import fake_realtime
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def realtime(monkeypatch):
+    """Заглушка OpenAI Realtime из бенчмарков на свободном порту; REALTIME_WS_URL указывает на нее"""
+    fake_realtime.stats.update(connections=0, active=0)
+    server = await websockets.serve(fake_realtime.make_handler(fake_realtime.parse_args([])), "127.0.0.1", 0, ping_interval=None)
+    monkeypatch.setattr(main, "REALTIME_WS_URL", f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}")
+    yield fake_realtime.stats
+    server.close()
+    await server.wait_closed()
+
+
+async def refilled(pool: main.RealtimeConnectionPool, api_key: str):
+    await pool.refills[api_key]
+    return [openai_ws for _, openai_ws in pool.idle[api_key]]
+
+
+async def test_warm_connection_checked_out(realtime):
+    pool = main.RealtimeConnectionPool(size=1, max_idle=60, max_keys=10, key_ttl=60)
+    first, hit = await pool.acquire("sk-test")
+    assert not hit
+    warm = await refilled(pool, "sk-test")
+    assert len(warm) == 1 and realtime["connections"] == 2
+
+    openai_ws, hit = await pool.acquire("sk-test")
+    assert hit and openai_ws is warm[0] and openai_ws.open
+    # Соединение из пула рабочее: заглушка отвечает на настройки сессии
+    await openai_ws.send('{"type":"session.update","session":{}}')
+    events = [await openai_ws.recv() for _ in range(2)]
+    assert '"session.updated"' in events[1]
+    assert pool.get_stats()["hits"] == 1 and pool.get_stats()["misses"] == 1
+    await first.close()
+    await openai_ws.close()
+    await pool.stop()
+
+
+async def test_stale_connections_evicted(realtime):
+    pool = main.RealtimeConnectionPool(size=2, max_idle=60, max_keys=10, key_ttl=60)
+    first, _ = await pool.acquire("sk-test")
+    closed, aged = await refilled(pool, "sk-test")
+    # Одно соединение закрыто (OpenAI оборвал простаивающий сокет), другое простаивает дольше max_idle
+    await closed.close()
+    pool.idle["sk-test"][1] = (pool.idle["sk-test"][1][0] - 120, aged)
+
+    openai_ws, hit = await pool.acquire("sk-test")
+    assert not hit and openai_ws is not closed and openai_ws is not aged and openai_ws.open
+    assert pool.stats["discarded"] == 2
+    await first.close()
+    await openai_ws.close()
+    # Вытесненные соединения закрываются в фоне; stop() дожидается их закрытия
+    await pool.stop()
+    assert not aged.open and not pool.closing
+
+
+async def test_pool_refilled_after_use(realtime):
+    pool = main.RealtimeConnectionPool(size=2, max_idle=60, max_keys=10, key_ttl=60)
+    used = [(await pool.acquire("sk-test"))[0]]
+    assert len(await refilled(pool, "sk-test")) == 2
+
+    for _ in range(2):
+        openai_ws, hit = await pool.acquire("sk-test")
+        assert hit
+        used.append(openai_ws)
+        assert len(await refilled(pool, "sk-test")) == 2
+    assert pool.stats["opened"] == 4 and realtime["connections"] == 5
+    assert len({id(openai_ws) for openai_ws in used + [ws for _, ws in pool.idle["sk-test"]]}) == 5
+    await asyncio.gather(*(openai_ws.close() for openai_ws in used))
+    await pool.stop()
@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+class Recorder:
+    """on_sent очереди: запоминает вызовы"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, queued, sending):
+        self.calls.append((queued, sending))
+
+
+async def send_all(queue: main.RelaySendQueue) -> list:
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    task = asyncio.create_task(main.relay_sender(queue, send, "test-client"))
+    while queue.items:
+        await asyncio.sleep(0.01)
+    task.cancel()
+    return sent
+
+
+async def test_trace_moves_to_next_frame_when_traced_frame_dropped():
+    queue = main.RelaySendQueue("downstream", max_bytes=250, policy={"drop_audio"})
+    on_sent = Recorder()
+    queue.put("a" * 100, "audio", on_sent=on_sent)
+    queue.put("b" * 100, "audio")
+    queue.put("c" * 100, "audio")  # Вытесняет отмеченный кадр
+    assert queue.stats["dropped_audio"] == 1 and queue.traced[0] == "b" * 100
+
+    sent = await send_all(queue)
+    assert sent == ["b" * 100, "c" * 100]
+    assert len(on_sent.calls) == 1 and on_sent.calls[0][0] is not None
+
+
+async def test_trace_waits_for_next_frame_when_traced_frame_rejected():
+    queue = main.RelaySendQueue("downstream", max_bytes=150, policy={"drop_audio"})
+    on_sent = Recorder()
+    queue.put("x" * 100, "control")
+    queue.put("a" * 100, "audio", on_sent=on_sent)  # Места нет даже после вытеснения - кадр отброшен сам
+    assert queue.traced[0] is None
+    await send_all(queue)
+    assert on_sent.calls == []
+
+    queue.put("b" * 100, "audio")
+    assert await send_all(queue) == ["b" * 100]
+    assert len(on_sent.calls) == 1 and on_sent.calls[0][0] is not None
+
+
+async def test_undelivered_trace_written_on_close(monkeypatch):
+    submitted = []
+    monkeypatch.setattr(main.turn_trace_writer, "submit", submitted.append)
+    queue = main.RelaySendQueue("downstream", max_bytes=150, policy={"drop_audio"})
+    now = time.perf_counter()
+    trace = {"speech_started": now - 2, "speech_stopped": now - 1, "first_audio": now}
+    queue.put("x" * 100, "control")
+    queue.put("a" * 100, "audio", on_sent=lambda queued, sending: main.on_turn_audio_sent(trace, queued, sending))
+    main.finish_turn_trace(trace, "assistant", None)
+    assert submitted == []  # Ждет отправки первого аудио
+
+    queue.clear()
+    assert len(submitted) == 1
+    assert submitted[0]["first_audio_ms"] is not None and submitted[0]["total_ms"] is None
+
+
+async def test_resume_drops_tool_events_of_previous_session(monkeypatch):
+    queue = main.RelaySendQueue("upstream", max_bytes=10000, policy={"drop_audio"})
+    tracker = main.ToolCallTracker("test-client")
+    monkeypatch.setitem(main.client_connections, "test-client", {"tool_calls": tracker, "queues": {"upstream": queue}})
+    call = main.ToolCall(client_id="test-client", assistant_id="test-assistant", call_id="call_old", name="now",
+                         spec={"name": "now", "handler": {"type": "builtin", "name": "current_time"}}, api_key=None)
+    tracker.start(call, "resp_old", "{}")
+    tracker.response_done("resp_old", "completed")
+    await asyncio.gather(*main.tool_call_tasks)
+    queue.put('{"type":"input_audio_buffer.append","audio":"AAAA"}', "audio")
+    queue.put('{"type":"input_audio_buffer.commit"}', "control")
+    assert [kind for _, kind, _ in queue.items] == ["tool", "tool", "audio", "control"]
+
+    # Переподключение: вызова call_old в новой сессии OpenAI нет
+    assert queue.drop_kind("tool") == 2
+    assert [kind for _, kind, _ in queue.items] == ["audio", "control"]
+    assert queue.size == sum(size for _, _, size in queue.items)
@@ -0,0 +1,130 @@
+import asyncio
+import json
+from urllib.parse import unquote
+
+import httpx
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeSheetsApi:
+    """Локальная заглушка values:append; statuses - коды следующих ответов (по умолчанию 200)"""
+
+    def __init__(self):
+        self.statuses = []
+        self.requests = []  # (sheet_id, range, authorization, строки)
+        self.server = None
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = (await reader.readuntil(b"\r\n\r\n")).decode()
+                lines = head.split("\r\n")
+                headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(":") for line in lines[1:] if line)}
+                body = json.loads(await reader.readexactly(int(headers["content-length"])))
+                parts = lines[0].split()[1].split("?")[0].split("/")
+                status = self.statuses.pop(0) if self.statuses else 200
+                self.requests.append((unquote(parts[3]), unquote(parts[5]).removesuffix(":append"), headers.get("authorization"), body["values"], status))
+                payload = b"{}"
+                writer.write(f"HTTP/1.1 {status} X\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload)
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    def appended(self, sheet_id: str) -> list:
+        return [row for sheet, _, _, rows, status in self.requests if sheet == sheet_id and status == 200 for row in rows]
+
+
+@pytest.fixture
+async def api(monkeypatch):
+    fake = FakeSheetsApi()
+    fake.server = await asyncio.start_server(fake.handle, "127.0.0.1", 0)
+    monkeypatch.setattr(main, "http_client", httpx.AsyncClient())
+    yield fake
+    fake.server.close()
+    await main.http_client.aclose()
+
+
+def make_writer(api: FakeSheetsApi) -> main.GoogleSheetsWriter:
+    writer = main.GoogleSheetsWriter(
+        f"http://127.0.0.1:{api.server.sockets[0].getsockname()[1]}",
+        flush_interval_ms=20, batch_rows=100, max_pending_rows=1000, max_retries=3, backoff_max=0.05
+    )
+    writer.tokens["user-1"] = {"access_token": "token-1"}
+    return writer
+
+
+async def drain(writer: main.GoogleSheetsWriter, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while writer.get_stats()["pending_rows"] or writer.sending:
+        assert asyncio.get_running_loop().time() < deadline, writer.get_stats()
+        await asyncio.sleep(0.01)
+
+
+async def test_rows_coalesced_per_sheet_in_order(api):
+    writer = make_writer(api)
+    for number in range(5):
+        for sheet_id in ("sheet-a", "sheet/b"):
+            assert writer.append("user-1", sheet_id, "A1", [sheet_id, number])
+    writer.start()
+    await drain(writer)
+    await writer.stop()
+
+    assert len(api.requests) == 2
+    assert {request[2] for request in api.requests} == {"Bearer token-1"}
+    assert api.appended("sheet-a") == [["sheet-a", number] for number in range(5)]
+    assert api.appended("sheet/b") == [["sheet/b", number] for number in range(5)]
+    assert writer.stats["appended"] == 10
+
+
+async def test_throttled_batch_retried_without_losing_rows(api):
+    api.statuses = [429, 503]
+    writer = make_writer(api)
+    writer.start()
+    for number in range(3):
+        writer.append("user-1", "sheet-a", "A1", [number])
+    await drain(writer)
+    await writer.stop()
+
+    assert [request[4] for request in api.requests] == [429, 503, 200]
+    assert api.appended("sheet-a") == [[0], [1], [2]]
+    assert writer.stats["throttled"] == 1 and writer.stats["retries"] == 2
+
+
+async def test_unexpected_error_keeps_batch(api, monkeypatch):
+    writer = make_writer(api)
+    failures = []
+    original = writer._access_token
+
+    async def broken_access_token(user_id):
+        if not failures:
+            failures.append(user_id)
+            raise RuntimeError("БД недоступна")
+        return await original(user_id)
+
+    monkeypatch.setattr(writer, "_access_token", broken_access_token)
+    writer.start()
+    writer.append("user-1", "sheet-a", "A1", [1])
+    writer.append("user-1", "sheet-a", "A1", [2])
+    await drain(writer)
+    await writer.stop()
+
+    assert failures == ["user-1"]
+    assert api.appended("sheet-a") == [[1], [2]]
+    assert writer.stats["appended"] == 2 and writer.stats["dropped"] == 0
+
+
+async def test_unauthorized_without_refresh_rejected_once(api):
+    api.statuses = [401]
+    writer = make_writer(api)
+    writer.start()
+    writer.append("user-1", "sheet-a", "A1", [1])
+    await drain(writer)
+    await writer.stop()
+
+    assert len(api.requests) == 1
+    assert writer.stats["rejected"] == 1 and writer.stats["retries"] == 0
+    assert "user-1" not in writer.tokens
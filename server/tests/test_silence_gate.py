@@ -0,0 +1,82 @@
+import itertools
+
+import numpy as np
+
+import main
+
+FRAME_MS = 20
+frame_numbers = itertools.count()
+
+
+def frame(level: float = 0.0, ms: int = FRAME_MS) -> tuple:
+    """Синтетический кадр PCM16 24 кГц: тон 440 Гц с амплитудой level (0 - тишина) и его сообщение append"""
+    t = np.arange(ms * main.TARGET_SAMPLE_RATE // 1000) / main.TARGET_SAMPLE_RATE
+    pcm = (level * np.sin(2 * np.pi * 440 * t) * 32767).astype('<i2').tobytes()
+    return pcm, f'{{"type":"input_audio_buffer.append","n":{next(frame_numbers)}}}'
+
+
+def gate() -> main.SilenceGate:
+    return main.SilenceGate(threshold_dbfs=-50, pre_roll_ms=100, hangover_ms=200)
+
+
+def test_pre_roll_replayed_before_speech():
+    silence_gate = gate()
+    silent = [frame() for _ in range(8)]
+    assert all(silence_gate.process(pcm, message) == [] for pcm, message in silent)
+
+    # Перед речью уходят последние 100 мс тишины в исходном порядке, более старые кадры отброшены
+    pcm, message = frame(0.3)
+    assert silence_gate.process(pcm, message) == [message for _, message in silent[-5:]] + [message]
+    stats = silence_gate.get_stats()
+    assert stats["frames_in"] == 9 and stats["frames_dropped"] == 3
+    assert stats["bytes_saved"] == sum(len(message) for _, message in silent[:3])
+
+
+def test_hangover_passes_silence_after_speech():
+    silence_gate = gate()
+    silence_gate.process(*frame(0.3))
+    # 200 мс тишины после речи пересылаются без изменений, дальше кадры снова придерживаются
+    passed = [silence_gate.process(*frame()) for _ in range(12)]
+    assert [len(outgoing) for outgoing in passed] == [1] * 10 + [0] * 2
+    assert silence_gate.hangover_left <= 0 and len(silence_gate.pre_roll) == 2
+
+    # Новая речь перезапускает hangover целиком; кадр нестандартной длины учитывается по байтам
+    silence_gate.process(*frame(0.3))
+    assert silence_gate.hangover_left == 200 * main.PCM16_BYTES_PER_MS
+    assert silence_gate.process(*frame(ms=150)) != [] and silence_gate.process(*frame(ms=60)) != []
+    assert silence_gate.process(*frame()) == []
+
+
+def test_commit_suppressed_after_only_silence():
+    silence_gate = gate()
+    for _ in range(8):
+        silence_gate.process(*frame())
+    assert not silence_gate.allow_commit()
+
+    # Короткая тишина целиком в pre-roll: в OpenAI ничего не ушло, commit тоже не нужен
+    silence_gate.reset()
+    silence_gate.process(*frame())
+    assert not silence_gate.allow_commit()
+
+    silence_gate.reset()
+    silence_gate.process(*frame(0.3))
+    for _ in range(20):
+        silence_gate.process(*frame())
+    assert silence_gate.allow_commit()
+    # Без аудио с прошлого commit решение остается за OpenAI
+    assert gate().allow_commit()
+
+
+def test_reset_on_clear_discards_held_frames():
+    silence_gate = gate()
+    silence_gate.process(*frame(0.3))
+    for _ in range(12):
+        silence_gate.process(*frame())
+    assert silence_gate.pre_roll
+
+    silence_gate.reset()
+    assert not silence_gate.pre_roll and silence_gate.pre_roll_pcm == 0 and silence_gate.hangover_left == 0
+    assert silence_gate.get_stats()["frames_dropped"] == 2
+    # После clear речь отправляется без тишины из очищенного буфера
+    pcm, message = frame(0.3)
+    assert silence_gate.process(pcm, message) == [message]
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+class UpstreamQueue:
+    """Очередь отправки в OpenAI: запоминает события вместо отправки"""
+
+    def __init__(self):
+        self.events = []
+
+    def put(self, message, kind: str = "control", on_sent=None):
+        self.events.append(json.loads(message))
+
+
+@pytest.fixture
+async def webhook():
+    """Локальная заглушка webhook: отвечает {"echo": аргументы} и запоминает запросы"""
+    requests = []
+
+    async def handle(reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = next(int(line.split(b":")[1]) for line in head.split(b"\r\n") if line.lower().startswith(b"content-length:"))
+        body = json.loads(await reader.readexactly(length))
+        requests.append(body)
+        payload = json.dumps({"echo": body["arguments"]}).encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\nContent-Length: "
+                     + str(len(payload)).encode() + b"\r\n\r\n" + payload)
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    yield f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/hook", requests
+    server.close()
+
+
+def make_call(call_id: str, url: str, assistant_id: str = "test-assistant", cache: dict = None) -> main.ToolCall:
+    spec = {"name": "get_order", "handler": {"type": "webhook", "url": url}}
+    if cache:
+        spec["cache"] = cache
+    return main.ToolCall(
+        client_id="test-client", assistant_id=assistant_id, call_id=call_id, name="get_order", spec=spec, api_key=None
+    )
+
+
+async def test_webhook_result_sent_before_single_response_create(webhook, monkeypatch):
+    url, requests = webhook
+    monkeypatch.setattr(main, "TOOL_WEBHOOK_ALLOW_PRIVATE", True)
+    monkeypatch.setattr(main, "http_client", main.httpx.AsyncClient())
+    upstream = UpstreamQueue()
+    tracker = main.ToolCallTracker("test-client")
+    monkeypatch.setitem(main.client_connections, "test-client", {"tool_calls": tracker, "queues": {"upstream": upstream}})
+
+    tracker.start(make_call("call_1", url), "resp_1", json.dumps({"order_id": "42"}))
+    tracker.response_done("resp_1", "completed")
+    await asyncio.gather(*main.tool_call_tasks)
+
+    assert [event["type"] for event in upstream.events] == ["conversation.item.create", "response.create"]
+    item = upstream.events[0]["item"]
+    assert item["type"] == "function_call_output" and item["call_id"] == "call_1"
+    assert json.loads(item["output"]) == {"echo": {"order_id": "42"}}
+    assert requests[0]["name"] == "get_order" and requests[0]["call_id"] == "call_1"
+    await main.http_client.aclose()
+
+
+@pytest.mark.parametrize("url", [
+    "http://example.com/hook",
+    "https://127.0.0.1/hook",
+    "https://169.254.169.254/latest/meta-data",
+    "https://10.0.0.5/hook",
+    "https://[::1]/hook",
+    "https://[::ffff:192.168.1.1]/hook",
+    "https://localhost/hook",
+])
+def test_internal_webhook_urls_rejected_on_save(url):
+    with pytest.raises(ValueError):
+        main.validate_function_handlers([{"name": "f", "handler": {"type": "webhook", "url": url}}])
+
+
+async def test_webhook_resolving_to_loopback_rejected_at_call_time(monkeypatch):
+    # Имя прошло проверку при сохранении, но DNS теперь отдает внутренний адрес
+    async def getaddrinfo(host, port, **kwargs):
+        return [(main.socket.AF_INET, main.socket.SOCK_STREAM, 6, "", ("93.184.216.34", port)),
+                (main.socket.AF_INET, main.socket.SOCK_STREAM, 6, "", ("127.0.0.1", port))]
+
+    monkeypatch.setattr(asyncio.get_running_loop(), "getaddrinfo", getaddrinfo)
+    main.validate_function_handlers([{"name": "f", "handler": {"type": "webhook", "url": "https://hooks.example.com/hook"}}])
+    output = await main.execute_tool_call(make_call("call_2", "https://hooks.example.com/hook"), "{}")
+    assert "внутреннюю сеть" in json.loads(output)["error"]
+
+
+async def test_cached_results_keyed_by_handler(webhook, monkeypatch):
+    url, requests = webhook
+    monkeypatch.setattr(main, "TOOL_WEBHOOK_ALLOW_PRIVATE", True)
+    monkeypatch.setattr(main, "http_client", main.httpx.AsyncClient())
+
+    async def generation(assistant_id):
+        return 0
+
+    monkeypatch.setattr(main, "load_tool_cache_generation", generation)
+    assistant_id = f"test-{uuid.uuid4()}"
+    arguments = json.dumps({"order_id": "42"})
+    for index, call_url in enumerate([url, url, url + "?v=2", url + "?v=2"]):
+        await main.execute_tool_call(make_call(f"call_{index}", call_url, assistant_id, {"ttl": 60}), arguments)
+    # Смена обработчика (другой адрес) не отдает результат прежнего
+    assert len(requests) == 2
+    await main.http_client.aclose()
+
+
+async def test_cached_results_dropped_after_reset_on_another_worker(db, webhook, monkeypatch):
+    url, requests = webhook
+    monkeypatch.setattr(main, "TOOL_WEBHOOK_ALLOW_PRIVATE", True)
+    monkeypatch.setattr(main, "http_client", main.httpx.AsyncClient())
+    user = main.User(email=f"test-{uuid.uuid4().hex[:12]}@example.com", password_hash="-")
+    assistant = main.AssistantConfig(user=user, name="Тест", system_prompt="-")
+    db.add_all([user, assistant])
+    await db.commit()
+    assistant_id = str(assistant.id)
+    arguments = json.dumps({"order_id": "42"})
+
+    async def call(index: int) -> dict:
+        return json.loads(await main.execute_tool_call(make_call(f"call_{index}", url, assistant_id, {"ttl": 60}), arguments))
+
+    await call(0)
+    await call(1)
+    assert len(requests) == 1
+
+    # Другой воркер сбросил кэш через API: уведомление сюда не дошло, но поколение в БД выросло
+    await db.execute(main.sa.update(main.AssistantConfig).where(main.AssistantConfig.id == assistant.id)
+                     .values(tool_cache_generation=main.AssistantConfig.tool_cache_generation + 1))
+    await db.commit()
+    main.get_tool_result_cache(assistant_id).checked_at = 0.0  # Срок сверки с БД истек
+    assert (await call(2)) == {"echo": {"order_id": "42"}}
+    assert len(requests) == 2
+    await call(3)
+    assert len(requests) == 2
+
+    await db.execute(main.sa.delete(main.User).where(main.User.id == user.id))
+    await db.commit()
+    await main.http_client.aclose()